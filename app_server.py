@@ -6,6 +6,7 @@ import json
 import os
 import sys
 import subprocess
+import types
 from lxml import etree
 from functools import wraps
 from flask import url_for, make_response
@@ -34,6 +35,10 @@ from model import (
     Patron,
 )
 from cdn import cdnify
+from external_search import (
+    ExternalSearchIndex,
+    SuggestionTrie,
+)
 from classifier import Classifier
 from config import Configuration
 from lane import (
@@ -74,8 +79,16 @@ def entry_response(entry, cache_for=AcquisitionFeed.FEED_CACHE_TIME):
     return _make_response(entry, content_type, cache_for)
 
 def _make_response(content, content_type, cache_for):
+    stream = False
     if isinstance(content, etree._Element):
         content = etree.tostring(content)
+    elif isinstance(content, types.GeneratorType):
+        # The document is being serialized a piece at a time (see
+        # AcquisitionFeed.stream). Send each piece as soon as it's
+        # ready, keeping the request context around until the last
+        # one has been generated.
+        content = flask.stream_with_context(content)
+        stream = True
     elif not isinstance(content, basestring):
         content = unicode(content)
 
@@ -89,8 +102,10 @@ def _make_response(content, content_type, cache_for):
     else:
         cache_control = "private, no-cache"
 
-    return make_response(content, 200, {"Content-Type": content_type,
-                                        "Cache-Control": cache_control})
+    headers = {"Content-Type": content_type, "Cache-Control": cache_control}
+    if stream:
+        return flask.Response(content, 200, headers)
+    return make_response(content, 200, headers)
 
 def load_facets_from_request(
         facet_config=None, worklist=None, base_class=Facets,
@@ -118,15 +133,26 @@ def load_facets_from_request(
         library, facet_config, get_arg, worklist, **kwargs
     )
 
-def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE):
-    """Figure out which Pagination object this request is asking for."""
+def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE,
+                                 facets=None):
+    """Figure out which Pagination object this request is asking for.
+
+    :param facets: The Facets object for this request, used to check
+        the pagination key against the sort order.
+    """
     arg = flask.request.args.get
     size = arg('size', default_size)
     offset = arg('after', 0)
-    return load_pagination(size, offset)
+    key = arg('key', None)
+    return load_pagination(size, offset, key, facets)
+
+def load_pagination(size, offset, key=None, facets=None):
+    """Turn user input into a Pagination object.
 
-def load_pagination(size, offset):
-    """Turn user input into a Pagination object."""
+    :param facets: If this is a Facets object, the values in the
+        pagination key must fit the types of the fields in its sort
+        order.
+    """
     try:
         size = int(size)
     except ValueError:
@@ -137,7 +163,19 @@ def load_pagination(size, offset):
             offset = int(offset)
         except ValueError:
             return INVALID_INPUT.detailed(_("Invalid offset: %(offset)s", offset=offset))
-    return Pagination(offset, size)
+    if key:
+        try:
+            parsed = Pagination.key_from_string(key)
+            if isinstance(facets, Facets):
+                # A key for some other sort order is ignored later on,
+                # but a key with the wrong kinds of values is an error.
+                parsed = facets.parse_sort_key(parsed) or parsed
+        except ValueError:
+            return INVALID_INPUT.detailed(_("Invalid pagination key: %(key)s", key=key))
+        key = parsed
+    else:
+        key = None
+    return Pagination(offset, size, key)
 
 def returns_problem_detail(f):
     @wraps(f)
@@ -255,11 +293,13 @@ class URNLookupController(object):
             # In a subclass, self.process_urns may return a ProblemDetail
             return response
 
+        # A lookup feed can be very large and is never cached, so
+        # stream it to the client as the entries are created.
         opds_feed = LookupAcquisitionFeed(
-            self._db, "Lookup results", this_url, self.works, annotator,
+            self._db, "Lookup results", this_url, [], annotator,
             precomposed_entries=self.precomposed_entries,
         )
-        return feed_response(opds_feed)
+        return feed_response(opds_feed.stream(self.works))
 
     def permalink(self, urn, annotator, route_name='work'):
         """Look up a single identifier and generate an OPDS feed."""
@@ -369,3 +409,75 @@ class ComplaintController(object):
             )
 
         return make_response(unicode(_("Success")), 201, {"Content-Type": "text/plain"})
+
+
+class SuggestionController(object):
+    """Suggest titles, series and authors for a search the patron is
+    still typing.
+
+    Suggestions come from the search index if one is configured, and
+    otherwise from a SuggestionTrie built from the database.
+    """
+
+    # An OpenSearch suggestions document.
+    CONTENT_TYPE = 'application/x-suggestions+json'
+
+    DEFAULT_SIZE = 10
+    MAX_SIZE = SuggestionTrie.SUGGESTIONS_PER_NODE
+
+    # The same prefix tends to be typed by many patrons, so let
+    # clients and the CDN hold on to the suggestions for a while.
+    CACHE_TIME = 600
+
+    def __init__(self, _db, search_engine=None):
+        self._db = _db
+        self.search_engine = search_engine
+
+    def suggest(self, library=None):
+        """Respond with suggestions for the 'q' argument of the
+        active request.
+
+        :return: A Response, or a ProblemDetail if the request was
+            invalid.
+        """
+        arg = flask.request.args.get
+        prefix = arg('q', '')
+        size = arg('size', self.DEFAULT_SIZE)
+        try:
+            size = int(size)
+        except ValueError:
+            size = None
+        if size is None or size <= 0:
+            return INVALID_INPUT.detailed(
+                _("Invalid page size: %(size)s", size=arg('size'))
+            )
+        size = min(size, self.MAX_SIZE)
+        if library is None:
+            library = getattr(flask.request, 'library', None)
+
+        suggestions = self.suggestions(prefix, library, size)
+        data = json.dumps([prefix, suggestions])
+        return _make_response(data, self.CONTENT_TYPE, self.CACHE_TIME)
+
+    def suggestions(self, prefix, library, size):
+        """Find up to `size` suggestions for `prefix`, best first."""
+        if (self.search_engine is None
+            and not ExternalSearchIndex.search_integration(self._db)):
+            trie = SuggestionTrie.for_library(self._db, library)
+            return trie.suggest(prefix, size)
+
+        search = self.search_engine or ExternalSearchIndex.for_lane_feeds(
+            self._db
+        )
+        if not search:
+            return []
+        try:
+            return search.suggest(prefix, library, size)
+        except Exception, e:
+            # Suggestions are a convenience. If the search index
+            # can't provide them, the patron can still search.
+            logging.error(
+                "Could not get search suggestions for %r", prefix,
+                exc_info=e
+            )
+            return []
@@ -122,6 +122,11 @@ class Configuration(object):
     NONGROUPED_MAX_AGE_POLICY = "default_nongrouped_feed_max_age"
     GROUPED_MAX_AGE_POLICY = "default_grouped_feed_max_age"
 
+    # The name of the site-wide configuration setting that determines
+    # whether an out-of-date cached feed is served while a single
+    # process regenerates it.
+    STALE_WHILE_REVALIDATE_POLICY = "feed_stale_while_revalidate"
+
     # The name of the per-library configuration policy that controls whether
     # books may be put on hold.
     ALLOW_HOLDS = "allow_holds"
@@ -134,6 +139,13 @@ class Configuration(object):
     # 'featured' lanes.
     FEATURED_LANE_SIZE = "featured_lane_size"
 
+    # Each library may choose to build its lane feeds from the search
+    # index rather than the materialized view in the database.
+    LANE_FEED_ENGINE = "lane_feed_engine"
+    LANE_FEED_ENGINE_DATABASE = "database"
+    LANE_FEED_ENGINE_SEARCH_INDEX = "search_index"
+    LANE_FEED_ENGINES = [LANE_FEED_ENGINE_DATABASE, LANE_FEED_ENGINE_SEARCH_INDEX]
+
     # Each facet group has two associated per-library keys: one
     # configuring which facets are enabled for that facet group, and
     # one configuring which facet is the default.
@@ -176,6 +188,16 @@ class Configuration(object):
             "key": GROUPED_MAX_AGE_POLICY,
             "label": _("Cache time for grouped OPDS feeds"),
         },
+        {
+            "key": STALE_WHILE_REVALIDATE_POLICY,
+            "label": _("Serve out-of-date OPDS feeds while they are being regenerated"),
+            "type": "select",
+            "options": [
+                { "key": "true", "label": _("Yes") },
+                { "key": "false", "label": _("No") },
+            ],
+            "default": "false",
+        },
         {
             "key": BASE_URL_KEY,
             "label": _("Base url of the application"),
@@ -236,6 +258,17 @@ class Configuration(object):
             "description": _("Between 0 and 1."),
             "default": 0.65,
         },
+        {
+            "key": LANE_FEED_ENGINE,
+            "label": _("Where lane feeds come from"),
+            "description": _("Building lane feeds from the search index takes load off the database, but changes to a book may take longer to show up."),
+            "type": "select",
+            "options": [
+                { "key": LANE_FEED_ENGINE_DATABASE, "label": _("Database") },
+                { "key": LANE_FEED_ENGINE_SEARCH_INDEX, "label": _("Search index") },
+            ],
+            "default": LANE_FEED_ENGINE_DATABASE,
+        },
     ] + [
         { "key": ENABLED_FACETS_KEY_PREFIX + group,
           "label": description,
@@ -1,6 +1,10 @@
 from nose.tools import set_trace
 import datetime
 import logging
+import multiprocessing
+import threading
+import time
+from threading import RLock
 
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
@@ -17,6 +21,7 @@ from model import (
     ExternalIntegration,
     Identifier,
     LicensePool,
+    SessionManager,
     Timestamp,
     Work,
     WorkCoverageRecord,
@@ -24,7 +29,11 @@ from model import (
 from metadata_layer import (
     ReplacementPolicy
 )
-from util.worker_pools import DatabaseJob
+from util.worker_pools import (
+    DatabaseJob,
+    Pool,
+    RateLimiter,
+)
 
 import log # This sets the appropriate log format.
 
@@ -115,14 +124,32 @@ class BaseCoverageProvider(object):
     # doing this.
     DEFAULT_BATCH_SIZE = 100
 
+    # If your subclass spends most of its time waiting on a network
+    # request for each item, implement fetch_item() and set this to
+    # the number of requests that may be in progress at once. It's
+    # also possible to change it by passing in a value for
+    # `concurrency` in the constructor.
+    DEFAULT_CONCURRENCY = 1
+
+    # If the data source can't handle more than a certain number of
+    # requests per second, set this to that number. The limit is
+    # shared by every CoverageProvider that uses the same data source.
+    REQUESTS_PER_SECOND = None
+
+    _rate_limiters = {}
+    _rate_limiters_lock = RLock()
+
     def __init__(self, _db, batch_size=None, cutoff_time=None,
-        registered_only=False,
+        registered_only=False, concurrency=None,
     ):
         """Constructor.
 
         :param batch_size: The maximum number of objects that will be processed
         at once.
 
+        :param concurrency: The number of items whose network-bound
+        work (see fetch_item) may be done at once.
+
         :param cutoff_time: Coverage records created before this time
         will be treated as though they did not exist.
 
@@ -147,6 +174,9 @@ class BaseCoverageProvider(object):
         self.cutoff_time = cutoff_time
         self.registered_only = registered_only
         self.collection_id = None
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self._fetch_pool = None
+        self._fetched = {}
 
     @property
     def log(self):
@@ -233,6 +263,33 @@ class BaseCoverageProvider(object):
         
         return offset
 
+    def run_on_id_range(self, min_id, max_id, count_as_covered=None):
+        """Give coverage to every item that needs it and has an ID
+        between `min_id` and `max_id` (inclusive).
+
+        Unlike run_once(), this finds each batch by its position in
+        the ID range rather than by an offset into the query, so it
+        works no matter how the results of earlier batches change
+        the set of items that need coverage.
+
+        :return: The number of items processed.
+        """
+        count_as_covered = count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
+        column = self.item_id_column
+        processed = 0
+        start = min_id
+        while start <= max_id:
+            qu = self.items_that_need_coverage(
+                count_as_covered=count_as_covered
+            ).filter(column >= start).filter(column <= max_id)
+            batch = qu.order_by(column).limit(self.batch_size).all()
+            if not batch:
+                break
+            self.process_batch_and_handle_results(batch)
+            processed += len(batch)
+            start = batch[-1].id + 1
+        return processed
+
     def process_batch_and_handle_results(self, batch):
         """:return: A 2-tuple (counts, records). 
 
@@ -322,14 +379,75 @@ class BaseCoverageProvider(object):
 
         :return: A mixed list of coverage records and CoverageFailures.
         """
-        results = []
-        for item in batch:
-            result = self.process_item(item)
-            if not isinstance(result, CoverageFailure):
-                self.handle_success(item)
-            results.append(result)
+        self.prefetch(batch)
+        try:
+            results = []
+            for item in batch:
+                result = self.process_item(item)
+                if not isinstance(result, CoverageFailure):
+                    self.handle_success(item)
+                results.append(result)
+        finally:
+            self._fetched = {}
         return results
 
+    def prefetch(self, items):
+        """Call fetch_item() on every item, `concurrency` items at a
+        time, before any of them are processed.
+
+        The results are made available through fetched(). Nothing
+        happens unless this CoverageProvider has a concurrency greater
+        than 1.
+        """
+        if self.concurrency <= 1:
+            return
+        if not self._fetch_pool:
+            self._fetch_pool = Pool(self.concurrency)
+        rate_limiter = self.rate_limiter
+
+        fetched = {}
+        def fetch(item):
+            if rate_limiter:
+                rate_limiter.wait()
+            try:
+                fetched[item] = self.fetch_item(item)
+            except Exception, e:
+                # The item will be fetched again when it's processed.
+                self.log.warn(
+                    "Could not fetch %r in advance: %s", item, e
+                )
+        for item in items:
+            self._fetch_pool.put(lambda item=item: fetch(item))
+        self._fetch_pool.join()
+        self._fetched = fetched
+
+    def fetched(self, item, fetch):
+        """Find the result of a call to fetch_item() made by prefetch().
+
+        :param fetch: If `item` wasn't fetched ahead of time, or
+            fetching it raised an exception, this function will be
+            called on `item` to fetch it now. It runs in the calling
+            thread, so, unlike fetch_item(), it may use the database.
+        """
+        if item in self._fetched:
+            return self._fetched.pop(item)
+        return fetch(item)
+
+    @property
+    def rate_limiter(self):
+        """The RateLimiter shared by every CoverageProvider that uses
+        the same data source as this one, if REQUESTS_PER_SECOND is set.
+        """
+        if not self.REQUESTS_PER_SECOND:
+            return None
+        key = getattr(self, 'DATA_SOURCE_NAME', None) or self.SERVICE_NAME
+        with self._rate_limiters_lock:
+            if key not in self._rate_limiters:
+                self._rate_limiters[key] = RateLimiter(
+                    self.REQUESTS_PER_SECOND
+                )
+            return self._rate_limiters[key]
+
     def add_coverage_records_for(self, items):
         """Add CoverageRecords for a group of items from a batch,
         each of which was successful.
@@ -387,6 +505,15 @@ class BaseCoverageProvider(object):
         Implemented in CoverageProvider and WorkCoverageProvider.
         """
         raise NotImplementedError()
+
+    @property
+    def item_id_column(self):
+        """The database column holding the ID of the items returned by
+        items_that_need_coverage().
+
+        Implemented in IdentifierCoverageProvider and WorkCoverageProvider.
+        """
+        raise NotImplementedError()
     
     def add_coverage_record_for(self, item):
         """Add a coverage record for the given item.
@@ -420,6 +547,20 @@ class BaseCoverageProvider(object):
         """
         raise NotImplementedError()
 
+    def fetch_item(self, item):
+        """Do the slow, network-bound part of giving coverage to one
+        specific item, and return whatever process_item() will need.
+
+        This is called in a worker thread, so it must not use the
+        database session, or load anything from the database through
+        `item`. process_item() picks up the result by calling
+        fetched().
+
+        This is optional, and only called if the CoverageProvider has
+        a concurrency greater than 1.
+        """
+        raise NotImplementedError()
+
 
 class IdentifierCoverageProvider(BaseCoverageProvider):
 
@@ -810,6 +951,10 @@ class IdentifierCoverageProvider(BaseCoverageProvider):
     # Implementation of BaseCoverageProvider virtual methods.
     #
 
+    @property
+    def item_id_column(self):
+        return Identifier.id
+
     def items_that_need_coverage(self, identifiers=None, **kwargs):
         """Find all items lacking coverage from this CoverageProvider.
 
@@ -1162,19 +1307,91 @@ class CollectionCoverageProvider(IdentifierCoverageProvider):
 
 
 class CollectionCoverageProviderJob(DatabaseJob):
+    """Run a CollectionCoverageProvider on the items in one range of IDs.
+
+    The job only holds on to IDs, so it can be run in a worker thread
+    of a DatabasePool or sent to a worker process of a ProcessPool.
+    """
 
-    def __init__(self, collection, provider_class, item_offset,
-        **provider_kwargs
+    def __init__(self, collection, provider_class, min_id, max_id,
+        progress=None, **provider_kwargs
     ):
-        self.collection = collection
-        self.offset = item_offset
+        self.collection_id = collection.id
+        self.min_id = min_id
+        self.max_id = max_id
         self.provider_class = provider_class
+        self.progress = progress
         self.provider_kwargs = provider_kwargs
 
-    def run(self, _db, **kwargs):
-        collection = _db.merge(self.collection)
+    def __getstate__(self):
+        # A CoverageProviderProgress can't be sent to another
+        # process. A job run in a worker process reports its progress
+        # through finished_in_process() instead.
+        state = dict(self.__dict__)
+        state['progress'] = None
+        return state
+
+    @classmethod
+    def worker_name(cls):
+        process = multiprocessing.current_process().name
+        if process == 'MainProcess':
+            return threading.current_thread().name
+        return process
+
+    def do_run(self, _db, **kwargs):
+        start = time.time()
+        collection = get_one(_db, Collection, id=self.collection_id)
         provider = self.provider_class(collection, **self.provider_kwargs)
-        provider.run_once(self.offset)
+        processed = provider.run_on_id_range(self.min_id, self.max_id)
+        result = (self.worker_name(), processed, time.time() - start)
+        self.finished_in_process(result)
+        return result
+
+    def finished_in_process(self, result):
+        if self.progress and result:
+            self.progress.add(*result)
+
+
+class CoverageProviderProgress(object):
+    """Keep track of how quickly each worker running
+    CollectionCoverageProviderJobs is providing coverage.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.workers = dict()
+        self.lock = RLock()
+        self.log = logging.getLogger("Coverage provider progress")
+
+    def add(self, worker, items, seconds):
+        with self.lock:
+            total_items, total_seconds = self.workers.get(worker, (0, 0))
+            self.workers[worker] = (total_items + items, total_seconds + seconds)
+
+    @property
+    def items(self):
+        return sum(items for items, seconds in self.workers.values())
+
+    def items_per_second(self, worker=None):
+        if worker:
+            items, elapsed = self.workers.get(worker, (0, 0))
+        else:
+            items, elapsed = self.items, time.time() - self.start
+        if elapsed <= 0:
+            return 0
+        return items / float(elapsed)
+
+    def report(self):
+        for worker in sorted(self.workers):
+            items, seconds = self.workers[worker]
+            self.log.info(
+                "%s: %d items in %.1f seconds (%.1f items/sec).",
+                worker, items, seconds, self.items_per_second(worker)
+            )
+        self.log.info(
+            "%d items processed by %d workers (%.1f items/sec).",
+            self.items, len(self.workers), self.items_per_second()
+        )
 
 
 class CatalogCoverageProvider(CollectionCoverageProvider):
@@ -1252,6 +1469,10 @@ class WorkCoverageProvider(BaseCoverageProvider):
     # Implementation of BaseCoverageProvider virtual methods.
     #
 
+    @property
+    def item_id_column(self):
+        return Work.id
+
     def items_that_need_coverage(self, identifiers=None, **kwargs):
         """Find all Works lacking coverage from this CoverageProvider.
 
@@ -1345,3 +1566,83 @@ class OPDSEntryWorkCoverageProvider(PresentationReadyWorkCoverageProvider):
     def process_item(self, work):
         work.calculate_opds_entries()
         return work
+
+
+class MaterializedViewMirrorCoverageProvider(WorkCoverageProvider):
+    """Keep the mirror of the lanes materialized view up to date by
+    replacing the rows for works whose data has changed.
+
+    Works are registered for this coverage by
+    Work.materialized_view_needs_updating(). If so many works are
+    registered that replacing their rows one batch at a time would
+    take longer than starting over, the materialized view is
+    refreshed and copied into the mirror instead.
+    """
+
+    SERVICE_NAME = "Materialized view mirror coverage provider"
+    OPERATION = WorkCoverageRecord.UPDATE_MATERIALIZED_VIEW_OPERATION
+
+    DEFAULT_BATCH_SIZE = 500
+
+    # If more works than this need their rows replaced, refresh the
+    # whole materialized view instead.
+    DEFAULT_MAXIMUM_DELTA = 50000
+
+    def __init__(self, _db, maximum_delta=None, **kwargs):
+        # Only works that have been registered as changed need to be
+        # covered. A work that was never registered is already
+        # represented correctly in the mirror.
+        kwargs['registered_only'] = True
+        super(MaterializedViewMirrorCoverageProvider, self).__init__(
+            _db, **kwargs
+        )
+        if maximum_delta is None:
+            maximum_delta = self.DEFAULT_MAXIMUM_DELTA
+        self.maximum_delta = maximum_delta
+
+    def run_once_and_update_timestamp(self):
+        delta = self.items_that_need_coverage().count()
+        if delta > self.maximum_delta:
+            self.log.info(
+                "%d works have changed; refreshing the entire materialized view.",
+                delta
+            )
+            self.refresh_everything()
+            self.update_timestamp()
+            return
+        return super(
+            MaterializedViewMirrorCoverageProvider, self
+        ).run_once_and_update_timestamp()
+
+    def refresh_everything(self):
+        """Refresh the materialized view without blocking readers, and
+        replace the contents of the mirror with the result.
+        """
+        start = datetime.datetime.utcnow()
+        self._db.execute(
+            "refresh materialized view concurrently %s;" %
+            SessionManager.MATERIALIZED_VIEW_LANES
+        )
+        SessionManager.update_materialized_view_mirror(self._db)
+
+        # Every work registered before we started is now covered.
+        # Works registered since then may have changed after the
+        # refresh, so they'll be handled the next time we run.
+        self._db.query(WorkCoverageRecord).filter(
+            WorkCoverageRecord.operation==self.operation
+        ).filter(
+            WorkCoverageRecord.status==WorkCoverageRecord.REGISTERED
+        ).filter(
+            WorkCoverageRecord.timestamp < start
+        ).update(
+            dict(status=WorkCoverageRecord.SUCCESS,
+                 timestamp=datetime.datetime.utcnow()),
+            synchronize_session=False
+        )
+        self._db.commit()
+
+    def process_batch(self, works):
+        SessionManager.update_materialized_view_mirror(
+            self._db, [work.id for work in works]
+        )
+        return works
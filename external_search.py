@@ -7,12 +7,16 @@ from config import (
     CannotLoadConfiguration,
 )
 from classifier import (
+    Classifier,
     KeywordBasedClassifier,
     GradeLevelClassifier,
     AgeClassifier,
 )
+from facets import FacetConstants
 from model import (
     ExternalIntegration, 
+    LicensePool,
+    SessionManager,
     Work,
     WorkCoverageRecord,
 )
@@ -21,10 +25,312 @@ from coverage import (
     CoverageFailure,
     WorkCoverageProvider,
 )
+from util.worker_pools import DatabaseJob
+import hashlib
+import json
 import os
 import logging
 import re
+import sys
 import time
+import unicodedata
+from collections import OrderedDict
+from threading import (
+    RLock,
+    Thread,
+)
+
+
+class SearchCache(object):
+    """A small, thread-safe, in-memory cache.
+
+    The least recently used entries are evicted once there are more
+    than `max_size` of them, and if a `ttl` is given, entries expire
+    that many seconds after they're stored.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        """Look up a cached value.
+
+        :return: The cached value, or None if there is no current
+            value for `key`.
+        """
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > now:
+                    # Move this entry to the most-recently-used end.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def store(self, key, value, now=None):
+        now = now or time.time()
+        expires = None
+        if self.ttl is not None:
+            expires = now + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SuggestionTrie(object):
+    """An in-memory prefix trie of search suggestions.
+
+    This is used to suggest titles, series and authors when there's
+    no search index to ask. Every node keeps its own list of the
+    best suggestions beneath it, so a lookup takes time proportional
+    to the length of the prefix, not the size of the collection.
+    """
+
+    # A trie built from the database is reused for this many seconds.
+    REBUILD_AFTER = 3600
+
+    # Works are loaded from the database this many at a time.
+    BATCH_SIZE = 500
+
+    # By default, each node remembers this many suggestions, which is
+    # the most anyone can ask for at once.
+    SUGGESTIONS_PER_NODE = 25
+
+    # Each library's trie, its builder thread, and the lock that
+    # controls access to both.
+    _by_library = {}
+    _builders = {}
+    _library_locks = {}
+    _lock = RLock()
+
+    def __init__(self, suggestions_per_node=None, max_depth=None):
+        """Constructor.
+
+        :param max_depth: Prefixes longer than this are looked up by
+            their first `max_depth` characters, and the rest is
+            checked against each suggestion. By default, this is the
+            longest prefix kept in the suggestions index.
+        """
+        self.suggestions_per_node = (
+            suggestions_per_node or self.SUGGESTIONS_PER_NODE
+        )
+        self.max_depth = (
+            max_depth or ExternalSearchIndex.MAX_SUGGESTION_PREFIX
+        )
+        self._suggestions = {}
+        self._root = None
+
+    @classmethod
+    def normalize(cls, text):
+        """Normalize text so that a prefix matches regardless of its
+        case, spacing, or accents.
+        """
+        if not text:
+            return u''
+        if not isinstance(text, unicode):
+            text = text.decode("utf8")
+        text = unicodedata.normalize("NFKD", text)
+        text = u"".join(x for x in text if not unicodedata.combining(x))
+        return u" ".join(text.lower().split())
+
+    def add(self, text, weight):
+        """Add a suggestion. If the same suggestion is added more than
+        once, the highest weight wins.
+        """
+        key = self.normalize(text)
+        if not key:
+            return
+        existing = self._suggestions.get(key)
+        if existing is None or weight > existing[0]:
+            self._suggestions[key] = (weight, u" ".join(text.split()))
+            self._root = None
+
+    def add_document(self, doc):
+        """Add the suggestions from a search document created by
+        ExternalSearchIndex.add_suggestions().
+        """
+        weight = doc.get('suggestion_weight') or 0
+        for text in doc.get('suggestions') or []:
+            self.add(text, weight)
+
+    def _build(self):
+        # Adding the suggestions in order of weight means each node's
+        # list is filled up with the best suggestions first.
+        root = ({}, [])
+        by_weight = sorted(
+            self._suggestions.items(), key=lambda x: (-x[1][0], x[0])
+        )
+        for key, (weight, text) in by_weight:
+            node = root
+            for depth, character in enumerate(key[:self.max_depth], 1):
+                children = node[0]
+                if character not in children:
+                    children[character] = ({}, [])
+                node = children[character]
+                # The deepest nodes stand in for every longer prefix,
+                # so they keep all of their suggestions.
+                if (depth == self.max_depth
+                    or len(node[1]) < self.suggestions_per_node):
+                    node[1].append(text)
+        return root
+
+    def suggest(self, prefix, limit=10):
+        """Find the best suggestions that start with `prefix`."""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        if self._root is None:
+            self._root = self._build()
+        node = self._root
+        for character in prefix[:self.max_depth]:
+            node = node[0].get(character)
+            if node is None:
+                return []
+        suggestions = node[1]
+        if len(prefix) > self.max_depth:
+            suggestions = [x for x in suggestions
+                           if self.normalize(x).startswith(prefix)]
+        return suggestions[:limit]
+
+    def __len__(self):
+        return len(self._suggestions)
+
+    @classmethod
+    def _library_lock(cls, key):
+        with cls._lock:
+            return cls._library_locks.setdefault(key, RLock())
+
+    @classmethod
+    def for_library(cls, _db, library, background=True):
+        """Find a trie containing the suggestions for every work
+        available to `library`.
+
+        Building a trie means loading every work in the library, so
+        by default it's never done while a request waits. If the trie
+        is missing or out of date, a SuggestionTrieBuilder builds a new
+        one in the background, and the old trie -- or an empty one --
+        is used until the new one is swapped in.
+
+        :param background: If False, build a missing or out-of-date
+            trie immediately, using `_db`.
+        """
+        key = getattr(library, 'id', None)
+        with cls._library_lock(key):
+            built, trie = cls._by_library.get(key, (None, None))
+            if trie is not None and built + cls.REBUILD_AFTER >= time.time():
+                return trie
+
+            collection_ids = None
+            if library is not None:
+                collection_ids = [x.id for x in library.collections]
+            if not background:
+                return cls.build(_db, key, collection_ids)
+
+            builder = cls._builders.get(key)
+            if builder is None or not builder.is_alive():
+                builder = SuggestionTrieBuilder(
+                    SessionManager.sessionmaker(session=_db), key,
+                    collection_ids
+                )
+                cls._builders[key] = builder
+                builder.start()
+        if trie is None:
+            trie = cls()
+        return trie
+
+    @classmethod
+    def build(cls, _db, key, collection_ids=None):
+        """Build a new trie for the given collections and make it the
+        one used for `key`.
+        """
+        trie = cls.from_database(_db, collection_ids)
+        with cls._library_lock(key):
+            cls._by_library[key] = (time.time(), trie)
+        return trie
+
+    @classmethod
+    def from_database(cls, _db, collection_ids=None, batch_size=None):
+        """Build a trie from the search documents for every
+        presentation-ready work in the given collections.
+        """
+        batch_size = batch_size or cls.BATCH_SIZE
+        trie = cls()
+        qu = _db.query(Work).filter(Work.presentation_ready==True)
+        if collection_ids is not None:
+            in_collections = _db.query(LicensePool.work_id).filter(
+                LicensePool.collection_id.in_(collection_ids)
+            )
+            qu = qu.filter(Work.id.in_(in_collections.subquery()))
+        min_id = 0
+        while True:
+            batch = qu.filter(Work.id >= min_id).order_by(
+                Work.id).limit(batch_size).all()
+            if not batch:
+                break
+            for doc in Work.to_search_documents(batch) or []:
+                ExternalSearchIndex.add_suggestions(doc)
+                trie.add_document(doc)
+            min_id = batch[-1].id + 1
+
+        # Build the nodes now, so that a trie shared between requests
+        # is never modified after it's been swapped in.
+        trie._root = trie._build()
+        return trie
+
+    @classmethod
+    def reset(cls):
+        """Forget every trie built from the database.
+
+        This method is only intended for use in testing.
+        """
+        with cls._lock:
+            cls._by_library = {}
+            cls._builders = {}
+            cls._library_locks = {}
+
+
+class SuggestionTrieBuilder(Thread):
+    """Build a library's SuggestionTrie in the background and swap it
+    in when it's ready.
+    """
+
+    def __init__(self, session_factory, key, collection_ids):
+        super(SuggestionTrieBuilder, self).__init__()
+        self.daemon = True
+        self.session_factory = session_factory
+        self.key = key
+        self.collection_ids = collection_ids
+
+    def run(self):
+        _db = self.session_factory()
+        try:
+            SuggestionTrie.build(_db, self.key, self.collection_ids)
+        except Exception, e:
+            logging.error(
+                "Could not build search suggestions for library %r",
+                self.key, exc_info=e
+            )
+        finally:
+            _db.close()
+
 
 class ExternalSearchIndex(object):
 
@@ -40,6 +346,20 @@ class ExternalSearchIndex(object):
     CURRENT_ALIAS_SUFFIX = 'current'
     VERSION_RE = re.compile('-v([0-9]+)$')
 
+    # The results of a popular search are reused for this many
+    # seconds. Search documents uploaded by this process, or a change
+    # to the index behind the -current alias, make them obsolete
+    # immediately; changes made by other processes may take this long
+    # to show up.
+    RESULT_CACHE_TTL = 60
+    RESULT_CACHE_SIZE = 1000
+    _result_cache = SearchCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+    # The query for a given search string never changes, so there's
+    # no need to rebuild it every time.
+    QUERY_CACHE_SIZE = 5000
+    _query_cache = SearchCache(QUERY_CACHE_SIZE)
+
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("URL") },
         { "key": WORKS_INDEX_PREFIX_KEY, "label": _("Index prefix"), 
@@ -50,6 +370,20 @@ class ExternalSearchIndex(object):
 
     SITEWIDE = True
 
+    # Lane feeds, facet counts and search suggestions need fields
+    # that were first mapped in this version of the index.
+    LANE_FEEDS_MINIMUM_VERSION = 4
+
+    # Whether the index that serves search queries is recent enough
+    # for lane feeds. This is set by set_works_index_and_alias().
+    supports_lane_feeds = False
+
+    # The ExternalSearchIndex returned by for_lane_feeds(), and the
+    # site configuration timestamp it was created under.
+    _lane_feed_client = None
+    _lane_feed_client_key = None
+    _lane_feed_client_lock = RLock()
+
     @classmethod
     def reset(cls):
         """Resets the __client object to None so a new configuration
@@ -58,6 +392,40 @@ class ExternalSearchIndex(object):
         This method is only intended for use in testing.
         """
         cls.__client = None
+        cls._result_cache.clear()
+        cls._query_cache.clear()
+        cls._lane_feed_client = None
+        cls._lane_feed_client_key = None
+
+    @classmethod
+    def for_lane_feeds(cls, _db):
+        """Find an ExternalSearchIndex to use when building lane feeds.
+
+        Creating an ExternalSearchIndex means making several requests
+        to Elasticsearch, which is too much to do for every feed, so
+        the same object is reused until the site configuration changes.
+
+        :return: An ExternalSearchIndex, or None if the search index
+            can't be used.
+        """
+        last_update = Configuration.site_configuration_last_update(_db)
+        with cls._lane_feed_client_lock:
+            if (cls._lane_feed_client is None
+                or cls._lane_feed_client_key != last_update):
+                try:
+                    cls._lane_feed_client = cls(_db)
+                    cls._lane_feed_client_key = last_update
+                except Exception, e:
+                    logging.error(
+                        "Could not load search index for lane feeds.",
+                        exc_info=e
+                    )
+                    return None
+            client = cls._lane_feed_client
+        if not client.supports_lane_feeds:
+            # The search index needs to be migrated first.
+            return None
+        return client
 
     @classmethod
     def search_integration(cls, _db):
@@ -151,10 +519,27 @@ class ExternalSearchIndex(object):
     def set_works_index_and_alias(self, _db):
         """Finds or creates the works_index and works_alias based on
         the current configuration.
+
+        If the -current alias is on an older version of the index,
+        that version stays in use until MigrateSearchIndexScript
+        builds the latest version and moves the alias onto it.
+        Deploying code with a new index version doesn't create an
+        empty index for searches and documents to go to.
         """
         # The index name to use is the one known to be right for this
-        # version.
-        self.works_index = self.__client.works_index = self.works_index_name(_db)
+        # version, unless an older version is still serving searches.
+        works_index = self.works_index_name(_db)
+        current_index = self.current_alias_index(_db)
+        if (current_index and current_index != works_index
+            and self.base_index_name(current_index)
+            == self.base_index_name(works_index)):
+            self.log.warn(
+                "Search queries are still using %s. Run "
+                "MigrateSearchIndexScript to build %s.",
+                current_index, works_index
+            )
+            works_index = current_index
+        self.works_index = self.__client.works_index = works_index
         if not self.indices.exists(self.works_index):
             # That index doesn't actually exist. Set it up.
             self.setup_index()
@@ -162,31 +547,44 @@ class ExternalSearchIndex(object):
         # Make sure the alias points to the most recent index.
         self.setup_current_alias(_db)
 
+        version = self.index_version(self.works_index)
+        self.supports_lane_feeds = bool(
+            version and version >= self.LANE_FEEDS_MINIMUM_VERSION
+        )
+
+    @classmethod
+    def index_version(cls, index):
+        """Find the version number in the name of an index.
+
+        :return: An integer, or None if the index name has no version.
+        """
+        match = cls.VERSION_RE.search(index)
+        if not match:
+            return None
+        return int(match.groups()[0])
+
     def setup_current_alias(self, _db):
         """Finds or creates the works_alias as named by the current site
         settings.
 
-        If the resulting alias exists and is affixed to a different
-        index or if it can't be generated for any reason, the alias will
-        not be created or moved. Instead, the search client will use the
-        the works_index directly for search queries.
+        If the alias already exists, search queries run against it,
+        even if it's affixed to a different index than the works_index.
+        The alias only moves once a new index is completely built (see
+        MigrateSearchIndexScript), so until then the works_index may be
+        missing documents.
+
+        If the alias doesn't exist and can't be created, the search
+        client will use the works_index directly for search queries.
         """
         alias_name = self.works_alias_name(_db)
         exists = self.indices.exists_alias(name=alias_name)
 
         def _set_works_alias(name):
             self.works_alias = self.__client.works_alias = name
+            self._result_cache.clear()
 
         if exists:
-            exists_on_works_index = self.indices.exists_alias(
-                index=self.works_index, name=alias_name
-            )
-            if exists_on_works_index:
-                _set_works_alias(alias_name)
-            else:
-                # The current alias is already set on a different index.
-                # Don't overwrite it. Instead, just use the given index.
-                _set_works_alias(self.works_index)
+            _set_works_alias(alias_name)
             return
 
         # Create the alias and search against it.
@@ -244,15 +642,36 @@ class ExternalSearchIndex(object):
             index=self.works_index, name=alias_name
         )
         if not exists_on_works_index:
-            # The alias exists on one or more other indices.
-            # Remove it from them.
-            self.indices.delete_alias(index='_all', name=alias_name)
-            self.indices.put_alias(
-                index=self.works_index, name=alias_name
-            )
+            # The alias exists on one or more other indices. Remove
+            # it from them and add it to the new index in a single
+            # request, so that there's never a moment when search
+            # queries have no index to run against.
+            actions = [
+                dict(remove=dict(index=index, alias=alias_name))
+                for index in self.indices.get_alias(name=alias_name).keys()
+            ]
+            actions.append(dict(add=dict(index=self.works_index, alias=alias_name)))
+            self.indices.update_aliases(body=dict(actions=actions))
 
         self.works_alias = self.__client.works_alias = alias_name
 
+        # Search results from the old index are no longer valid.
+        self._result_cache.clear()
+
+    def current_alias_index(self, _db):
+        """Find the index that the -current alias points to.
+
+        :return: The name of an index, or None if the alias doesn't
+            exist or points to more than one index.
+        """
+        alias_name = self.works_alias_name(_db)
+        if not self.indices.exists_alias(name=alias_name):
+            return None
+        indices = self.indices.get_alias(name=alias_name).keys()
+        if len(indices) != 1:
+            return None
+        return indices[0]
+
     def base_index_name(self, index_or_alias):
         """Removes version or current suffix from base index name"""
 
@@ -278,6 +697,15 @@ class ExternalSearchIndex(object):
         else:
             collection_ids = [x.id for x in library.collections]
 
+        cache_key = self.result_cache_key(
+            query_string, collection_ids, media, languages, fiction,
+            audiences, target_age, in_any_of_these_genres,
+            on_any_of_these_lists, fields, size, offset
+        )
+        results = self._result_cache.get(cache_key)
+        if results is not None:
+            return results
+
         filter = self.make_filter(
             collection_ids, media, languages, fiction, 
             audiences, target_age, in_any_of_these_genres,
@@ -302,9 +730,410 @@ class ExternalSearchIndex(object):
         # print "Args looks like: %r" % search_args
         results = self.search(**search_args)
         # print "Results: %r" % results
+        self._result_cache.store(cache_key, results)
         return results
 
+    def result_cache_key(self, query_string, collection_ids, media,
+                         languages, fiction, audiences, target_age, genres,
+                         customlist_ids, fields, size, offset):
+        """Turn the arguments to query_works() into a key for the
+        search result cache.
+
+        Two searches that differ only in the order of their filter
+        values, or in the case and spacing of the query string, will
+        get the same key.
+        """
+        def _sorted(values):
+            if values is None:
+                return None
+            if isinstance(values, basestring):
+                values = [values]
+            return tuple(sorted(values))
+
+        if query_string is not None:
+            query_string = u" ".join(query_string.lower().split())
+        if genres:
+            genres = [getattr(x, 'id', x) for x in genres]
+        if target_age and not isinstance(target_age, tuple):
+            target_age = (target_age.lower, target_age.upper)
+        return (
+            self.works_alias, query_string, _sorted(collection_ids),
+            _sorted(media), _sorted(languages), fiction,
+            _sorted(audiences), target_age, _sorted(genres),
+            _sorted(customlist_ids), _sorted(fields), size, offset
+        )
+
+    # Works found by query_works_by_filter() are sorted by the
+    # requested field, and then by these fields.
+    DEFAULT_SORT_ORDER = ['sort_author', 'sort_title']
+
+    def query_works_by_filter(self, filters, order=None, order_ascending=True,
+                              minimum_quality=None, main_collection_only=False,
+                              featurable_quality=None, availability=None,
+                              size=30, offset=0):
+        """Find works that match a set of filters, with no search query
+        involved.
+
+        This lets lane feeds be built from the search index instead
+        of the database.
+
+        :param filters: A list of filters created by make_filter(). A
+            work must match every one of them.
+        :param order: Sort the works by this field of the search
+            document, and then by DEFAULT_SORT_ORDER.
+        :param order_ascending: This applies to the `order` field only;
+            everything else is sorted ascending.
+        :param minimum_quality: Exclude works of lower quality than this.
+        :param main_collection_only: Exclude open-access works of low
+            quality, as the 'main' collection facet does.
+        :param featurable_quality: If this is present, `order` is
+            ignored and the works are returned in random order, with
+            works of at least this quality first, followed by works
+            that would show up in the main collection.
+        :param availability: Restrict the works to those matching
+            this availability facet.
+        :return: A list of Work IDs.
+        """
+        if not self.works_alias:
+            return []
+
+        clauses = [x for x in filters if x]
+        if minimum_quality is not None:
+            clauses.append(self._minimum_quality_filter(minimum_quality))
+        if main_collection_only:
+            clauses.append(self._main_collection_filter())
+        if availability and availability != FacetConstants.AVAILABLE_ALL:
+            clauses.append(self._availability_filters()[availability])
+        if clauses:
+            filter = {'and': clauses}
+        else:
+            filter = {'match_all': {}}
+        query = dict(filtered=dict(filter=filter))
+
+        body = dict(query=query)
+        if featurable_quality is not None:
+            # This mirrors FeaturedFacets.quality_tier_field().
+            body = dict(
+                query=dict(
+                    function_score=dict(
+                        query=query,
+                        functions=[
+                            dict(filter=self._minimum_quality_filter(
+                                featurable_quality), weight=5),
+                            dict(filter=self._main_collection_filter(),
+                                 weight=2),
+                            dict(random_score={}),
+                        ],
+                        score_mode="sum",
+                        boost_mode="replace",
+                    )
+                )
+            )
+        else:
+            fields = list(self.DEFAULT_SORT_ORDER)
+            if order:
+                fields = [order] + [x for x in fields if x != order]
+            sort = [{field: dict(order="asc")} for field in fields]
+            if not order_ascending:
+                sort[0] = {fields[0]: dict(order="desc")}
+            body['sort'] = sort
+
+        cache_key = (
+            self.works_alias, json.dumps(body, sort_keys=True), size, offset
+        )
+        work_ids = self._result_cache.get(cache_key)
+        if work_ids is not None:
+            return work_ids
+
+        results = self.search(
+            index=self.works_alias, body=body, from_=offset, size=size,
+            _source=False
+        )
+        work_ids = [int(x['_id']) for x in results['hits']['hits']]
+        self._result_cache.store(cache_key, work_ids)
+        return work_ids
+
+    def _minimum_quality_filter(self, quality):
+        return {"range": {"quality": {"gte": quality}}}
+
+    def _main_collection_filter(self):
+        # Open-access books with a quality of less than 0.3 aren't
+        # in the main collection.
+        return {
+            'or': [
+                {'term': {'open_access': False}},
+                self._minimum_quality_filter(0.3),
+            ]
+        }
+
+    # The names of the dictionaries returned by facet_counts() that
+    # don't correspond to a facet group.
+    LANGUAGE_COUNTS = 'language'
+    AUDIENCE_COUNTS = 'audience'
+    GENRE_COUNTS = 'genre'
+
+    # Audiences are indexed without spaces and analyzed, so "Young
+    # Adult" comes back from an aggregation as "youngadult".
+    AUDIENCES_BY_INDEXED_VALUE = dict(
+        (audience.lower().replace(" ", ""), audience)
+        for audience in Classifier.AUDIENCES
+    )
+
+    def facet_counts(self, filters, availability=None, collection=None,
+                     minimum_featured_quality=None, counts=None):
+        """Count the works that match a set of filters, broken down by
+        availability and collection, and optionally by language,
+        audience and genre.
+
+        This takes a single request, no matter how many counts are
+        needed.
+
+        :param filters: A list of filters created by make_filter().
+        :param availability: The currently selected availability
+            facet. It restricts every count except the availability
+            counts themselves, so each count is the number of works a
+            patron would see after choosing that value.
+        :param collection: The currently selected collection facet.
+            This works the same way as `availability`.
+        :param minimum_featured_quality: Needed to count the works
+            in the 'featured' collection.
+        :param counts: Any of LANGUAGE_COUNTS, AUDIENCE_COUNTS and
+            GENRE_COUNTS. These counts aren't needed for facet links,
+            so they're only computed when asked for.
+
+        :return: A dictionary with a 'total' count and a dictionary of
+            counts for each of FacetConstants.AVAILABILITY_FACET_GROUP_NAME,
+            FacetConstants.COLLECTION_FACET_GROUP_NAME, and anything
+            named in `counts`. Languages are keyed by language code,
+            audiences by Classifier audience, and genres by Genre ID.
+        """
+        if not self.works_alias:
+            return None
+
+        availability_filters = self._availability_filters()
+        collection_filters = self._collection_filters(
+            minimum_featured_quality
+        )
+        selected_availability = availability_filters.get(availability)
+        selected_collection = collection_filters.get(collection)
+
+        def restricted_to(*selected):
+            selected = [x for x in selected if x]
+            if not selected:
+                return {'match_all': {}}
+            return {'and': selected}
+
+        def filters_aggregation(filters, selected):
+            return {
+                'filter': selected,
+                'aggs': {'values': {'filters': {'filters': filters}}},
+            }
+
+        def terms_aggregation(field, selected):
+            # In Elasticsearch 1.x and 2.x, a size of zero means
+            # "every term".
+            return {
+                'filter': selected,
+                'aggs': {'values': {'terms': {'field': field, 'size': 0}}},
+            }
+
+        both = restricted_to(selected_availability, selected_collection)
+        aggregations = {
+            FacetConstants.AVAILABILITY_FACET_GROUP_NAME: filters_aggregation(
+                availability_filters, restricted_to(selected_collection)
+            ),
+            FacetConstants.COLLECTION_FACET_GROUP_NAME: filters_aggregation(
+                collection_filters, restricted_to(selected_availability)
+            ),
+        }
+        fields = {
+            self.LANGUAGE_COUNTS: 'language',
+            self.AUDIENCE_COUNTS: 'audience',
+            self.GENRE_COUNTS: 'genres.term',
+        }
+        for name in counts or []:
+            aggregations[name] = terms_aggregation(fields[name], both)
+
+        clauses = [x for x in filters if x]
+        if clauses:
+            filter = {'and': clauses}
+        else:
+            filter = {'match_all': {}}
+        body = dict(
+            query=dict(filtered=dict(filter=filter)),
+            aggs=aggregations,
+        )
+
+        cache_key = (self.works_alias, json.dumps(body, sort_keys=True))
+        counts = self._result_cache.get(cache_key)
+        if counts is not None:
+            return counts
+
+        results = self.search(
+            index=self.works_alias, body=body, size=0, _source=False
+        )
+        counts = self._parse_facet_counts(results)
+        self._result_cache.store(cache_key, counts)
+        return counts
+
+    def _availability_filters(self):
+        """Search index filters corresponding to the availability facets."""
+        return {
+            FacetConstants.AVAILABLE_ALL: {'match_all': {}},
+            FacetConstants.AVAILABLE_NOW: {'term': {'available': True}},
+            FacetConstants.AVAILABLE_OPEN_ACCESS: {'term': {'open_access': True}},
+        }
+
+    def _collection_filters(self, minimum_featured_quality=None):
+        """Search index filters corresponding to the collection facets."""
+        filters = {
+            FacetConstants.COLLECTION_FULL: {'match_all': {}},
+            FacetConstants.COLLECTION_MAIN: self._main_collection_filter(),
+        }
+        if minimum_featured_quality is not None:
+            filters[FacetConstants.COLLECTION_FEATURED] = (
+                self._minimum_quality_filter(minimum_featured_quality)
+            )
+        return filters
+
+    def _parse_facet_counts(self, results):
+        """Turn an Elasticsearch response to the request made by
+        facet_counts() into a dictionary of counts.
+        """
+        aggregations = results.get('aggregations', {})
+        def buckets(name, default):
+            values = aggregations.get(name, {}).get('values', {})
+            return values.get('buckets', default)
+
+        counts = dict(total=results['hits']['total'])
+        for name in (FacetConstants.AVAILABILITY_FACET_GROUP_NAME,
+                     FacetConstants.COLLECTION_FACET_GROUP_NAME):
+            counts[name] = dict(
+                (value, bucket['doc_count'])
+                for value, bucket in buckets(name, {}).items()
+            )
+
+        # The other counts are only present if they were asked for.
+        audiences = self.AUDIENCES_BY_INDEXED_VALUE
+        keys = {
+            self.LANGUAGE_COUNTS: lambda key: key,
+            self.AUDIENCE_COUNTS: lambda key: audiences.get(key, key),
+            self.GENRE_COUNTS: int,
+        }
+        for name, key in keys.items():
+            if name in aggregations:
+                counts[name] = dict(
+                    (key(bucket['key']), bucket['doc_count'])
+                    for bucket in buckets(name, [])
+                )
+        return counts
+
+    # Suggestions are weighted by the quality and popularity of the
+    # works they come from.
+    SUGGESTION_QUALITY_WEIGHT = 1000
+    SUGGESTION_POPULARITY_WEIGHT = 500
+
+    # The suggestions index stores prefixes up to this long. Longer
+    # prefixes are matched against the first MAX_SUGGESTION_PREFIX
+    # characters, and the rest is checked here.
+    MAX_SUGGESTION_PREFIX = 20
+
+    # Several suggestions can come from a single work, and many works
+    # can offer the same suggestion, so ask for more works than the
+    # number of suggestions needed.
+    SUGGESTION_OVERFETCH = 3
+
+    @classmethod
+    def add_suggestions(cls, doc):
+        """Add the search suggestions offered by a work -- its title,
+        series and author -- to its search document.
+        """
+        suggestions = []
+        seen = set()
+        for text in (doc.get('title'), doc.get('series'), doc.get('author')):
+            key = SuggestionTrie.normalize(text)
+            if key and key not in seen:
+                seen.add(key)
+                suggestions.append(u" ".join(text.split()))
+        doc['suggestions'] = suggestions
+
+        def _normalized(value):
+            return min(max(float(value or 0), 0), 1)
+        doc['suggestion_weight'] = int(round(
+            _normalized(doc.get('quality')) * cls.SUGGESTION_QUALITY_WEIGHT
+            + _normalized(doc.get('popularity')) * cls.SUGGESTION_POPULARITY_WEIGHT
+        ))
+        return doc
+
+    def suggest(self, prefix, library=None, limit=10):
+        """Suggest titles, series and authors that start with `prefix`.
+
+        :return: A list of up to `limit` strings, best first.
+        """
+        prefix = SuggestionTrie.normalize(prefix)
+        if not prefix or not self.works_alias:
+            return []
+
+        collection_ids = None
+        if library is not None:
+            collection_ids = sorted(x.id for x in library.collections)
+        cache_key = (
+            'suggest', self.works_alias, prefix,
+            collection_ids and tuple(collection_ids), limit
+        )
+        suggestions = self._result_cache.get(cache_key)
+        if suggestions is not None:
+            return suggestions
+
+        filter = self.make_filter(
+            collection_ids, None, None, None, None, None, None, None
+        ) or {'match_all': {}}
+        query = dict(
+            filtered=dict(
+                query=dict(
+                    match=dict(suggestions=prefix[:self.MAX_SUGGESTION_PREFIX])
+                ),
+                filter=filter,
+            )
+        )
+        results = self.search(
+            index=self.works_alias,
+            body=dict(
+                query=query,
+                sort=[dict(suggestion_weight=dict(order='desc'))],
+            ),
+            _source=['suggestions'],
+            size=limit * self.SUGGESTION_OVERFETCH,
+        )
+
+        # The works are sorted by weight, so the first time a
+        # suggestion shows up is the best it'll do.
+        suggestions = []
+        seen = set()
+        for hit in results.get('hits', {}).get('hits', []):
+            for text in hit.get('_source', {}).get('suggestions') or []:
+                key = SuggestionTrie.normalize(text)
+                if key.startswith(prefix) and key not in seen:
+                    seen.add(key)
+                    suggestions.append(text)
+        suggestions = suggestions[:limit]
+        self._result_cache.store(cache_key, suggestions)
+        return suggestions
+
     def make_query(self, query_string):
+        """Build the Elasticsearch query for a search string.
+
+        Building the query is expensive, so the query for a given
+        string is cached. The return value is shared between callers
+        and must not be modified.
+        """
+        query = self._query_cache.get(query_string)
+        if query is None:
+            query = self._make_query(query_string)
+            self._query_cache.store(query_string, query)
+        return query
+
+    def _make_query(self, query_string):
 
         def make_query_string_query(query_string, fields):
             return {
@@ -619,10 +1448,26 @@ class ExternalSearchIndex(object):
 
     def bulk_update(self, works, retry_on_batch_failure=True):
         """Upload a batch of works to the search index at once."""
+        removed, docs = self.create_search_documents(works)
+        return self.upload_search_documents(
+            works, removed, docs, retry_on_batch_failure
+        )
+
+    def create_search_documents(self, works):
+        """Create search documents for a batch of works.
+
+        This is the part of bulk_update() that happens in the
+        database. Works that are no longer presentation-ready are
+        removed from the search index along the way.
 
+        :return: A 2-tuple (removed, docs). `removed` is a list of
+            the Works that were removed from the search index, and
+            `docs` is a list of search documents ready to be passed
+            into upload_search_documents().
+        """
         time1 = time.time()
         needs_add = []
-        successes = []
+        removed = []
         for work in works:
             if work.presentation_ready:
                 needs_add.append(work)
@@ -631,7 +1476,7 @@ class ExternalSearchIndex(object):
                 # pose a performance problem because works almost never
                 # stop being presentation ready.
                 self.remove_work(work)
-                successes.append(work)
+                removed.append(work)
 
         # Add any works that need adding.
         docs = Work.to_search_documents(needs_add)
@@ -639,8 +1484,108 @@ class ExternalSearchIndex(object):
         for doc in docs:
             doc["_index"] = self.works_index
             doc["_type"] = self.work_document_type
+            self.add_suggestions(doc)
         time2 = time.time()
+        self.log.info("Created %i search documents in %.2f seconds" % (len(docs), time2 - time1))
+        return removed, docs
+
+    # A search document is updated in place, rather than replaced,
+    # if only these fields have changed. They're the ones that change
+    # whenever a circulation sync runs.
+    AVAILABILITY_FIELDS = [
+        'collections', 'open_access', 'available', 'availability_time'
+    ]
+
+    @classmethod
+    def content_hash(cls, doc):
+        """Summarize a search document as a string that changes whenever
+        the document does.
+
+        The hash has two parts: one for the AVAILABILITY_FIELDS and
+        one for everything else, so it's possible to tell when only
+        the availability fields have changed.
+
+        The index the document is uploaded to is part of the hash, so
+        when documents start going to a new index (as they do before
+        the works alias is moved onto it), every document is uploaded
+        in full.
+        """
+        body = dict(_index=doc.get('_index'))
+        availability = {}
+        for key, value in doc.items():
+            if key.startswith('_'):
+                # This is bulk upload metadata, not part of the document.
+                continue
+            if key in cls.AVAILABILITY_FIELDS:
+                availability[key] = value
+            else:
+                body[key] = value
+
+        def _hash(value):
+            return hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()
+        return u"%s-%s" % (_hash(body), _hash(availability))
+
+    @classmethod
+    def content_hashes(cls, docs):
+        """Find the content hash of each of the given search documents.
+
+        :return: A dictionary mapping Work IDs to content hashes.
+        """
+        return dict((doc['_id'], cls.content_hash(doc)) for doc in docs)
 
+    def changed_documents(self, docs, hashes, previous_hashes):
+        """Avoid uploading search documents that haven't changed since
+        the last time they were uploaded.
+
+        :param hashes: The content hash of each document in `docs`, as
+            returned by content_hashes().
+        :param previous_hashes: The content hashes of the documents as
+            they were last uploaded.
+
+        :return: A 2-tuple (docs, unchanged). `docs` is a list of
+            search documents and partial updates to upload. `unchanged`
+            is a set containing the IDs of the Works whose documents
+            don't need to be uploaded at all.
+        """
+        changed = []
+        unchanged = set()
+        for doc in docs:
+            work_id = doc['_id']
+            new_hash = hashes[work_id]
+            old_hash = previous_hashes.get(work_id)
+            if new_hash == old_hash:
+                unchanged.add(work_id)
+            elif (old_hash is not None
+                  and new_hash.split('-')[0] == old_hash.split('-')[0]):
+                # Only the availability fields have changed.
+                changed.append(dict(
+                    _op_type='update', _index=doc['_index'],
+                    _type=doc['_type'], _id=work_id,
+                    doc=dict((field, doc.get(field))
+                             for field in self.AVAILABILITY_FIELDS),
+                ))
+            else:
+                changed.append(doc)
+        return changed, unchanged
+
+    def upload_search_documents(self, works, removed, docs,
+                                retry_on_batch_failure=True):
+        """Upload search documents created by create_search_documents().
+
+        This is the part of bulk_update() that happens in the search
+        index. It doesn't use the database, so it can run at the same
+        time as create_search_documents() is working on another batch.
+
+        :return: A 2-tuple (successes, failures), as with bulk_update().
+        """
+        if not docs:
+            # Every document was unchanged or removed, so there's
+            # nothing to upload.
+            if removed:
+                self._result_cache.clear()
+            return self.reconcile_upload_results(works, removed, docs, [])
+
+        time2 = time.time()
         success_count, errors = self.bulk(
             docs,
             raise_on_error=False,
@@ -651,57 +1596,97 @@ class ExternalSearchIndex(object):
         # giving up on the batch.
         #
         # Removed works were already removed, so no need to try them again.
-        if len(errors) == len(docs):
+        if docs and len(errors) == len(docs):
             if retry_on_batch_failure:
                 self.log.info("Elasticsearch bulk update timed out, trying again.")
-                return self.bulk_update(needs_add, retry_on_batch_failure=False)
+                return self.upload_search_documents(
+                    works, removed, docs, retry_on_batch_failure=False
+                )
             else:
                 docs = []
 
         time3 = time.time()
-        self.log.info("Created %i search documents in %.2f seconds" % (len(docs), time2 - time1))
         self.log.info("Uploaded %i search documents in  %.2f seconds" % (len(docs), time3 - time2))
-        
-        doc_ids = [d['_id'] for d in docs]
-        
-        # We weren't able to create search documents for these works, maybe
-        # because they don't have presentation editions yet.
-        def get_error_id(error):
-            return error.get('data', {}).get('_id', None) or error.get('index', {}).get('_id', None)   
-        error_ids = [get_error_id(error) for error in errors]
-
-        missing_works = [
-            work for work in works 
-            if work.id not in doc_ids and work.id not in error_ids
-            and work not in successes
-        ]
-            
-        successes.extend(
-            [work for work in works 
-             if work.id in doc_ids and work.id not in error_ids]
+
+        # Cached search results may not reflect the new documents.
+        self._result_cache.clear()
+
+        successes, failures = self.reconcile_upload_results(
+            works, removed, docs, errors
         )
+        self.log.info("Successfully indexed %i documents, failed to index %i." % (success_count, len(failures)))
 
-        failures = []
-        for missing in missing_works:
-            failures.append((work, "Work not indexed"))
+        return successes, failures
+
+    @classmethod
+    def _document_id(cls, value):
+        # Elasticsearch reports document IDs as strings, but our own
+        # search documents use the integer Work IDs.
+        if value is None:
+            return None
+        return unicode(value)
 
+    @classmethod
+    def _error_document_id(cls, error):
+        return cls._document_id(
+            error.get('data', {}).get('_id', None)
+            or cls._error_action(error).get('_id', None)
+        )
+
+    @classmethod
+    def _error_action(cls, error):
+        # Elasticsearch describes a failed action under the name of
+        # the action: 'index' for a whole document, 'update' for a
+        # partial one.
+        return error.get('index') or error.get('update') or {}
+
+    def reconcile_upload_results(self, works, removed, docs, errors):
+        """Figure out which works were successfully mirrored to the
+        search index, given the results of a bulk upload.
+
+        Everything is looked up by Work ID, so this takes time
+        proportional to the size of the batch, not its square.
+
+        :param works: The Works that were meant to be updated.
+        :param removed: The Works that were removed from the search index.
+        :param docs: The search documents that were uploaded.
+        :param errors: The errors reported by the bulk upload.
+        :return: A 2-tuple (successes, failures), as with bulk_update().
+        """
+        works_by_id = dict(
+            (self._document_id(work.id), work) for work in works
+        )
+
+        error_ids = set()
+        error_failures = []
         for error in errors:
-            
-            error_id = get_error_id(error)
-            work = None
-            works_with_error = [work for work in works if work.id == error_id]
-            if works_with_error:
-                work = works_with_error[0]
+            error_id = self._error_document_id(error)
+            error_ids.add(error_id)
+            work = works_by_id.get(error_id)
 
-            exception = error.get('exception', None)
             error_message = error.get('error', None)
             if not error_message:
-                error_message = error.get('index', {}).get('error', None)
+                error_message = self._error_action(error).get('error', None)
 
-            failures.append((work, error_message))
+            error_failures.append((work, error_message))
 
-        self.log.info("Successfully indexed %i documents, failed to index %i." % (success_count, len(failures)))
+        removed_ids = set(self._document_id(work.id) for work in removed)
+        doc_ids = set(self._document_id(doc['_id']) for doc in docs)
 
+        successes = list(removed)
+        failures = []
+        for work in works:
+            work_id = self._document_id(work.id)
+            if work_id in error_ids or work_id in removed_ids:
+                continue
+            if work_id in doc_ids:
+                successes.append(work)
+            else:
+                # We weren't able to create a search document for
+                # this work, maybe because it doesn't have a
+                # presentation edition yet.
+                failures.append((work, "Work not indexed"))
+        failures.extend(error_failures)
         return successes, failures
 
     def remove_work(self, work):
@@ -711,10 +1696,16 @@ class ExternalSearchIndex(object):
                     id=work.id)
         if self.exists(**args):
             self.delete(**args)
+            self._result_cache.clear()
 
 class ExternalSearchIndexVersions(object):
 
-    VERSIONS = ['v2', 'v3']
+    # Deploying code with a new version here doesn't change the index
+    # that serves search queries. MigrateSearchIndexScript must be run
+    # to build the new version and move the -current alias onto it.
+    # Until then, features that need the new version's mapping are
+    # turned off (see ExternalSearchIndex.supports_lane_feeds).
+    VERSIONS = ['v2', 'v3', 'v4']
 
     @classmethod
     def latest(cls):
@@ -735,6 +1726,49 @@ class ExternalSearchIndexVersions(object):
             mapping["properties"][field] = field_description
         return mapping
 
+    @classmethod
+    def v4_body(cls):
+        """The v4 body is the same as the v3 except that the fields
+        used to sort lane feeds are mapped so they can be sorted on:
+        the sort title and author are not analyzed, and the dates are
+        dates. The flags used to filter and count works by
+        availability are booleans. Search suggestions are indexed by
+        every prefix, so they can be looked up as a patron types.
+        """
+        body = cls.v3_body()
+        analysis = body['settings']['analysis']
+        analysis['filter']['autocomplete_filter'] = {
+            "type": "edge_ngram",
+            "min_gram": 1,
+            "max_gram": ExternalSearchIndex.MAX_SUGGESTION_PREFIX,
+        }
+        analysis['analyzer']['autocomplete_analyzer'] = {
+            "type": "custom",
+            "tokenizer": "keyword",
+            "filter": ["lowercase", "asciifolding", "autocomplete_filter"]
+        }
+        analysis['analyzer']['autocomplete_search_analyzer'] = {
+            "type": "custom",
+            "tokenizer": "keyword",
+            "filter": ["lowercase", "asciifolding"]
+        }
+        mapping = body['mappings'][ExternalSearchIndex.work_document_type]
+        properties = mapping['properties']
+        for field in ('sort_title', 'sort_author'):
+            properties[field] = {"type": "string", "index": "not_analyzed"}
+        for field in ('availability_time', 'last_update_time'):
+            properties[field] = {"type": "date"}
+        for field in ('open_access', 'available'):
+            properties[field] = {"type": "boolean"}
+        properties['quality'] = {"type": "float"}
+        properties['suggestions'] = {
+            "type": "string",
+            "analyzer": "autocomplete_analyzer",
+            "search_analyzer": "autocomplete_search_analyzer",
+        }
+        properties['suggestion_weight'] = {"type": "integer"}
+        return body
+
     @classmethod
     def v3_body(cls):
         """The v3 body is the same as the v2 except for the inclusion of the
@@ -844,17 +1878,23 @@ class ExternalSearchIndexVersions(object):
         return dict(settings=settings, mappings=mappings)
 
     @classmethod
-    def create_new_version(cls, search_client, base_index_name, version=None):
-        """Creates an index for a new version
-
-        :return: True or False, indicating whether the index was created new.
+    def versioned_index_name(cls, base_index_name, version=None):
+        """The name of the index for the given version (by default,
+        the latest version).
         """
         if not version:
             version = cls.latest()
         if not version.startswith('v'):
             version = 'v%s' % version
+        return base_index_name+'-'+version
+
+    @classmethod
+    def create_new_version(cls, search_client, base_index_name, version=None):
+        """Creates an index for a new version
 
-        versioned_index = base_index_name+'-'+version
+        :return: True or False, indicating whether the index was created new.
+        """
+        versioned_index = cls.versioned_index_name(base_index_name, version)
         if search_client.indices.exists(index=versioned_index):
             return False
         else:
@@ -866,6 +1906,8 @@ class DummyExternalSearchIndex(ExternalSearchIndex):
 
     work_document_type = 'work-type'
 
+    supports_lane_feeds = True
+
     def __init__(self, url=None):
         self.url = url
         self.docs = {}
@@ -897,9 +1939,65 @@ class DummyExternalSearchIndex(ExternalSearchIndex):
             doc_ids = doc_ids[offset: offset + size]
         return { "hits" : { "hits" : doc_ids }}
 
+    def query_works_by_filter(self, *args, **kwargs):
+        self.queries.append((args, kwargs))
+        work_ids = sorted(key[2] for key in self.docs.keys())
+        offset = kwargs.get('offset', 0)
+        size = kwargs.get('size', 30)
+        return work_ids[offset:offset+size]
+
+    def facet_counts(self, *args, **kwargs):
+        self.queries.append((args, kwargs))
+        docs = self.docs.values()
+        def count(values):
+            counts = {}
+            for value in values:
+                if value is not None:
+                    counts[value] = counts.get(value, 0) + 1
+            return counts
+        genres = [genre.get('term') for doc in docs
+                  for genre in (doc.get('genres') or [])]
+        results = {
+            'total' : len(docs),
+            FacetConstants.AVAILABILITY_FACET_GROUP_NAME : {
+                FacetConstants.AVAILABLE_ALL : len(docs),
+                FacetConstants.AVAILABLE_NOW : len(
+                    [x for x in docs if x.get('available')]
+                ),
+                FacetConstants.AVAILABLE_OPEN_ACCESS : len(
+                    [x for x in docs if x.get('open_access')]
+                ),
+            },
+            FacetConstants.COLLECTION_FACET_GROUP_NAME : {
+                FacetConstants.COLLECTION_FULL : len(docs),
+            },
+        }
+        other_counts = {
+            self.LANGUAGE_COUNTS : count(x.get('language') for x in docs),
+            self.AUDIENCE_COUNTS : count(
+                self.AUDIENCES_BY_INDEXED_VALUE.get((x.get('audience') or '').lower())
+                for x in docs
+            ),
+            self.GENRE_COUNTS : count(genres),
+        }
+        for name in kwargs.get('counts') or []:
+            results[name] = other_counts[name]
+        return results
+
+    def suggest(self, prefix, library=None, limit=10):
+        self.queries.append(((prefix,), dict(library=library, limit=limit)))
+        trie = SuggestionTrie()
+        for doc in self.docs.values():
+            trie.add_document(doc)
+        return trie.suggest(prefix, limit)
+
     def bulk(self, docs, **kwargs):
         for doc in docs:
-            self.index(doc['_index'], doc['_type'], doc['_id'], doc)
+            if doc.get('_op_type') == 'update':
+                key = self._key(doc['_index'], doc['_type'], doc['_id'])
+                self.docs[key].update(doc['doc'])
+            else:
+                self.index(doc['_index'], doc['_type'], doc['_id'], doc)
         return len(docs), []
 
 
@@ -949,9 +2047,192 @@ class SearchIndexMonitor(WorkSweepMonitor):
             return 0
 
 
+class SearchIndexProgress(object):
+    """Keep track of how quickly search documents are being uploaded
+    by any number of SearchIndexRangeJobs.
+    """
+
+    def __init__(self, total=None):
+        """Constructor.
+
+        :param total: The number of documents expected to be
+            uploaded, if known.
+        """
+        self.start = time.time()
+        self.total = total
+        self.documents = 0
+        self.failures = 0
+        self.lock = RLock()
+        self.log = logging.getLogger("Search index rebuild")
+
+    def add(self, documents, failures=0):
+        with self.lock:
+            self.documents += documents
+            self.failures += failures
+
+    @property
+    def documents_per_second(self):
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0
+        return self.documents / elapsed
+
+    @property
+    def percent_complete(self):
+        if not self.total:
+            return None
+        return min(100.0, 100.0 * self.documents / self.total)
+
+    def report(self):
+        if self.total:
+            self.log.info(
+                "%d/%d search documents uploaded (%.1f%%), %d failures "
+                "(%.1f documents/sec).", self.documents, self.total, self.percent_complete,
+                self.failures, self.documents_per_second
+            )
+        else:
+            self.log.info(
+                "%d search documents uploaded, %d failures (%.1f documents/sec).",
+                self.documents, self.failures, self.documents_per_second
+            )
+
+
+class SearchDocumentUpload(Thread):
+    """Upload search documents created by
+    ExternalSearchIndex.create_search_documents() in the background.
+    """
+
+    def __init__(self, search_index_client, works, removed, docs):
+        super(SearchDocumentUpload, self).__init__()
+        self.daemon = True
+        self.search_index_client = search_index_client
+        self.works = works
+        self.removed = removed
+        self.docs = docs
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.search_index_client.upload_search_documents(
+                self.works, self.removed, self.docs
+            )
+        except Exception, e:
+            self.exc_info = sys.exc_info()
+
+    def finish(self):
+        """Wait for the upload to finish.
+
+        :return: A 2-tuple (successes, failures), as with
+            ExternalSearchIndex.bulk_update().
+        """
+        self.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SearchIndexRangeJob(DatabaseJob):
+    """Update the search index for every Work whose ID falls within a
+    given range.
+
+    While one batch of search documents is being uploaded to the
+    search index, the search documents for the next batch are created
+    in the database, so neither one sits idle waiting on the other.
+    """
+
+    def __init__(self, search_index_client, min_id, max_id, batch_size,
+                 progress=None, record_coverage=True):
+        """Constructor.
+
+        :param min_id: The lowest Work ID to cover.
+        :param max_id: The highest Work ID to cover.
+        :param progress: A SearchIndexProgress to notify as batches
+            are uploaded.
+        :param record_coverage: If this is False, no
+            WorkCoverageRecords will be created for the uploaded
+            works. This is appropriate when the index being built is
+            not the one the rest of the system is keeping up to date.
+        """
+        self.search_index_client = search_index_client
+        self.min_id = min_id
+        self.max_id = max_id
+        self.batch_size = batch_size
+        self.progress = progress
+        self.record_coverage = record_coverage
+        self.log = logging.getLogger("Search index rebuild")
+
+    def fetch_batch(self, _db, min_id):
+        return _db.query(Work).filter(
+            Work.id >= min_id
+        ).filter(
+            Work.id <= self.max_id
+        ).order_by(Work.id).limit(self.batch_size).all()
+
+    def do_run(self, _db):
+        # Each batch's upload is still looking at its Works after
+        # we've moved on and committed the previous batch's coverage
+        # records. If the commit expired those Works, the upload
+        # thread would go back to the database to reload them.
+        expire_on_commit = _db.expire_on_commit
+        _db.expire_on_commit = False
+        try:
+            self._run(_db)
+        finally:
+            _db.expire_on_commit = expire_on_commit
+
+    def _run(self, _db):
+        upload = None
+        min_id = self.min_id
+        while True:
+            batch = self.fetch_batch(_db, min_id)
+            if batch:
+                removed, docs = self.search_index_client.create_search_documents(
+                    batch
+                )
+
+            # Now that the database is done with this batch, finish
+            # the upload of the previous one.
+            if upload:
+                self.upload_finished(_db, upload)
+                upload = None
+
+            if not batch:
+                break
+            upload = SearchDocumentUpload(
+                self.search_index_client, batch, removed, docs
+            )
+            upload.start()
+            min_id = batch[-1].id + 1
+
+    def upload_finished(self, _db, upload):
+        successes, failures = upload.finish()
+        for work, message in failures:
+            self.log.error(
+                "Failed to update search index for %s: %s", work, message
+            )
+        if self.record_coverage:
+            operation = WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+            WorkCoverageRecord.bulk_add(successes, operation)
+            success_ids = set(work.id for work in successes)
+            hashes = self.search_index_client.content_hashes(
+                [doc for doc in upload.docs if doc['_id'] in success_ids]
+            )
+            WorkCoverageRecord.bulk_set_content_hash(_db, hashes, operation)
+        _db.commit()
+        if self.progress:
+            self.progress.add(len(upload.docs), len(failures))
+            self.progress.report()
+
+
 class SearchIndexCoverageProvider(WorkCoverageProvider):
     """Make sure all Works have up-to-date representation in the
     search index.
+
+    A content hash of each work's search document is kept on its
+    WorkCoverageRecord. A document that hasn't changed since it was
+    last uploaded isn't uploaded again, and a document where only the
+    availability fields have changed is updated in place.
     """
 
     SERVICE_NAME = 'Search index coverage provider'
@@ -966,15 +2247,60 @@ class SearchIndexCoverageProvider(WorkCoverageProvider):
         self.search_index_client = (
             search_index_client or ExternalSearchIndex(self._db)
         )
+        self._content_hashes = {}
 
     def process_batch(self, works):
         """
         :return: a mixed list of Works and CoverageFailure objects.
         """
-        successes, failures = self.search_index_client.bulk_update(works)
+        client = self.search_index_client
+        removed, docs = client.create_search_documents(works)
+        hashes = client.content_hashes(docs)
+        previous_hashes = WorkCoverageRecord.content_hashes(
+            self._db, [work.id for work in works], self.operation
+        )
+        docs, unchanged = client.changed_documents(
+            docs, hashes, previous_hashes
+        )
+        unchanged_works = [work for work in works if work.id in unchanged]
+        successes, failures = client.upload_search_documents(
+            [work for work in works if work.id not in unchanged],
+            removed, docs
+        )
+        if unchanged_works:
+            self.log.info(
+                "Skipped %d unchanged search documents.", len(unchanged_works)
+            )
+
+        # Once coverage records have been added for the successes,
+        # add_coverage_records_for() will store their new hashes.
+        # Removed works no longer have a search document, and there's
+        # no telling what state a failed work's document is in.
+        self._content_hashes = dict(
+            (work.id, hashes.get(work.id)) for work in successes
+        )
+        self._content_hashes.update(
+            (work.id, hashes.get(work.id)) for work in unchanged_works
+        )
+        WorkCoverageRecord.bulk_set_content_hash(
+            self._db, dict((work.id, None) for work, error in failures
+                           if work is not None),
+            self.operation
+        )
 
-        records = list(successes)
+        records = list(successes) + unchanged_works
         for (work, error) in failures:
             records.append(CoverageFailure(work, error))
 
         return records
+
+    def add_coverage_records_for(self, works):
+        records = super(SearchIndexCoverageProvider, self).add_coverage_records_for(
+            works
+        )
+        WorkCoverageRecord.bulk_set_content_hash(
+            self._db,
+            dict((work.id, self._content_hashes.get(work.id)) for work in works),
+            self.operation
+        )
+        return records
@@ -0,0 +1,365 @@
+"""A cache tier that sits in front of the `cachedfeeds` table.
+
+Every OPDS feed request goes through CachedFeed.fetch(). Without a
+FeedCache, that means loading the (potentially very large) content of
+the feed from the database every time. A FeedCache keeps copies of
+feed content somewhere cheaper to get at -- in process memory or on
+local disk -- so that the database only has to tell us _which_
+version of the feed is current.
+
+The `cachedfeeds` table remains the source of truth. Cached content
+is only used if it was stored for the same CachedFeed timestamp the
+database reports, so a feed regenerated by some other process will
+never be shadowed by an old copy.
+"""
+from nose.tools import set_trace
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import tempfile
+from threading import RLock
+
+from config import (
+    Configuration,
+    CannotLoadConfiguration,
+)
+
+
+class FeedCache(object):
+    """Keeps copies of CachedFeed content outside the database.
+
+    Subclasses implement _get(), _store() and _remove(); this class
+    takes care of finding the right implementation for the site's
+    configuration, checking timestamps, and keeping statistics.
+    """
+
+    FEED_CACHE_GOAL = u'feed_cache'
+
+    # Depending on the .protocol of the ExternalIntegration with
+    # .goal=FEED_CACHE_GOAL, a different subclass will be instantiated
+    # by for_database(). A subclass that wants to take advantage of
+    # this should add a mapping here from its .NAME to itself.
+    IMPLEMENTATION_REGISTRY = {}
+
+    # The total size of all cached feeds will be kept below this
+    # number of bytes, if the implementation is capable of enforcing
+    # such a limit.
+    MAX_SIZE = u'max_size_bytes'
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    # A FeedCache needs to live longer than any individual database
+    # session, so once we create one, we hold on to it for as long as
+    # the site configuration doesn't change.
+    RESET = object()
+    _instance = RESET
+    _instance_key = None
+    _instance_lock = RLock()
+
+    @classmethod
+    def reset(cls):
+        """Forget about any previously created FeedCache.
+
+        This method is primarily intended for use in testing.
+        """
+        with cls._instance_lock:
+            cls._instance = cls.RESET
+            cls._instance_key = None
+
+    @classmethod
+    def integration(cls, _db):
+        """Find the ExternalIntegration for the site-wide feed cache.
+
+        :return: An ExternalIntegration, or None if no feed cache is
+            configured.
+        """
+        from model import ExternalIntegration
+        integrations = _db.query(ExternalIntegration).filter(
+            ExternalIntegration.goal==cls.FEED_CACHE_GOAL
+        ).all()
+        if not integrations:
+            return None
+        if len(integrations) > 1:
+            # Much as with the storage integration, if there are
+            # multiple feed caches configured, none of them can be
+            # the site-wide feed cache.
+            logging.warn("Multiple feed cache integrations are configured.")
+            return None
+        [integration] = integrations
+        return integration
+
+    @classmethod
+    def for_database(cls, _db):
+        """Find the FeedCache to use with the given database.
+
+        :return: A FeedCache, or None if no feed cache is configured.
+        """
+        last_update = Configuration.site_configuration_last_update(_db)
+        if (cls._instance is not cls.RESET
+            and cls._instance_key == last_update):
+            return cls._instance
+
+        with cls._instance_lock:
+            instance = None
+            integration = cls.integration(_db)
+            if integration:
+                try:
+                    instance = cls.implementation(integration)
+                except CannotLoadConfiguration, e:
+                    logging.error(
+                        "Could not load feed cache configuration.",
+                        exc_info=e
+                    )
+            if (instance and cls._instance not in (None, cls.RESET)
+                and instance.signature == cls._instance.signature):
+                # The site configuration changed, but not in a way
+                # that affects the feed cache. Don't throw away a
+                # perfectly good cache.
+                instance = cls._instance
+            cls._instance = instance
+            cls._instance_key = last_update
+        return instance
+
+    @classmethod
+    def implementation(cls, integration):
+        """Instantiate the appropriate implementation of FeedCache
+        for the given ExternalIntegration.
+        """
+        implementation_class = cls.IMPLEMENTATION_REGISTRY.get(
+            integration.protocol
+        )
+        if not implementation_class:
+            raise CannotLoadConfiguration(
+                "Unrecognized feed cache protocol: %s" % integration.protocol
+            )
+        return implementation_class.from_integration(integration)
+
+    @classmethod
+    def from_integration(cls, integration):
+        max_size = integration.setting(cls.MAX_SIZE).int_value
+        return cls(max_size=max_size)
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.max_size = max_size
+        self.log = logging.getLogger("Feed cache")
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.bytes_stored = 0
+
+    @property
+    def signature(self):
+        """Two FeedCache objects with the same signature are
+        interchangeable.
+        """
+        return (self.__class__, self.max_size)
+
+    @classmethod
+    def key_string(cls, key):
+        """Turn a key tuple into a string."""
+        parts = []
+        for part in key:
+            if part is None:
+                part = u''
+            if not isinstance(part, unicode):
+                part = unicode(part)
+            parts.append(part.encode("utf8"))
+        return "\t".join(parts)
+
+    @classmethod
+    def timestamp_string(cls, timestamp):
+        return timestamp.isoformat()
+
+    def get(self, key, timestamp):
+        """Find the cached content of a feed.
+
+        :param key: A tuple uniquely identifying a feed; see
+            CachedFeed.feed_cache_key.
+        :param timestamp: The timestamp the database has for the feed.
+            Content cached for any other timestamp is out of date and
+            will not be returned.
+        :return: A Unicode string, or None if the feed is not cached.
+        """
+        if timestamp is None:
+            return None
+        key = self.key_string(key)
+        cached = self._get(key)
+        if cached:
+            cached_timestamp, content = cached
+            if cached_timestamp == self.timestamp_string(timestamp):
+                self.hits += 1
+                self.bytes_served += len(content)
+                return content.decode("utf8")
+        self.misses += 1
+        return None
+
+    def store(self, key, timestamp, content):
+        """Cache the content of a feed as of a given timestamp."""
+        if timestamp is None or content is None:
+            return
+        key = self.key_string(key)
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        self._store(key, self.timestamp_string(timestamp), content)
+        self.bytes_stored += len(content)
+
+    def remove(self, key):
+        """Remove a feed from the cache, if it's there."""
+        self._remove(self.key_string(key))
+
+    @property
+    def statistics(self):
+        """Summarize how useful this cache has been."""
+        return dict(
+            hits=self.hits, misses=self.misses,
+            bytes_served=self.bytes_served, bytes_stored=self.bytes_stored,
+        )
+
+    def _get(self, key):
+        """Look up a cached feed.
+
+        :return: A 2-tuple (timestamp string, UTF-8 encoded content),
+            or None.
+        """
+        raise NotImplementedError()
+
+    def _store(self, key, timestamp, content):
+        raise NotImplementedError()
+
+    def _remove(self, key):
+        raise NotImplementedError()
+
+
+class InMemoryFeedCache(FeedCache):
+    """Keep recently used feeds in process memory.
+
+    The least recently used feeds are evicted once the total size of
+    the cached content goes over the limit.
+    """
+
+    NAME = u'In-memory feed cache'
+
+    def __init__(self, max_size=None):
+        super(InMemoryFeedCache, self).__init__(max_size)
+        self._feeds = OrderedDict()
+        self._lock = RLock()
+        self.size = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        with self._lock:
+            cached = self._feeds.pop(key, None)
+            if cached:
+                # Move this feed to the most-recently-used end.
+                self._feeds[key] = cached
+            return cached
+
+    def _store(self, key, timestamp, content):
+        with self._lock:
+            self._remove(key)
+            if len(content) > self.max_size:
+                # This feed would push everything else out of the
+                # cache. Don't bother.
+                return
+            self._feeds[key] = (timestamp, content)
+            self.size += len(content)
+            while self.size > self.max_size:
+                ignore, (ignore, evicted) = self._feeds.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def _remove(self, key):
+        with self._lock:
+            cached = self._feeds.pop(key, None)
+            if cached:
+                self.size -= len(cached[1])
+
+    @property
+    def statistics(self):
+        statistics = super(InMemoryFeedCache, self).statistics
+        statistics.update(
+            size=self.size, feeds=len(self._feeds), evictions=self.evictions
+        )
+        return statistics
+
+FeedCache.IMPLEMENTATION_REGISTRY[InMemoryFeedCache.NAME] = InMemoryFeedCache
+
+
+class LocalDiskFeedCache(FeedCache):
+    """Keep feeds in files on local disk.
+
+    The cache is shared by every process on this host that's
+    configured to use the same directory. It does not enforce a size
+    limit; CachedFeedReaper will eventually delete the database rows
+    for old feeds, and the corresponding files are overwritten the
+    next time a feed with the same key is generated.
+    """
+
+    NAME = u'Local disk feed cache'
+
+    # The directory in which to store feeds.
+    DIRECTORY = u'directory'
+
+    @classmethod
+    def from_integration(cls, integration):
+        directory = integration.setting(cls.DIRECTORY).value
+        return cls(directory)
+
+    def __init__(self, directory=None):
+        super(LocalDiskFeedCache, self).__init__()
+        if not directory:
+            data_directory = Configuration.data_directory()
+            if not data_directory:
+                raise CannotLoadConfiguration(
+                    "No directory configured for the local disk feed cache."
+                )
+            directory = os.path.join(data_directory, 'feed_cache')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    @property
+    def signature(self):
+        return (self.__class__, self.directory)
+
+    def path(self, key):
+        """The file in which the feed with the given key is stored."""
+        filename = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, filename[:2], filename)
+
+    def _get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                timestamp = f.readline().strip()
+                return timestamp, f.read()
+        except IOError:
+            return None
+
+    def _store(self, key, timestamp, content):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process created the directory first.
+                pass
+
+        # Write to a temporary file and move it into place, so that
+        # no other process ever sees a partially written feed.
+        fd, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(timestamp + "\n")
+            f.write(content)
+        os.rename(temporary_path, path)
+
+    def _remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+FeedCache.IMPLEMENTATION_REGISTRY[LocalDiskFeedCache.NAME] = LocalDiskFeedCache
@@ -0,0 +1,14 @@
+-- Create a regular table that mirrors mv_works_for_lanes.
+--
+-- Once this table exists, lanes are built from it instead of from the
+-- materialized view, and it's kept up to date incrementally by
+-- MaterializedViewMirrorCoverageProvider. Drop the table to go back to
+-- refreshing the materialized view all at once.
+--
+-- The table starts out with the same columns and indexes as the
+-- materialized view.
+create table works_for_lanes (like mv_works_for_lanes including indexes);
+
+insert into works_for_lanes select * from mv_works_for_lanes;
+
+analyze works_for_lanes;
@@ -1,13 +1,22 @@
 from collections import defaultdict
 from nose.tools import set_trace
 import datetime
+from decimal import (
+    Decimal,
+    InvalidOperation,
+)
+import json
 import logging
 import random
 import time
 import urllib
 
 from psycopg2.extras import NumericRange
-from sqlalchemy.sql import select
+from sqlalchemy.sql import (
+    func,
+    select,
+    union_all,
+)
 from sqlalchemy.sql.expression import Select
 
 from config import Configuration
@@ -24,7 +33,11 @@ from sqlalchemy import (
     case,
     or_,
     not_,
+    Date,
+    DateTime,
     Integer,
+    Numeric,
+    String,
     Table,
     Unicode,
 )
@@ -43,7 +56,10 @@ from sqlalchemy.orm import (
     lazyload,
     relationship,
 )
-from sqlalchemy.sql.expression import literal
+from sqlalchemy.sql.expression import (
+    literal,
+    literal_column,
+)
 
 from entrypoint import (
     EntryPoint,
@@ -527,6 +543,131 @@ class Facets(FacetsWithEntryPoint):
             order_by_sorted = [order_by[0].desc()] + [x.asc() for x in order_by[1:]]
         return order_by_sorted, order_by
 
+    def sort_key(self, work):
+        """Find the values a MaterializedWorkWithGenre has for the
+        fields in the ORDER BY clause created by order_by().
+
+        :return: A list suitable for use as Pagination.key.
+        """
+        ignore, fields = self.order_by()
+        return [getattr(work, field.key) for field in fields]
+
+    # Dates in a sort key are serialized in one of these formats by
+    # Pagination.key_to_string().
+    SORT_KEY_DATETIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]
+    SORT_KEY_DATE_FORMAT = "%Y-%m-%d"
+
+    def parse_sort_key(self, key):
+        """Make sure a sort key, possibly from user input, fits the
+        ORDER BY clause created by order_by(), and convert each of its
+        values to the type of the corresponding field.
+
+        :param key: A list of values, as returned by sort_key() or
+            Pagination.key_from_string().
+        :return: A list of values, or None if `key` is for some other
+            sort order -- perhaps the client changed the sort order in
+            the middle of paging through a list.
+        :raise ValueError: If `key` has the right number of values,
+            but they can't be compared to the fields in the sort order.
+        """
+        ignore, fields = self.order_by()
+        if not isinstance(key, list) or len(key) != len(fields):
+            return None
+        return [self.parse_sort_key_value(field, value)
+                for field, value in zip(fields, key)]
+
+    @classmethod
+    def parse_sort_key_value(cls, field, value):
+        """Convert one value in a sort key to the type of `field`.
+
+        :raise ValueError: If `value` can't be compared to `field`.
+        """
+        if value is None:
+            return value
+        field_type = field.type
+        if isinstance(field_type, (DateTime, Date)):
+            if isinstance(value, (datetime.datetime, datetime.date)):
+                return value
+            if isinstance(value, basestring):
+                if isinstance(field_type, DateTime):
+                    formats = cls.SORT_KEY_DATETIME_FORMATS
+                else:
+                    formats = [cls.SORT_KEY_DATE_FORMAT]
+                for format in formats:
+                    try:
+                        parsed = datetime.datetime.strptime(value, format)
+                    except ValueError:
+                        continue
+                    if isinstance(field_type, DateTime):
+                        return parsed
+                    return parsed.date()
+        elif isinstance(field_type, (Integer, Numeric)):
+            if isinstance(value, bool):
+                pass
+            elif isinstance(field_type, Integer):
+                if isinstance(value, (int, long)):
+                    return value
+            elif isinstance(value, (int, long, float, Decimal)):
+                return value
+            elif isinstance(value, basestring):
+                # Pagination.key_to_string() turns a Decimal into a
+                # string.
+                try:
+                    return Decimal(value)
+                except InvalidOperation:
+                    pass
+        elif isinstance(field_type, String):
+            if isinstance(value, basestring):
+                return value
+        raise ValueError(
+            "Invalid value for %s in sort key: %r" % (field.key, value)
+        )
+
+    def keyset_clause(self, key):
+        """Create a clause that matches only the works which come after
+        the given sort key, in the order created by order_by().
+
+        This lets a query seek directly to a given page of results
+        without having the database count through every work on the
+        previous pages.
+
+        :param key: A list of values, as returned by sort_key().
+        :return: A SQLAlchemy clause, or None if `key` can't be used
+            with this sort order.
+        """
+        ignore, fields = self.order_by()
+        try:
+            key = self.parse_sort_key(key)
+        except ValueError:
+            key = None
+        if key is None:
+            return None
+
+        # Postgres puts NULLs after everything else in an ascending
+        # sort and before everything else in a descending sort.
+        def comes_after(field, value, ascending):
+            if ascending:
+                if value is None:
+                    return None
+                return or_(field > value, field == None)
+            if value is None:
+                return field != None
+            return field < value
+
+        # The work must match every field up to some point in the sort
+        # key, and come after the key on the next field.
+        clauses = []
+        equal_so_far = []
+        for i, (field, value) in enumerate(zip(fields, key)):
+            ascending = (i > 0 or self.order_ascending)
+            after = comes_after(field, value, ascending)
+            if after is not None:
+                clauses.append(and_(*(equal_so_far + [after])))
+            equal_so_far.append(field == value)
+        if not clauses:
+            return literal(False)
+        return or_(*clauses)
+
 
 class FeaturedFacets(FacetsWithEntryPoint):
 
@@ -664,24 +805,70 @@ class Pagination(object):
     def default(cls):
         return Pagination(0, cls.DEFAULT_SIZE)
 
-    def __init__(self, offset=0, size=DEFAULT_SIZE):
+    def __init__(self, offset=0, size=DEFAULT_SIZE, key=None):
         """Constructor.
 
         :param offset: Start pulling entries from the query at this index.
         :param size: Pull no more than this number of entries from the query.
+        :param key: The sort key of the last item on the previous page
+            (see Facets.sort_key). If this is present, and the query's
+            sort order supports it, the query will skip directly to the
+            items that come after this key, rather than having the
+            database count through `offset` items.
         """
         self.offset = offset
         self.size = size
+        self.key = key
         self.total_size = None
         self.this_page_size = None
+        self.last_item_key = None
+
+    @classmethod
+    def key_to_string(cls, key):
+        """Serialize a sort key for use in a URL."""
+        def convert(value):
+            if isinstance(value, (datetime.datetime, datetime.date)):
+                return value.isoformat()
+            return unicode(value)
+        return json.dumps(key, default=convert, separators=(',', ':'))
+
+    @classmethod
+    def key_from_string(cls, string):
+        """Parse a sort key serialized by key_to_string.
+
+        :raise ValueError: If `string` is not a serialized sort key.
+        """
+        key = json.loads(string)
+        if not isinstance(key, list):
+            raise ValueError("Sort key must be a list: %r" % key)
+        for value in key:
+            if not (value is None
+                    or isinstance(value, (basestring, int, long, float))):
+                raise ValueError("Invalid value in sort key: %r" % value)
+        return key
 
     def items(self):
         yield("after", self.offset)
         yield("size", self.size)
+        if self.key is not None:
+            yield("key", self.key_to_string(self.key))
 
     @property
     def query_string(self):
-       return "&".join("=".join(map(str, x)) for x in self.items())
+       return "&".join(
+           "=".join((k, urllib.quote(str(v)))) for k, v in self.items()
+       )
+
+    def page_loaded(self, page, facets=None):
+        """Take note of the items found on the current page.
+
+        :param page: A list of items obtained by running a query that
+            was modified by apply().
+        :param facets: The faceting object used to order the query.
+        """
+        self.this_page_size = len(page)
+        if page and isinstance(facets, Facets):
+            self.last_item_key = facets.sort_key(page[-1])
 
     @property
     def first_page(self):
@@ -689,7 +876,11 @@ class Pagination(object):
 
     @property
     def next_page(self):
-        return Pagination(self.offset+self.size, self.size)
+        # If we know the sort key of the last item on this page, the
+        # next page can be found by seeking past it.
+        return Pagination(
+            self.offset+self.size, self.size, key=self.last_item_key
+        )
 
     @property
     def previous_page(self):
@@ -722,8 +913,19 @@ class Pagination(object):
         # a next page.
         return True
 
-    def apply(self, qu):
-        """Modify the given query with OFFSET and LIMIT."""
+    def apply(self, qu, facets=None):
+        """Modify the given query with OFFSET and LIMIT.
+
+        :param facets: The faceting object that determined the order
+            of `qu`. If this Pagination has a sort key the faceting
+            object understands, the query is restricted to items after
+            that key, instead of using OFFSET.
+        """
+        keyset_clause = None
+        if self.key is not None and isinstance(facets, Facets):
+            keyset_clause = facets.keyset_clause(self.key)
+        if keyset_clause is not None:
+            return qu.filter(keyset_clause).limit(self.size)
         return qu.offset(self.offset).limit(self.size)
 
 
@@ -742,6 +944,14 @@ class WorkList(object):
     # By default, a WorkList does not draw from CustomLists
     uses_customlists = False
 
+    # The search index can only find the works in a WorkList if
+    # search_index_filter_arguments() describes every restriction on
+    # them. A subclass that restricts its works some other way, by
+    # overriding apply_filters() or bibliographic_filter_clause(),
+    # gets its feeds from the database unless it sets this to True
+    # itself.
+    supports_search_index_feeds = True
+
     @classmethod
     def top_level_for_library(self, _db, library):
         """Create a WorkList representing this library's collection
@@ -961,22 +1171,40 @@ class WorkList(object):
             if not child.visible:
                 continue
 
-            if isinstance(child, Lane):
-                # Children that turn out to be Lanes go into relevant_lanes.
-                # Their Works will all be filled in with a single query.
+            if (isinstance(child, WorkList)
+                and child._featured_works_can_be_batched()):
+                # Children that turn out to be WorkLists (including
+                # Lanes) go into relevant_lanes, unless they have
+                # their own ideas about what to feature. Their Works
+                # will all be filled in with a single query.
                 relevant_lanes.append(child)
-            # Both Lanes and WorkLists go into relevant_children.
+            # Every child goes into relevant_children.
             # This controls the yield order for Works.
             relevant_children.append(child)
 
         # _groups_for_lanes will run a query to pull featured works
-        # for any children that are Lanes, and call groups()
+        # for any children that are WorkLists, and call groups()
         # recursively for any children that are not.
         for work, worklist in self._groups_for_lanes(
                 _db, relevant_children, relevant_lanes, facets=facets
         ):
             yield work, worklist
 
+    @classmethod
+    def _featured_works_can_be_batched(cls):
+        """Can this WorkList's featured works be found as part of its
+        parent's grouped feed query?
+
+        Only if it uses the stock implementations of groups() and
+        featured_works(). A subclass that overrides either one gets
+        its groups() called the old-fashioned way.
+        """
+        groups = cls.groups.__func__
+        return (
+            groups in (WorkList.groups.__func__, Lane.groups.__func__)
+            and cls.featured_works.__func__ is WorkList.featured_works.__func__
+        )
+
     def default_featured_facets(self, _db):
         """Helper method to create a FeaturedFacets object."""
         library = self.get_library(_db)
@@ -985,13 +1213,16 @@ class WorkList(object):
             uses_customlists=self.uses_customlists
         )
 
-    def featured_works(self, _db, facets=None):
+    def featured_works(self, _db, facets=None, search_client=None):
         """Find a random sample of featured books.
 
         Used when building a grouped OPDS feed for this WorkList's parent.
 
         :param facets: A FeaturedFacets object.
 
+        :param search_client: An ExternalSearchIndex to use if the
+        library gets its lane feeds from the search index.
+
         :return: A list of MaterializedWorkWithGenre objects.  Under
         no circumstances will a single work show up multiple times in
         this list, even if that means the list contains fewer works
@@ -1004,6 +1235,15 @@ class WorkList(object):
         target_size = library.featured_lane_size
 
         facets = facets or self.default_featured_facets(_db)
+
+        search_client = self.lane_feed_search_client(_db, search_client)
+        if search_client:
+            work_ids = self.work_ids_from_search_index(
+                search_client, facets, size=target_size
+            )
+            if work_ids is not None:
+                return self.works_for_specific_ids(_db, work_ids)
+
         query = self.works(_db, facets=facets)
         if not query:
             # works() may return None, indicating that the whole
@@ -1013,7 +1253,7 @@ class WorkList(object):
 
         work_ids = set()
         works = []
-        for work in self.random_sample(query, target_size)[:target_size]:
+        for work in self.random_window_sample(query, target_size)[:target_size]:
             if isinstance(work, tuple):
                 # This is a (work, score) 2-tuple.
                 work = work[0]
@@ -1022,7 +1262,8 @@ class WorkList(object):
                 work_ids.add(work.works_id)
         return works
 
-    def works(self, _db, facets=None, pagination=None, include_quality_tier=False):
+    def works(self, _db, facets=None, pagination=None, include_quality_tier=False,
+              search_client=None):
         """Create a query against a materialized view that finds Work-like
         objects corresponding to all the Works that belong in this
         WorkList.
@@ -1030,11 +1271,17 @@ class WorkList(object):
         The apply_filters() implementation defines which Works qualify
         for membership in a WorkList of this type.
 
+        If the library gets its lane feeds from the search index, a
+        page of a feed is found in the search index instead, and the
+        query only looks up the works on that page.
+
         :param _db: A database connection.
         :param facets: A Facets object which may put additional
            constraints on WorkList membership.
         :param pagination: A Pagination object indicating which part of
            the WorkList the caller is looking at.
+        :param search_client: An ExternalSearchIndex to use if the
+           library gets its lane feeds from the search index.
         :return: A Query, or None if the WorkList is deemed to be a
            bad idea in the first place.
         """
@@ -1042,6 +1289,15 @@ class WorkList(object):
             MaterializedWorkWithGenre,
         )
         mw = MaterializedWorkWithGenre
+
+        if isinstance(facets, Facets) and pagination is not None:
+            search_client = self.lane_feed_search_client(_db, search_client)
+            if search_client:
+                work_ids = self.work_ids_from_search_index(
+                    search_client, facets, pagination.size, pagination.offset
+                )
+                if work_ids is not None:
+                    return self.works_for_specific_ids_query(_db, work_ids)
         # apply_filters() will apply the genre
         # restrictions.
 
@@ -1101,15 +1357,7 @@ class WorkList(object):
         # Get a list of MaterializedWorkWithGenre objects as though we
         # had called works().
         from model import MaterializedWorkWithGenre as mw
-        qu = _db.query(mw).join(
-            LicensePool, mw.license_pool_id==LicensePool.id
-        ).filter(
-            mw.works_id.in_(work_ids),
-            LicensePool.work_id.in_(work_ids),
-        ).enable_eagerloads(False)
-        qu = self._lazy_load(qu)
-        qu = self._defer_unused_fields(qu)
-        qu = self.only_show_ready_deliverable_works(_db, qu)
+        qu = self._specific_ids_query(_db, work_ids)
         qu = qu.distinct(mw.works_id)
         work_by_id = dict()
         a = time.time()
@@ -1128,6 +1376,226 @@ class WorkList(object):
         )
         return results
 
+    def works_for_specific_ids_query(self, _db, work_ids):
+        """Create a query that finds the specific MaterializedWorks
+        identified by `work_ids`, in the same order as `work_ids`.
+
+        This is what works() returns when a page of a feed was found
+        in the search index.
+        """
+        from model import MaterializedWorkWithGenre as mw
+        if not work_ids:
+            return _db.query(mw).filter(literal(False))
+        qu = self._specific_ids_query(_db, work_ids)
+        position = case(
+            [(mw.works_id==work_id, i) for i, work_id in enumerate(work_ids)]
+        )
+        return qu.order_by(position).distinct(position)
+
+    def _specific_ids_query(self, _db, work_ids):
+        from model import MaterializedWorkWithGenre as mw
+        qu = _db.query(mw).join(
+            LicensePool, mw.license_pool_id==LicensePool.id
+        ).filter(
+            mw.works_id.in_(work_ids),
+            LicensePool.work_id.in_(work_ids),
+        ).enable_eagerloads(False)
+        qu = self._lazy_load(qu)
+        qu = self._defer_unused_fields(qu)
+        return self.only_show_ready_deliverable_works(_db, qu)
+
+    # Lane feeds from the search index can be ordered by these facets.
+    SEARCH_INDEX_ORDER_FIELDS = {
+        Facets.ORDER_TITLE : 'sort_title',
+        Facets.ORDER_AUTHOR : 'sort_author',
+        Facets.ORDER_ADDED_TO_COLLECTION : 'availability_time',
+        Facets.ORDER_LAST_UPDATE : 'last_update_time',
+    }
+
+    @classmethod
+    def search_index_feeds_supported(cls):
+        """Can this class's feeds come from the search index?
+
+        :return: True only if supports_search_index_feeds is True, and
+            was set by the same class (or a subclass of the class)
+            that defines apply_filters() and
+            bibliographic_filter_clause().
+        """
+        def defined_by(name):
+            for klass in cls.__mro__:
+                if name in vars(klass):
+                    return klass
+        declared_by = defined_by('supports_search_index_feeds')
+        if not declared_by or not declared_by.supports_search_index_feeds:
+            return False
+        for hook in ('apply_filters', 'bibliographic_filter_clause'):
+            if not issubclass(declared_by, defined_by(hook)):
+                return False
+        return True
+
+    def lane_feed_search_client(self, _db, search_client=None):
+        """Decide whether this WorkList's feeds should come from the
+        search index rather than the database.
+
+        :param search_client: An ExternalSearchIndex to use instead of
+            the default one.
+        :return: An ExternalSearchIndex, or None if the feeds should
+            come from the database.
+        """
+        if not self.search_index_feeds_supported():
+            return None
+        library = self.get_library(_db)
+        if (not library or library.lane_feed_engine
+            != Configuration.LANE_FEED_ENGINE_SEARCH_INDEX):
+            return None
+        if search_client:
+            return search_client
+        from external_search import ExternalSearchIndex
+        return ExternalSearchIndex.for_lane_feeds(_db)
+
+    def search_index_filter_arguments(self):
+        """Describe the works in this WorkList as arguments to
+        ExternalSearchIndex.query_works().
+
+        :return: A dictionary, or None if this WorkList has
+            restrictions that the search index can't apply.
+        """
+        if self.audiences and (
+            Classifier.AUDIENCE_CHILDREN in self.audiences
+            or Classifier.AUDIENCE_YOUNG_ADULT in self.audiences
+        ):
+            # audience_filter_clauses() hides Project Gutenberg books
+            # from children, and search documents don't know where
+            # their books came from.
+            return None
+        if self.target_age:
+            target_age = numericrange_to_tuple(self.target_age)
+        else:
+            target_age = None
+        return dict(
+            media=self.media,
+            languages=self.languages,
+            fiction=self.fiction,
+            audiences=self.audiences,
+            target_age=target_age,
+            in_any_of_these_genres=self.genre_ids,
+            on_any_of_these_lists=self.customlist_ids,
+        )
+
+    def search_index_filters(self, search_client, entrypoint=None):
+        """Turn the restrictions on this WorkList into search index
+        filters.
+
+        :param entrypoint: Apply this EntryPoint's restrictions as well.
+        :return: A list of filters, or None if this WorkList has
+            restrictions that the search index can't apply.
+        """
+        if not self.search_index_feeds_supported():
+            return None
+        kwargs = self.search_index_filter_arguments()
+        if kwargs is None:
+            return None
+        if entrypoint:
+            kwargs = entrypoint.modified_search_arguments(**kwargs)
+        return [
+            search_client.make_filter(
+                self.collection_ids, kwargs['media'], kwargs['languages'],
+                kwargs['fiction'], kwargs['audiences'], kwargs['target_age'],
+                kwargs['in_any_of_these_genres'],
+                kwargs['on_any_of_these_lists'],
+            )
+        ]
+
+    def work_ids_from_search_index(self, search_client, facets, size,
+                                   offset=0):
+        """Find the works that belong in a feed for this WorkList by
+        running a filter query against the search index.
+
+        :param facets: A Facets object (for a page of a feed) or a
+            FeaturedFacets object (for a sample of featured works).
+        :return: A list of Work IDs, or None if the search index
+            can't be used to find this feed, in which case the
+            database should be used instead.
+        """
+        filters = self.search_index_filters(
+            search_client, getattr(facets, 'entrypoint', None)
+        )
+        if filters is None:
+            return None
+
+        kwargs = dict(size=size, offset=offset)
+        if isinstance(facets, FeaturedFacets):
+            if facets.uses_customlists:
+                # The search index doesn't know which works are
+                # featured on their lists.
+                return None
+            kwargs['featurable_quality'] = facets.minimum_featured_quality
+        elif isinstance(facets, Facets):
+            order = self.SEARCH_INDEX_ORDER_FIELDS.get(facets.order)
+            if order is None:
+                # The search index doesn't know how to sort this way.
+                return None
+            kwargs['order'] = order
+            kwargs['order_ascending'] = facets.order_ascending
+            kwargs['availability'] = facets.availability
+            if facets.collection == Facets.COLLECTION_MAIN:
+                kwargs['main_collection_only'] = True
+            elif facets.collection == Facets.COLLECTION_FEATURED:
+                kwargs['minimum_quality'] = (
+                    facets.library.minimum_featured_quality
+                )
+        else:
+            return None
+
+        try:
+            return search_client.query_works_by_filter(filters, **kwargs)
+        except elasticsearch.exceptions.ElasticsearchException, e:
+            logging.error(
+                "Could not get lane feed from the search index. Using the database instead.",
+                exc_info=e
+            )
+            return None
+
+    def facet_counts(self, _db, facets, search_client=None, counts=None):
+        """Count the works in this WorkList for each value of the
+        facets a patron might choose, using a single search index
+        request instead of a COUNT query for each value.
+
+        :param facets: A Facets object. Each count reflects the
+            facets already selected, other than the one being counted.
+        :param search_client: An ExternalSearchIndex to use instead of
+            the default one.
+        :param counts: Any other counts to compute, as described in
+            ExternalSearchIndex.facet_counts().
+        :return: A dictionary of counts as described in
+            ExternalSearchIndex.facet_counts(), or None if the counts
+            can't be obtained from the search index.
+        """
+        if not search_client:
+            from external_search import ExternalSearchIndex
+            search_client = ExternalSearchIndex.for_lane_feeds(_db)
+        if not search_client:
+            return None
+        filters = self.search_index_filters(
+            search_client, getattr(facets, 'entrypoint', None)
+        )
+        if filters is None:
+            return None
+        library = self.get_library(_db)
+        try:
+            return search_client.facet_counts(
+                filters, availability=facets.availability,
+                collection=facets.collection,
+                minimum_featured_quality=library.minimum_featured_quality,
+                counts=counts
+            )
+        except elasticsearch.exceptions.ElasticsearchException, e:
+            logging.error(
+                "Could not get facet counts from the search index.",
+                exc_info=e
+            )
+            return None
+
     def apply_filters(self, _db, qu, facets, pagination, featured=False):
         """Apply common WorkList filters to a query. Also apply any
         subclass-specific filters defined by
@@ -1160,7 +1628,7 @@ class WorkList(object):
             qu = qu.distinct(work_model.works_id)
 
         if pagination:
-            qu = pagination.apply(qu)
+            qu = pagination.apply(qu, facets)
 
         return qu
 
@@ -1239,6 +1707,43 @@ class WorkList(object):
             collection_ids=self.collection_ids
         )
 
+    @classmethod
+    def random_window_sample(cls, query, target_size, start=None):
+        """Take a random sample of high-quality items from a query,
+        using the precomputed `random` field instead of counting the
+        items and choosing a random OFFSET.
+
+        A random point is chosen along the `random` field, and the
+        sample is taken from the items just below that point. Since
+        WorkRandomnessUpdateMonitor periodically reassigns every
+        work's `random` value, the same point won't always select the
+        same works.
+
+        :param query: A query against MaterializedWorkWithGenre,
+            ordered by quality tier and then by `random` descending,
+            as FeaturedFacets.apply() does.
+        :param start: Start the sample at this value of the `random`
+            field, instead of at a randomly chosen point.
+        """
+        from model import MaterializedWorkWithGenre as work_model
+        if not query:
+            return []
+        if start is None:
+            # Work.random only has three decimal places.
+            start = round(random.random(), 3)
+
+        items = query.filter(
+            work_model.random <= start
+        ).limit(target_size).all()
+        if len(items) < target_size:
+            # There weren't enough items below the starting point.
+            # Wrap around to the top of the range.
+            items += query.filter(
+                work_model.random > start
+            ).limit(target_size-len(items)).all()
+        random.shuffle(items)
+        return items
+
     @classmethod
     def random_sample(self, query, target_size, quality_coefficient=0.1):
         """Take a random sample of high-quality items from a query.
@@ -1282,11 +1787,15 @@ class WorkList(object):
         return items
 
     @classmethod
-    def _lazy_load(cls, qu):
+    def _lazy_load(cls, qu, work_model=None):
         """Avoid eager loading of objects that are contained in the
         materialized view.
+
+        :param work_model: An alias for MaterializedWorkWithGenre,
+        if the query uses one.
         """
-        from model import MaterializedWorkWithGenre as work_model
+        if work_model is None:
+            from model import MaterializedWorkWithGenre as work_model
         return qu.options(
             lazyload(work_model.license_pool, LicensePool.data_source),
             lazyload(work_model.license_pool, LicensePool.identifier),
@@ -1294,13 +1803,17 @@ class WorkList(object):
         )
 
     @classmethod
-    def _defer_unused_fields(cls, query):
+    def _defer_unused_fields(cls, query, work_model=None):
         """Some applications use the simple OPDS entry and some
         applications use the verbose. Whichever one we don't need,
         we can stop from even being sent over from the
         database.
+
+        :param work_model: An alias for MaterializedWorkWithGenre,
+        if the query uses one.
         """
-        from model import MaterializedWorkWithGenre as work_model
+        if work_model is None:
+            from model import MaterializedWorkWithGenre as work_model
         if Configuration.DEFAULT_OPDS_FORMAT == "simple_opds_entry":
             return query.options(defer(work_model.verbose_opds_entry))
         else:
@@ -1453,17 +1966,17 @@ class WorkList(object):
                     yield (mw, lane)
             else:
                 # We didn't try to use the main query to find results
-                # for this lane because we knew the results, if there
-                # were any, wouldn't be representative. This is most
-                # likely because this 'lane' is a WorkList and not a
-                # Lane at all. Do a whole separate query and plug it
-                # in at this point.
+                # for this lane, most likely because this 'lane'
+                # isn't a WorkList at all and has its own idea of
+                # what its groups should be. Ask it for them and plug
+                # them in at this point.
                 for x in lane.groups(
                     _db, include_sublanes=False, facets=facets
                 ):
                     yield x
 
-    def _featured_works_with_lanes(self, _db, lanes, facets):
+    def _featured_works_with_lanes(self, _db, lanes, facets,
+                                   search_client=None):
         """Find a sequence of works that can be used to
         populate this lane's grouped acquisition feed.
 
@@ -1473,8 +1986,12 @@ class WorkList(object):
 
         :param facets: A faceting object, presumably a FeaturedFacets
 
+        :param search_client: An ExternalSearchIndex to use if the
+        library gets its lane feeds from the search index.
+
         :yield: A sequence of (MaterializedWorkWithGenre,
-        quality_tier, Lane) 3-tuples.
+        quality_tier, Lane) 3-tuples, grouped by Lane in the order
+        the Lanes were passed in.
         """
         if not lanes:
             # We can't run this query at all.
@@ -1485,13 +2002,130 @@ class WorkList(object):
 
         facets = facets or self.default_featured_facets(_db)
 
-        # Pull a window of works for every lane we were given.
+        # If the library gets its lane feeds from the search index,
+        # find as many lanes' works there as possible, then look them
+        # all up in a single query.
+        work_ids_by_lane = {}
+        search_client = self.lane_feed_search_client(_db, search_client)
+        if search_client:
+            for lane in lanes:
+                work_ids = lane.work_ids_from_search_index(
+                    search_client, facets, int(target_size*1.3)
+                )
+                if work_ids is not None:
+                    work_ids_by_lane[lane] = work_ids
+        database_lanes = [x for x in lanes if x not in work_ids_by_lane]
+
+        by_lane = defaultdict(list)
+        if work_ids_by_lane:
+            all_work_ids = set()
+            for work_ids in work_ids_by_lane.values():
+                all_work_ids.update(work_ids)
+            works_by_id = dict(
+                (mw.works_id, mw) for mw in
+                self.works_for_specific_ids(_db, list(all_work_ids))
+            )
+            for lane, work_ids in work_ids_by_lane.items():
+                by_lane[lane] = [
+                    (works_by_id[x], None) for x in work_ids
+                    if x in works_by_id
+                ]
+
+        if database_lanes:
+            query = self._featured_works_query(
+                _db, database_lanes, facets, target_size
+            )
+            if query is not None:
+                for mw, quality_tier, lane_index in query:
+                    by_lane[database_lanes[lane_index]].append(
+                        (mw, quality_tier)
+                    )
+
         for lane in lanes:
-            for mw, quality_tier in lane.works_in_window(
-                    _db, facets, target_size
-            ):
+            for mw, quality_tier in by_lane[lane]:
                 yield mw, quality_tier, lane
 
+    def _featured_works_query(self, _db, lanes, facets, target_size):
+        """Build a single query that finds a window of featured works
+        for every one of the given lanes.
+
+        Each lane's works_in_window() query becomes one branch of a
+        UNION ALL. Like works_in_window(), each branch orders its
+        lane's works by quality tier and then randomly, and only
+        keeps as many as might be featured. row_number() then puts
+        the surviving works in order within each lane, all without
+        leaving the database.
+
+        :return: A query that finds (MaterializedWorkWithGenre,
+        quality_tier, lane index) 3-tuples, or None if none of the
+        lanes can be queried.
+        """
+        from model import MaterializedWorkWithGenre as work_model
+
+        # A WorkList has no idea how big it is, so it can't pick a
+        # window of Work.random that will contain about the right
+        # number of works. Instead, choose a point along Work.random
+        # and rank the works below that point ahead of the works
+        # above it, so different works are featured each time. A
+        # Lane's window was already chosen randomly, so its works are
+        # ranked from the top of the window.
+        worklist_start = round(random.random(), 3)
+
+        def rotated(random_column, start):
+            return case(
+                [(random_column <= start, random_column)],
+                else_=random_column - 1
+            )
+
+        # Allow some overage to reduce the risk that we'll have to
+        # use a given book more than once in the overall feed, just
+        # as works_in_window() does.
+        limit = int(target_size*1.3)
+
+        quality = facets.quality_tier_field()
+        columns = list(work_model.__table__.columns)
+        branches = []
+        for index, lane in enumerate(lanes):
+            query = lane._restrict_query_to_window(
+                lane.works(_db, facets=facets), target_size
+            )
+            if query is None:
+                continue
+            if isinstance(lane, Lane):
+                start = 1
+            else:
+                start = worklist_start
+            window = query.with_entities(
+                *(columns + [quality])
+            ).order_by(None).subquery()
+            branch = select([
+                window,
+                literal_column("%.3f" % start, Numeric).label("random_start"),
+                literal_column(str(index), Integer).label("lane_index"),
+            ]).order_by(
+                window.c.quality_tier.desc(),
+                rotated(window.c.random, start).desc()
+            ).limit(limit)
+            branches.append(select([branch.alias()]))
+        if not branches:
+            return None
+
+        windows = union_all(*branches).alias("windows")
+        rank = func.row_number().over(
+            partition_by=windows.c.lane_index,
+            order_by=[
+                windows.c.quality_tier.desc(),
+                rotated(windows.c.random, windows.c.random_start).desc()
+            ]
+        ).label("rank")
+        ranked = select([windows, rank]).alias("ranked")
+
+        mw = aliased(work_model, ranked)
+        qu = _db.query(mw, ranked.c.quality_tier, ranked.c.lane_index)
+        qu = self._lazy_load(qu, mw)
+        qu = self._defer_unused_fields(qu, mw)
+        return qu.order_by(ranked.c.lane_index, ranked.c.rank)
+
     def works_in_window(self, _db, facets, target_size):
         """Find all MaterializedWorkWithGenre objects within a randomly
         selected window of values for the `random` field.
@@ -1522,6 +2156,18 @@ class WorkList(object):
         lane_query = lane_query.limit(target_size*1.3)
         return lane_query
 
+    def featured_window(self, target_size):
+        """Select an interval over `Work.random` that ought to contain
+        approximately `target_size` high-quality works from this
+        WorkList.
+
+        A WorkList doesn't know how many works it contains, so the
+        entire span is considered.
+
+        :return: A 2-tuple (low value, high value).
+        """
+        return 0, 1
+
     def _restrict_query_to_window(self, query, target_size):
         """Restrict the given SQLAlchemy query so that it matches
         approximately `target_size` items.
@@ -1633,6 +2279,10 @@ class Lane(Base, WorkList):
     # Lane is cacheable for twenty minutes by default.
     MAX_CACHE_AGE = 20*60
 
+    # search_index_filter_arguments() describes the restrictions
+    # applied by this class's bibliographic_filter_clause().
+    supports_search_index_feeds = True
+
     __tablename__ = 'lanes'
     id = Column(Integer, primary_key=True)
     library_id = Column(Integer, ForeignKey('libraries.id'), index=True,
@@ -2123,11 +2773,12 @@ class Lane(Base, WorkList):
 
         # We can use a single query to build the featured feeds for
         # this lane, as well as any of its sublanes that inherit this
-        # lane's restrictions. Lanes that don't inherit this lane's
-        # restrictions will need to be handled in a separate call to
-        # groups().
+        # lane's restrictions. A sublane that doesn't inherit this
+        # lane's restrictions can go into the same query as long as
+        # it would feature its own works in a grouped feed.
         queryable_lanes = [x for x in relevant_lanes
-                           if x == self or x.inherit_parent_restrictions]
+                           if x == self or x.inherit_parent_restrictions
+                           or x.include_self_in_grouped_feed]
         return self._groups_for_lanes(
             _db, relevant_lanes, queryable_lanes, facets=facets
         )
@@ -2144,6 +2795,33 @@ class Lane(Base, WorkList):
         else:
             return target.search(_db, query, search_client, media, pagination, languages, facets=facets)
 
+    def search_index_filter_arguments(self):
+        """Describe the works in this Lane as arguments to
+        ExternalSearchIndex.query_works().
+
+        :return: A dictionary, or None if this Lane has restrictions
+            that the search index can't apply.
+        """
+        if self.license_datasource or self.list_seen_in_previous_days:
+            # Search documents don't know where their books came
+            # from or when they were added to their lists.
+            return None
+        return super(Lane, self).search_index_filter_arguments()
+
+    def search_index_filters(self, search_client, entrypoint=None):
+        """Turn the restrictions on this Lane, and on any parent whose
+        restrictions it inherits, into search index filters.
+        """
+        filters = super(Lane, self).search_index_filters(
+            search_client, entrypoint
+        )
+        if filters is not None and self.parent and self.inherit_parent_restrictions:
+            parent_filters = self.parent.search_index_filters(search_client)
+            if parent_filters is None:
+                return None
+            filters = filters + parent_filters
+        return filters
+
     def bibliographic_filter_clause(self, _db, qu, featured, outer_join=False):
         """Create an AND clause that restricts a query to find
         only works classified in this lane.
@@ -1418,11 +1418,16 @@ class Metadata(MetaToModelUtility):
               replace_formats=False,
               replace_rights=False,
               force=False,
+              lookups=None,
     ):
         """Apply this metadata to the given edition.
 
         :param mirror: Open-access books and cover images will be mirrored
         to this MirrorUploader.
+        :param lookups: An object, such as an OPDSImportBatch, whose
+        contributor() and subject() methods find the Contributors and
+        Subjects this metadata refers to. If this is None, they're
+        looked up one at a time.
         :return: (edition, made_core_changes), where edition is the newly-updated object, and made_core_changes 
         answers the question: were any edition core fields harmed in the making of this update?  
         So, if title changed, return True.  
@@ -1490,7 +1495,8 @@ class Metadata(MetaToModelUtility):
         # Create equivalencies between all given identifiers and
         # the edition's primary identifier.
         contributors_changed = self.update_contributions(_db, edition, 
-                                  metadata_client, replace.contributions)
+                                  metadata_client, replace.contributions,
+                                  lookups=lookups)
         if contributors_changed:
             made_core_changes = True
 
@@ -1544,9 +1550,12 @@ class Metadata(MetaToModelUtility):
 
         # Apply all new subjects to the identifier.
         for subject in new_subjects.values():
+            found = None
+            if lookups:
+                found = lookups.subject(subject)
             identifier.classify(
                 data_source, subject.type, subject.identifier,
-                subject.name, weight=subject.weight)
+                subject.name, weight=subject.weight, subject=found)
 
         # Associate all links with the primary identifier.
         if replace.links and self.links is not None:
@@ -1745,7 +1754,7 @@ class Metadata(MetaToModelUtility):
 
 
     def update_contributions(self, _db, edition, metadata_client=None,
-                             replace=True):
+                             replace=True, lookups=None):
         contributors_changed = False
         old_contributors = []
         new_contributors = []
@@ -1771,8 +1780,11 @@ class Metadata(MetaToModelUtility):
             if (contributor_data.sort_name
                 or contributor_data.lc
                 or contributor_data.viaf):
+                name = contributor_data.sort_name
+                if lookups:
+                    name = lookups.contributor(contributor_data)
                 contributor = edition.add_contributor(
-                    name=contributor_data.sort_name,
+                    name=name,
                     roles=contributor_data.roles,
                     lc=contributor_data.lc,
                     viaf=contributor_data.viaf
@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN generation_time float;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.generation_time already exists, not creating it.';
+    END;
+  END;
+$$;
@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN recent_requests integer not null default 0;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.recent_requests already exists, not creating it.';
+    END;
+  END;
+$$;
@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE workcoveragerecords ADD COLUMN content_hash varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column workcoveragerecords.content_hash already exists, not creating it.';
+    END;
+  END;
+$$;
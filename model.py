@@ -48,6 +48,7 @@ from sqlalchemy.sql import select
 from sqlalchemy.orm import (
     backref,
     contains_eager,
+    deferred,
     joinedload,
     lazyload,
     mapper,
@@ -55,6 +56,7 @@ from sqlalchemy.orm import (
     sessionmaker,
     synonym,
 )
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.base import NO_VALUE
 from sqlalchemy.orm.exc import (
     NoResultFound,
@@ -71,6 +73,7 @@ from sqlalchemy.ext.hybrid import (
 )
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import (
+    bindparam,
     cast,
     and_,
     or_,
@@ -127,6 +130,11 @@ from util import (
     TitleProcessor,
 )
 from mirror import MirrorUploader
+from feed_cache import (
+    FeedCache,
+    InMemoryFeedCache,
+    LocalDiskFeedCache,
+)
 from util.http import (
     HTTP,
     RemoteIntegrationException,
@@ -326,6 +334,20 @@ class SessionManager(object):
         MATERIALIZED_VIEW_LANES : 'materialized_view_for_lanes.sql',
     }
 
+    # If this table exists, MaterializedWorkWithGenre is mapped onto
+    # it instead of onto MATERIALIZED_VIEW_LANES. It holds the same
+    # rows as the materialized view, but since it's a regular table,
+    # it can be kept up to date a few works at a time (see
+    # MaterializedViewMirrorCoverageProvider) rather than being
+    # refreshed all at once. It's created from the SQL in
+    # MATERIALIZED_VIEW_LANES_MIRROR_FILE.
+    MATERIALIZED_VIEW_LANES_MIRROR = 'works_for_lanes'
+    MATERIALIZED_VIEW_LANES_MIRROR_FILE = 'works_for_lanes_mirror.sql'
+
+    # This is set to True when MaterializedWorkWithGenre is mapped
+    # onto the mirror table.
+    uses_materialized_view_mirror = False
+
     # A function that calculates recursively equivalent identifiers
     # is also defined in SQL.
     RECURSIVE_EQUIVALENTS_FUNCTION = 'recursive_equivalents.sql'
@@ -414,9 +436,14 @@ class SessionManager(object):
             connection.close()
 
         if create_materialized_work_class:
+            lanes_table_name = cls.MATERIALIZED_VIEW_LANES
+            if engine.has_table(cls.MATERIALIZED_VIEW_LANES_MIRROR):
+                lanes_table_name = cls.MATERIALIZED_VIEW_LANES_MIRROR
+                cls.uses_materialized_view_mirror = True
+
             class MaterializedWorkWithGenre(Base, BaseMaterializedWork):
                 __table__ = Table(
-                    cls.MATERIALIZED_VIEW_LANES,
+                    lanes_table_name,
                     Base.metadata,
                     Column('works_id', Integer, primary_key=True, index=True),
                     Column('workgenres_id', Integer, primary_key=True, index=True),
@@ -449,12 +476,57 @@ class SessionManager(object):
         for view_name in self.MATERIALIZED_VIEWS.keys():
             _db.execute("refresh materialized view %s;" % view_name)
             _db.commit()
+        if self.uses_materialized_view_mirror:
+            self.update_materialized_view_mirror(_db)
+            _db.commit()
         # Immediately update the number of works associated with each
         # lane.
         from lane import Lane
         for lane in _db.query(Lane):
             lane.update_size(_db)
 
+    @classmethod
+    def update_materialized_view_mirror(cls, _db, work_ids=None):
+        """Bring rows in the mirror of the lanes materialized view up
+        to date.
+
+        This doesn't commit the transaction, so other processes will
+        keep seeing the old rows until the caller commits.
+
+        :param work_ids: Replace only the rows for these works,
+            calculating them from the materialized view's own
+            definition. By default, every row is replaced with a copy
+            of the corresponding row in the materialized view, which
+            should have just been refreshed.
+        """
+        mirror = cls.MATERIALIZED_VIEW_LANES_MIRROR
+        if work_ids is None:
+            _db.execute("delete from %s;" % mirror)
+            _db.execute(
+                "insert into %s select * from %s;" % (
+                    mirror, cls.MATERIALIZED_VIEW_LANES
+                )
+            )
+            return
+
+        if not work_ids:
+            return
+        work_ids = tuple(work_ids)
+        [[definition]] = _db.execute(
+            "select pg_get_viewdef(cast(:view as regclass));",
+            dict(view=cls.MATERIALIZED_VIEW_LANES)
+        )
+        definition = definition.strip().rstrip(";")
+        _db.execute(
+            "delete from %s where works_id in :work_ids;" % mirror,
+            dict(work_ids=work_ids)
+        )
+        _db.execute(
+            "insert into %s select * from (%s) as lanes_view "
+            "where lanes_view.works_id in :work_ids;" % (mirror, definition),
+            dict(work_ids=work_ids)
+        )
+
     @classmethod
     def session(cls, url, initialize_data=True):
         engine = connection = 0
@@ -1443,6 +1515,32 @@ class CoverageRecord(Base, BaseCoverageRecord):
             on_multiple='interchangeable',
         )
 
+    @classmethod
+    def lookup_for_identifiers(cls, _db, identifiers, data_source,
+                               operation=None, collection=None):
+        """Look up the CoverageRecords for many Identifiers at once.
+
+        The query is covered by one of the unique indexes on
+        (identifier_id, data_source_id, operation).
+
+        :return: A dictionary mapping Identifier IDs to CoverageRecords.
+        """
+        identifier_ids = [i.id for i in identifiers]
+        if not identifier_ids:
+            return dict()
+        if isinstance(data_source, basestring):
+            data_source = DataSource.lookup(_db, data_source)
+        collection_id = None
+        if collection:
+            collection_id = collection.id
+        qu = _db.query(cls).filter(
+            cls.identifier_id.in_(identifier_ids),
+            cls.data_source_id==data_source.id,
+            cls.operation==operation,
+            cls.collection_id==collection_id,
+        )
+        return dict((record.identifier_id, record) for record in qu)
+
     @classmethod
     def add_for(self, edition, data_source, operation=None, timestamp=None,
                 status=BaseCoverageRecord.SUCCESS, collection=None):
@@ -1584,6 +1682,7 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
     QUALITY_OPERATION = u'quality'
     GENERATE_OPDS_OPERATION = u'generate-opds'
     UPDATE_SEARCH_INDEX_OPERATION = u'update-search-index'
+    UPDATE_MATERIALIZED_VIEW_OPERATION = u'update-materialized-view'
 
     id = Column(Integer, primary_key=True)
     work_id = Column(Integer, ForeignKey('works.id'), index=True)
@@ -1594,6 +1693,12 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
     status = Column(BaseCoverageRecord.status_enum, index=True)
     exception = Column(Unicode, index=True)
 
+    # A summary of the output of the operation, as of the last time
+    # it succeeded. If the output hasn't changed, there's no need to
+    # do anything with it. See
+    # ExternalSearchIndex.content_hash() for an example.
+    content_hash = Column(Unicode)
+
     __table_args__ = (
         UniqueConstraint('work_id', 'operation'),
     )
@@ -1640,6 +1745,10 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
                  status=CoverageRecord.SUCCESS, exception=None):
         """Create and update WorkCoverageRecords so that every Work in
         `works` has an identical record.
+
+        Any content hash on the existing records is cleared, since
+        there's no way of knowing whether it's still accurate. Use
+        bulk_set_content_hash() to set new ones.
         """
         if not works:
             # Nothing to do.
@@ -1654,7 +1763,8 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
         update = WorkCoverageRecord.__table__.update().where(
             and_(WorkCoverageRecord.work_id.in_(work_ids),
                  WorkCoverageRecord.operation==operation)
-        ).values(dict(timestamp=timestamp, status=status, exception=exception))
+        ).values(dict(timestamp=timestamp, status=status, exception=exception,
+                      content_hash=None))
         _db.execute(update)
 
         # Make sure that any works that are missing a
@@ -1696,6 +1806,45 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
         )
         _db.execute(insert)
 
+    @classmethod
+    def content_hashes(cls, _db, work_ids, operation):
+        """Look up the content hashes recorded for the given works.
+
+        :return: A dictionary mapping Work IDs to content hashes.
+            Works with no content hash are left out.
+        """
+        if not work_ids:
+            return {}
+        qu = _db.query(
+            WorkCoverageRecord.work_id, WorkCoverageRecord.content_hash
+        ).filter(
+            WorkCoverageRecord.work_id.in_(work_ids)
+        ).filter(
+            WorkCoverageRecord.operation==operation
+        ).filter(
+            WorkCoverageRecord.content_hash != None
+        )
+        return dict(qu)
+
+    @classmethod
+    def bulk_set_content_hash(cls, _db, hashes, operation):
+        """Set the content hash of existing WorkCoverageRecords.
+
+        :param hashes: A dictionary mapping Work IDs to content
+            hashes. A hash of None clears the content hash.
+        """
+        if not hashes:
+            return
+        table = WorkCoverageRecord.__table__
+        update = table.update().where(
+            and_(table.c.work_id==bindparam('_work_id'),
+                 table.c.operation==operation)
+        ).values(content_hash=bindparam('_content_hash'))
+        _db.execute(update, [
+            dict(_work_id=work_id, _content_hash=content_hash)
+            for work_id, content_hash in hashes.items()
+        ])
+
 Index("ix_workcoveragerecords_operation_work_id", WorkCoverageRecord.operation, WorkCoverageRecord.work_id)
 
 class Equivalency(Base):
@@ -2286,7 +2435,7 @@ class Identifier(Base):
             value=value, weight=weight, is_most_recent=True)[0]
 
     def classify(self, data_source, subject_type, subject_identifier,
-                 subject_name=None, weight=1):
+                 subject_name=None, weight=1, subject=None):
         """Classify this Identifier under a Subject.
 
         :param type: Classification scheme; one of the constants from Subject.
@@ -2299,13 +2448,16 @@ class Identifier(Base):
                     book under this subject. The meaning of this
                     number depends entirely on the source of the
                     information.
+
+        ``subject``: The Subject, if it's already been looked up.
         """
         _db = Session.object_session(self)
         # Turn the subject type and identifier into a Subject.
         classifications = []
-        subject, is_new = Subject.lookup(
-            _db, subject_type, subject_identifier, subject_name,
-        )
+        if subject is None:
+            subject, is_new = Subject.lookup(
+                _db, subject_type, subject_identifier, subject_name,
+            )
 
         logging.debug(
             "CLASSIFICATION: %s on %s/%s: %s %s/%s (wt=%d)",
@@ -4792,6 +4944,7 @@ class Work(Base):
         WorkCoverageRecord.add_for(
             self, operation=WorkCoverageRecord.GENERATE_OPDS_OPERATION
         )
+        self.materialized_view_needs_updating()
 
     def external_index_needs_updating(self):
         """Mark this work as needing to have its search document reindexed.
@@ -4806,6 +4959,21 @@ class Work(Base):
         )
         return record
 
+    def materialized_view_needs_updating(self):
+        """Mark this work as needing to have its rows in the mirror of the
+        lanes materialized view replaced.
+
+        If the materialized view is refreshed all at once instead of
+        being mirrored, this does nothing.
+        """
+        if not SessionManager.uses_materialized_view_mirror:
+            return None
+        operation = WorkCoverageRecord.UPDATE_MATERIALIZED_VIEW_OPERATION
+        record, is_new = WorkCoverageRecord.add_for(
+            self, operation=operation, status=CoverageRecord.REGISTERED
+        )
+        return record
+
     def update_external_index(self, client, add_coverage_record=True):
         """Create a WorkCoverageRecord so that this work's
         entry in the search index can be modified or deleted.
@@ -4825,6 +4993,7 @@ class Work(Base):
         self.random = random.random()
         if not exclude_search:
             self.external_index_needs_updating()
+        self.materialized_view_needs_updating()
 
     def set_presentation_ready_based_on_content(self, search_index_client=None):
         """Set this work as presentation ready, if it appears to
@@ -4850,6 +5019,7 @@ class Work(Base):
             # processed, this work will be removed from the search
             # index.
             self.external_index_needs_updating()
+            self.materialized_view_needs_updating()
         else:
             self.set_presentation_ready(search_index_client=search_index_client)
 
@@ -5016,6 +5186,7 @@ class Work(Base):
              Work.quality,
              Work.rating,
              Work.popularity,
+             Work.last_update_time,
             ],
             Work.id.in_((w.id for w in works))
         ).select_from(
@@ -5057,6 +5228,23 @@ class Work(Base):
         ).alias("collections_subquery")
         collections_json = query_to_json_array(collections)
 
+        # These subqueries summarize the same LicensePools, so that
+        # lane feeds can be built from the search index.
+        owned_license_pools = and_(
+            LicensePool.work_id==work_id_column,
+            or_(LicensePool.open_access, LicensePool.licenses_owned>0)
+        )
+        open_access = select(
+            [func.bool_or(LicensePool.open_access)]
+        ).where(owned_license_pools).as_scalar()
+        availability_time = select(
+            [func.max(LicensePool.availability_time)]
+        ).where(owned_license_pools).as_scalar()
+        available = select(
+            [func.bool_or(or_(LicensePool.open_access,
+                              LicensePool.licenses_available>0))]
+        ).where(owned_license_pools).as_scalar()
+
         # This subquery gets CustomList IDs for all lists
         # that contain the work.
         customlists = select(
@@ -5180,6 +5368,10 @@ class Work(Base):
              works_alias.c.quality,
              works_alias.c.rating,
              works_alias.c.popularity,
+             works_alias.c.last_update_time,
+             open_access.label('open_access'),
+             availability_time.label('availability_time'),
+             available.label('available'),
 
              # Here are all the subqueries.
              collections_json.label("collections"),
@@ -6677,8 +6869,9 @@ class CachedFeed(Base):
     # A 'page' feed is associated with a set of values for pagination.
     pagination = Column(Unicode, nullable=False)
 
-    # The content of the feed.
-    content = Column(Unicode, nullable=True)
+    # The content of the feed. This is loaded only when needed, since
+    # a FeedCache may already have a copy.
+    content = deferred(Column(Unicode, nullable=True))
 
     # Every feed is associated with a Library.
     library_id = Column(
@@ -6689,17 +6882,50 @@ class CachedFeed(Base):
     work_id = Column(Integer, ForeignKey('works.id'),
         nullable=True, index=True)
 
+    # How long it took, in seconds, to generate the current content
+    # of the feed.
+    generation_time = Column(Float, nullable=True)
+
+    # How many times this feed has been requested recently. This is
+    # used to decide which feeds are most worth keeping warm.
+    recent_requests = Column(Integer, nullable=False, default=0)
+
     GROUPS_TYPE = u'groups'
     PAGE_TYPE = u'page'
     RECOMMENDATIONS_TYPE = u'recommendations'
     SERIES_TYPE = u'series'
     CONTRIBUTOR_TYPE = u'contributor'
 
+    # Postgres advisory locks are identified by a pair of integers.
+    # Locks taken out to regenerate a CachedFeed use this number as
+    # the first integer and the CachedFeed's ID as the second.
+    REGENERATION_LOCK_NAMESPACE = 6651
+
+    # Rather than update recent_requests every time a feed is
+    # requested, we count requests in memory and write the counts to
+    # the database once this many requests have piled up.
+    REQUEST_COUNT_BATCH_SIZE = 100
+    _request_counts = Counter()
+    _request_count_total = 0
+    _request_counts_lock = RLock()
+
     log = logging.getLogger("CachedFeed")
 
     @classmethod
     def fetch(cls, _db, lane, type, facets, pagination, annotator,
-              force_refresh=False, max_age=None):
+              force_refresh=False, max_age=None,
+              stale_while_revalidate=False):
+        """Find the CachedFeed for a given lane, facets and pagination.
+
+        :param stale_while_revalidate: If this is True and the cached
+            feed is out of date, it will be treated as usable unless
+            this process manages to become the (single) process
+            responsible for regenerating it.
+
+        :return: A 2-tuple (CachedFeed, usable). If `usable` is
+            False, the caller is expected to generate the feed and
+            call update() on the CachedFeed.
+        """
         from opds import AcquisitionFeed
         from lane import Lane, WorkList
         if max_age is None:
@@ -6714,51 +6940,29 @@ class CachedFeed(Base):
         if isinstance(max_age, int):
             max_age = datetime.timedelta(seconds=max_age)
 
-        unique_key = None
-        if lane and isinstance(lane, Lane):
-            lane_id = lane.id
-        else:
-            lane_id = None
-            unique_key = "%s-%s-%s" % (lane.display_name, lane.language_key, lane.audience_key)
-        work = None
-        if lane:
-            work = getattr(lane, 'work', None)
-        library = None
-        if lane and isinstance(lane, Lane):
-            library = lane.library
-        elif lane and isinstance(lane, WorkList):
-            library = lane.get_library(_db)
-
-        if facets:
-            facets_key = unicode(facets.query_string)
-        else:
-            facets_key = u""
-
-        if pagination:
-            pagination_key = unicode(pagination.query_string)
-        else:
-            pagination_key = u""
-
         # Get a CachedFeed object. We will either return its .content,
         # or update its .content.
-        constraint_clause = and_(cls.content!=None, cls.timestamp!=None)
         feed, is_new = get_one_or_create(
             _db, cls,
             on_multiple='interchangeable',
-            constraint=constraint_clause,
-            lane_id=lane_id,
-            unique_key=unique_key,
-            library=library,
-            work=work,
-            type=type,
-            facets=facets_key,
-            pagination=pagination_key)
+            constraint=cls._has_content_clause(),
+            **cls._lookup_kwargs(_db, lane, type, facets, pagination)
+        )
 
         if force_refresh is True:
             # No matter what, we've been directed to treat this
-            # cached feed as stale.
+            # cached feed as stale. This happens when a feed is
+            # regenerated behind the scenes, so it doesn't count
+            # as a request for the feed.
             return feed, False
 
+        cls.record_request(_db, feed)
+
+        if not is_new:
+            # If a FeedCache has a copy of this feed, use it rather
+            # than loading the content from the database.
+            feed.load_content(FeedCache.for_database(_db))
+
         if max_age is AcquisitionFeed.CACHE_FOREVER:
             # This feed is so expensive to generate that it must be cached
             # forever (unless force_refresh is True).
@@ -6792,15 +6996,198 @@ class CachedFeed(Base):
             if feed.timestamp and feed.content:
                 if feed.timestamp >= cutoff:
                     fresh = True
+                elif (stale_while_revalidate
+                      and not feed.lock_for_regeneration(_db)):
+                    # Some other process is regenerating this feed
+                    # right now. Rather than duplicate that work, serve
+                    # the stale version.
+                    fresh = True
             return feed, fresh
 
         # Either there is no cached feed or it's time to update it.
         return feed, False
 
-    def update(self, _db, content):
+    @classmethod
+    def find(cls, _db, lane, type, facets, pagination):
+        """Find the CachedFeed for a given lane, facets and
+        pagination, without creating one or counting a request for it.
+
+        :return: A CachedFeed with content, or None.
+        """
+        return get_one(
+            _db, cls,
+            on_multiple='interchangeable',
+            constraint=cls._has_content_clause(),
+            **cls._lookup_kwargs(_db, lane, type, facets, pagination)
+        )
+
+    @classmethod
+    def _has_content_clause(cls):
+        return and_(cls.content!=None, cls.timestamp!=None)
+
+    @classmethod
+    def _lookup_kwargs(cls, _db, lane, type, facets, pagination):
+        """Find the field values that identify the CachedFeed for a
+        given lane, facets and pagination.
+        """
+        from lane import Lane, WorkList
+        unique_key = None
+        if lane and isinstance(lane, Lane):
+            lane_id = lane.id
+        else:
+            lane_id = None
+            unique_key = "%s-%s-%s" % (lane.display_name, lane.language_key, lane.audience_key)
+        work = None
+        if lane:
+            work = getattr(lane, 'work', None)
+        library = None
+        if lane and isinstance(lane, Lane):
+            library = lane.library
+        elif lane and isinstance(lane, WorkList):
+            library = lane.get_library(_db)
+
+        if facets:
+            facets_key = unicode(facets.query_string)
+        else:
+            facets_key = u""
+
+        if pagination:
+            pagination_key = unicode(pagination.query_string)
+        else:
+            pagination_key = u""
+
+        return dict(
+            lane_id=lane_id,
+            unique_key=unique_key,
+            library=library,
+            work=work,
+            type=type,
+            facets=facets_key,
+            pagination=pagination_key,
+        )
+
+    @classmethod
+    def record_request(cls, _db, feed):
+        """Note that a patron asked for the given feed."""
+        if not feed.id:
+            return
+        with cls._request_counts_lock:
+            cls._request_counts[feed.id] += 1
+            cls._request_count_total += 1
+            if cls._request_count_total < cls.REQUEST_COUNT_BATCH_SIZE:
+                return
+            counts = cls._request_counts
+            cls._request_counts = Counter()
+            cls._request_count_total = 0
+        cls.write_request_counts(_db, counts)
+
+    @classmethod
+    def reset_request_counts(cls):
+        """Forget about any requests that haven't been written to the
+        database yet.
+
+        This method is primarily intended for use in testing.
+        """
+        with cls._request_counts_lock:
+            cls._request_counts = Counter()
+            cls._request_count_total = 0
+
+    @classmethod
+    def write_request_counts(cls, _db, counts):
+        """Add request counts to CachedFeed.recent_requests.
+
+        :param counts: A Counter mapping CachedFeed IDs to the number
+            of times the feed was requested.
+        """
+        # Group the feeds by how many requests they got, so that one
+        # UPDATE statement can take care of many feeds.
+        feed_ids_by_count = defaultdict(list)
+        for feed_id, count in counts.items():
+            feed_ids_by_count[count].append(feed_id)
+        table = cls.__table__
+        for count, feed_ids in feed_ids_by_count.items():
+            _db.execute(
+                table.update().where(table.c.id.in_(feed_ids)).values(
+                    recent_requests=table.c.recent_requests + count
+                )
+            )
+
+    @classmethod
+    def decay_request_counts(cls, _db):
+        """Halve every feed's request count, so that recent requests
+        count for more than old requests.
+        """
+        table = cls.__table__
+        _db.execute(
+            table.update().where(table.c.recent_requests > 0).values(
+                recent_requests=table.c.recent_requests / 2
+            )
+        )
+
+    @property
+    def feed_cache_key(self):
+        """The key under which a FeedCache stores this feed's content."""
+        return (
+            self.lane_id, self.unique_key, self.library_id, self.work_id,
+            self.type, self.facets, self.pagination
+        )
+
+    def load_content(self, feed_cache):
+        """Make sure this feed's .content is loaded, preferably from
+        the given FeedCache rather than from the database.
+        """
+        if not feed_cache:
+            return
+        content = feed_cache.get(self.feed_cache_key, self.timestamp)
+        if content is not None:
+            # Act as though this content had been loaded from the
+            # database, so it won't be written back.
+            set_committed_value(self, 'content', content)
+        else:
+            # Load the content from the database and keep a copy for
+            # next time.
+            feed_cache.store(
+                self.feed_cache_key, self.timestamp, self.content
+            )
+
+    def lock_for_regeneration(self, _db):
+        """Try to become the one process responsible for regenerating
+        this feed.
+
+        This takes out a Postgres advisory lock which is released
+        when the current transaction ends -- normally, right after
+        the new content is committed.
+
+        :return: True if this process holds the lock and should
+            regenerate the feed; False if another process holds it.
+        """
+        if not self.id:
+            return True
+        sql = text(
+            "SELECT pg_try_advisory_xact_lock(:namespace, :id)"
+        )
+        return _db.execute(
+            sql, dict(namespace=self.REGENERATION_LOCK_NAMESPACE, id=self.id)
+        ).scalar()
+
+    def update(self, _db, content, generation_time=None):
+        """Set new content for this feed.
+
+        :param generation_time: How long it took, in seconds, to
+            generate `content`.
+        """
         self.content = content
         self.timestamp = datetime.datetime.utcnow()
+        self.generation_time = generation_time
+        if generation_time is not None:
+            self.log.info(
+                "Regenerated %s feed for lane %s in %.2fsec",
+                self.type, self.lane_id or self.unique_key, generation_time
+            )
         flush(_db)
+        feed_cache = FeedCache.for_database(_db)
+        if feed_cache:
+            feed_cache.store(self.feed_cache_key, self.timestamp, content)
 
     def __repr__(self):
         if self.content:
@@ -9767,6 +10154,8 @@ class CustomList(Base):
         # list membership.
         if entry.work and update_external_index:
             entry.work.external_index_needs_updating()
+        if entry.work:
+            entry.work.materialized_view_needs_updating()
 
         return entry, was_new
 
@@ -9782,6 +10171,7 @@ class CustomList(Base):
                 # Make sure the Work's search document is updated to
                 # reflect its new list membership.
                 entry.work.external_index_needs_updating()
+                entry.work.materialized_view_needs_updating()
 
             _db.delete(entry)
 
@@ -10264,6 +10654,9 @@ class Library(Base, HasFullTableCache):
     # 'featured' lanes.
     FEATURED_LANE_SIZE = Configuration.FEATURED_LANE_SIZE
 
+    # Each library may choose where its lane feeds come from.
+    LANE_FEED_ENGINE = Configuration.LANE_FEED_ENGINE
+
     @property
     def allow_holds(self):
         """Does this library allow patrons to put items on hold?"""
@@ -10290,6 +10683,16 @@ class Library(Base, HasFullTableCache):
             value = 15
         return value
 
+    @property
+    def lane_feed_engine(self):
+        """Where this library's lane feeds come from: the database or
+        the search index.
+        """
+        value = self.setting(self.LANE_FEED_ENGINE).value
+        if value not in Configuration.LANE_FEED_ENGINES:
+            value = Configuration.LANE_FEED_ENGINE_DATABASE
+        return value
+
     @property
     def entrypoints(self):
         """The EntryPoints enabled for this library."""
@@ -10680,6 +11083,10 @@ class ExternalIntegration(Base, HasFullTableCache):
     # collect logs of server-side events.
     LOGGING_GOAL = u'logging'
 
+    # These integrations are associated with services that keep
+    # copies of CachedFeed content outside the database.
+    FEED_CACHE_GOAL = FeedCache.FEED_CACHE_GOAL
+
     # Supported protocols for ExternalIntegrations with LICENSE_GOAL.
     OPDS_IMPORT = u'OPDS Import'
     OVERDRIVE = DataSource.OVERDRIVE
@@ -10755,6 +11162,10 @@ class ExternalIntegration(Base, HasFullTableCache):
     INTERNAL_LOGGING = u'Internal logging'
     LOGGLY = u"Loggly"
 
+    # Integrations with FEED_CACHE_GOAL
+    IN_MEMORY_FEED_CACHE = InMemoryFeedCache.NAME
+    LOCAL_DISK_FEED_CACHE = LocalDiskFeedCache.NAME
+
     # Keys for common configuration settings
 
     # If there is a special URL to use for access to this API,
@@ -12101,7 +12512,8 @@ def _site_configuration_has_changed(_db, timeout=1):
         )
 
 # Certain ORM events, however they occur, indicate that a work's
-# external index needs updating.
+# external index (and, if it's being kept, its copy in the mirror of
+# the lanes materialized view) needs updating.
 
 @event.listens_for(LicensePool, 'after_delete')
 def licensepool_deleted(mapper, connection, target):
@@ -12111,6 +12523,7 @@ def licensepool_deleted(mapper, connection, target):
     work = target.work
     if work:
         record = work.external_index_needs_updating()
+        work.materialized_view_needs_updating()
 
 @event.listens_for(LicensePool.collection_id, 'set')
 def licensepool_collection_change(target, value, oldvalue, initiator):
@@ -12123,7 +12536,42 @@ def licensepool_collection_change(target, value, oldvalue, initiator):
     if value == oldvalue:
         return
     work.external_index_needs_updating()
+    work.materialized_view_needs_updating()
+
+
+@event.listens_for(LicensePool.work_id, 'set', active_history=True)
+def licensepool_work_id_change(target, value, oldvalue, initiator):
+    """A LicensePool contributes rows to the lanes materialized view
+    for its Work, so when it moves to a different Work, both Works'
+    rows in the mirror of the view need to be replaced.
+    """
+    if not SessionManager.uses_materialized_view_mirror:
+        return
+    if value == oldvalue:
+        return
+    _db = Session.object_session(target)
+    if not _db or _db._flushing:
+        # When LicensePool.work is set, work_id is only synced
+        # during the flush, and work_license_pools_change has already
+        # taken care of both Works.
+        return
+    for work_id in (oldvalue, value):
+        if not isinstance(work_id, (int, long)):
+            continue
+        work = _db.query(Work).get(work_id)
+        if work:
+            work.materialized_view_needs_updating()
 
+@event.listens_for(Work.license_pools, 'append')
+@event.listens_for(Work.license_pools, 'remove')
+def work_license_pools_change(target, value, initiator):
+    """Setting LicensePool.work changes Work.license_pools through the
+    backref, and the Work's rows in the lanes view change with it.
+    """
+    if not SessionManager.uses_materialized_view_mirror:
+        return
+    if Session.object_session(target):
+        target.materialized_view_needs_updating()
 
 @event.listens_for(LicensePool.licenses_owned, 'set')
 def licenses_owned_change(target, value, oldvalue, initiator):
@@ -12143,6 +12591,25 @@ def licenses_owned_change(target, value, oldvalue, initiator):
         return
     work.external_index_needs_updating()
 
+@event.listens_for(LicensePool.licenses_available, 'set')
+def licenses_available_change(target, value, oldvalue, initiator):
+    """A Work may need to have its search document re-indexed if one of
+    its LicensePools changes the number of licenses_available to or
+    from zero, since the search document says whether the Work is
+    available now.
+    """
+    work = target.work
+    if not work:
+        return
+    if target.open_access:
+        # Open-access works are always available.
+        return
+    if (value == oldvalue) or (value > 0 and oldvalue > 0):
+        # The availability of this LicensePool has not changed. No need
+        # to reindex anything.
+        return
+    work.external_index_needs_updating()
+
 @event.listens_for(LicensePool.open_access, 'set')
 def licensepool_open_access_change(target, value, oldvalue, initiator):
     """A Work may need to have its search document re-indexed if one of
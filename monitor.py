@@ -4,6 +4,7 @@ import os
 import logging
 import time
 import traceback
+from threading import RLock
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import (
     or_,
@@ -25,13 +26,19 @@ from model import (
     ExternalIntegration,
     CustomListEntry,
     Identifier,
+    Library,
     LicensePool,
     PresentationCalculationPolicy,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
     WorkCoverageRecord,
 )
+from util.worker_pools import (
+    DatabaseJob,
+    DatabasePool,
+)
 
 
 class Monitor(object):
@@ -617,6 +624,18 @@ class WorkRandomnessUpdateMonitor(WorkSweepMonitor):
         new_offset = offset + self.batch_size
         text = "update works set random=random() where id >= :offset and id < :new_offset;"
         self._db.execute(text, dict(offset=offset, new_offset=new_offset))
+        if SessionManager.uses_materialized_view_mirror:
+            # Featured works are sampled from the mirror of the lanes
+            # materialized view, so copy the new values over in the
+            # same transaction rather than waiting for the mirror to
+            # be rebuilt.
+            mirror = SessionManager.MATERIALIZED_VIEW_LANES_MIRROR
+            text = ("update %s set random=works.random from works "
+                    "where %s.works_id=works.id "
+                    "and works.id >= :offset and works.id < :new_offset;") % (
+                        mirror, mirror
+                    )
+            self._db.execute(text, dict(offset=offset, new_offset=new_offset))
         [[self.max_work_id]] = self._db.execute('select max(id) from works')
         if self.max_work_id < new_offset:
             # We're all done.
@@ -706,3 +725,243 @@ class CredentialReaper(ReaperMonitor):
     TIMESTAMP_FIELD = 'expires'
     MAX_AGE = 1
 ReaperMonitor.REGISTRY.append(CredentialReaper)
+
+
+class CachedFeedWarmer(Monitor):
+    """Regenerate grouped feeds and first-page feeds shortly before
+    they expire, so that patrons almost never have to wait for a feed
+    to be generated.
+
+    Every visible lane of every library is considered. Lanes whose
+    feeds have been requested most often recently are warmed first.
+    """
+    SERVICE_NAME = "Cached Feed Warmer"
+    INTERVAL_SECONDS = 60 * 5
+
+    # A feed will be regenerated if it will expire within this many
+    # seconds.
+    WARMING_WINDOW = 60 * 10
+
+    DEFAULT_WORKER_SIZE = 4
+
+    def __init__(self, _db, annotator_factory, worker_size=None,
+                 warming_window=None, pool=None):
+        """Constructor.
+
+        :param annotator_factory: A callable that takes a lane and
+            returns the Annotator to use when generating its feeds.
+        :param warming_window: Regenerate feeds that will expire within
+            this number of seconds.
+        :param pool: A DatabasePool (or other) object for use in testing
+            environments.
+        """
+        super(CachedFeedWarmer, self).__init__(_db)
+        self.annotator_factory = annotator_factory
+        self.worker_size = worker_size or self.DEFAULT_WORKER_SIZE
+        if warming_window is None:
+            warming_window = self.WARMING_WINDOW
+        if isinstance(warming_window, int):
+            warming_window = datetime.timedelta(seconds=warming_window)
+        self.warming_window = warming_window
+        self.session_factory = SessionManager.sessionmaker(session=_db)
+        self.pool = pool
+        self.warmed = []
+        self._warmed_lock = RLock()
+
+    def run_once(self, start, cutoff):
+        jobs = self.jobs()
+
+        # Without a commit, the queries used to find the jobs may
+        # block the worker threads.
+        self._db.commit()
+
+        self.warmed = []
+        started_at = time.time()
+        with (
+            self.pool or DatabasePool(self.worker_size, self.session_factory)
+        ) as job_queue:
+            for job in jobs:
+                job_queue.put(job)
+        elapsed = time.time() - started_at
+
+        # Old requests should count for less the next time we decide
+        # which lanes to warm first.
+        CachedFeed.decay_request_counts(self._db)
+
+        total_generation_time = sum(x[2] for x in self.warmed)
+        self.log.info(
+            "Warmed %d of %d feeds in %.2f sec (%.2f sec of generation time).",
+            len(self.warmed), len(jobs), elapsed, total_generation_time
+        )
+
+    def record_warmed(self, lane_name, type, elapsed):
+        """Note that a feed was regenerated.
+
+        This is called from worker threads.
+        """
+        with self._warmed_lock:
+            self.warmed.append((lane_name, type, elapsed))
+        self.log.debug(
+            "Warmed %s feed for %s in %.2f sec", type, lane_name, elapsed
+        )
+
+    def jobs(self):
+        """Find every feed that needs warming.
+
+        :return: A list of CachedFeedWarmingJobs, most popular lanes
+            first.
+        """
+        from lane import (
+            Facets,
+            Lane,
+            Pagination,
+        )
+        from opds import AcquisitionFeed
+        lane_requests, worklist_requests = self.request_counts()
+        grouped_max_age = AcquisitionFeed.grouped_max_age(self._db)
+        page_max_age = AcquisitionFeed.nongrouped_max_age(self._db)
+
+        jobs = []
+        for library in self._db.query(Library):
+            for lane in self.lanes(library):
+                if isinstance(lane, Lane):
+                    lane_id = lane.id
+                    requests = lane_requests.get(lane_id, 0)
+                else:
+                    lane_id = None
+                    requests = worklist_requests.get(library.id, 0)
+
+                if lane.children:
+                    # If the lane doesn't have enough works for a
+                    # grouped feed, AcquisitionFeed.groups() files a
+                    # page feed with the default facets and pagination
+                    # under the groups type instead.
+                    facets = lane.default_featured_facets(self._db)
+                    fallback = (Facets.default(library), Pagination.default())
+                    if self.needs_warming(
+                        lane, CachedFeed.GROUPS_TYPE, facets, None,
+                        grouped_max_age, fallback=fallback
+                    ):
+                        jobs.append(CachedFeedWarmingJob(
+                            self, library, lane_id, CachedFeed.GROUPS_TYPE,
+                            requests
+                        ))
+
+                facets = Facets.default(library)
+                pagination = Pagination.default()
+                if self.needs_warming(
+                    lane, CachedFeed.PAGE_TYPE, facets, pagination,
+                    page_max_age
+                ):
+                    jobs.append(CachedFeedWarmingJob(
+                        self, library, lane_id, CachedFeed.PAGE_TYPE,
+                        requests
+                    ))
+
+        # The most popular lanes get warmed first. A stable sort
+        # keeps each lane's grouped feed ahead of its page feed.
+        jobs.sort(key=lambda job: -job.requests)
+        return jobs
+
+    def lanes(self, library):
+        """Yield every visible lane in a library's lane tree, starting
+        with the top-level WorkList.
+        """
+        from lane import WorkList
+        queue = [WorkList.top_level_for_library(self._db, library)]
+        while queue:
+            lane = queue.pop(0)
+            if not lane.visible:
+                continue
+            yield lane
+            queue.extend(lane.children)
+
+    def request_counts(self):
+        """Find out how often each lane's feeds were requested recently.
+
+        :return: A 2-tuple of dictionaries. The first maps Lane IDs
+            to request counts. The second maps Library IDs to request
+            counts for the library's top-level WorkList.
+        """
+        qu = self._db.query(
+            CachedFeed.lane_id, CachedFeed.library_id,
+            func.sum(CachedFeed.recent_requests)
+        ).filter(
+            CachedFeed.type.in_([CachedFeed.GROUPS_TYPE, CachedFeed.PAGE_TYPE])
+        ).group_by(CachedFeed.lane_id, CachedFeed.library_id)
+        lanes = dict()
+        worklists = dict()
+        for lane_id, library_id, requests in qu:
+            if lane_id is None:
+                # Feeds with no lane belong to a WorkList.
+                worklists[library_id] = worklists.get(library_id, 0) + requests
+            else:
+                lanes[lane_id] = lanes.get(lane_id, 0) + requests
+        return lanes, worklists
+
+    def needs_warming(self, lane, type, facets, pagination, max_age,
+                      fallback=None):
+        """Will this feed be missing or out of date by the end of the
+        warming window?
+
+        :param fallback: A 2-tuple (facets, pagination) under which
+            the feed may have been cached instead. If the feed is
+            cached under both, the newer one counts.
+        """
+        from opds import AcquisitionFeed
+        feeds = [CachedFeed.find(self._db, lane, type, facets, pagination)]
+        if fallback:
+            feeds.append(CachedFeed.find(self._db, lane, type, *fallback))
+        feeds = [x for x in feeds if x]
+        if not feeds:
+            return True
+        feed = max(feeds, key=lambda x: x.timestamp)
+        if max_age is AcquisitionFeed.CACHE_FOREVER:
+            return False
+        if isinstance(max_age, int):
+            max_age = datetime.timedelta(seconds=max_age)
+        expires = feed.timestamp + max_age
+        return expires < datetime.datetime.utcnow() + self.warming_window
+
+
+class CachedFeedWarmingJob(DatabaseJob):
+    """Regenerate one feed on behalf of CachedFeedWarmer."""
+
+    def __init__(self, warmer, library, lane_id, type, requests=0):
+        self.warmer = warmer
+        self.library_id = library.id
+        self.lane_id = lane_id
+        self.type = type
+        self.requests = requests
+
+    def lane(self, _db):
+        """Find this job's lane in the worker's database session."""
+        from lane import (
+            Lane,
+            WorkList,
+        )
+        if self.lane_id is None:
+            library = get_one(_db, Library, id=self.library_id)
+            return WorkList.top_level_for_library(_db, library)
+        return get_one(_db, Lane, id=self.lane_id)
+
+    def do_run(self, _db):
+        from opds import AcquisitionFeed
+        lane = self.lane(_db)
+        annotator = self.warmer.annotator_factory(lane)
+        start = time.time()
+        if self.type == CachedFeed.GROUPS_TYPE:
+            url = annotator.groups_url(lane)
+            AcquisitionFeed.groups(
+                _db, lane.display_name, url, lane, annotator,
+                force_refresh=True
+            )
+        else:
+            url = annotator.feed_url(lane)
+            AcquisitionFeed.page(
+                _db, lane.display_name, url, lane, annotator,
+                force_refresh=True
+            )
+        self.warmer.record_warmed(
+            lane.display_name, self.type, time.time() - start
+        )
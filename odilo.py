@@ -221,14 +221,16 @@ class OdiloAPI(object):
             expires_in = (odilo_data['expiresIn'] * 0.9)
             credential.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
 
-    def get_metadata(self, record_id):
+    def get_metadata(self, record_id, exception_on_401=False):
         identifier = record_id
         if isinstance(record_id, Identifier):
             identifier = record_id.identifier
 
         url = self.RECORD_METADATA_ENDPOINT.format(recordId=identifier)
 
-        status_code, headers, content = self.get(url)
+        status_code, headers, content = self.get(
+            url, exception_on_401=exception_on_401
+        )
         if status_code == 200 and content:
             return content
         else:
@@ -238,9 +240,11 @@ class OdiloAPI(object):
             self.log.warn(msg)
             return None
 
-    def get_availability(self, record_id):
+    def get_availability(self, record_id, exception_on_401=False):
         url = self.RECORD_AVAILABILITY_ENDPOINT.format(recordId=record_id)
-        status_code, headers, content = self.get(url)
+        status_code, headers, content = self.get(
+            url, exception_on_401=exception_on_401
+        )
         content = json.loads(content)
 
         if status_code == 200 and len(content) > 0:
@@ -577,6 +581,9 @@ class OdiloBibliographicCoverageProvider(BibliographicCoverageProvider):
     PROTOCOL = ExternalIntegration.ODILO
     INPUT_IDENTIFIER_TYPES = Identifier.ODILO_ID
 
+    # Look up this many books at once.
+    DEFAULT_CONCURRENCY = 5
+
     def __init__(self, collection, api_class=OdiloAPI, **kwargs):
         """Constructor.
 
@@ -610,16 +617,33 @@ class OdiloBibliographicCoverageProvider(BibliographicCoverageProvider):
             analytics=Analytics(self._db)
         )
 
+    def fetch_item(self, record_id):
+        # If the Bearer Token needs to be refreshed, that will happen
+        # when the item is processed.
+        return self.lookup(record_id, exception_on_401=True)
+
+    def lookup(self, record_id, exception_on_401=False):
+        """Retrieve a record's metadata and availability.
+
+        :return: A 2-tuple (record, availability).
+        """
+        record = self.api.get_metadata(record_id, exception_on_401)
+        availability = None
+        if record:
+            availability = self.api.get_availability(
+                record_id, exception_on_401
+            )
+        return record, availability
+
     def process_item(self, record_id, record=None):
-        if not record:
-            record = self.api.get_metadata(record_id)
+        if record:
+            availability = self.api.get_availability(record_id)
+        else:
+            record, availability = self.fetched(record_id, self.lookup)
 
         if not record:
             return self.failure(record_id, 'Record not found', transient=False)
 
-        # Retrieve availability
-        availability = self.api.get_availability(record_id)
-
         metadata, is_active = OdiloRepresentationExtractor.record_info_to_metadata(record, availability)
         if not metadata:
             e = "Could not extract metadata from Odilo data: %s" % record_id
@@ -7,6 +7,7 @@ from urlparse import urlparse, urljoin
 import copy
 import datetime
 import feedparser
+import itertools
 import logging
 import md5
 import os
@@ -19,6 +20,9 @@ import urllib
 
 from nose.tools import set_trace
 
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.query import Query
 from sqlalchemy.sql.expression import func
 from sqlalchemy.orm.session import Session
@@ -36,6 +40,7 @@ from model import (
     BaseMaterializedWork,
     CachedFeed,
     ConfigurationSetting,
+    Contribution,
     Contributor,
     CustomList,
     CustomListEntry,
@@ -44,9 +49,12 @@ from model import (
     Resource,
     Identifier,
     Edition,
+    LicensePool,
+    LicensePoolDeliveryMechanism,
     Measurement,
     Subject,
     Work,
+    WorkGenre,
 )
 from lane import (
     Facets,
@@ -79,6 +87,28 @@ class Annotator(object):
 
     opds_cache_field = Work.simple_opds_entry.name
 
+    # This is True if annotate_work_entry() only adds tags to the end
+    # of an entry, without looking at what's already there. That lets
+    # AcquisitionFeed annotate an empty <entry> and splice the new tags
+    # into a work's cached OPDS entry, instead of parsing the cached
+    # entry and serializing it all over again.
+    #
+    # It only counts when set by the class that implements
+    # annotate_work_entry(), so a subclass that overrides
+    # annotate_work_entry() has to set it again; see
+    # only_appends_to_entries().
+    appends_to_entries = True
+
+    @classmethod
+    def only_appends_to_entries(cls):
+        """Can this annotator's entries be built from cached entries
+        without parsing them?
+        """
+        for klass in cls.__mro__:
+            if 'annotate_work_entry' in vars(klass):
+                return vars(klass).get('appends_to_entries', False)
+        return False
+
     def annotate_work_entry(self, work, active_license_pool, edition,
                             identifier, feed, entry, updated=None):
         """Make any custom modifications necessary to integrate this
@@ -448,6 +478,8 @@ class VerboseAnnotator(Annotator):
 
     opds_cache_field = Work.verbose_opds_entry.name
 
+    appends_to_entries = True
+
     def annotate_work_entry(self, work, active_license_pool, edition,
                             identifier, feed, entry):
         super(VerboseAnnotator, self).annotate_work_entry(
@@ -555,16 +587,32 @@ class AcquisitionFeed(OPDSFeed):
     FEED_CACHE_TIME = int(Configuration.get('default_feed_cache_time', 600))
     NO_CACHE = object()
 
+    # Set to True while add_entries() is adding entries to the feed.
+    use_entry_fragments = False
+
+    # When a feed is streamed, this many works are turned into
+    # entries at a time.
+    STREAMING_BATCH_SIZE = 100
+
     @classmethod
     def groups(cls, _db, title, url, lane, annotator,
-               cache_type=None, force_refresh=False, facets=None):
+               cache_type=None, force_refresh=False, facets=None,
+               stale_while_revalidate=None):
         """The acquisition feed for 'featured' items from a given lane's
         sublanes, organized into per-lane groups.
 
         :param facets: A GroupsFacet object.
 
+        :param stale_while_revalidate: If a cached copy of this feed is
+            out of date, should it be served anyway while some other
+            process regenerates it? If this is None, the site-wide
+            policy is used.
+
         :return: CachedFeed (if use_cache is True) or unicode
         """
+        start = time.time()
+        if stale_while_revalidate is None:
+            stale_while_revalidate = cls.use_stale_while_revalidate(_db)
         works_and_lanes = None
         if lane.children:
             # Since this lane has children, it's reasonable to at least
@@ -586,6 +634,7 @@ class AcquisitionFeed(OPDSFeed):
                     pagination=None,
                     annotator=annotator,
                     force_refresh=force_refresh,
+                    stale_while_revalidate=stale_while_revalidate,
                 )
                 if usable:
                     return cached.content
@@ -612,6 +661,7 @@ class AcquisitionFeed(OPDSFeed):
                 cache_type=cache_type,
                 force_refresh=force_refresh,
                 facets=None,
+                stale_while_revalidate=stale_while_revalidate,
             )
             return cached
 
@@ -669,18 +719,26 @@ class AcquisitionFeed(OPDSFeed):
 
         content = unicode(feed)
         if cached and use_cache:
-            cached.update(_db, content)
+            cached.update(_db, content, generation_time=time.time()-start)
         return content
 
     @classmethod
     def page(cls, _db, title, url, lane, annotator,
              cache_type=None, facets=None, pagination=None,
-             force_refresh=False
+             force_refresh=False, stale_while_revalidate=None
     ):
         """Create a feed representing one page of works from a given lane.
 
+        :param stale_while_revalidate: If a cached copy of this feed is
+            out of date, should it be served anyway while some other
+            process regenerates it? If this is None, the site-wide
+            policy is used.
+
         :return: CachedFeed (if use_cache is True) or unicode
         """
+        start = time.time()
+        if stale_while_revalidate is None:
+            stale_while_revalidate = cls.use_stale_while_revalidate(_db)
         if isinstance(lane, Lane):
             library = lane.library
         elif isinstance(lane, WorkList):
@@ -702,6 +760,7 @@ class AcquisitionFeed(OPDSFeed):
                 pagination=pagination,
                 annotator=annotator,
                 force_refresh=force_refresh,
+                stale_while_revalidate=stale_while_revalidate,
             )
             if usable:
                 return cached.content
@@ -712,7 +771,7 @@ class AcquisitionFeed(OPDSFeed):
             works = []
         else:
             works = works_q.all()
-            pagination.this_page_size = len(works)
+            pagination.page_loaded(works, facets)
         feed = cls(_db, title, url, works, annotator)
 
         entrypoints = facets.selectable_entrypoints(lane)
@@ -731,8 +790,13 @@ class AcquisitionFeed(OPDSFeed):
                 feed, make_link, entrypoints, facets.entrypoint
             )
 
-        # Add URLs to change faceted views of the collection.
-        for args in cls.facet_links(annotator, facets):
+        # Add URLs to change faceted views of the collection. If the
+        # feed came from the search index, the search index can also
+        # say how many works are behind each link.
+        facet_counts = None
+        if isinstance(lane, WorkList) and lane.lane_feed_search_client(_db):
+            facet_counts = lane.facet_counts(_db, facets)
+        for args in cls.facet_links(annotator, facets, facet_counts):
             OPDSFeed.add_link_to_feed(feed=feed.feed, **args)
 
         if len(works) > 0 and pagination.has_next_page:
@@ -752,11 +816,12 @@ class AcquisitionFeed(OPDSFeed):
 
         content = unicode(feed)
         if cached and use_cache:
-            cached.update(_db, content)
+            cached.update(_db, content, generation_time=time.time()-start)
         return content
 
     @classmethod
-    def facet_link(cls, href, title, facet_group_name, is_active):
+    def facet_link(cls, href, title, facet_group_name, is_active,
+                   count=None):
         """Build a set of attributes for a facet link.
 
         :param href: Destination of the link.
@@ -765,6 +830,8 @@ class AcquisitionFeed(OPDSFeed):
            e.g. "Sort By".
         :param is_active: True if this is the client's currently
            selected facet.
+        :param count: The number of works the client will find by
+           following the link, if known.
 
         :return: A dictionary of attributes, suitable for passing as
             keyword arguments into OPDSFeed.add_link_to_feed.
@@ -774,6 +841,8 @@ class AcquisitionFeed(OPDSFeed):
         args['{%s}facetGroup' % AtomFeed.OPDS_NS] = facet_group_name
         if is_active:
             args['{%s}activeFacet' % AtomFeed.OPDS_NS] = "true"
+        if count is not None:
+            args['{%s}count' % AtomFeed.THR_NS] = str(count)
         return args
 
     @classmethod
@@ -957,7 +1026,7 @@ class AcquisitionFeed(OPDSFeed):
         return OPDSMessage(identifier.urn, error_status, error_message)
 
     @classmethod
-    def facet_links(cls, annotator, facets):
+    def facet_links(cls, annotator, facets, facet_counts=None):
         """Create links for this feed's navigational facet groups.
 
         This does not create links for the entry point facet group,
@@ -965,14 +1034,22 @@ class AcquisitionFeed(OPDSFeed):
         circumstances, and this method doesn't know if those
         circumstances apply. You need to decide whether to call
         add_entrypoint_links in addition to calling this method.
+
+        :param facet_counts: A dictionary of counts, as returned by
+            WorkList.facet_counts(). If a count is known for a facet,
+            it's included in the facet's link.
         """
+        facet_counts = facet_counts or {}
         for group, value, new_facets, selected, in facets.facet_groups:
             url = annotator.facet_url(new_facets)
             if not url:
                 continue
             group_title = str(Facets.GROUP_DISPLAY_TITLES[group])
             facet_title = str(Facets.FACET_DISPLAY_TITLES[value])
-            yield cls.facet_link(url, facet_title, group_title, selected)
+            count = facet_counts.get(group, {}).get(value)
+            yield cls.facet_link(
+                url, facet_title, group_title, selected, count
+            )
 
     CACHE_FOREVER = 'forever'
 
@@ -1005,6 +1082,15 @@ class AcquisitionFeed(OPDSFeed):
             value = cls.DEFAULT_NONGROUPED_MAX_AGE
         return value
 
+    STALE_WHILE_REVALIDATE_POLICY = Configuration.STALE_WHILE_REVALIDATE_POLICY
+
+    @classmethod
+    def use_stale_while_revalidate(cls, _db):
+        "Should out-of-date cached feeds be served while being regenerated?"
+        value = ConfigurationSetting.sitewide(
+            _db, cls.STALE_WHILE_REVALIDATE_POLICY).bool_value
+        return value is True
+
     def __init__(self, _db, title, url, works, annotator=None,
                  precomposed_entries=[]):
         """Turn a list of works, messages, and precomposed <opds> entries
@@ -1017,15 +1103,282 @@ class AcquisitionFeed(OPDSFeed):
         self.annotator = annotator
 
         super(AcquisitionFeed, self).__init__(title, url)
+        self._db = _db
 
-        for work in works:
-            self.add_entry(work)
+        self.add_entries(works)
 
         # Add the precomposed entries and the messages.
+        self.precomposed_tags = []
         for entry in precomposed_entries:
             if isinstance(entry, OPDSMessage):
                 entry = entry.tag
             self.feed.append(entry)
+            self.precomposed_tags.append(entry)
+
+    def add_entries(self, works):
+        """Add an entry to the feed for each of the given works."""
+        works = list(works)
+        self.preload(self._db, works, self.annotator)
+
+        # Entries for the works are kept as strings where possible.
+        # Entries created some other way, by calling create_entry()
+        # directly, are always lxml tags.
+        appends = getattr(self.annotator, 'only_appends_to_entries', None)
+        self.use_entry_fragments = bool(appends and appends())
+        try:
+            for work in works:
+                self.add_entry(work)
+        finally:
+            self.use_entry_fragments = False
+
+    def stream(self, works=()):
+        """Serialize this feed a piece at a time, creating entries for
+        `works` along the way.
+
+        Entries are created STREAMING_BATCH_SIZE works at a time, so
+        the first part of the feed can be sent to the client long
+        before the last entry has been created, and only one batch of
+        entries is held in memory at once.
+
+        The first batch is created before this method returns, so
+        that a problem with the works is raised here, while it can
+        still be turned into an error response.
+
+        :return: A generator that yields UTF-8 encoded strings.
+        """
+        works = iter(works)
+        first_batch = self._detached_entries(
+            list(itertools.islice(works, self.STREAMING_BATCH_SIZE))
+        )
+
+        # The precomposed entries and messages go after the works,
+        # as they would if the works had been passed into the
+        # constructor.
+        precomposed = list(self.precomposed_tags)
+        for tag in precomposed:
+            self.feed.remove(tag)
+        self.precomposed_tags = []
+
+        entries = itertools.chain(
+            first_batch, self._stream_entries(works), precomposed
+        )
+        return super(AcquisitionFeed, self).stream(entries)
+
+    def _stream_entries(self, works):
+        batch = []
+        for work in works:
+            batch.append(work)
+            if len(batch) >= self.STREAMING_BATCH_SIZE:
+                for entry in self._detached_entries(batch):
+                    yield entry
+                batch = []
+        for entry in self._detached_entries(batch):
+            yield entry
+
+    def _detached_entries(self, works):
+        """Create entries for the given works without leaving them
+        in the feed.
+
+        :return: A list of lxml tags and/or pre-serialized entries.
+        """
+        if not works:
+            return []
+        start = len(self.feed)
+        fragment_start = len(self.entry_fragments)
+        try:
+            self.add_entries(works)
+            entries = self.entries_from(start)
+        finally:
+            for child in self.feed[start:]:
+                self.feed.remove(child)
+            del self.entry_fragments[fragment_start:]
+        return entries
+
+    @classmethod
+    def preload(cls, _db, works, annotator=None):
+        """Load everything needed to build OPDS entries for a list of
+        works, using a small number of queries no matter how long the
+        list is.
+
+        Left to itself, each entry in a feed lazy-loads its own
+        presentation edition, identifier, contributors, genres, and so
+        on, one query at a time. Instead, we gather up the IDs of all
+        the related rows, load each kind of row with a single IN
+        query, and attach the results to the works, so that building
+        the entries doesn't need to go to the database at all.
+
+        Relationships that are already loaded are left alone.
+
+        :param works: A list of Works and/or MaterializedWorks.
+        :param annotator: The Annotator that will be used to build the
+            entries. Bibliographic information is only loaded for Works
+            that don't have a cached OPDS entry in the annotator's
+            `opds_cache_field`.
+        """
+        annotator = annotator or Annotator
+        works = [x for x in works
+                 if isinstance(x, (Work, BaseMaterializedWork))]
+        if not works:
+            return
+        _db = _db or Session.object_session(works[0])
+        if not _db:
+            return
+
+        # A Work's license pools are normally loaded along with the
+        # Work itself, but that's not guaranteed.
+        unloaded = [x for x in works if isinstance(x, Work)
+                    and cls._unloaded(x, 'license_pools')]
+        if unloaded:
+            by_work = defaultdict(list)
+            qu = _db.query(LicensePool).filter(
+                LicensePool.work_id.in_([x.id for x in unloaded])
+            )
+            for pool in qu:
+                by_work[pool.work_id].append(pool)
+            for work in unloaded:
+                set_committed_value(work, 'license_pools', by_work[work.id])
+
+        # A MaterializedWork comes with its license pool attached.
+        pools = []
+        needs_entry = []
+        for work in works:
+            if isinstance(work, BaseMaterializedWork):
+                if work.license_pool:
+                    pools.append(work.license_pool)
+                continue
+            pools.extend(work.license_pools)
+            field = annotator.opds_cache_field
+            if not field or not getattr(work, field):
+                needs_entry.append(work)
+
+        # Load all the editions, identifiers, and data sources in one
+        # go, and attach them to the objects that refer to them.
+        editions = cls._load_related(
+            _db, Edition,
+            [(x, 'presentation_edition', 'presentation_edition_id')
+             for x in pools + [w for w in works if isinstance(w, Work)]]
+        )
+        cls._load_related(
+            _db, Identifier,
+            [(x, 'identifier', 'identifier_id') for x in pools]
+            + [(x, 'primary_identifier', 'primary_identifier_id')
+               for x in editions]
+        )
+        cls._load_related(
+            _db, DataSource,
+            [(x, 'data_source', 'data_source_id') for x in pools]
+        )
+
+        # The delivery mechanisms are used by circulation annotators
+        # to generate acquisition links.
+        pools = [x for x in pools
+                 if cls._unloaded(x, 'delivery_mechanisms')]
+        if pools:
+            by_pool = defaultdict(list)
+            qu = _db.query(LicensePoolDeliveryMechanism).filter(
+                LicensePoolDeliveryMechanism.identifier_id.in_(
+                    set([x.identifier_id for x in pools])
+                )
+            ).options(
+                joinedload("delivery_mechanism"),
+                joinedload("resource"),
+                joinedload("resource", "representation"),
+            )
+            for lpdm in qu:
+                by_pool[(lpdm.data_source_id, lpdm.identifier_id)].append(lpdm)
+            for pool in pools:
+                set_committed_value(
+                    pool, 'delivery_mechanisms',
+                    by_pool[(pool.data_source_id, pool.identifier_id)]
+                )
+
+        if not needs_entry:
+            return
+
+        # The rest is only needed to build entries from scratch.
+        editions = set(
+            [x.presentation_edition for x in needs_entry]
+            + [x.presentation_edition for x in pools]
+        )
+        editions = [x for x in editions
+                    if x and cls._unloaded(x, 'contributions')]
+        if editions:
+            by_edition = defaultdict(list)
+            qu = _db.query(Contribution).filter(
+                Contribution.edition_id.in_([x.id for x in editions])
+            ).options(joinedload(Contribution.contributor))
+            for contribution in qu:
+                by_edition[contribution.edition_id].append(contribution)
+            for edition in editions:
+                set_committed_value(
+                    edition, 'contributions', by_edition[edition.id]
+                )
+
+        works = [x for x in needs_entry if cls._unloaded(x, 'work_genres')]
+        if works:
+            by_work = defaultdict(list)
+            qu = _db.query(WorkGenre).filter(
+                WorkGenre.work_id.in_([x.id for x in works])
+            ).options(joinedload(WorkGenre.genre))
+            for work_genre in qu:
+                by_work[work_genre.work_id].append(work_genre)
+            for work in works:
+                set_committed_value(work, 'work_genres', by_work[work.id])
+
+        cls._load_related(
+            _db, Resource,
+            [(x, 'summary', 'summary_id') for x in needs_entry
+             if x.summary_text is None]
+        )
+
+    @classmethod
+    def _load_by_id(cls, _db, model, ids):
+        """Load all the `model` objects with the given IDs into the
+        session with a single query.
+        """
+        ids = set([x for x in ids if x is not None])
+        if not ids:
+            return []
+        return _db.query(model).filter(model.id.in_(ids)).all()
+
+    @classmethod
+    def _load_related(cls, _db, model, relationships):
+        """Load the `model` objects at the other end of some
+        many-to-one relationships with a single query, and attach
+        them.
+
+        Loading them isn't enough on its own: the session only keeps
+        weak references to the objects it loads, so an object nothing
+        else refers to may be gone by the time it's needed.
+
+        :param relationships: A list of (object, relationship name,
+            foreign key name) 3-tuples. Relationships that are already
+            loaded are left alone.
+        :return: A list of all the `model` objects referred to.
+        """
+        unloaded = []
+        loaded = []
+        for obj, name, key in relationships:
+            if cls._unloaded(obj, name):
+                unloaded.append((obj, name, key))
+            else:
+                loaded.append(getattr(obj, name))
+        by_id = dict(
+            (x.id, x) for x in cls._load_by_id(
+                _db, model, [getattr(obj, key) for obj, name, key in unloaded]
+            )
+        )
+        for obj, name, key in unloaded:
+            value = by_id.get(getattr(obj, key))
+            if value is not None:
+                set_committed_value(obj, name, value)
+        return list(set([x for x in loaded if x is not None] + by_id.values()))
+
+    @classmethod
+    def _unloaded(cls, obj, attribute):
+        """Is the given relationship not yet loaded from the database?"""
+        state = inspect(obj)
+        return state.persistent and attribute in state.unloaded
 
     def add_entry(self, work):
         """Attempt to create an OPDS <entry>. If successful, append it to
@@ -1036,7 +1389,10 @@ class AcquisitionFeed(OPDSFeed):
         if entry is not None:
             if isinstance(entry, OPDSMessage):
                 entry = entry.tag
-            self.feed.append(entry)
+            if isinstance(entry, basestring):
+                self.add_entry_fragment(entry)
+            else:
+                self.feed.append(entry)
         return entry
 
     def create_entry(self, work, even_if_no_license_pool=False,
@@ -1130,13 +1486,21 @@ class AcquisitionFeed(OPDSFeed):
             in the appropriate storage field of Work -- either
             simple_opds_entry or verbose_opds_entry. (NOTE: this has some
             overlap with force_create which is difficult to explain.)
-        :return: An lxml Element object
+        :return: An lxml Element object, or (while the feed's own works
+            are being added) possibly a Unicode string.
         """
         xml = None
         field = self.annotator.opds_cache_field
         if field and work and not force_create and use_cache:
             xml = getattr(work, field)
 
+        if xml and self.use_entry_fragments:
+            fragment = self._create_entry_fragment(
+                work, active_license_pool, edition, identifier, xml
+            )
+            if fragment is not None:
+                return fragment
+
         if xml:
             xml = etree.fromstring(xml)
         else:
@@ -1155,6 +1519,26 @@ class AcquisitionFeed(OPDSFeed):
 
         return xml
 
+    def _create_entry_fragment(self, work, active_license_pool, edition,
+                               identifier, cached):
+        """Annotate a cached OPDS entry without parsing it.
+
+        The annotator adds its tags to an empty <entry>, and those tags
+        are spliced into the cached entry just before its closing tag.
+
+        :param cached: The Work's cached OPDS entry.
+        :return: A Unicode string, or None if the cached entry couldn't
+            be used this way.
+        """
+        if isinstance(cached, str):
+            cached = cached.decode("utf8")
+        annotations = AtomFeed.entry()
+        self.annotator.annotate_work_entry(
+            work, active_license_pool, edition, identifier, self,
+            annotations
+        )
+        return AtomFeed.add_to_entry_fragment(cached, annotations)
+
     def _make_entry_xml(self, work, edition):
         """Create a new (incomplete) OPDS entry for the given work.
 
@@ -1582,6 +1966,16 @@ class LookupAcquisitionFeed(AcquisitionFeed):
     default LicensePool.
     """
 
+    @classmethod
+    def preload(cls, _db, works, annotator=None):
+        """A LookupAcquisitionFeed's works are (Identifier, Work)
+        2-tuples.
+        """
+        works = [work for (identifier, work) in works]
+        return super(LookupAcquisitionFeed, cls).preload(
+            _db, works, annotator
+        )
+
     def create_entry(self, work):
         """Turn an Identifier and a Work into an entry for an acquisition
         feed.
@@ -1,16 +1,31 @@
 from nose.tools import set_trace
 from StringIO import StringIO
+from io import BytesIO
 from collections import (
     defaultdict,
     Counter,
 )
 import base64
+import re
 import datetime
 import feedparser
 import logging
+import sys
+import time
 import traceback
 import urllib
+from Queue import (
+    Full,
+    Queue,
+)
+from threading import (
+    Event,
+    Thread,
+)
+from dateutil.parser import parse as parse_date
 from urlparse import urlparse, urljoin
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.session import Session
 from flask_babel import lazy_gettext as _
@@ -36,7 +51,9 @@ from metadata_layer import (
 )
 from model import (
     get_one,
+    get_one_or_create,
     Collection,
+    Contributor,
     CoverageRecord,
     DataSource,
     Edition,
@@ -322,6 +339,7 @@ class OPDSXMLParser(XMLParser):
 
     NAMESPACES = { "simplified": "http://librarysimplified.org/terms/",
                    "app" : "http://www.w3.org/2007/app",
+                   "bibframe" : "http://bibframe.org/vocab/",
                    "dcterms" : "http://purl.org/dc/terms/",
                    "dc" : "http://purl.org/dc/elements/1.1/",
                    "opds": "http://opds-spec.org/2010/catalog",
@@ -331,6 +349,247 @@ class OPDSXMLParser(XMLParser):
     }
 
 
+class OPDSImportBatch(object):
+    """The database objects needed to import one page of an OPDS feed,
+    looked up (or created) with a handful of queries instead of
+    several queries per entry.
+
+    This covers Identifiers, Editions, LicensePools, Contributors and
+    Subjects. Contributions, Classifications and the rest of what
+    Metadata.apply() does are still handled one entry at a time.
+    """
+
+    def __init__(self, _db, urns):
+        """Find or create an Identifier for every URN on the page."""
+        self._db = _db
+        identifiers_by_urn, ignore = Identifier.parse_urns(_db, urns)
+
+        # parse_urns() keys its results by each Identifier's own URN,
+        # which isn't always the URN found in the feed, so
+        # Identifiers are kept by type and identifier instead.
+        self.identifiers = dict(
+            ((i.type, i.identifier), i) for i in identifiers_by_urn.values()
+        )
+        self.editions = dict()
+        self.pools = dict()
+        self.contributors_by_sort_name = dict()
+        self.contributors_by_lc = dict()
+        self.contributors_by_viaf = dict()
+        self.subjects = dict()
+
+    def identifier(self, urn):
+        """Look up an Identifier by URN, the way Identifier.parse_urn does.
+
+        :return: A 2-tuple (Identifier, is_new)
+        """
+        try:
+            key = Identifier.prepare_foreign_type_and_identifier(
+                *Identifier.type_and_identifier_for_urn(urn)
+            )
+        except ValueError, e:
+            key = None
+        identifier = self.identifiers.get(key)
+        if identifier:
+            return identifier, False
+        identifier, is_new = Identifier.parse_urn(self._db, urn)
+        self.identifiers[(identifier.type, identifier.identifier)] = identifier
+        return identifier, is_new
+
+    def identifier_for(self, identifier_data):
+        """Find or create the Identifier described by an IdentifierData."""
+        key = (identifier_data.type, identifier_data.identifier)
+        identifier = self.identifiers.get(key)
+        if not identifier:
+            identifier, ignore = identifier_data.load(self._db)
+            self.identifiers[key] = identifier
+        return identifier
+
+    def load(self, metadata_objs):
+        """Find or create the Edition for every Metadata object, and find
+        the existing LicensePools for their identifiers.
+        """
+        wanted = set()
+        for metadata in metadata_objs:
+            identifier = self.identifier_for(metadata.primary_identifier)
+            data_source = metadata.data_source(self._db)
+            wanted.add((data_source.id, identifier.id))
+        if not wanted:
+            return
+        data_source_ids = set(x[0] for x in wanted)
+        identifier_ids = set(x[1] for x in wanted)
+
+        def find_editions():
+            qu = self._db.query(Edition).filter(
+                Edition.data_source_id.in_(data_source_ids)
+            ).filter(Edition.primary_identifier_id.in_(identifier_ids))
+            for edition in qu:
+                key = (edition.data_source_id, edition.primary_identifier_id)
+                self.editions[key] = edition
+        find_editions()
+
+        # Create every missing Edition with a single INSERT.
+        missing = [
+            dict(data_source_id=data_source_id,
+                 primary_identifier_id=identifier_id)
+            for data_source_id, identifier_id in wanted
+            if (data_source_id, identifier_id) not in self.editions
+        ]
+        if missing:
+            transaction = self._db.begin_nested()
+            try:
+                self._db.bulk_insert_mappings(Edition, missing)
+                transaction.commit()
+            except IntegrityError:
+                # Some of these Editions were created by someone else
+                # in the meantime. Create the rest one at a time, the
+                # way Metadata.edition() would.
+                transaction.rollback()
+                for values in missing:
+                    get_one_or_create(self._db, Edition, **values)
+            find_editions()
+
+        qu = self._db.query(LicensePool).filter(
+            LicensePool.identifier_id.in_(identifier_ids)
+        )
+        for pool in qu:
+            # Any LicensePool will do; see update_work_for_edition().
+            self.pools.setdefault(pool.identifier_id, pool)
+
+        self.load_contributors(metadata_objs)
+        self.load_subjects(metadata_objs)
+
+    def load_contributors(self, metadata_objs):
+        """Find the existing Contributors mentioned by any of the
+        Metadata objects, by sort name, LC or VIAF.
+        """
+        sort_names = set()
+        lcs = set()
+        viafs = set()
+        for metadata in metadata_objs:
+            for contributor_data in metadata.contributors or []:
+                if contributor_data.lc or contributor_data.viaf:
+                    if contributor_data.lc:
+                        lcs.add(contributor_data.lc)
+                    if contributor_data.viaf:
+                        viafs.add(contributor_data.viaf)
+                elif contributor_data.sort_name:
+                    sort_names.add(contributor_data.sort_name)
+        clauses = []
+        if sort_names:
+            clauses.append(Contributor.sort_name.in_(sort_names))
+        if lcs:
+            clauses.append(Contributor.lc.in_(lcs))
+        if viafs:
+            clauses.append(Contributor.viaf.in_(viafs))
+        if not clauses:
+            return
+        for contributor in self._db.query(Contributor).filter(or_(*clauses)):
+            self._add_contributor(contributor)
+
+    def _add_contributor(self, contributor):
+        for index, key in (
+            (self.contributors_by_sort_name, contributor.sort_name),
+            (self.contributors_by_lc, contributor.lc),
+            (self.contributors_by_viaf, contributor.viaf),
+        ):
+            if not key:
+                continue
+            contributors = index.setdefault(key, [])
+            if contributor not in contributors:
+                contributors.append(contributor)
+
+    def load_subjects(self, metadata_objs):
+        """Find the existing Subjects mentioned by any of the Metadata
+        objects, by type and identifier.
+        """
+        types = set()
+        identifiers = set()
+        for metadata in metadata_objs:
+            for subject_data in metadata.subjects or []:
+                if subject_data.type and subject_data.identifier:
+                    types.add(subject_data.type)
+                    identifiers.add(subject_data.identifier)
+        if not identifiers:
+            return
+        qu = self._db.query(Subject).filter(
+            Subject.type.in_(types)
+        ).filter(Subject.identifier.in_(identifiers))
+        for subject in qu:
+            self.subjects[(subject.type, subject.identifier)] = subject
+
+    def edition(self, metadata):
+        """Find or create the Edition described by a Metadata object.
+
+        :return: A 2-tuple (Edition, is_new)
+        """
+        identifier = self.identifier_for(metadata.primary_identifier)
+        data_source = metadata.data_source(self._db)
+        edition = self.editions.get((data_source.id, identifier.id))
+        if edition:
+            return edition, False
+        return metadata.edition(self._db)
+
+    def license_pool(self, identifier):
+        """Find a LicensePool for an Identifier."""
+        pool = self.pools.get(identifier.id)
+        if not pool:
+            pool = get_one(
+                self._db, LicensePool, identifier=identifier,
+                on_multiple='interchangeable'
+            )
+        return pool
+
+    def contributor(self, contributor_data):
+        """Find or create the Contributor described by a ContributorData,
+        the way Contributor.lookup does.
+        """
+        sort_name = contributor_data.sort_name
+        lc = contributor_data.lc
+        viaf = contributor_data.viaf
+        if lc or viaf:
+            if lc:
+                candidates = self.contributors_by_lc.get(lc, [])
+            else:
+                candidates = self.contributors_by_viaf.get(viaf, [])
+            candidates = [
+                x for x in candidates
+                if (not lc or x.lc == lc) and (not viaf or x.viaf == viaf)
+            ]
+        else:
+            candidates = self.contributors_by_sort_name.get(sort_name, [])
+        if candidates:
+            return candidates[0]
+
+        contributors, is_new = Contributor.lookup(
+            self._db, sort_name=sort_name, lc=lc, viaf=viaf
+        )
+        contributor = contributors[0]
+        self._add_contributor(contributor)
+        return contributor
+
+    def subject(self, subject_data):
+        """Find or create the Subject described by a SubjectData,
+        the way Subject.lookup does.
+        """
+        subject = None
+        if subject_data.identifier:
+            subject = self.subjects.get(
+                (subject_data.type, subject_data.identifier)
+            )
+        if not subject:
+            subject, is_new = Subject.lookup(
+                self._db, subject_data.type, subject_data.identifier,
+                subject_data.name
+            )
+            if subject.identifier:
+                self.subjects[(subject.type, subject.identifier)] = subject
+        elif subject_data.name and not subject.name:
+            # We just discovered the name of a subject that previously
+            # had only an ID.
+            subject.name = subject_data.name
+        return subject
+
+
 class OPDSImporter(object):
     """ Imports editions and license pools from an OPDS feed.
     Creates Edition, LicensePool and Work rows in the database, if those 
@@ -386,10 +645,25 @@ class OPDSImporter(object):
     # when they show up in <simplified:message> tags.
     SUCCESS_STATUS_CODES = None
 
+    # The encoding attribute of an XML declaration, which has to go
+    # when a unicode feed is re-encoded before parsing.
+    XML_ENCODING_DECLARATION = re.compile(
+        r'^(\s*<\?xml[^>]*?)\s+encoding\s*=\s*["\'][^"\']*["\']'
+    )
+
+    # Atom's names for the types of text constructs, and the media
+    # types feedparser uses for them.
+    ATOM_TEXT_TYPES = {
+        'text': 'text/plain',
+        'html': 'text/html',
+        'xhtml': 'application/xhtml+xml',
+    }
+
     def __init__(self, _db, collection, data_source_name=None,
                  identifier_mapping=None, mirror=None, http_get=None,
                  metadata_client=None, content_modifier=None,
-                 map_from_collection=None,
+                 map_from_collection=None, single_pass=True,
+                 batch_import=False,
     ):
         """:param collection: LicensePools created by this OPDS import
         will be associated with the given Collection. If this is None,
@@ -415,6 +689,15 @@ class OPDSImporter(object):
         :param content_modifier: A function that may modify-in-place
         representations (such as images and EPUB documents) as they
         come in from the network.
+
+        :param single_pass: If this is True, feeds are parsed once, by
+        extract_data_in_one_pass(). If it's False, feeds are parsed
+        twice, once by feedparser and once by lxml.
+
+        :param batch_import: If this is True, the Identifiers,
+        Editions, LicensePools, Contributors and Subjects for each page
+        of a feed are looked up (or created) in bulk, through an
+        OPDSImportBatch, before any entries are imported.
         """
         self._db = _db
         self.log = logging.getLogger("OPDS Importer")
@@ -454,6 +737,9 @@ class OPDSImporter(object):
         # gutenberg.org.
         self.http_get = http_get or Representation.cautious_http_get
         self.map_from_collection = map_from_collection
+        self.single_pass = single_pass
+        self.batch_import = batch_import
+        self.batch = None
 
     @property
     def data_source(self):
@@ -480,7 +766,13 @@ class OPDSImporter(object):
 
         # If parsing the overall feed throws an exception, we should address that before
         # moving on. Let the exception propagate.
+        self.batch = None
         metadata_objs, failures = self.extract_feed_data(feed, feed_url)
+        if self.batch:
+            self.batch.load(
+                [metadata for key, metadata in metadata_objs.iteritems()
+                 if key not in failures]
+            )
 
         # make editions.  if have problem, make sure associated pool and work aren't created.
         for key, metadata in metadata_objs.iteritems():
@@ -501,7 +793,7 @@ class OPDSImporter(object):
                 # Rather than scratch the whole import, treat this as a failure that only applies
                 # to this item.
                 self.log.error("Error importing an OPDS item", exc_info=e)
-                identifier, ignore = Identifier.parse_urn(self._db, key)
+                identifier, ignore = self.parse_urn(key)
                 data_source = self.data_source
                 failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
                 failures[key] = failure
@@ -520,11 +812,12 @@ class OPDSImporter(object):
                 if work:
                     works[key] = work
             except Exception, e:
-                identifier, ignore = Identifier.parse_urn(self._db, key)
+                identifier, ignore = self.parse_urn(key)
                 data_source = self.data_source
                 failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
                 failures[key] = failure
 
+        self.batch = None
         return imported_editions.values(), pools.values(), works.values(), failures
 
     def import_edition_from_metadata(
@@ -535,7 +828,10 @@ class OPDSImporter(object):
             CirculationData in it.
         """
         # Locate or create an Edition for this book.
-        edition, is_new_edition = metadata.edition(self._db)
+        if self.batch:
+            edition, is_new_edition = self.batch.edition(metadata)
+        else:
+            edition, is_new_edition = metadata.edition(self._db)
 
         policy = ReplacementPolicy(
             subjects=True,
@@ -550,7 +846,8 @@ class OPDSImporter(object):
         )
         metadata.apply(
             edition=edition, collection=self.collection,
-            metadata_client=self.metadata_client, replace=policy
+            metadata_client=self.metadata_client, replace=policy,
+            lookups=self.batch
         )
 
         return edition
@@ -565,10 +862,13 @@ class OPDSImporter(object):
         # imported the edition. If there was already a pool from a
         # different data source or a different collection, that's fine
         # too.
-        pool = get_one(
-            self._db, LicensePool, identifier=edition.primary_identifier,
-            on_multiple='interchangeable'
-        )
+        if self.batch:
+            pool = self.batch.license_pool(edition.primary_identifier)
+        else:
+            pool = get_one(
+                self._db, LicensePool, identifier=edition.primary_identifier,
+                on_multiple='interchangeable'
+            )
 
         if pool:
             # Note: pool.calculate_work will call self.set_presentation_edition(), 
@@ -651,19 +951,32 @@ class OPDSImporter(object):
         with associated messages and next_links.
         """
         data_source = self.data_source
-        fp_metadata, fp_failures = self.extract_data_from_feedparser(feed=feed, data_source=data_source)
-        # gets: medium, measurements, links, contributors, etc.
-        xml_data_meta, xml_failures = self.extract_metadata_from_elementtree(
-            feed, data_source=data_source, feed_url=feed_url
-        )
+        if self.single_pass:
+            fp_metadata, xml_data_meta, failures = self.extract_data_in_one_pass(
+                feed, data_source=data_source, feed_url=feed_url
+            )
+        else:
+            fp_metadata, fp_failures = self.extract_data_from_feedparser(feed=feed, data_source=data_source)
+            # gets: medium, measurements, links, contributors, etc.
+            xml_data_meta, xml_failures = self.extract_metadata_from_elementtree(
+                feed, data_source=data_source, feed_url=feed_url
+            )
+            failures = dict(fp_failures)
+            failures.update(xml_failures)
+
+        if self.batch_import:
+            # Look up every Identifier on this page at once.
+            self.batch = OPDSImportBatch(
+                self._db, fp_metadata.keys() + failures.keys()
+            )
 
         if self.map_from_collection:
             # Build the identifier_mapping based on the Collection.
-            self.build_identifier_mapping(fp_metadata.keys() + fp_failures.keys())
+            self.build_identifier_mapping(fp_metadata.keys() + failures.keys())
 
         # translate the id in failures to identifier.urn
         identified_failures = {}
-        for urn, failure in fp_failures.items() + xml_failures.items():
+        for urn, failure in failures.items():
             identifier, failure = self.handle_failure(urn, failure)
             identified_failures[identifier.urn] = failure
 
@@ -671,7 +984,7 @@ class OPDSImporter(object):
         metadata = {}
         circulationdata = {}
         for id, m_data_dict in fp_metadata.items():
-            external_identifier, ignore = Identifier.parse_urn(self._db, id)
+            external_identifier, ignore = self.parse_urn(id)
             if self.identifier_mapping:
                 internal_identifier = self.identifier_mapping.get(
                     external_identifier, external_identifier)
@@ -749,7 +1062,7 @@ class OPDSImporter(object):
         that what a normal OPDSImporter would consider 'failure' is
         considered success.
         """
-        external_identifier, ignore = Identifier.parse_urn(self._db, urn)
+        external_identifier, ignore = self.parse_urn(urn)
         if self.identifier_mapping:
             # The identifier found in the OPDS feed is different from 
             # the identifier we want to export.
@@ -768,6 +1081,15 @@ class OPDSImporter(object):
             failure.obj = internal_identifier
         return internal_identifier, failure
 
+    def parse_urn(self, urn):
+        """Find or create the Identifier for a URN found in a feed.
+
+        :return: A 2-tuple (Identifier, is_new)
+        """
+        if self.batch:
+            return self.batch.identifier(urn)
+        return Identifier.parse_urn(self._db, urn)
+
     @classmethod
     def _add_format_data(cls, circulation):
         """Subclasses that specialize OPDS Import can implement this
@@ -890,6 +1212,182 @@ class OPDSImporter(object):
                     values[identifier] = detail
         return values, failures
 
+    @classmethod
+    def extract_data_in_one_pass(cls, feed, data_source, feed_url=None):
+        """Parse an OPDS feed once, extracting everything that
+        extract_data_from_feedparser() and
+        extract_metadata_from_elementtree() would extract between them.
+
+        Each <entry> tag is processed as soon as it has been parsed, and
+        then thrown away, so memory use doesn't grow with the size of
+        the feed's XML.
+
+        If no `feed_url` is provided, the feed's self link is used to
+        resolve relative links, so long as it shows up before the
+        entries (it almost always does).
+
+        :return: A 3-tuple (feedparser-style data, elementtree-style
+        data, failures). The first two are dictionaries mapping IDs to
+        dictionaries of the kind returned by
+        extract_data_from_feedparser() and
+        extract_metadata_from_elementtree(). `failures` maps IDs to
+        CoverageFailures (or Identifiers, for messages that indicate
+        success).
+        """
+        parser = cls.PARSER_CLASS()
+        atom = '{%s}' % parser.NAMESPACES['atom']
+        message = '{%s}message' % parser.NAMESPACES['simplified']
+
+        values = {}
+        xml_values = {}
+        # When both parsers find a failure for the same ID, the
+        # elementtree failure takes precedence, and a failure in an
+        # <entry> takes precedence over a <simplified:message>.
+        fp_failures = {}
+        message_failures = {}
+        xml_failures = {}
+
+        if isinstance(feed, unicode):
+            # lxml only parses bytes incrementally, and once the
+            # feed is encoded as UTF-8, whatever encoding it declares
+            # for itself no longer applies.
+            feed = cls.XML_ENCODING_DECLARATION.sub(
+                r'\1', feed, count=1
+            ).encode("utf8")
+
+        root = None
+        for event, tag in etree.iterparse(
+            BytesIO(feed), events=('start', 'end')
+        ):
+            if root is None:
+                root = tag
+                continue
+            if event != 'end' or tag.getparent() is not root:
+                continue
+
+            if tag.tag == atom + 'link':
+                if not feed_url and tag.get('rel') == 'self':
+                    feed_url = tag.get('href')
+            elif tag.tag == message:
+                failure = cls.coveragefailure_from_message(
+                    data_source, cls.message_from_tag(parser, tag)
+                )
+                if isinstance(failure, Identifier):
+                    message_failures[failure.urn] = failure
+                elif failure:
+                    message_failures[failure.obj.urn] = failure
+            elif tag.tag == atom + 'entry':
+                entry = cls.feedparser_style_entry(parser, tag)
+                identifier, detail, failure = cls.data_detail_for_feedparser_entry(
+                    entry=entry, data_source=data_source
+                )
+                if not identifier:
+                    logging.error("Tried to parse an element without a valid identifier.  feed=%s" % feed)
+                elif failure:
+                    fp_failures[identifier] = failure
+                elif detail:
+                    values[identifier] = detail
+
+                identifier, detail, failure = cls.detail_for_elementtree_entry(
+                    parser, tag, data_source, feed_url
+                )
+                if identifier:
+                    if failure:
+                        xml_failures[identifier] = failure
+                    if detail:
+                        xml_values[identifier] = detail
+
+            # We're done with this tag and everything before it.
+            tag.clear()
+            while tag.getprevious() is not None:
+                del root[0]
+
+        failures = fp_failures
+        failures.update(message_failures)
+        failures.update(xml_failures)
+        return values, xml_values, failures
+
+    @classmethod
+    def feedparser_style_entry(cls, parser, entry_tag):
+        """Turn an <atom:entry> tag into a dictionary like the one
+        feedparser would create for it, with the keys used by
+        _data_detail_for_feedparser_entry().
+        """
+        def text(path):
+            value = parser.text_of_optional_subtag(entry_tag, path)
+            if value is not None:
+                value = value.strip()
+            return value
+
+        entry = dict(
+            id=text('atom:id'),
+            title=text('atom:title'),
+            schema_alternativeheadline=text('schema:alternativeHeadline'),
+            publisher=text('dc:publisher'),
+            dcterms_publisher=text('dcterms:publisher'),
+            language=text('dc:language'),
+            dcterms_language=text('dcterms:language'),
+            rights=(
+                text('atom:rights') or text('dc:rights')
+                or text('dcterms:rights') or ''
+            ),
+        )
+
+        # Like feedparser, fall back to the publication date if
+        # there's no update date.
+        updated = text('atom:updated') or text('atom:published')
+        if updated:
+            entry['updated_parsed'] = cls._time_tuple(updated)
+
+        distribution = parser._xpath1(entry_tag, 'bibframe:distribution')
+        if distribution is not None:
+            # feedparser lowercases attribute names.
+            entry['bibframe_distribution'] = dict(
+                ('bibframe:' + etree.QName(key).localname.lower(), value)
+                for key, value in distribution.attrib.items()
+            )
+
+        contents = [
+            cls._text_construct_detail(tag)
+            for tag in parser._xpath(entry_tag, 'atom:content')
+        ]
+        if contents:
+            entry['content'] = contents
+        summary = parser._xpath1(entry_tag, 'atom:summary')
+        if summary is not None:
+            entry['summary_detail'] = cls._text_construct_detail(summary)
+        elif contents and contents[0]['type'] in ('text/plain', 'text/html'):
+            # feedparser uses text or HTML <content> as the summary
+            # when there's no <summary>.
+            entry['summary_detail'] = dict(contents[0])
+        return entry
+
+    @classmethod
+    def _text_construct_detail(cls, tag):
+        """Turn an Atom text construct such as <summary> into a
+        dictionary like feedparser's `summary_detail`.
+        """
+        media_type = tag.get('type', 'text')
+        media_type = cls.ATOM_TEXT_TYPES.get(media_type, media_type)
+        if media_type == cls.ATOM_TEXT_TYPES['xhtml']:
+            value = (tag.text or '') + ''.join(
+                etree.tostring(child, encoding=unicode) for child in tag
+            )
+        else:
+            value = tag.text or ''
+        value = value.strip()
+        if value and media_type != cls.ATOM_TEXT_TYPES['text']:
+            value = feedparser._sanitizeHTML(value, 'utf-8', media_type)
+        return dict(value=value, type=media_type)
+
+    @classmethod
+    def _time_tuple(cls, value):
+        """Parse a date the way feedparser does, into a UTC time tuple."""
+        try:
+            return parse_date(value).utctimetuple()
+        except (ValueError, OverflowError), e:
+            return None
+
     @classmethod
     def _datetime(cls, entry, key):
         value = entry.get(key, None)
@@ -1069,33 +1567,38 @@ class OPDSImporter(object):
         """
         path = '/atom:feed/simplified:message'
         for message_tag in parser._xpath(feed_tag, path):
+            yield cls.message_from_tag(parser, message_tag)
 
-            # First thing to do is determine which Identifier we're
-            # talking about.
-            identifier_tag = parser._xpath1(message_tag, 'atom:id')
-            if identifier_tag is None:
-                urn = None
-            else:
-                urn = identifier_tag.text
+    @classmethod
+    def message_from_tag(cls, parser, message_tag):
+        """Convert a <simplified:message> tag into an OPDSMessage."""
+
+        # First thing to do is determine which Identifier we're
+        # talking about.
+        identifier_tag = parser._xpath1(message_tag, 'atom:id')
+        if identifier_tag is None:
+            urn = None
+        else:
+            urn = identifier_tag.text
 
-            # What status code is associated with the message?
-            status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
-            if status_code_tag is None:
+        # What status code is associated with the message?
+        status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
+        if status_code_tag is None:
+            status_code = None
+        else:
+            try:
+                status_code = int(status_code_tag.text)
+            except ValueError:
                 status_code = None
-            else:
-                try:
-                    status_code = int(status_code_tag.text)
-                except ValueError:
-                    status_code = None
-
-            # What is the human-readable message?
-            description_tag = parser._xpath1(message_tag, 'schema:description')
-            if description_tag is None:
-                description = ''
-            else:
-                description = description_tag.text
-        
-            yield OPDSMessage(urn, status_code, description)
+
+        # What is the human-readable message?
+        description_tag = parser._xpath1(message_tag, 'schema:description')
+        if description_tag is None:
+            description = ''
+        else:
+            description = description_tag.text
+
+        return OPDSMessage(urn, status_code, description)
     
     @classmethod
     def coveragefailures_from_messages(cls, data_source, parser, feed_tag):
@@ -1455,6 +1958,87 @@ class OPDSImporter(object):
         return series_name, series_position
 
 
+class FeedPage(object):
+    """One page of an OPDS feed, downloaded by a FeedPrefetcher."""
+
+    def __init__(self, url, feed, next_links, fetch_time):
+        self.url = url
+        self.feed = feed
+        self.next_links = next_links
+        self.fetch_time = fetch_time
+
+
+class FeedPrefetcher(Thread):
+    """Follow the next links of an OPDS feed in the background,
+    downloading up to `size` pages ahead of the pages that have been
+    consumed.
+
+    Pages come out of pages() in the order they would be visited by
+    OPDSImportMonitor.follow_links(). The prefetcher doesn't know
+    which pages contain new data, so it will follow links that
+    turn out not to be needed; stop() tells it to give up.
+    """
+
+    def __init__(self, monitor, url, size, do_get=None):
+        super(FeedPrefetcher, self).__init__()
+        self.daemon = True
+        self.monitor = monitor
+        self.url = url
+        self.do_get = do_get
+        self.queue = Queue(maxsize=max(1, size))
+        self.stopped = Event()
+        self.exc_info = None
+
+    def run(self):
+        queue = [self.url]
+        seen_links = set([])
+        try:
+            while queue and not self.stopped.is_set():
+                new_queue = []
+                for link in queue:
+                    if link in seen_links:
+                        continue
+                    seen_links.add(link)
+                    start = time.time()
+                    feed = self.monitor.fetch_one_link(link, self.do_get)
+                    next_links = self.monitor.importer.extract_next_links(feed)
+                    page = FeedPage(link, feed, next_links, time.time()-start)
+                    if not self._put(page):
+                        return
+                    new_queue.extend(next_links)
+                queue = new_queue
+        except Exception, e:
+            self.exc_info = sys.exc_info()
+        self._put(None)
+
+    def _put(self, page):
+        """Wait for room in the queue, unless the prefetcher is stopped.
+
+        :return: True if the page was queued, False if the prefetcher
+            was stopped first.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(page, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def pages(self):
+        """Yield FeedPages as they become available."""
+        while True:
+            page = self.queue.get()
+            if page is None:
+                break
+            yield page
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def stop(self):
+        self.stopped.set()
+
+
 class OPDSImportMonitor(CollectionMonitor):
 
     """Periodically monitor a Collection's OPDS archive feed and import
@@ -1474,7 +2058,13 @@ class OPDSImportMonitor(CollectionMonitor):
     PROTOCOL = ExternalIntegration.OPDS_IMPORT
 
     def __init__(self, _db, collection, import_class,
-                 force_reimport=False, **import_class_kwargs):
+                 force_reimport=False, prefetch=0, **import_class_kwargs):
+        """Constructor.
+
+        :param prefetch: If this is more than zero, follow the feed's
+            next links in a background thread, downloading up to this
+            many pages ahead of the page being checked for new data.
+        """
         if not collection:
             raise ValueError(
                 "OPDSImportMonitor can only be run in the context of a Collection."
@@ -1495,6 +2085,8 @@ class OPDSImportMonitor(CollectionMonitor):
 
         self.feed_url = self.opds_url(collection)
         self.force_reimport = force_reimport
+        self.prefetch = prefetch
+        self.page_timings = dict()
         self.username = collection.external_integration.username
         self.password = collection.external_integration.password
         self.importer = import_class(
@@ -1557,24 +2149,55 @@ class OPDSImportMonitor(CollectionMonitor):
         # item was last updated.
         last_update_dates = self.importer.extract_last_update_dates(feed)
 
-        new_data = False
-        for identifier, remote_updated in last_update_dates:
+        # Find all the Identifiers, and their CoverageRecords, at once.
+        keys = dict()
+        for urn, remote_updated in last_update_dates:
+            try:
+                keys[urn] = Identifier.prepare_foreign_type_and_identifier(
+                    *Identifier.type_and_identifier_for_urn(urn)
+                )
+            except ValueError, e:
+                keys[urn] = None
+        identifiers_by_urn, ignore = Identifier.parse_urns(
+            self._db, [urn for urn, key in keys.items() if key],
+            autocreate=False
+        )
+        identifiers = dict(
+            ((i.type, i.identifier), i) for i in identifiers_by_urn.values()
+        )
+        records = CoverageRecord.lookup_for_identifiers(
+            self._db, identifiers.values(), self.importer.data_source,
+            operation=CoverageRecord.IMPORT_OPERATION
+        )
 
-            identifier, ignore = Identifier.parse_urn(self._db, identifier)
-            if not identifier:
+        for urn, remote_updated in last_update_dates:
+            key = keys[urn]
+            if not key:
                 # Maybe this is new, maybe not, but we can't associate
                 # the information with an Identifier, so we can't do
                 # anything about it.
                 self.log.info(
-                    "Ignoring %s because unable to turn into an Identifier."
-                )                
+                    "Ignoring %s because unable to turn into an Identifier.",
+                    urn
+                )
                 continue
 
-            if self.identifier_needs_import(identifier, remote_updated):
-                new_data = True
-                break
-        return new_data
-            
+            identifier = identifiers.get(key)
+            if not identifier:
+                # We've never heard of this Identifier, so we
+                # certainly haven't imported it.
+                self.log.info(
+                    "Counting %s as new because it has no Identifier.", urn
+                )
+                return True
+
+            record = records.get(identifier.id)
+            if self.coverage_record_needs_import(
+                identifier, record, remote_updated
+            ):
+                return True
+        return False
+
     def identifier_needs_import(self, identifier, last_updated_remote):
         """Does the remote side have new information about this Identifier?
 
@@ -1589,7 +2212,20 @@ class OPDSImportMonitor(CollectionMonitor):
             identifier, self.importer.data_source,
             operation=CoverageRecord.IMPORT_OPERATION
         )
+        return self.coverage_record_needs_import(
+            identifier, record, last_updated_remote
+        )
+
+    def coverage_record_needs_import(self, identifier, record,
+                                     last_updated_remote):
+        """Given the CoverageRecord for an earlier import of an
+        Identifier, does the remote side have new information about it?
 
+        :param record: The Identifier's import CoverageRecord, or None
+            if it has never been imported.
+        :param last_update_remote: The last time the remote side updated
+            the OPDS entry for this Identifier.
+        """
         if not record:
             # We have no record of importing this Identifier. Import
             # it now.
@@ -1643,6 +2279,26 @@ class OPDSImportMonitor(CollectionMonitor):
             that needs to be imported.
         """
         self.log.info("Following next link: %s", url)
+        feed = self.fetch_one_link(url, do_get)
+        new_data = self.feed_contains_new_data(feed)
+
+        if new_data:
+            # There's something new on this page, so we need to check
+            # the next page as well.
+            next_links = self.importer.extract_next_links(feed)
+            return next_links, feed
+        else:
+            # There's nothing new, so we don't need to import this
+            # feed or check the next page.
+            self.log.info("No new data.")
+            return [], None
+
+    def fetch_one_link(self, url, do_get=None):
+        """Download a page of an OPDS feed.
+
+        :return: The content of the page.
+        :raise BadResponseException: If the page isn't an Atom feed.
+        """
         get = do_get or self._get
         status_code, headers, feed = get(url, {})
 
@@ -1657,19 +2313,7 @@ class OPDSImportMonitor(CollectionMonitor):
                 url, message=message, debug_message=feed,
                 status_code=status_code
             )
-
-        new_data = self.feed_contains_new_data(feed)
-
-        if new_data:
-            # There's something new on this page, so we need to check
-            # the next page as well.
-            next_links = self.importer.extract_next_links(feed)
-            return next_links, feed
-        else:
-            # There's nothing new, so we don't need to import this
-            # feed or check the next page.
-            self.log.info("No new data.")
-            return [], None
+        return feed
 
     def import_one_feed(self, feed):
         """Import every book mentioned in an OPDS feed."""
@@ -1683,12 +2327,19 @@ class OPDSImportMonitor(CollectionMonitor):
         )
 
         # Create CoverageRecords for the successful imports.
-        for edition in imported_editions:
-            record = CoverageRecord.add_for(
-                edition, self.importer.data_source,
-                CoverageRecord.IMPORT_OPERATION,
-                status=CoverageRecord.SUCCESS
+        if self.importer.batch_import:
+            CoverageRecord.bulk_add(
+                [edition.primary_identifier for edition in imported_editions],
+                self.importer.data_source, CoverageRecord.IMPORT_OPERATION,
+                status=CoverageRecord.SUCCESS, force=True
             )
+        else:
+            for edition in imported_editions:
+                record = CoverageRecord.add_for(
+                    edition, self.importer.data_source,
+                    CoverageRecord.IMPORT_OPERATION,
+                    status=CoverageRecord.SUCCESS
+                )
 
         # Create CoverageRecords for the failures.
         for urn, failure in failures.items():
@@ -1696,30 +2347,107 @@ class OPDSImportMonitor(CollectionMonitor):
                 operation=CoverageRecord.IMPORT_OPERATION
             )
         
-    def run_once(self, start_ignore, cutoff_ignore):
+    def follow_links(self):
+        """Follow the feed's next links until we reach a page with
+        nothing new.
+
+        :return: A list of (link, feed) 2-tuples for the pages that
+            need to be imported.
+        """
         feeds = []
         queue = [self.feed_url]
         seen_links = set([])
-        
-        # First, follow the feed's next links until we reach a page with
-        # nothing new. If any link raises an exception, nothing will be imported.
         while queue:
             new_queue = []
 
             for link in queue:
                 if link in seen_links:
                     continue
+                start = time.time()
                 next_links, feed = self.follow_one_link(link)
+                self.page_timings[link] = dict(fetch=time.time()-start)
                 new_queue.extend(next_links)
                 if feed:
                     feeds.append((link, feed))
                 seen_links.add(link)
 
             queue = new_queue
+        return feeds
+
+    def follow_links_with_prefetch(self, do_get=None):
+        """Like follow_links(), but the next few pages are downloaded
+        in the background while each page is checked for new data.
+        """
+        feeds = []
+        wanted = [self.feed_url]
+        seen_links = set([])
+        downloaded = dict()
+        prefetcher = FeedPrefetcher(self, self.feed_url, self.prefetch, do_get)
+        prefetcher.start()
+        try:
+            waiting_since = time.time()
+            for page in prefetcher.pages():
+                downloaded[page.url] = page
+                wait = time.time() - waiting_since
+
+                # Check the pages we want in the order follow_links()
+                # would have checked them.
+                while wanted:
+                    link = wanted[0]
+                    if link in seen_links:
+                        wanted.pop(0)
+                        continue
+                    if link not in downloaded:
+                        break
+                    wanted.pop(0)
+                    page = downloaded.pop(link)
+                    seen_links.add(link)
+                    self.log.info("Following next link: %s", link)
+                    start = time.time()
+                    new_data = self.feed_contains_new_data(page.feed)
+                    self.page_timings[link] = dict(
+                        fetch=page.fetch_time, wait=wait,
+                        check=time.time()-start
+                    )
+                    wait = 0
+                    if new_data:
+                        feeds.append((link, page.feed))
+                        wanted.extend(page.next_links)
+                    else:
+                        self.log.info("No new data.")
+                if not wanted:
+                    break
+                waiting_since = time.time()
+        finally:
+            prefetcher.stop()
+        return feeds
+
+    def run_once(self, start_ignore, cutoff_ignore):
+        self.page_timings = dict()
+
+        # First, follow the feed's next links until we reach a page with
+        # nothing new. If any link raises an exception, nothing will be imported.
+        if self.prefetch:
+            feeds = self.follow_links_with_prefetch()
+        else:
+            feeds = self.follow_links()
 
         # Start importing at the end. If something fails, it will be easier to
         # pick up where we left off.
         for link, feed in reversed(feeds):
             self.log.info("Importing next feed: %s", link)
+            start = time.time()
             self.import_one_feed(feed)
             self._db.commit()
+            self.page_timings.setdefault(link, dict())['import'] = (
+                time.time() - start
+            )
+        self.log_page_timings()
+
+    def log_page_timings(self):
+        for link, timings in self.page_timings.items():
+            self.log.info(
+                "%s: %s", link, ", ".join(
+                    "%s %.2fs" % (k, v) for k, v in sorted(timings.items())
+                )
+            )
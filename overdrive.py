@@ -386,14 +386,20 @@ class OverdriveAPI(object):
             for i in page_inventory:
                 yield i
 
-    def metadata_lookup(self, identifier):
+    def metadata_lookup(self, identifier, exception_on_401=False):
         """Look up metadata for an Overdrive identifier.
+
+        :param exception_on_401: Raise an exception instead of
+            refreshing the Bearer Token if it's expired. Refreshing
+            the token uses the database.
         """
         url = self.METADATA_ENDPOINT % dict(
             collection_token=self.collection_token,
             item_id=identifier.identifier
         )
-        status_code, headers, content = self.get(url, {})
+        status_code, headers, content = self.get(
+            url, {}, exception_on_401=exception_on_401
+        )
         if isinstance(content, basestring):
             content = json.loads(content)
         return content
@@ -1082,7 +1088,10 @@ class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
     DATA_SOURCE_NAME = DataSource.OVERDRIVE
     PROTOCOL = ExternalIntegration.OVERDRIVE
     INPUT_IDENTIFIER_TYPES = Identifier.OVERDRIVE_ID
-    
+
+    # Look up this many books at once.
+    DEFAULT_CONCURRENCY = 10
+
     def __init__(self, collection, api_class=OverdriveAPI, **kwargs):
         """Constructor.
 
@@ -1104,8 +1113,13 @@ class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
             _db = Session.object_session(collection)
             self.api = api_class(_db, collection)
 
+    def fetch_item(self, identifier):
+        # If the Bearer Token needs to be refreshed, that will happen
+        # when the item is processed.
+        return self.api.metadata_lookup(identifier, exception_on_401=True)
+
     def process_item(self, identifier):
-        info = self.api.metadata_lookup(identifier)
+        info = self.fetched(identifier, self.api.metadata_lookup)
         error = None
         if info.get('errorCode') == 'NotFound':
             error = "ID not recognized by Overdrive: %s" % identifier.identifier
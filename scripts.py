@@ -21,7 +21,10 @@ import unicodedata
 from collections import defaultdict
 from external_search import (
     ExternalSearchIndex,
+    ExternalSearchIndexVersions,
     SearchIndexMonitor,
+    SearchIndexProgress,
+    SearchIndexRangeJob,
 )
 import json
 from nose.tools import set_trace
@@ -42,7 +45,10 @@ from sqlalchemy.orm import Session
 from app_server import ComplaintController
 from axis import Axis360BibliographicCoverageProvider
 from config import Configuration, CannotLoadConfiguration
-from coverage import CollectionCoverageProviderJob
+from coverage import (
+    CollectionCoverageProviderJob,
+    CoverageProviderProgress,
+)
 from lane import Lane
 from metadata_layer import (
     LinkData,
@@ -94,7 +100,6 @@ from oneclick import (
     OneClickBibliographicCoverageProvider,
 )
 from overdrive import OverdriveBibliographicCoverageProvider
-from util import fast_query_count
 from util.opds_writer import OPDSFeed
 from util.personal_names import (
     contributor_name_match_ratio, 
@@ -104,6 +109,7 @@ from util.personal_names import (
 from util.worker_pools import (
     DatabaseWorker,
     DatabasePool,
+    ProcessPool,
 )
 
 from bibliotheca import (
@@ -300,6 +306,251 @@ class UpdateSearchIndexScript(RunMonitorScript):
         )
 
 
+class RebuildSearchIndexScript(Script):
+    """Update the search index for every Work, splitting the Works up
+    by ID among several threads.
+
+    Unlike UpdateSearchIndexScript, which handles one batch at a time,
+    this keeps both the database and the search index busy, so it's
+    the way to go when the whole index needs to be rebuilt.
+    """
+
+    DEFAULT_WORKER_SIZE = 5
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--works-index',
+            help='The ElasticSearch index to update, if other than the default.'
+        )
+        cls.add_worker_arguments(parser)
+        return parser
+
+    @classmethod
+    def add_worker_arguments(cls, parser):
+        parser.add_argument(
+            '--workers',
+            help='Number of threads to use.',
+            type=int, default=cls.DEFAULT_WORKER_SIZE
+        )
+        parser.add_argument(
+            '--batch-size',
+            help='Number of works to upload to the search index at once.',
+            type=int, default=SearchIndexMonitor.DEFAULT_BATCH_SIZE
+        )
+
+    def do_run(self, cmd_args=None, search_index_client=None, pool=None):
+        """Rebuild the search index.
+
+        :param search_index_client: An ExternalSearchIndex, for use in
+            tests.
+        :param pool: A DatabasePool (or other) object, for use in tests.
+        :return: A SearchIndexProgress describing the work that was done.
+        """
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        search_index_client = search_index_client or ExternalSearchIndex(
+            self._db, works_index=parsed.works_index
+        )
+        return self.rebuild(
+            search_index_client, parsed.workers, parsed.batch_size, pool=pool
+        )
+
+    def rebuild(self, search_index_client, workers, batch_size, pool=None,
+                record_coverage=True):
+        """Upload a search document for every Work to the
+        search client's works_index.
+
+        :param record_coverage: Passed into each SearchIndexRangeJob.
+        :return: A SearchIndexProgress describing the work that was done.
+        """
+        min_id, max_id, total = self._db.query(
+            func.min(Work.id), func.max(Work.id), func.count(Work.id)
+        ).one()
+        progress = SearchIndexProgress(total=total)
+        if min_id is None:
+            self.log.info("There are no works to index.")
+            return progress
+
+        # Without a commit, the query above holds up the threads.
+        self._db.commit()
+        session_factory = SessionManager.sessionmaker(session=self._db)
+        with (
+            pool or DatabasePool(workers, session_factory)
+        ) as job_queue:
+            for start, end in self.partitions(min_id, max_id, workers):
+                job_queue.put(
+                    SearchIndexRangeJob(
+                        search_index_client, start, end, batch_size,
+                        progress, record_coverage=record_coverage
+                    )
+                )
+        progress.report()
+        return progress
+
+    @classmethod
+    def partitions(cls, min_id, max_id, count):
+        """Split the range of IDs from `min_id` to `max_id` (inclusive)
+        into `count` ranges of roughly equal size.
+
+        :return: A list of (first ID, last ID) 2-tuples.
+        """
+        count = max(1, count)
+        size = max(1, (max_id - min_id + count) / count)
+        partitions = []
+        start = min_id
+        while start <= max_id:
+            end = min(start + size - 1, max_id)
+            partitions.append((start, end))
+            start = end + 1
+        return partitions
+
+
+class MigrateSearchIndexScript(RebuildSearchIndexScript):
+    """Build a new version of the search index while the -current
+    alias keeps serving search queries from the old one, then move the
+    alias over to the new index.
+
+    Works that change while the new index is being built are
+    reindexed in one or more catch-up passes before the alias moves,
+    so a mapping change doesn't mean a period of missing or stale
+    search results.
+    """
+
+    # Keep running catch-up passes until a pass finds no more than
+    # this many changed works...
+    CATCH_UP_THRESHOLD = 100
+
+    # ...or until this many passes have been run.
+    MAX_CATCH_UP_PASSES = 5
+
+    # Other processes may register works with clocks that don't quite
+    # match ours. Reindexing a few extra works is cheap; missing one
+    # isn't.
+    CATCH_UP_OVERLAP = datetime.timedelta(minutes=5)
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--version',
+            help='The index version to build, if other than the latest.'
+        )
+        cls.add_worker_arguments(parser)
+        return parser
+
+    def do_run(self, cmd_args=None, search_index_client=None, pool=None):
+        """Build the new index and move the alias onto it.
+
+        :param search_index_client: An ExternalSearchIndex, for use in
+            tests.
+        :param pool: A DatabasePool (or other) object, for use in tests.
+        :return: A SearchIndexProgress describing the initial build, or
+            None if there was nothing to do.
+        """
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        client = search_index_client or ExternalSearchIndex(self._db)
+
+        base_name = client.base_index_name(client.works_index)
+        new_index = ExternalSearchIndexVersions.versioned_index_name(
+            base_name, parsed.version
+        )
+        old_index = client.current_alias_index(self._db)
+        if old_index == new_index:
+            self.log.info(
+                "Search queries are already using %s. Use "
+                "RebuildSearchIndexScript to rebuild it in place.", new_index
+            )
+            return None
+
+        if ExternalSearchIndexVersions.create_new_version(
+            client, base_name, parsed.version
+        ):
+            self.log.info("Created new index %s.", new_index)
+        else:
+            self.log.info("Building into existing index %s.", new_index)
+
+        # From now on, search documents go into the new index.
+        # Search queries continue to go through the alias, which
+        # still points to the old index.
+        client.works_index = new_index
+
+        self.log.info(
+            "Building %s while %s continues to serve searches.",
+            new_index, old_index
+        )
+        started = datetime.datetime.utcnow()
+        progress = self.rebuild(
+            client, parsed.workers, parsed.batch_size, pool=pool,
+            record_coverage=False
+        )
+
+        # Reindex works that changed during the build. Each pass
+        # should take less time than the last, so fewer works will
+        # change while it runs.
+        since = started
+        for i in range(self.MAX_CATCH_UP_PASSES):
+            pass_started = datetime.datetime.utcnow()
+            changed = self.catch_up(client, since, parsed.batch_size)
+            since = pass_started
+            if changed <= self.CATCH_UP_THRESHOLD:
+                break
+
+        self.log.info("Moving the search alias from %s to %s.",
+                      old_index, new_index)
+        client.transfer_current_alias(self._db, new_index)
+
+        # Let running servers know that the search index has changed,
+        # so they start using the new version.
+        site_configuration_has_changed(self._db)
+
+        # Pick up anything that changed during the last pass, before
+        # the alias moved.
+        self.catch_up(client, since, parsed.batch_size)
+        return progress
+
+    def catch_up(self, search_index_client, since, batch_size):
+        """Reindex every Work that was registered as needing a search
+        index update at or after the given time.
+
+        This covers works updated directly by the
+        SearchIndexCoverageProvider as well as works still waiting
+        for it, since either way the WorkCoverageRecord's timestamp
+        will have changed.
+
+        :return: The number of works reindexed.
+        """
+        since = since - self.CATCH_UP_OVERLAP
+        qu = self._db.query(Work).join(Work.coverage_records).filter(
+            WorkCoverageRecord.operation
+            ==WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        ).filter(
+            WorkCoverageRecord.timestamp >= since
+        ).order_by(Work.id)
+
+        progress = SearchIndexProgress()
+        min_id = None
+        while True:
+            batch_qu = qu
+            if min_id is not None:
+                batch_qu = batch_qu.filter(Work.id > min_id)
+            batch = batch_qu.limit(batch_size).all()
+            if not batch:
+                break
+            successes, failures = search_index_client.bulk_update(batch)
+            for work, message in failures:
+                self.log.error(
+                    "Failed to update search index for %s: %s", work, message
+                )
+            progress.add(len(batch), len(failures))
+            min_id = batch[-1].id
+        self.log.info(
+            "Catch-up pass reindexed %d works changed since %s.",
+            progress.documents, since
+        )
+        return progress.documents
+
+
 class RunCoverageProvidersScript(Script):
     """Alternate between multiple coverage providers."""
     def __init__(self, providers, _db=None):
@@ -348,16 +599,33 @@ class RunCollectionCoverageProviderScript(RunCoverageProvidersScript):
 
 
 class RunThreadedCollectionCoverageProviderScript(Script):
-    """Run coverage providers in multiple threads."""
+    """Run coverage providers in multiple threads, or in multiple
+    processes.
+
+    The items that need coverage are split up front into ranges of
+    IDs, one batch's worth of items per range, and each range is
+    handed to a worker as a CollectionCoverageProviderJob.
+    """
 
     DEFAULT_WORKER_SIZE = 5
 
     def __init__(self, provider_class, worker_size=None, _db=None,
-        **provider_kwargs
+        processes=False, database_url=None, **provider_kwargs
     ):
+        """Constructor.
+
+        :param processes: If this is True, run the jobs in a pool of
+            worker processes rather than a pool of threads. This helps
+            when the provider spends most of its time on the CPU
+            rather than waiting on the network.
+        :param database_url: The database the worker processes should
+            connect to. By default, this is the production database.
+        """
         super(RunThreadedCollectionCoverageProviderScript, self).__init__(_db)
 
         self.worker_size = worker_size or self.DEFAULT_WORKER_SIZE
+        self.processes = processes
+        self.database_url = database_url
         self.session_factory = SessionManager.sessionmaker(session=self._db)
 
         # Use a database from the factory.
@@ -382,33 +650,48 @@ class RunThreadedCollectionCoverageProviderScript(Script):
 
         for collection in collections:
             provider = self.provider_class(collection, **self.provider_kwargs)
-            with (
-                pool or DatabasePool(self.worker_size, self.session_factory)
-            ) as job_queue:
-                query_size, batch_size = self.get_query_and_batch_sizes(
-                    provider
-                )
-                # Without a commit, the query to count which items need
-                # coverage hangs in the database, blocking the threads.
-                self._db.commit()
+            partitions = self.partitions(provider)
+            # Without a commit, the query to find which items need
+            # coverage hangs in the database, blocking the workers.
+            self._db.commit()
 
-                offset = 0
-                while offset < query_size:
+            progress = CoverageProviderProgress()
+            with (pool or self.pool()) as job_queue:
+                for min_id, max_id in partitions:
                     job = CollectionCoverageProviderJob(
-                        collection, self.provider_class, offset,
-                        **self.provider_kwargs
+                        collection, self.provider_class, min_id, max_id,
+                        progress=progress, **self.provider_kwargs
                     )
                     job_queue.put(job)
-                    offset += batch_size
+            progress.report()
 
             # Now that all the work is done, update the timestamp.
             provider.update_timestamp()
 
-    def get_query_and_batch_sizes(self, provider):
+    def pool(self):
+        if self.processes:
+            return ProcessPool(
+                self.worker_size,
+                self.database_url or Configuration.database_url()
+            )
+        return DatabasePool(self.worker_size, self.session_factory)
+
+    def partitions(self, provider):
+        """Split the items that need coverage into ranges of IDs
+        holding one batch's worth of items each.
+
+        :return: A list of (first ID, last ID) 2-tuples.
+        """
+        column = provider.item_id_column
         qu = provider.items_that_need_coverage(
             count_as_covered=BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
-        )
-        return fast_query_count(qu), provider.batch_size
+        ).with_entities(column).order_by(column)
+        ids = [id for (id,) in qu]
+        batch_size = provider.batch_size
+        return [
+            (ids[i], ids[min(i + batch_size, len(ids)) - 1])
+            for i in range(0, len(ids), batch_size)
+        ]
 
 
 class RunWorkCoverageProviderScript(RunCollectionCoverageProviderScript):
@@ -2042,6 +2325,18 @@ class RefreshMaterializedViewsScript(Script):
             b = time.time()
             self.log.info("%s vacuumed in %.2f sec", view_name, b-a)
 
+        if SessionManager.uses_materialized_view_mirror:
+            # Lanes are built from a mirror of the materialized
+            # view, which needs to be brought up to date too.
+            a = time.time()
+            SessionManager.update_materialized_view_mirror(db)
+            db.commit()
+            b = time.time()
+            self.log.info(
+                "%s updated in %.2f sec.",
+                SessionManager.MATERIALIZED_VIEW_LANES_MIRROR, b-a
+            )
+
         # Recalculate the sizes of lanes.
         for lane in db.query(Lane):
             lane.update_size(db)
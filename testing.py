@@ -17,6 +17,7 @@ from lane import (
 )
 from model import (
     Base,
+    CachedFeed,
     Classification,
     IntegrationClient,
     Collection,
@@ -58,6 +59,7 @@ from coverage import (
 )
 
 from external_search import DummyExternalSearchIndex
+from feed_cache import FeedCache
 from log import LogConfiguration
 import external_search
 import mock
@@ -182,6 +184,11 @@ class DatabaseTest(object):
         ExternalIntegration.reset_cache()
         Genre.reset_cache()
         Library.reset_cache()
+
+        # Forget about any FeedCache, which may contain copies of
+        # now-rolled-back feeds, and any request counts for those feeds.
+        FeedCache.reset()
+        CachedFeed.reset_request_counts()
         
         # Also roll back any record of those changes in the
         # Configuration instance.
@@ -1,3 +1,4 @@
+import datetime
 import os
 import json
 
@@ -33,12 +34,19 @@ from app_server import (
     URNLookupController,
     ErrorHandler,
     ComplaintController,
+    SuggestionController,
     load_facets_from_request,
+    load_pagination,
     load_pagination_from_request,
 )
 
 from config import Configuration
 
+from external_search import (
+    DummyExternalSearchIndex,
+    SuggestionTrie,
+)
+
 from entrypoint import (
     AudiobooksEntryPoint,
     EbooksEntryPoint,
@@ -188,6 +196,9 @@ class TestURNLookupController(DatabaseTest):
             eq_(200, response.status_code)
             eq_(OPDSFeed.ACQUISITION_FEED_TYPE,
                 response.headers['Content-Type'])
+
+            # The feed is streamed to the client as it's generated.
+            eq_(True, response.is_streamed)
             assert identifier.urn in response.data
             assert work.title in response.data
 
@@ -256,6 +267,69 @@ class TestComplaintController(DatabaseTest):
         eq_("bar", complaint.detail)
 
 
+class TestSuggestionController(DatabaseTest):
+
+    def setup(self):
+        super(TestSuggestionController, self).setup()
+        self.app = Flask(__name__)
+        Babel(self.app)
+        self.search = DummyExternalSearchIndex()
+        self.controller = SuggestionController(self._db, self.search)
+
+    def teardown(self):
+        SuggestionTrie.reset()
+        super(TestSuggestionController, self).teardown()
+
+    def test_suggest(self):
+        work = self._work(title=u"Moby Dick", quality=0.5)
+        work.presentation_ready = True
+        self.search.bulk_update([work])
+
+        with self.app.test_request_context('/?q=mob&size=5'):
+            response = self.controller.suggest(self._default_library)
+        eq_(200, response.status_code)
+        eq_(SuggestionController.CONTENT_TYPE,
+            response.headers['Content-Type'])
+        assert "max-age=%d" % SuggestionController.CACHE_TIME in (
+            response.headers['Cache-Control']
+        )
+        eq_(["mob", ["Moby Dick"]], json.loads(response.data))
+        [(args, kwargs)] = self.search.queries
+        eq_(("mob",), args)
+        eq_(dict(library=self._default_library, limit=5), kwargs)
+
+        # The number of suggestions is limited.
+        with self.app.test_request_context('/?q=mob&size=500'):
+            self.controller.suggest(self._default_library)
+        eq_(SuggestionController.MAX_SIZE, self.search.queries[-1][1]['limit'])
+
+        for size in ('string', '0', '-1'):
+            with self.app.test_request_context('/?q=mob&size=%s' % size):
+                problem = self.controller.suggest(self._default_library)
+            eq_(INVALID_INPUT.uri, problem.uri)
+
+    def test_search_index_error(self):
+        def fail(*args, **kwargs):
+            raise Exception("Elasticsearch is down")
+        self.search.suggest = fail
+        eq_([], self.controller.suggestions("mob", None, 10))
+
+    def test_no_search_integration(self):
+        # With no search integration configured, suggestions come
+        # from the database.
+        work = self._work(title=u"Moby Dick", with_license_pool=True)
+        work.presentation_ready = True
+        self._db.flush()
+        controller = SuggestionController(self._db)
+
+        # The trie is built in the background, so there are no
+        # suggestions until it's ready.
+        eq_([], controller.suggestions("moby", self._default_library, 10))
+        SuggestionTrie._builders[self._default_library.id].join()
+        eq_([u"Moby Dick"],
+            controller.suggestions("moby", self._default_library, 10))
+
+
 class TestLoadMethods(DatabaseTest):
 
     def setup(self):
@@ -345,6 +419,47 @@ class TestLoadMethods(DatabaseTest):
             pagination = load_pagination_from_request()
             eq_(100, pagination.size)
 
+        # A 'next' link may include the sort key of the last item on
+        # the previous page.
+        with self.app.test_request_context('/?after=50&key=%5B%22Author%22%2C1%5D'):
+            pagination = load_pagination_from_request()
+            eq_(50, pagination.offset)
+            eq_(["Author", 1], pagination.key)
+
+        with self.app.test_request_context('/?key=notakey'):
+            pagination = load_pagination_from_request()
+            eq_(INVALID_INPUT.uri, pagination.uri)
+            eq_("Invalid pagination key: notakey", str(pagination.detail))
+
+        # Each value in the key must be a string, a number or null.
+        with self.app.test_request_context('/?key=%5B%7B%22a%22%3A1%7D%5D'):
+            pagination = load_pagination_from_request()
+            eq_(INVALID_INPUT.uri, pagination.uri)
+
+    def test_load_pagination_with_facets(self):
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_ADDED_TO_COLLECTION
+        )
+
+        # The key is checked against the types of the fields in the
+        # sort order, and dates are turned back into datetimes.
+        pagination = load_pagination(
+            50, 50, '["2018-01-01T12:30:00","a","b",1]', facets
+        )
+        eq_([datetime.datetime(2018, 1, 1, 12, 30), "a", "b", 1],
+            pagination.key)
+
+        pagination = load_pagination(50, 50, '["not-a-date","a","b",1]', facets)
+        eq_(INVALID_INPUT.uri, pagination.uri)
+        eq_('Invalid pagination key: ["not-a-date","a","b",1]',
+            str(pagination.detail))
+
+        # A key for another sort order is left alone, and will be
+        # ignored in favor of the offset.
+        pagination = load_pagination(50, 50, '["a","b",1]', facets)
+        eq_(["a", "b", 1], pagination.key)
+
     def test_load_pagination_from_request_default_size(self):
         with self.app.test_request_context('/?size=50&after=10'):
             pagination = load_pagination_from_request(default_size=10)
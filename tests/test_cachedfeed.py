@@ -155,3 +155,77 @@ class TestCachedFeed(DatabaseTest):
             *args, max_age=AcquisitionFeed.CACHE_FOREVER
         )
         eq_("Cache this forever!", feed.content)
+
+    def test_stale_while_revalidate(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = self._lane(u"My Lane")
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets,
+                pagination, None)
+
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+        feed.update(self._db, u"Stale content", generation_time=1.5)
+        eq_(1.5, feed.generation_time)
+
+        # By default, a stale feed is not usable.
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+        eq_(False, fresh)
+
+        # In stale-while-revalidate mode, if another process is
+        # regenerating the feed, the stale version is usable.
+        other_connection = self.engine.connect()
+        try:
+            other_connection.execute(
+                "SELECT pg_advisory_lock(%d, %d)" % (
+                    CachedFeed.REGENERATION_LOCK_NAMESPACE, feed.id
+                )
+            )
+            feed, fresh = CachedFeed.fetch(
+                *args, max_age=0, stale_while_revalidate=True
+            )
+            eq_(True, fresh)
+            eq_(u"Stale content", feed.content)
+        finally:
+            other_connection.execute("SELECT pg_advisory_unlock_all()")
+            other_connection.close()
+
+        # Once no one else is regenerating the feed, the next process
+        # to ask for it gets the job of regenerating it.
+        feed, fresh = CachedFeed.fetch(
+            *args, max_age=0, stale_while_revalidate=True
+        )
+        eq_(False, fresh)
+
+    def test_request_counts(self):
+        lane = self._lane()
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, None, None, None)
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+        eq_(0, feed.recent_requests)
+
+        # Once the feed has content, later requests find the same row.
+        feed.update(self._db, u"The content")
+
+        # Requests are counted in memory until enough of them pile up.
+        old_batch_size = CachedFeed.REQUEST_COUNT_BATCH_SIZE
+        CachedFeed.REQUEST_COUNT_BATCH_SIZE = 3
+        try:
+            CachedFeed.fetch(*args, max_age=0)
+            self._db.refresh(feed)
+            eq_(0, feed.recent_requests)
+
+            CachedFeed.fetch(*args, max_age=0)
+            self._db.refresh(feed)
+            eq_(3, feed.recent_requests)
+        finally:
+            CachedFeed.REQUEST_COUNT_BATCH_SIZE = old_batch_size
+
+        # Regenerating a feed behind the scenes doesn't count as a
+        # request.
+        CachedFeed.fetch(*args, max_age=0, force_refresh=True)
+        eq_({}, dict(CachedFeed._request_counts))
+
+        # Request counts can be decayed so that older requests count
+        # for less.
+        CachedFeed.decay_request_counts(self._db)
+        self._db.refresh(feed)
+        eq_(1, feed.recent_requests)
@@ -1,4 +1,7 @@
 import datetime
+import os
+import pickle
+import threading
 from nose.tools import (
     assert_raises,
     assert_raises_regexp,
@@ -35,6 +38,7 @@ from model import (
     PresentationCalculationPolicy,
     Representation,
     RightsStatus,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
@@ -56,8 +60,11 @@ from coverage import (
     BibliographicCoverageProvider,
     CatalogCoverageProvider,
     CollectionCoverageProvider,
+    CollectionCoverageProviderJob,
     CoverageFailure,
+    CoverageProviderProgress,
     IdentifierCoverageProvider,
+    MaterializedViewMirrorCoverageProvider,
     OPDSEntryWorkCoverageProvider,
     PresentationReadyWorkCoverageProvider,
 )
@@ -304,6 +311,36 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         # successfully covered.
         assert covered in provider.attempts
 
+    def test_run_on_id_range(self):
+        identifiers = sorted(
+            [self._identifier() for i in range(5)], key=lambda x: x.id
+        )
+
+        # A transient failure doesn't make the provider try the same
+        # item over and over.
+        provider = TransientFailureCoverageProvider(self._db, batch_size=1)
+        processed = provider.run_on_id_range(
+            identifiers[3].id, identifiers[4].id
+        )
+        eq_(2, processed)
+        eq_([identifiers[3], identifiers[4]], provider.attempts)
+
+        provider = AlwaysSuccessfulCoverageProvider(self._db, batch_size=2)
+        data_source = provider.data_source
+
+        # One of the identifiers in the range already has coverage.
+        self._coverage_record(
+            identifiers[2], data_source, status=CoverageRecord.SUCCESS
+        )
+
+        # Only the identifiers in the range that need coverage are
+        # processed, a batch at a time.
+        processed = provider.run_on_id_range(
+            identifiers[1].id, identifiers[3].id
+        )
+        eq_(2, processed)
+        eq_([identifiers[1], identifiers[3]], provider.attempts)
+
     def test_process_batch_and_handle_results(self):
         """Test that process_batch_and_handle_results passes the identifiers
         its given into the appropriate BaseCoverageProvider, and deals
@@ -397,6 +434,53 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         Among other things, verify that handle_success is called.
         """
 
+    def test_process_batch_with_concurrency(self):
+        class Fetching(AlwaysSuccessfulCoverageProvider):
+            REQUESTS_PER_SECOND = 1000
+            def __init__(self, *args, **kwargs):
+                super(Fetching, self).__init__(*args, **kwargs)
+                self.fetch_threads = set()
+                self.fetched_in_process_item = []
+            def fetch_item(self, item):
+                self.fetch_threads.add(threading.current_thread())
+                if item.identifier == 'broken':
+                    raise Exception("network trouble")
+                return "prefetched %s" % item.identifier
+            def process_item(self, item):
+                self.fetched_in_process_item.append(
+                    self.fetched(item, lambda x: "fetched %s" % x.identifier)
+                )
+                return super(Fetching, self).process_item(item)
+
+        i1 = self._identifier(foreign_id='good')
+        i2 = self._identifier(foreign_id='broken')
+
+        provider = Fetching(self._db, concurrency=4)
+        eq_(4, provider.concurrency)
+        results = provider.process_batch([i1, i2])
+        eq_([i1, i2], results)
+        eq_([i1, i2], provider.attempts)
+
+        # Both items were fetched in worker threads. The one that
+        # couldn't be fetched there was fetched in this thread, when
+        # it was processed.
+        assert threading.current_thread() not in provider.fetch_threads
+        eq_(["prefetched good", "fetched broken"],
+            provider.fetched_in_process_item)
+
+        # The prefetched results don't outlive the batch.
+        eq_({}, provider._fetched)
+
+        # Every provider for a data source shares the same rate limiter.
+        eq_(provider.rate_limiter, Fetching(self._db).rate_limiter)
+
+        # By default, nothing is prefetched.
+        provider = Fetching(self._db)
+        eq_(1, provider.concurrency)
+        provider.process_batch([i1])
+        eq_(set(), provider.fetch_threads)
+        eq_(["fetched good"], provider.fetched_in_process_item)
+
     def test_should_update(self):
         """Verify that should_update gives the correct answer when we
         ask if a CoverageRecord needs to be updated.
@@ -1657,6 +1741,62 @@ class TestCollectionCoverageProvider(CoverageProviderTest):
         eq_(True, pool.work.presentation_ready)
 
 
+class TestCollectionCoverageProviderJob(DatabaseTest):
+
+    def test_run(self):
+        collection = self._collection()
+        editions = [
+            self._edition(collection=collection, with_license_pool=True)[0]
+            for i in range(3)
+        ]
+        ids = sorted(e.primary_identifier.id for e in editions)
+
+        progress = CoverageProviderProgress()
+        job = CollectionCoverageProviderJob(
+            collection, AlwaysSuccessfulCollectionCoverageProvider,
+            ids[0], ids[1], progress=progress
+        )
+        worker, items, seconds = job.run(self._db)
+
+        # The items in the job's range were covered; the other wasn't.
+        provider = AlwaysSuccessfulCollectionCoverageProvider(collection)
+        eq_([ids[2]], [x.id for x in provider.items_that_need_coverage()])
+
+        # The job's progress was recorded.
+        eq_(threading.current_thread().name, worker)
+        eq_(2, items)
+        eq_({worker: (items, seconds)}, progress.workers)
+
+    def test_pickle(self):
+        # A job sent to a worker process leaves its progress behind.
+        progress = CoverageProviderProgress()
+        job = CollectionCoverageProviderJob(
+            self._default_collection,
+            AlwaysSuccessfulCollectionCoverageProvider, 1, 10,
+            progress=progress
+        )
+        unpickled = pickle.loads(pickle.dumps(job))
+        eq_(None, unpickled.progress)
+        eq_((1, 10), (unpickled.min_id, unpickled.max_id))
+
+        # Once the job's result comes back, it's recorded.
+        job.finished_in_process(("Process-1", 5, 2.5))
+        eq_({"Process-1": (5, 2.5)}, progress.workers)
+
+
+class TestCoverageProviderProgress(object):
+
+    def test_add(self):
+        progress = CoverageProviderProgress()
+        progress.add("Thread-1", 10, 2)
+        progress.add("Thread-2", 3, 1)
+        progress.add("Thread-1", 10, 3)
+        eq_({"Thread-1": (20, 5), "Thread-2": (3, 1)}, progress.workers)
+        eq_(23, progress.items)
+        eq_(4, progress.items_per_second("Thread-1"))
+        eq_(0, progress.items_per_second("Thread-3"))
+
+
 class TestCatalogCoverageProvider(CoverageProviderTest):
 
     def test_items_that_need_coverage(self):
@@ -1904,3 +2044,64 @@ class TestOPDSEntryWorkCoverageProvider(DatabaseTest):
         assert work.simple_opds_entry.startswith('<entry')
         assert work.verbose_opds_entry.startswith('<entry')
 
+
+class TestMaterializedViewMirrorCoverageProvider(DatabaseTest):
+
+    def setup(self):
+        super(TestMaterializedViewMirrorCoverageProvider, self).setup()
+
+        # Create the mirror table, and act as though lanes are being
+        # built from it.
+        base_path = os.path.split(os.path.split(__file__)[0])[0]
+        path = os.path.join(
+            base_path, "files",
+            SessionManager.MATERIALIZED_VIEW_LANES_MIRROR_FILE
+        )
+        self._db.execute(open(path).read())
+        self.old_uses_mirror = SessionManager.uses_materialized_view_mirror
+        SessionManager.uses_materialized_view_mirror = True
+
+    def teardown(self):
+        SessionManager.uses_materialized_view_mirror = self.old_uses_mirror
+        super(TestMaterializedViewMirrorCoverageProvider, self).teardown()
+
+    def work_ids_in(self, table):
+        return set(
+            x[0] for x in self._db.execute("select works_id from %s" % table)
+        )
+
+    def test_run(self):
+        # Creating a work registers it as needing to be mirrored.
+        work = self._work(with_license_pool=True)
+        provider = MaterializedViewMirrorCoverageProvider(self._db)
+        eq_([work], provider.items_that_need_coverage().all())
+        eq_(set(), self.work_ids_in("works_for_lanes"))
+
+        provider.run()
+
+        # The work's rows were calculated from the materialized view's
+        # definition and put into the mirror. The materialized view
+        # itself was not refreshed.
+        eq_(set([work.id]), self.work_ids_in("works_for_lanes"))
+        eq_(set(), self.work_ids_in("mv_works_for_lanes"))
+        eq_([], provider.items_that_need_coverage().all())
+
+        # If the work no longer belongs in the view, its rows are
+        # removed from the mirror.
+        work.simple_opds_entry = None
+        work.materialized_view_needs_updating()
+        provider.run()
+        eq_(set(), self.work_ids_in("works_for_lanes"))
+
+    def test_run_refreshes_everything_when_too_much_has_changed(self):
+        work = self._work(with_license_pool=True)
+        provider = MaterializedViewMirrorCoverageProvider(
+            self._db, maximum_delta=0
+        )
+        provider.run()
+
+        # The materialized view was refreshed and copied into the
+        # mirror, and the work no longer needs coverage.
+        eq_(set([work.id]), self.work_ids_in("mv_works_for_lanes"))
+        eq_(set([work.id]), self.work_ids_in("works_for_lanes"))
+        eq_([], provider.items_that_need_coverage().all())
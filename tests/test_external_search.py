@@ -1,9 +1,12 @@
+# encoding: utf-8
 from nose.tools import (
     assert_raises,
     eq_,
     set_trace,
 )
+from nose.plugins.skip import SkipTest
 import logging
+import os
 import time
 from psycopg2.extras import NumericRange
 
@@ -11,7 +14,11 @@ from . import (
     DatabaseTest,
 )
 
-from lane import Lane
+from config import Configuration
+from lane import (
+    Facets,
+    Lane,
+)
 from model import (
     Edition,
     ExternalIntegration,
@@ -21,8 +28,12 @@ from external_search import (
     ExternalSearchIndex,
     ExternalSearchIndexVersions,
     DummyExternalSearchIndex,
+    SearchCache,
     SearchIndexCoverageProvider,
     SearchIndexMonitor,
+    SearchIndexProgress,
+    SearchIndexRangeJob,
+    SuggestionTrie,
 )
 from classifier import Classifier
 
@@ -60,6 +71,10 @@ class ExternalSearchTest(DatabaseTest):
                 self.search.indices.delete(self.search.works_index, ignore=[404])
             self.search.indices.delete('the_other_index', ignore=[404])
             self.search.indices.delete('test_index-v100', ignore=[404])
+            self.search.indices.delete('test_index-v3', ignore=[404])
+            self.search.indices.delete(
+                self.search.works_index_name(self._db), ignore=[404]
+            )
             ExternalSearchIndex.reset()
         super(ExternalSearchTest, self).teardown()
 
@@ -84,7 +99,8 @@ class TestExternalSearch(ExternalSearchTest):
         """
         if not self.search:
             return
-        eq_("test_index-v3", self.search.works_index_name(self._db))
+        eq_("test_index-" + ExternalSearchIndexVersions.latest(),
+            self.search.works_index_name(self._db))
 
     def test_setup_index_creates_new_index(self):
         if not self.search:
@@ -151,6 +167,40 @@ class TestExternalSearch(ExternalSearchTest):
         eq_('my-app-%s' % version, self.search.works_index)
         eq_('my-app-' + self.search.CURRENT_ALIAS_SUFFIX, self.search.works_alias)
 
+    def test_setup_current_alias_on_older_index(self):
+        if not self.search:
+            return
+
+        # A new version of the index is being built, but the -current
+        # alias is still on the old version.
+        self.search.setup_index(new_index='test_index-v3')
+        self.search.transfer_current_alias(self._db, 'test_index-v3')
+        self.search.setup_index(new_index='test_index-v4')
+        self.search.works_index = 'test_index-v4'
+        self.search.works_alias = None
+
+        # Search queries go through the alias to the old index, not
+        # to the half-built new one.
+        self.search.setup_current_alias(self._db)
+        alias = 'test_index-' + self.search.CURRENT_ALIAS_SUFFIX
+        eq_(alias, self.search.works_alias)
+        eq_(['test_index-v3'],
+            self.search.indices.get_alias(name=alias).keys())
+
+        # The same is true for a process that starts up while the
+        # new index is being built. That process also sends its
+        # search documents to the old index, since the new one will be
+        # caught up before the alias moves.
+        ExternalSearchIndex.reset()
+        self.search = ExternalSearchIndex(self._db)
+        eq_(alias, self.search.works_alias)
+        eq_(['test_index-v3'],
+            self.search.indices.get_alias(name=alias).keys())
+        eq_('test_index-v3', self.search.works_index)
+
+        # The old index doesn't have the fields needed for lane feeds.
+        eq_(False, self.search.supports_lane_feeds)
+
     def test_transfer_current_alias(self):
         if not self.search:
             return
@@ -201,6 +251,49 @@ class TestExternalSearch(ExternalSearchTest):
             'banana-v10'
         )
 
+    def test_current_alias_index(self):
+        if not self.search:
+            return
+
+        original_index = self.search.works_index
+        eq_(original_index, self.search.current_alias_index(self._db))
+
+        self.search.setup_index(new_index='test_index-v9999')
+        self.search.transfer_current_alias(self._db, 'test_index-v9999')
+        eq_('test_index-v9999', self.search.current_alias_index(self._db))
+
+        # If there is no alias, there's no current index.
+        self.search.indices.delete_alias(
+            index='test_index-v9999', name='test_index-current'
+        )
+        eq_(None, self.search.current_alias_index(self._db))
+
+class TestForLaneFeeds(DatabaseTest):
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+        super(TestForLaneFeeds, self).teardown()
+
+    def test_for_lane_feeds(self):
+        client = DummyExternalSearchIndex()
+        ExternalSearchIndex._lane_feed_client = client
+        ExternalSearchIndex._lane_feed_client_key = (
+            Configuration.site_configuration_last_update(self._db)
+        )
+        eq_(client, ExternalSearchIndex.for_lane_feeds(self._db))
+
+        # If the index serving search queries is too old to have the
+        # fields lane feeds need, lane feeds can't use it.
+        client.supports_lane_feeds = False
+        eq_(None, ExternalSearchIndex.for_lane_feeds(self._db))
+
+    def test_index_version(self):
+        m = ExternalSearchIndex.index_version
+        eq_(3, m("circulation-works-v3"))
+        eq_(100, m("circulation-works-v100"))
+        eq_(None, m("circulation-works-current"))
+
+
 class TestExternalSearchWithWorks(ExternalSearchTest):
     """These tests run against a real search index with works in it.
     The setup is very slow, so all the tests are in the same method.
@@ -1193,6 +1286,535 @@ class TestSearchQuery(DatabaseTest):
         assert "5" not in remaining_query['query']
         assert "years" not in remaining_query['query']
 
+    def test_make_query_is_memoized(self):
+        search = DummyExternalSearchIndex()
+        ExternalSearchIndex.reset()
+        query = search.make_query("test romance")
+
+        # The same query string gets the same query object, even from
+        # a different ExternalSearchIndex.
+        assert query is DummyExternalSearchIndex().make_query("test romance")
+        assert query is not search.make_query("test mystery")
+
+        # But the query is the same as it would be if it were built
+        # from scratch.
+        eq_(search._make_query("test romance"), query)
+
+
+class TestSearchResultCache(object):
+
+    def setup(self):
+        ExternalSearchIndex.reset()
+        self.search = DummyExternalSearchIndex()
+        self.requests = []
+        def search(**kwargs):
+            self.requests.append(kwargs)
+            return dict(hits=dict(hits=[dict(_id=len(self.requests))]))
+        self.search.search = search
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+
+    def query(self, query_string, media=None, languages=None, offset=0):
+        # DummyExternalSearchIndex doesn't talk to Elasticsearch, so
+        # use the real implementation of query_works.
+        return ExternalSearchIndex.query_works(
+            self.search, None, query_string, media, languages, None,
+            None, None, offset=offset
+        )
+
+    def test_query_works_caches_results(self):
+        first = self.query("Harry Potter", media=["Book", "Audio"])
+        eq_(1, len(self.requests))
+
+        # A search that differs only in capitalization, spacing, and
+        # the order of its filter values is answered from the cache.
+        eq_(first, self.query(" harry  potter", media=["Audio", "Book"]))
+        eq_(1, len(self.requests))
+
+        # But a different page of results is a different search.
+        self.query("harry potter", media=["Book", "Audio"], offset=30)
+        eq_(2, len(self.requests))
+
+        # Uploading search documents invalidates the cache, but
+        # uploading nothing doesn't.
+        self.search.upload_search_documents([], [], [])
+        self.query("harry potter", media=["Book", "Audio"])
+        eq_(2, len(self.requests))
+        doc = dict(_id=1, _index="works", _type="work-type")
+        self.search.upload_search_documents([], [], [doc])
+        self.query("harry potter", media=["Book", "Audio"])
+        eq_(3, len(self.requests))
+
+        # So does moving the search alias.
+        self.search.works_alias = "works-v2"
+        self.query("harry potter", media=["Book", "Audio"])
+        eq_(4, len(self.requests))
+        eq_("works-v2", self.requests[-1]['index'])
+
+    def test_result_cache_key(self):
+        m = self.search.result_cache_key
+        args = (None, None, None, None, None, None, None, None, None, 30, 0)
+        eq_(m("moby dick", *args), m("Moby   Dick ", *args))
+
+        # Genres may be given as objects or IDs.
+        class MockGenre(object):
+            id = 5
+        genre_args = (None, None, None, None, None, None)
+        eq_(m("q", *(genre_args + ([MockGenre()], None, None, 30, 0))),
+            m("q", *(genre_args + ([5], None, None, 30, 0))))
+
+        # Target age may be given as a tuple or a range.
+        eq_(m("q", None, None, None, None, None, (5, 8), None, None, None, 30, 0),
+            m("q", None, None, None, None, None, NumericRange(5, 8),
+              None, None, None, 30, 0))
+
+    def test_search_cache(self):
+        cache = SearchCache(max_size=2, ttl=10)
+        cache.store("a", 1, now=100)
+        cache.store("b", 2, now=100)
+        eq_(1, cache.get("a", now=105))
+
+        # Storing a third value evicts the least recently used one.
+        cache.store("c", 3, now=105)
+        eq_(None, cache.get("b", now=105))
+        eq_(1, cache.get("a", now=105))
+        eq_(2, len(cache))
+
+        # Values expire after the TTL.
+        eq_(None, cache.get("a", now=110))
+        eq_(3, cache.get("c", now=110))
+        eq_(3, cache.hits)
+        eq_(2, cache.misses)
+
+        # A cache with no TTL keeps values until they're evicted.
+        cache = SearchCache(max_size=2)
+        cache.store("a", 1, now=100)
+        eq_(1, cache.get("a", now=1000000))
+
+
+class TestQueryWorksByFilter(object):
+
+    def setup(self):
+        ExternalSearchIndex.reset()
+        self.search = DummyExternalSearchIndex()
+        self.requests = []
+        def search(**kwargs):
+            self.requests.append(kwargs)
+            return dict(hits=dict(hits=[dict(_id="2"), dict(_id="1")]))
+        self.search.search = search
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+
+    def query(self, filters, **kwargs):
+        # DummyExternalSearchIndex has its own query_works_by_filter,
+        # so use the real implementation.
+        return ExternalSearchIndex.query_works_by_filter(
+            self.search, filters, **kwargs
+        )
+
+    def test_sort_order(self):
+        filter = {'term': {'medium': 'book'}}
+        eq_([2, 1], self.query([filter, None], order='availability_time',
+                               order_ascending=False, size=10, offset=20))
+        [request] = self.requests
+        eq_("works-current", request['index'])
+        eq_(10, request['size'])
+        eq_(20, request['from_'])
+        eq_(False, request['_source'])
+
+        body = request['body']
+        eq_(dict(filtered=dict(filter={'and': [filter]})), body['query'])
+
+        # The requested order comes first, then the default order
+        # is used to break ties.
+        eq_([{'availability_time': dict(order='desc')},
+             {'sort_author': dict(order='asc')},
+             {'sort_title': dict(order='asc')}],
+            body['sort'])
+
+        # If the requested order is one of the defaults, it's not
+        # repeated.
+        self.query([], order='sort_title')
+        eq_([{'sort_title': dict(order='asc')},
+             {'sort_author': dict(order='asc')}],
+            self.requests[-1]['body']['sort'])
+        eq_(dict(filtered=dict(filter={'match_all': {}})),
+            self.requests[-1]['body']['query'])
+
+    def test_quality_filters(self):
+        self.query([], minimum_quality=0.6, main_collection_only=True)
+        [minimum_quality, main_collection] = (
+            self.requests[-1]['body']['query']['filtered']['filter']['and']
+        )
+        eq_({"range": {"quality": {"gte": 0.6}}}, minimum_quality)
+        eq_({'or': [{'term': {'open_access': False}},
+                    {"range": {"quality": {"gte": 0.3}}}]},
+            main_collection)
+
+    def test_availability(self):
+        self.query([], availability=Facets.AVAILABLE_NOW)
+        eq_(dict(filtered=dict(filter={'and': [{'term': {'available': True}}]})),
+            self.requests[-1]['body']['query'])
+
+        self.query([], availability=Facets.AVAILABLE_OPEN_ACCESS)
+        eq_(dict(filtered=dict(filter={'and': [{'term': {'open_access': True}}]})),
+            self.requests[-1]['body']['query'])
+
+        # Asking for all books doesn't add a filter.
+        self.query([], availability=Facets.AVAILABLE_ALL)
+        eq_(dict(filtered=dict(filter={'match_all': {}})),
+            self.requests[-1]['body']['query'])
+
+    def test_featurable_quality(self):
+        # When looking for featured works, high-quality works are
+        # scored highest, and ties are broken randomly.
+        self.query([], featurable_quality=0.65, order='sort_title')
+        body = self.requests[-1]['body']
+        assert 'sort' not in body
+        function_score = body['query']['function_score']
+        [quality, main_collection, random] = function_score['functions']
+        eq_({"range": {"quality": {"gte": 0.65}}}, quality['filter'])
+        eq_(5, quality['weight'])
+        eq_(2, main_collection['weight'])
+        eq_(dict(random_score={}), random)
+        eq_("replace", function_score['boost_mode'])
+
+    def test_results_are_cached(self):
+        eq_([2, 1], self.query([], order='sort_title'))
+        eq_([2, 1], self.query([], order='sort_title'))
+        eq_(1, len(self.requests))
+
+        # A different page is a different request.
+        self.query([], order='sort_title', offset=30)
+        eq_(2, len(self.requests))
+
+        # Uploading search documents invalidates the cache.
+        doc = dict(_id=1, _index="works", _type="work-type")
+        self.search.upload_search_documents([], [], [doc])
+        self.query([], order='sort_title')
+        eq_(3, len(self.requests))
+
+
+class TestFacetCounts(object):
+
+    def setup(self):
+        ExternalSearchIndex.reset()
+        self.search = DummyExternalSearchIndex()
+        self.requests = []
+        def search(**kwargs):
+            self.requests.append(kwargs)
+            return self.response
+        self.search.search = search
+        self.response = {
+            "hits": {"total": 12, "hits": []},
+            "aggregations": {
+                "available": {"doc_count": 12, "values": {"buckets": {
+                    "all": {"doc_count": 12},
+                    "now": {"doc_count": 5},
+                    "always": {"doc_count": 2},
+                }}},
+                "collection": {"doc_count": 5, "values": {"buckets": {
+                    "full": {"doc_count": 5},
+                    "main": {"doc_count": 4},
+                    "featured": {"doc_count": 1},
+                }}},
+                "language": {"doc_count": 4, "values": {"buckets": [
+                    {"key": "eng", "doc_count": 3},
+                    {"key": "spa", "doc_count": 1},
+                ]}},
+                "audience": {"doc_count": 4, "values": {"buckets": [
+                    {"key": "adult", "doc_count": 3},
+                    {"key": "youngadult", "doc_count": 1},
+                ]}},
+                "genre": {"doc_count": 4, "values": {"buckets": [
+                    {"key": 7, "doc_count": 4},
+                ]}},
+            }
+        }
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+
+    OTHER_COUNTS = [
+        ExternalSearchIndex.LANGUAGE_COUNTS,
+        ExternalSearchIndex.AUDIENCE_COUNTS,
+        ExternalSearchIndex.GENRE_COUNTS,
+    ]
+
+    def facet_counts(self, *args, **kwargs):
+        # DummyExternalSearchIndex has its own facet_counts, so use
+        # the real implementation.
+        return ExternalSearchIndex.facet_counts(self.search, *args, **kwargs)
+
+    def test_request(self):
+        filter = {'term': {'medium': 'book'}}
+        self.facet_counts(
+            [filter], availability=Facets.AVAILABLE_NOW,
+            collection=Facets.COLLECTION_MAIN, minimum_featured_quality=0.6,
+            counts=self.OTHER_COUNTS
+        )
+
+        # One request was made, and no works were requested -- only
+        # counts.
+        [request] = self.requests
+        eq_(0, request['size'])
+        body = request['body']
+        eq_(dict(filtered=dict(filter={'and': [filter]})), body['query'])
+
+        aggs = body['aggs']
+        now = {'term': {'available': True}}
+        main = self.search._main_collection_filter()
+
+        # The availability counts are restricted by the currently
+        # selected collection, and vice versa.
+        availability = aggs[Facets.AVAILABILITY_FACET_GROUP_NAME]
+        eq_({'and': [main]}, availability['filter'])
+        eq_(now, availability['aggs']['values']['filters']['filters']['now'])
+
+        collection = aggs[Facets.COLLECTION_FACET_GROUP_NAME]
+        eq_({'and': [now]}, collection['filter'])
+        eq_({"range": {"quality": {"gte": 0.6}}},
+            collection['aggs']['values']['filters']['filters']['featured'])
+
+        # The other counts are restricted by both.
+        for name, field in (('language', 'language'),
+                            ('audience', 'audience'),
+                            ('genre', 'genres.term')):
+            eq_({'and': [now, main]}, aggs[name]['filter'])
+            eq_(field, aggs[name]['aggs']['values']['terms']['field'])
+
+        # With no facets selected, nothing is restricted, and there's
+        # no way to count the 'featured' collection.
+        self.facet_counts([])
+        body = self.requests[-1]['body']
+        eq_({'match_all': {}}, body['query']['filtered']['filter'])
+        collection = body['aggs'][Facets.COLLECTION_FACET_GROUP_NAME]
+        eq_({'match_all': {}}, collection['filter'])
+        assert 'featured' not in collection['aggs']['values']['filters']['filters']
+
+        # Only the facet groups are counted unless other counts are
+        # asked for.
+        eq_(set([Facets.AVAILABILITY_FACET_GROUP_NAME,
+                 Facets.COLLECTION_FACET_GROUP_NAME]),
+            set(body['aggs'].keys()))
+
+    def test_response(self):
+        counts = self.facet_counts([], counts=self.OTHER_COUNTS)
+        eq_(12, counts['total'])
+        eq_(dict(all=12, now=5, always=2),
+            counts[Facets.AVAILABILITY_FACET_GROUP_NAME])
+        eq_(dict(full=5, main=4, featured=1),
+            counts[Facets.COLLECTION_FACET_GROUP_NAME])
+        eq_(dict(eng=3, spa=1), counts['language'])
+        eq_({Classifier.AUDIENCE_ADULT: 3, Classifier.AUDIENCE_YOUNG_ADULT: 1},
+            counts['audience'])
+        eq_({7: 4}, counts['genre'])
+
+        # The counts are cached.
+        eq_(counts, self.facet_counts([], counts=self.OTHER_COUNTS))
+        eq_(1, len(self.requests))
+
+
+class TestSuggestions(object):
+
+    def setup(self):
+        ExternalSearchIndex.reset()
+        self.search = DummyExternalSearchIndex()
+        self.requests = []
+        def search(**kwargs):
+            self.requests.append(kwargs)
+            return dict(hits=dict(hits=[
+                dict(_id="2", _source=dict(
+                    suggestions=["Moby Dick", "Herman Melville"])),
+                dict(_id="1", _source=dict(
+                    suggestions=["moby  dick", "Mobile Suits", "Anonymous"])),
+            ]))
+        self.search.search = search
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+
+    def suggest(self, *args, **kwargs):
+        # DummyExternalSearchIndex has its own suggest, so use the
+        # real implementation.
+        return ExternalSearchIndex.suggest(self.search, *args, **kwargs)
+
+    def test_add_suggestions(self):
+        doc = dict(title=u"Moby Dick", series=u"  moby dick ",
+                   author=u"Herman  Melville", quality=0.5, popularity=2)
+        ExternalSearchIndex.add_suggestions(doc)
+        eq_([u"Moby Dick", u"Herman Melville"], doc['suggestions'])
+
+        # Quality and popularity are both counted, but popularity
+        # is capped.
+        eq_(500 + 500, doc['suggestion_weight'])
+
+        doc = ExternalSearchIndex.add_suggestions(dict(title=u"Untitled"))
+        eq_([u"Untitled"], doc['suggestions'])
+        eq_(0, doc['suggestion_weight'])
+
+    def test_request(self):
+        eq_(["Moby Dick", "Mobile Suits"], self.suggest(" MOB", limit=5))
+        [request] = self.requests
+        eq_("works-current", request['index'])
+        eq_(15, request['size'])
+        eq_(['suggestions'], request['_source'])
+        eq_([dict(suggestion_weight=dict(order='desc'))],
+            request['body']['sort'])
+        filtered = request['body']['query']['filtered']
+        eq_(dict(match=dict(suggestions="mob")), filtered['query'])
+        eq_({'match_all': {}}, filtered['filter'])
+
+        # The suggestions are cached.
+        eq_(["Moby Dick", "Mobile Suits"], self.suggest("mob", limit=5))
+        eq_(1, len(self.requests))
+
+        # Only the first MAX_SUGGESTION_PREFIX characters are sent to
+        # the search index, but the whole prefix must match.
+        self.search.MAX_SUGGESTION_PREFIX = 3
+        eq_(["Moby Dick"], self.suggest("moby", limit=5))
+        eq_(dict(match=dict(suggestions="mob")),
+            self.requests[-1]['body']['query']['filtered']['query'])
+
+        # An empty prefix doesn't need a request.
+        eq_([], self.suggest("  "))
+        eq_(2, len(self.requests))
+
+    def test_library_filter(self):
+        class MockCollection(object):
+            def __init__(self, id):
+                self.id = id
+        class MockLibrary(object):
+            collections = [MockCollection(2), MockCollection(1)]
+        self.suggest("mob", MockLibrary())
+        filter = self.requests[-1]['body']['query']['filtered']['filter']
+        eq_(self.search.make_filter(
+            [1, 2], None, None, None, None, None, None, None
+        ), filter)
+
+
+class TestSuggestionTrie(object):
+
+    def test_suggest(self):
+        trie = SuggestionTrie(suggestions_per_node=2)
+        trie.add(u"Moby Dick", 5)
+        trie.add(u"Mobile  Suits", 9)
+        trie.add(u"Émile", 4)
+
+        # The best suggestions come first, and prefixes match
+        # regardless of case, spacing or accents.
+        eq_([u"Mobile Suits", u"Moby Dick"], trie.suggest(u"MO"))
+        eq_([u"Moby Dick"], trie.suggest(u"moby "))
+        eq_([u"Émile"], trie.suggest(u"emi"))
+        eq_([u"Mobile Suits"], trie.suggest(u"mo", limit=1))
+        eq_([], trie.suggest(u"x"))
+        eq_([], trie.suggest(u""))
+
+        # Adding the same suggestion again keeps the highest weight.
+        trie.add(u"moby dick", 1)
+        trie.add(u"Moby Dick", 10)
+        eq_([u"Moby Dick", u"Mobile Suits"], trie.suggest(u"mo"))
+        eq_(3, len(trie))
+
+        # Each node only remembers its best suggestions.
+        trie.add(u"Mo", 1)
+        eq_([u"Moby Dick", u"Mobile Suits"], trie.suggest(u"mo", limit=5))
+
+    def test_max_depth(self):
+        # By default, the trie goes as deep as the suggestions index,
+        # and a node holds as many suggestions as anyone can ask for.
+        trie = SuggestionTrie()
+        eq_(ExternalSearchIndex.MAX_SUGGESTION_PREFIX, trie.max_depth)
+        eq_(SuggestionTrie.SUGGESTIONS_PER_NODE, trie.suggestions_per_node)
+
+        trie = SuggestionTrie(suggestions_per_node=1, max_depth=3)
+        trie.add(u"Moby Dick", 5)
+        trie.add(u"Mobile Suits", 9)
+        trie.add(u"Mob Rule", 4)
+
+        # The trie stops at three characters.
+        node = trie._build()
+        for character in u"mob":
+            node = node[0][character]
+        eq_({}, node[0])
+
+        # Since the deepest nodes are used to answer every longer
+        # prefix, they keep every suggestion, not just the best ones.
+        eq_([u"Mobile Suits", u"Moby Dick", u"Mob Rule"], node[1])
+        eq_([u"Mobile Suits"], trie.suggest(u"mo", limit=5))
+        eq_([u"Moby Dick"], trie.suggest(u"moby", limit=5))
+        eq_([u"Mob Rule"], trie.suggest(u"MOB R", limit=5))
+        eq_([], trie.suggest(u"mobs", limit=5))
+
+    def test_add_document(self):
+        trie = SuggestionTrie()
+        doc = ExternalSearchIndex.add_suggestions(
+            dict(title=u"Moby Dick", author=u"Herman Melville", quality=0.5)
+        )
+        trie.add_document(doc)
+        eq_([u"Herman Melville"], trie.suggest(u"her"))
+
+
+class TestSuggestionTrieFromDatabase(DatabaseTest):
+
+    def teardown(self):
+        SuggestionTrie.reset()
+        super(TestSuggestionTrieFromDatabase, self).teardown()
+
+    def test_for_library(self):
+        moby = self._work(title=u"Moby Dick", with_license_pool=True)
+        moby.presentation_ready = True
+        unready = self._work(title=u"Mobile Suits", with_license_pool=True)
+        unready.presentation_ready = False
+        elsewhere = self._work(
+            title=u"Mobility", with_license_pool=True,
+            collection=self._collection()
+        )
+        elsewhere.presentation_ready = True
+
+        self._db.flush()
+
+        # The first time a library's trie is needed, it's built in the
+        # background and an empty trie is used in the meantime.
+        library = self._default_library
+        empty = SuggestionTrie.for_library(self._db, library)
+        eq_(0, len(empty))
+        builder = SuggestionTrie._builders[library.id]
+        builder.join()
+
+        trie = SuggestionTrie.for_library(self._db, library)
+        eq_([u"Moby Dick"], trie.suggest(u"mob"))
+
+        # The trie is reused until it's time to rebuild it.
+        eq_(trie, SuggestionTrie.for_library(self._db, library))
+        eq_(builder, SuggestionTrie._builders[library.id])
+
+        # Once it's out of date, the old trie is served while a new
+        # one is built.
+        built, trie = SuggestionTrie._by_library[library.id]
+        SuggestionTrie._by_library[library.id] = (
+            built - SuggestionTrie.REBUILD_AFTER - 1, trie
+        )
+        eq_(trie, SuggestionTrie.for_library(self._db, library))
+        new_builder = SuggestionTrie._builders[library.id]
+        assert new_builder != builder
+        new_builder.join()
+        rebuilt = SuggestionTrie.for_library(self._db, library)
+        assert rebuilt != trie
+        eq_([u"Moby Dick"], rebuilt.suggest(u"mob"))
+
+        # A trie can also be built immediately.
+        other = self._library()
+        trie = SuggestionTrie.for_library(self._db, other, background=False)
+        eq_([], trie.suggest(u"mob"))
+        assert other.id not in SuggestionTrie._builders
+
+        # With no library, every collection is included.
+        trie = SuggestionTrie.from_database(self._db, batch_size=1)
+        eq_(set([u"Moby Dick", u"Mobility"]), set(trie.suggest(u"mob")))
+
 
 class TestSearchFilterFromLane(DatabaseTest):
 
@@ -1295,6 +1917,163 @@ class TestBulkUpdate(DatabaseTest):
         eq_(set([w1, w2, w3]), set(successes))
         eq_([], failures)
 
+
+class TestContentHash(object):
+
+    def test_content_hash(self):
+        m = ExternalSearchIndex.content_hash
+        doc = dict(_id=1, _index="works", title="Moby Dick",
+                   open_access=True, collections=[dict(collection_id=1)])
+        body, availability = m(doc).split('-')
+
+        # Bulk upload metadata doesn't count...
+        eq_(m(doc), m(dict(doc, _type="other-type")))
+
+        # ...except for the index, since a document that's up to date
+        # in one index may be missing from another.
+        new_body, new_availability = m(dict(doc, _index="other-works")).split('-')
+        assert body != new_body
+        eq_(availability, new_availability)
+
+        # A change to an availability field changes only the second
+        # half of the hash.
+        new_body, new_availability = m(dict(doc, open_access=False)).split('-')
+        eq_(body, new_body)
+        assert availability != new_availability
+
+        # Any other change changes the first half.
+        new_body, new_availability = m(dict(doc, title="Omoo")).split('-')
+        assert body != new_body
+        eq_(availability, new_availability)
+
+    def test_changed_documents(self):
+        search = DummyExternalSearchIndex()
+        def doc(id, **kwargs):
+            return dict(_id=id, _index="works", _type="work-type", **kwargs)
+        same = doc(1, title="Same")
+        available = doc(2, title="Available", available=True)
+        retitled = doc(3, title="Retitled")
+        new = doc(4, title="New")
+        previous = {
+            1: search.content_hash(same),
+            2: search.content_hash(dict(available, available=False)),
+            3: search.content_hash(dict(retitled, title="Old title")),
+        }
+        docs = [same, available, retitled, new]
+        changed, unchanged = search.changed_documents(
+            docs, search.content_hashes(docs), previous
+        )
+        eq_(set([1]), unchanged)
+        [update, retitled_doc, new_doc] = changed
+        eq_(dict(_op_type='update', _index="works", _type="work-type", _id=2,
+                 doc=dict(collections=None, open_access=None, available=True,
+                          availability_time=None)),
+            update)
+        eq_(retitled, retitled_doc)
+        eq_(new, new_doc)
+
+
+class TestReconcileUploadResults(object):
+
+    class MockWork(object):
+        """Acts enough like a Work for reconcile_upload_results(),
+        and keeps track of how often it's compared to another work.
+        """
+        comparisons = 0
+
+        def __init__(self, id):
+            self.id = id
+
+        def __eq__(self, other):
+            TestReconcileUploadResults.MockWork.comparisons += 1
+            return self is other
+
+    def setup(self):
+        self.index = DummyExternalSearchIndex()
+        self.MockWork.comparisons = 0
+
+    def batch(self, size):
+        """Simulate the upload of `size` works, where one in every ten
+        was removed from the index, one in every hundred had no
+        search document, and one in every hundred failed to upload.
+        """
+        works = [self.MockWork(i) for i in range(size)]
+        removed = [w for w in works if w.id % 10 == 1]
+        docs = [dict(_id=w.id) for w in works
+                if w.id % 10 != 1 and w.id % 100 != 2]
+        # Elasticsearch reports document IDs as strings.
+        errors = [dict(index=dict(_id=unicode(w.id), error="Oops"))
+                  for w in works if w.id % 100 == 3]
+        return works, removed, docs, errors
+
+    def test_reconcile_upload_results(self):
+        works, removed, docs, errors = self.batch(200)
+        successes, failures = self.index.reconcile_upload_results(
+            works, removed, docs, errors
+        )
+
+        # Removed works come first, followed by successfully indexed works.
+        eq_(removed, successes[:len(removed)])
+        eq_(200 - 4, len(successes))
+
+        # Works with no search document are failures, as are works
+        # whose documents couldn't be uploaded.
+        eq_([(works[2], "Work not indexed"), (works[102], "Work not indexed"),
+             (works[3], "Oops"), (works[103], "Oops")],
+            failures)
+
+        # An error that can't be traced back to a work is still a failure.
+        errors = [dict(data=dict(_id=12345), error="Who knows?")]
+        successes, failures = self.index.reconcile_upload_results(
+            [], [], [], errors
+        )
+        eq_([(None, "Who knows?")], failures)
+
+    def test_reconciliation_is_linear(self):
+        """Make sure the work done by reconciliation grows linearly
+        with the size of the batch.
+        """
+        calls = []
+        original = self.index._document_id
+        def _document_id(id):
+            calls.append(id)
+            return original(id)
+        self.index._document_id = _document_id
+
+        lookups = {}
+        for size in (1000, 10000):
+            works, removed, docs, errors = self.batch(size)
+            calls[:] = []
+            successes, failures = self.index.reconcile_upload_results(
+                works, removed, docs, errors
+            )
+            eq_(size, len(successes) + len(failures))
+            lookups[size] = len(calls)
+
+        # A quadratic algorithm would compare works to each other
+        # (e.g. with `work in successes`) millions of times.
+        eq_(0, self.MockWork.comparisons)
+
+        # Ten times as many works means ten times as many document ID
+        # lookups, not a hundred times as many.
+        eq_(lookups[1000] * 10, lookups[10000])
+
+    def test_reconciliation_benchmark(self):
+        """Time reconciliation of large batches. This only runs if the
+        RUN_BENCHMARKS environment variable is set.
+        """
+        if not os.environ.get('RUN_BENCHMARKS'):
+            raise SkipTest("Set RUN_BENCHMARKS to run benchmarks.")
+        for size in (1000, 2000, 5000, 10000):
+            works, removed, docs, errors = self.batch(size)
+            start = time.time()
+            self.index.reconcile_upload_results(works, removed, docs, errors)
+            logging.info(
+                "Reconciled %d works in %.4f seconds",
+                size, time.time() - start
+            )
+
+
 class TestSearchErrors(ExternalSearchTest):
 
     def test_search_connection_timeout(self):
@@ -1404,6 +2183,81 @@ class TestSearchIndexCoverageProvider(DatabaseTest):
         eq_(True, record.transient)
         eq_('There was an error!', record.exception)
 
+    def test_unchanged_documents_are_skipped(self):
+        work = self._work(with_license_pool=True)
+        work.set_presentation_ready()
+        [pool] = work.license_pools
+        pool.open_access = False
+        pool.licenses_owned = 1
+        index = DummyExternalSearchIndex()
+        uploads = []
+        def bulk(docs, **kwargs):
+            uploads.append(list(docs))
+            return DummyExternalSearchIndex.bulk(index, docs, **kwargs)
+        index.bulk = bulk
+        provider = SearchIndexCoverageProvider(
+            self._db, search_index_client=index
+        )
+        operation = provider.operation
+        def content_hash():
+            return WorkCoverageRecord.content_hashes(
+                self._db, [work.id], operation
+            ).get(work.id)
+
+        # The first time, the whole document is uploaded, and its
+        # hash is recorded.
+        provider.process_batch_and_handle_results([work])
+        [[doc]] = uploads
+        eq_(index.content_hash(doc), content_hash())
+
+        # If nothing has changed, nothing is uploaded, but the work
+        # still counts as covered.
+        eq_([work], provider.process_batch([work]))
+        eq_(1, len(uploads))
+
+        # If only the work's availability has changed, the document
+        # is updated in place. (Search documents are built with a
+        # SELECT statement, which doesn't flush the session.)
+        pool.open_access = True
+        self._db.flush()
+        provider.process_batch_and_handle_results([work])
+        [update] = uploads[-1]
+        eq_('update', update['_op_type'])
+        eq_(sorted(index.AVAILABILITY_FIELDS), sorted(update['doc'].keys()))
+        eq_(True, update['doc']['open_access'])
+        [indexed] = index.docs.values()
+        eq_(True, indexed['open_access'])
+        eq_(index.content_hash(indexed), content_hash())
+
+        # If anything else has changed, the whole document is uploaded.
+        work.presentation_edition.title = u"A new title"
+        self._db.flush()
+        provider.process_batch_and_handle_results([work])
+        [doc] = uploads[-1]
+        assert '_op_type' not in doc
+        eq_(u"A new title", doc['title'])
+
+        # Nothing has changed, but if the documents are going to a new
+        # index, the whole document is uploaded there.
+        index.works_index = "new-works-index"
+        provider.process_batch_and_handle_results([work])
+        [doc] = uploads[-1]
+        assert '_op_type' not in doc
+        eq_("new-works-index", doc['_index'])
+        eq_(index.content_hash(doc), content_hash())
+
+        # A failure clears the hash, so the whole document will be
+        # uploaded next time.
+        index.bulk = lambda docs, **kwargs: (0, [
+            dict(update=dict(_id=doc['_id'], error="Document missing"))
+            for doc in docs
+        ])
+        pool.open_access = False
+        self._db.flush()
+        [failure] = provider.process_batch([work])
+        eq_("Document missing", failure.exception)
+        eq_(None, content_hash())
+
 
 class TestSearchIndexMonitor(DatabaseTest):
 
@@ -1446,3 +2300,91 @@ class TestSearchIndexMonitor(DatabaseTest):
         # The next time we call process_batch, no work is done and the
         # result is 0, meaning we're done with every work in the system.
         eq_(0, monitor.process_batch(work.id))
+
+
+class TestSearchIndexRangeJob(DatabaseTest):
+
+    def test_run(self):
+        index = DummyExternalSearchIndex()
+        works = [self._work(with_license_pool=True) for i in range(4)]
+        [w1, w2, w3, w4] = sorted(works, key=lambda x: x.id)
+
+        # This work is no longer presentation-ready, but it still has
+        # a search document.
+        w3.presentation_ready = False
+        index.index(index.works_index, index.work_document_type, w3.id, {})
+        self._db.commit()
+
+        # Create a job that covers all but the first work, two works
+        # at a time.
+        progress = SearchIndexProgress()
+        job = SearchIndexRangeJob(index, w2.id, w4.id, 2, progress)
+        job.run(self._db)
+
+        # The presentation-ready works in range were added to the
+        # search index, and the other work was removed.
+        eq_(set([w2.id, w4.id]), set(x[-1] for x in index.docs.keys()))
+        eq_(2, progress.documents)
+        eq_(0, progress.failures)
+
+        # Every work in range got a WorkCoverageRecord, whether it was
+        # added to the index or removed from it.
+        def has_record(work):
+            return any(
+                x.operation==WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+                and x.status==WorkCoverageRecord.SUCCESS
+                for x in work.coverage_records
+            )
+        eq_([False, True, True, True], [has_record(w) for w in w1, w2, w3, w4])
+
+        # The job left the session the way it found it.
+        eq_(True, self._db.expire_on_commit)
+
+        # A job can also be told not to create WorkCoverageRecords.
+        job = SearchIndexRangeJob(
+            index, w1.id, w1.id, 2, record_coverage=False
+        )
+        job.run(self._db)
+        eq_(False, has_record(w1))
+
+
+class TestExternalSearchIndexVersions(object):
+
+    def test_versioned_index_name(self):
+        m = ExternalSearchIndexVersions.versioned_index_name
+        eq_("works-v2", m("works", "v2"))
+        eq_("works-v2", m("works", "2"))
+        eq_("works-" + ExternalSearchIndexVersions.latest(), m("works"))
+
+    def test_v4_body(self):
+        # The fields used to sort lane feeds can be sorted on.
+        body = ExternalSearchIndexVersions.v4_body()
+        properties = body['mappings'][ExternalSearchIndex.work_document_type]['properties']
+        eq_("not_analyzed", properties['sort_title']['index'])
+        eq_("not_analyzed", properties['sort_author']['index'])
+        eq_("date", properties['availability_time']['type'])
+        eq_("date", properties['last_update_time']['type'])
+        eq_("boolean", properties['open_access']['type'])
+
+        # Search suggestions are indexed by prefix.
+        eq_("autocomplete_analyzer", properties['suggestions']['analyzer'])
+        eq_("autocomplete_search_analyzer",
+            properties['suggestions']['search_analyzer'])
+        eq_("integer", properties['suggestion_weight']['type'])
+        analysis = body['settings']['analysis']
+        eq_("edge_ngram", analysis['filter']['autocomplete_filter']['type'])
+
+        # Everything else is the same as in v3.
+        v3_properties = ExternalSearchIndexVersions.v3_body()['mappings'][ExternalSearchIndex.work_document_type]['properties']
+        eq_(v3_properties['title'], properties['title'])
+
+
+class TestSearchIndexProgress(object):
+
+    def test_percent_complete(self):
+        progress = SearchIndexProgress()
+        eq_(None, progress.percent_complete)
+
+        progress = SearchIndexProgress(total=8)
+        progress.add(2)
+        eq_(25, progress.percent_complete)
@@ -0,0 +1,184 @@
+# encoding: utf-8
+import datetime
+import shutil
+import tempfile
+
+from nose.tools import (
+    assert_raises_regexp,
+    eq_,
+    set_trace,
+)
+
+from config import CannotLoadConfiguration
+from feed_cache import (
+    FeedCache,
+    InMemoryFeedCache,
+    LocalDiskFeedCache,
+)
+from lane import (
+    Facets,
+    Pagination,
+)
+from model import (
+    CachedFeed,
+    ExternalIntegration,
+)
+
+from . import DatabaseTest
+
+
+class TestInMemoryFeedCache(object):
+
+    def test_get_and_store(self):
+        cache = InMemoryFeedCache()
+        key = (1, None, 2, None, u"page", u"order=title", u"size=50")
+        now = datetime.datetime.utcnow()
+
+        # Nothing is cached yet.
+        eq_(None, cache.get(key, now))
+        eq_(1, cache.misses)
+
+        cache.store(key, now, u"A feed ☃")
+        eq_(u"A feed ☃", cache.get(key, now))
+        eq_(1, cache.hits)
+        eq_(len(u"A feed ☃".encode("utf8")), cache.bytes_served)
+        eq_(cache.bytes_served, cache.bytes_stored)
+
+        # If the database has a different timestamp for this feed,
+        # the cached copy is out of date and is not used.
+        later = now + datetime.timedelta(seconds=1)
+        eq_(None, cache.get(key, later))
+        eq_(2, cache.misses)
+
+        # A feed with no timestamp is never cached.
+        eq_(None, cache.get(key, None))
+
+        cache.remove(key)
+        eq_(None, cache.get(key, now))
+        eq_(0, cache.size)
+
+    def test_least_recently_used_feeds_are_evicted(self):
+        cache = InMemoryFeedCache(max_size=10)
+        now = datetime.datetime.utcnow()
+        cache.store(("a",), now, u"12345")
+        cache.store(("b",), now, u"12345")
+        eq_(10, cache.size)
+
+        # Using feed 'a' makes 'b' the least recently used feed.
+        eq_(u"12345", cache.get(("a",), now))
+        cache.store(("c",), now, u"12345")
+        eq_(10, cache.size)
+        eq_(1, cache.evictions)
+        eq_(None, cache.get(("b",), now))
+        eq_(u"12345", cache.get(("a",), now))
+        eq_(u"12345", cache.get(("c",), now))
+
+        # A feed that's bigger than the whole cache is not stored.
+        cache.store(("d",), now, u"12345678901")
+        eq_(None, cache.get(("d",), now))
+        eq_(10, cache.size)
+
+    def test_statistics(self):
+        cache = InMemoryFeedCache()
+        now = datetime.datetime.utcnow()
+        cache.store(("a",), now, u"feed")
+        cache.get(("a",), now)
+        cache.get(("b",), now)
+        eq_(dict(hits=1, misses=1, bytes_served=4, bytes_stored=4,
+                 size=4, feeds=1, evictions=0),
+            cache.statistics)
+
+
+class TestLocalDiskFeedCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_and_store(self):
+        cache = LocalDiskFeedCache(self.directory)
+        key = (1, None, 2, None, u"page", u"order=title", u"size=50")
+        now = datetime.datetime.utcnow()
+        eq_(None, cache.get(key, now))
+
+        cache.store(key, now, u"A feed ☃\nwith two lines")
+
+        # A different LocalDiskFeedCache using the same directory
+        # (e.g. in another process) sees the stored feed.
+        other = LocalDiskFeedCache(self.directory)
+        eq_(u"A feed ☃\nwith two lines", other.get(key, now))
+        eq_(None, other.get(key, now + datetime.timedelta(seconds=1)))
+
+        cache.remove(key)
+        eq_(None, other.get(key, now))
+
+
+class TestFeedCache(DatabaseTest):
+
+    def test_for_database(self):
+        # No feed cache is configured.
+        eq_(None, FeedCache.for_database(self._db))
+
+        integration = self._external_integration(
+            ExternalIntegration.IN_MEMORY_FEED_CACHE,
+            ExternalIntegration.FEED_CACHE_GOAL,
+        )
+        integration.setting(FeedCache.MAX_SIZE).value = "1000"
+        FeedCache.reset()
+        cache = FeedCache.for_database(self._db)
+        assert isinstance(cache, InMemoryFeedCache)
+        eq_(1000, cache.max_size)
+
+        # The same object is returned every time, so the cache
+        # persists across database sessions.
+        eq_(cache, FeedCache.for_database(self._db))
+
+    def test_implementation(self):
+        integration = self._external_integration(
+            u"Unknown", ExternalIntegration.FEED_CACHE_GOAL,
+        )
+        assert_raises_regexp(
+            CannotLoadConfiguration, "Unrecognized feed cache protocol",
+            FeedCache.implementation, integration
+        )
+
+    def test_cached_feed_uses_feed_cache(self):
+        self._external_integration(
+            ExternalIntegration.IN_MEMORY_FEED_CACHE,
+            ExternalIntegration.FEED_CACHE_GOAL,
+        )
+        FeedCache.reset()
+        cache = FeedCache.for_database(self._db)
+
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = self._lane(u"My Lane")
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+
+        # Updating a CachedFeed writes its content through to the cache.
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        feed.update(self._db, u"The content")
+        eq_(u"The content",
+            cache.get(feed.feed_cache_key, feed.timestamp))
+
+        # When the feed is fetched again, its content comes from the
+        # cache.
+        self._db.expire_all()
+        cache.store(feed.feed_cache_key, feed.timestamp, u"Cached content")
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(True, fresh)
+        eq_(u"Cached content", feed.content)
+
+        # The cached copy was not written back to the database.
+        assert feed not in self._db.dirty
+
+        # If the cache doesn't have a copy, the content is loaded from
+        # the database and stored in the cache for next time.
+        cache.remove(feed.feed_cache_key)
+        self._db.expire_all()
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(u"The content", feed.content)
+        eq_(u"The content",
+            cache.get(feed.feed_cache_key, feed.timestamp))
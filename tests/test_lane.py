@@ -1,4 +1,5 @@
 import datetime
+from decimal import Decimal
 import json
 import random
 from nose.tools import (
@@ -12,10 +13,12 @@ from . import DatabaseTest
 from sqlalchemy.sql.elements import Case
 from sqlalchemy import (
     and_,
+    event,
     func,
 )
 
 from classifier import Classifier
+from config import Configuration
 
 from entrypoint import (
     AudiobooksEntryPoint,
@@ -929,6 +932,159 @@ class TestPagination(DatabaseTest):
         pagination.this_page_size = 1
         eq_(True, pagination.has_next_page)
 
+    def test_key(self):
+        now = datetime.datetime(2018, 1, 1, 12, 30)
+        pagination = Pagination(offset=50, size=25)
+        eq_(None, pagination.key)
+        eq_("after=50&size=25", pagination.query_string)
+
+        # Once a page of results has been loaded, the next page will
+        # seek past the last item on this page.
+        class MockFacets(Facets):
+            def __init__(self):
+                pass
+            def sort_key(self, work):
+                return [work, now, None]
+        pagination.page_loaded(["a", "b"], MockFacets())
+        eq_(2, pagination.this_page_size)
+        eq_(["b", now, None], pagination.last_item_key)
+
+        next_page = pagination.next_page
+        eq_(75, next_page.offset)
+        eq_(["b", now, None], next_page.key)
+        eq_('["b","2018-01-01T12:30:00",null]',
+            dict(next_page.items())['key'])
+        eq_("after=75&size=25&key=%5B%22b%22%2C%222018-01-01T12%3A30%3A00%22%2Cnull%5D",
+            next_page.query_string)
+
+        # The key round-trips through a string.
+        eq_(["b", "2018-01-01T12:30:00", None],
+            Pagination.key_from_string(dict(next_page.items())['key']))
+        assert_raises(ValueError, Pagination.key_from_string, "notjson")
+        assert_raises(ValueError, Pagination.key_from_string, '{"a":1}')
+        assert_raises(ValueError, Pagination.key_from_string, '[{"a":1}]')
+        assert_raises(ValueError, Pagination.key_from_string, '[["a"]]')
+
+        # The first and previous pages are found by offset.
+        eq_(None, next_page.first_page.key)
+        eq_(None, next_page.previous_page.key)
+
+        # Without a faceting object, there's no way to know the sort
+        # key of an item.
+        pagination = Pagination()
+        pagination.page_loaded(["a", "b"])
+        eq_(None, pagination.next_page.key)
+
+    def test_keyset_pagination(self):
+        # Create some works, two of which have the same title.
+        works = []
+        for title in ["b", "a", "c", "a", "d"]:
+            work = self._work(title=title, with_license_pool=True)
+            works.append(work)
+        works[0].license_pools[0].availability_time = None
+        self.add_to_materialized_view(works)
+
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        def all_pages(facets, size):
+            # Follow 'next' links through the whole list.
+            pagination = Pagination(size=size)
+            work_ids = []
+            while True:
+                qu = wl.works(self._db, facets, pagination)
+                if pagination.key is not None:
+                    # The database doesn't need to count through the
+                    # earlier pages.
+                    assert 'OFFSET' not in str(qu)
+                page = qu.all()
+                if not page:
+                    break
+                work_ids.extend(x.works_id for x in page)
+                pagination.page_loaded(page, facets)
+                pagination = pagination.next_page
+            return work_ids
+
+        for order in (Facets.ORDER_TITLE, Facets.ORDER_AUTHOR,
+                      Facets.ORDER_ADDED_TO_COLLECTION, Facets.ORDER_RANDOM):
+            facets = Facets(
+                self._default_library, Facets.COLLECTION_FULL,
+                Facets.AVAILABLE_ALL, order
+            )
+            expect = [x.works_id for x in wl.works(self._db, facets)]
+            eq_(5, len(expect))
+
+            # However the works are ordered, and whatever the page
+            # size, paging through with sort keys finds every work
+            # exactly once, in the right order.
+            for size in (1, 2, 3):
+                eq_(expect, all_pages(facets, size))
+
+    def test_apply_falls_back_to_offset(self):
+        # If the sort key doesn't match the sort order -- perhaps the
+        # client changed the sort order in the middle of paging
+        # through a list -- the offset is used instead.
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_TITLE
+        )
+        eq_(None, facets.keyset_clause(["too", "short"]))
+        from model import MaterializedWorkWithGenre as mwg
+        qu = self._db.query(mwg)
+        pagination = Pagination(offset=10, size=5, key=["too", "short"])
+        assert 'OFFSET' in str(pagination.apply(qu, facets))
+
+        pagination = Pagination(offset=10, size=5, key=["a", "b", 1])
+        assert 'OFFSET' not in str(pagination.apply(qu, facets))
+
+        # A key with values that don't fit the types of the fields in
+        # the sort order is never sent to the database.
+        for bad_key in (["a", "b", "c"], ["a", 1, 1], ["a", "b", 1.5]):
+            eq_(None, facets.keyset_clause(bad_key))
+            pagination = Pagination(offset=10, size=5, key=bad_key)
+            assert 'OFFSET' in str(pagination.apply(qu, facets))
+
+    def test_parse_sort_key(self):
+        def facets(order):
+            return Facets(
+                self._default_library, Facets.COLLECTION_FULL,
+                Facets.AVAILABLE_ALL, order
+            )
+
+        # Text fields take strings, and ID fields take integers. Any
+        # field can be null.
+        by_title = facets(Facets.ORDER_TITLE)
+        eq_([u"a", None, 1], by_title.parse_sort_key([u"a", None, 1]))
+        assert_raises(ValueError, by_title.parse_sort_key, [1, "b", 1])
+        assert_raises(ValueError, by_title.parse_sort_key, ["a", "b", "1"])
+        assert_raises(ValueError, by_title.parse_sort_key, ["a", "b", True])
+
+        # Dates are turned back into datetimes.
+        by_date = facets(Facets.ORDER_ADDED_TO_COLLECTION)
+        eq_([datetime.datetime(2018, 1, 1, 12, 30), "a", "b", 1],
+            by_date.parse_sort_key(["2018-01-01T12:30:00", "a", "b", 1]))
+        eq_(datetime.datetime(2018, 1, 1, 12, 30, 0, 500),
+            by_date.parse_sort_key(
+                ["2018-01-01T12:30:00.000500", "a", "b", 1])[0])
+        now = datetime.datetime.utcnow()
+        eq_(now, by_date.parse_sort_key([now, "a", "b", 1])[0])
+        assert_raises(ValueError, by_date.parse_sort_key,
+                      ["not-a-date", "a", "b", 1])
+        assert_raises(ValueError, by_date.parse_sort_key, [1, "a", "b", 1])
+
+        # Numeric fields take numbers, or the strings
+        # Pagination.key_to_string() makes out of Decimals.
+        by_random = facets(Facets.ORDER_RANDOM)
+        eq_([Decimal("0.123"), "a", "b", 1],
+            by_random.parse_sort_key(["0.123", "a", "b", 1]))
+        eq_(0.5, by_random.parse_sort_key([0.5, "a", "b", 1])[0])
+        assert_raises(ValueError, by_random.parse_sort_key,
+                      ["random", "a", "b", 1])
+
+        # A key for some other sort order isn't an error; it just
+        # can't be used.
+        eq_(None, by_title.parse_sort_key(["a"]))
+
 
 class MockFeaturedWorks(object):
     """A mock WorkList that mocks featured_works()."""
@@ -965,7 +1121,7 @@ class MockWorks(WorkList):
     def reset(self):
         self._works = []
         self.works_calls = []
-        self.random_sample_calls = []
+        self.random_window_sample_calls = []
 
     def queue_works(self, works):
         """Set the next return value for works()."""
@@ -978,11 +1134,11 @@ class MockWorks(WorkList):
         except IndexError:
             return []
 
-    def random_sample(self, query, target_size):
+    def random_window_sample(self, query, target_size):
         # The 'query' is actually a list, and we're in a test
         # environment where randomness is not welcome. Just take
         # a sample from the front of the list.
-        self.random_sample_calls.append((query, target_size))
+        self.random_window_sample_calls.append((query, target_size))
         return query[:target_size]
 
 
@@ -1161,6 +1317,24 @@ class TestWorkList(DatabaseTest):
         eq_((w2, child2), wwl2)
         eq_((w1, child2), wwl3)
 
+    def test_groups_respects_overridden_featured_works(self):
+        w1 = MockWork(1)
+
+        # A WorkList subclass with its own idea of what to feature
+        # isn't folded into its parent's grouped feed query.
+        class FeaturesItsOwnWorks(WorkList):
+            def featured_works(self, _db, facets=None):
+                return [w1]
+        eq_(False, FeaturesItsOwnWorks._featured_works_can_be_batched())
+        eq_(True, WorkList._featured_works_can_be_batched())
+        eq_(True, Lane._featured_works_can_be_batched())
+
+        child = FeaturesItsOwnWorks()
+        child.initialize(self._default_library)
+        wl = WorkList()
+        wl.initialize(self._default_library, children=[child])
+        eq_([(w1, child)], list(wl.groups(self._db)))
+
     def test_groups_propagates_facets(self):
         """Verify that the Facets object passed into groups() is
         propagated to the methods called by groups().
@@ -1210,8 +1384,8 @@ class TestWorkList(DatabaseTest):
             facets.minimum_featured_quality)
         eq_(False, facets.uses_customlists)
 
-        # We then called random_sample() on the results.
-        [(query, target_size)] = wl.random_sample_calls
+        # We then called random_window_sample() on the results.
+        [(query, target_size)] = wl.random_window_sample_calls
         eq_([w1, w1], query)
         eq_(self._default_library.featured_lane_size, target_size)
 
@@ -1370,16 +1544,17 @@ class TestWorkList(DatabaseTest):
                 return query
 
         class MockPagination(object):
-            def apply(self, query):
+            def apply(self, query, facets=None):
                 called['pagination.apply'] = True
+                called['pagination.apply.facets'] = facets
                 return query
 
         from model import MaterializedWorkWithGenre as work_model
         original_qu = self._db.query(work_model)
         wl = MockWorkList()
+        facets = MockFacets()
         final_qu = wl.apply_filters(
-            self._db, original_qu, MockFacets(),
-            MockPagination()
+            self._db, original_qu, facets, MockPagination()
         )
 
         # The hook methods were called with the right arguments.
@@ -1387,6 +1562,7 @@ class TestWorkList(DatabaseTest):
         eq_(called['apply_bibliographic_filters'], True)
         eq_(called['facets.apply'], True)
         eq_(called['pagination.apply'], True)
+        eq_(called['pagination.apply.facets'], facets)
 
         eq_(called['apply_bibliographic_filters.featured'], False)
 
@@ -1575,6 +1751,43 @@ class TestWorkList(DatabaseTest):
                  non_gutenberg_children.id]),
             set(for_audiences()))
 
+    def test_random_window_sample(self):
+        # Create some works with known values for Work.random.
+        works = []
+        for i, value in enumerate([0.1, 0.3, 0.5, 0.7, 0.9]):
+            work = self._work(with_license_pool=True)
+            work.random = value
+            works.append(work)
+        self.add_to_materialized_view(works)
+        [w1, w3, w5, w7, w9] = works
+
+        wl = WorkList()
+        wl.initialize(self._default_library)
+        facets = FeaturedFacets(0)
+        query = wl.works(self._db, facets=facets)
+
+        def sample(target_size, start):
+            return set(
+                x[0].works_id for x in
+                WorkList.random_window_sample(query, target_size, start)
+            )
+
+        # The sample is taken from the works just below the starting
+        # point.
+        eq_(set([w5.id, w3.id]), sample(2, 0.6))
+        eq_(set([w5.id]), sample(1, 0.5))
+
+        # If there aren't enough works below the starting point, the
+        # sample wraps around to the top of the range.
+        eq_(set([w1.id, w9.id]), sample(2, 0.2))
+        eq_(set([w9.id, w7.id]), sample(2, 0.05))
+
+        # A sample larger than the population gets everything.
+        eq_(set([x.id for x in works]), sample(10, 0.6))
+
+        # A query that won't run gives an empty sample.
+        eq_([], WorkList.random_window_sample(None, 2))
+
     def test_random_sample(self):
         # This lets me test which items are chosen in a random sample,
         # but for some reason the shuffled lists still come out in an
@@ -2944,43 +3157,81 @@ class TestWorkListGroups(DatabaseTest):
         eq_(wl.uses_customlists, facets2.uses_customlists)
 
     def test_featured_works_with_lanes(self):
-        """_featured_works_with_lanes calls works_in_window on every lane
-        pass in to it.
+        """_featured_works_with_lanes finds a window of works for every
+        lane passed in to it, using a single query.
         """
-        class Mock(object):
-            """A Mock of Lane.works_in_window."""
-
-            def __init__(self, mock_works):
-                self.mock_works = mock_works
-
-            def works_in_window(self, _db, facets, target_size):
-                self.called_with = [_db, facets, target_size]
-                return [self.mock_works]
-
-        mock1 = Mock(("mw1","quality1"))
-        mock2 = Mock(("mw2","quality2"))
-
-        lane = self._lane()
-        facets = FeaturedFacets(0.1)
-        results = lane._featured_works_with_lanes(
-            self._db, [mock1, mock2], facets
-        )
-
-        # The results of works_in_window were annotated with the
-        # 'lane' that produced the result.
-        eq_([('mw1', 'quality1', mock1), ('mw2', 'quality2', mock2)],
-            list(results))
-
-        # Each Mock's works_in_window was called with the same
-        # arguments.
-        eq_(mock1.called_with, mock2.called_with)
+        library = self._default_library
+        library.setting(library.FEATURED_LANE_SIZE).value = "1"
 
-        # The Facets object passed in to _featured_works_with_lanes()
-        # is passed on into works_in_window().
-        _db, called_with_facets, target_size = mock1.called_with
-        eq_(self._db, _db)
-        eq_(facets, called_with_facets)
-        eq_(lane.library.featured_lane_size, target_size)
+        hq_sf = self._work(genre="Science Fiction", with_license_pool=True)
+        hq_sf.quality = 0.8
+        lq_sf = self._work(genre="Science Fiction", with_license_pool=True)
+        lq_sf.quality = 0.1
+        romance = self._work(genre="Romance", with_license_pool=True)
+        romance.quality = 0.8
+        self.add_to_materialized_view([hq_sf, lq_sf, romance])
+
+        sf_lane = self._lane(genres=["Science Fiction"])
+        romance_lane = self._lane(genres=["Romance"])
+
+        # A WorkList that isn't a Lane can go into the same query.
+        everything = WorkList()
+        everything.initialize(library)
+
+        # This library gets its lane feeds from the database. Once
+        # that setting has been looked up, it's cached and doesn't
+        # need another query.
+        eq_(Configuration.LANE_FEED_ENGINE_DATABASE, library.lane_feed_engine)
+
+        def featured_works():
+            return list(everything._featured_works_with_lanes(
+                self._db, [sf_lane, romance_lane, everything],
+                FeaturedFacets(0.5)
+            ))
+
+        # The first time through, the lanes load their genres, lists
+        # and so on. After that, finding the works for every lane
+        # takes a single query.
+        featured_works()
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.connection, "before_cursor_execute", count)
+        try:
+            results = featured_works()
+        finally:
+            event.remove(self.connection, "before_cursor_execute", count)
+        eq_(1, len(statements))
+
+        # featured_lane_size*1.3 rounds down to one work per lane.
+        # Each lane got its highest-quality work, and each result was
+        # annotated with the lane that produced it, in the order the
+        # lanes were passed in.
+        [(sf_work, sf_tier, lane1), (romance_work, romance_tier, lane2),
+         (everything_work, everything_tier, lane3)] = results
+        eq_([sf_lane, romance_lane, everything], [lane1, lane2, lane3])
+        eq_(hq_sf.id, sf_work.works_id)
+        eq_(romance.id, romance_work.works_id)
+
+        # The WorkList got one of the two high-quality works.
+        assert everything_work.works_id in (hq_sf.id, romance.id)
+        eq_(sf_tier, romance_tier)
+        eq_(sf_tier, everything_tier)
+
+        # Each lane's part of the query is sorted and limited on its
+        # own, so the WorkList, which has no window, doesn't need to
+        # rank every work in the collection.
+        query = everything._featured_works_query(
+            self._db, [sf_lane, romance_lane, everything],
+            FeaturedFacets(0.5), 10
+        )
+        eq_(3, str(query).count("LIMIT"))
+        eq_(3, len([x for x in query.all() if x[2] == 2]))
+
+        # If none of the lanes can be queried, nothing is returned.
+        eq_([], list(everything._featured_works_with_lanes(
+            self._db, [], FeaturedFacets(0.5)
+        )))
 
     def test_featured_window(self):
         lane = self._lane()
@@ -3116,3 +3367,278 @@ class TestWorkListGroups(DatabaseTest):
         width = expect_upper-expect_lower
         new_lower, new_upper = lane.featured_window(target_size)
         eq_(round(width, 3), round(new_upper-new_lower, 3))
+
+
+class TestLaneFeedsFromSearchIndex(DatabaseTest):
+    """Tests of the code that builds lane feeds from the search index
+    instead of the materialized view.
+    """
+
+    def setup(self):
+        super(TestLaneFeedsFromSearchIndex, self).setup()
+        self.library = self._default_library
+        self.library.setting(Library.LANE_FEED_ENGINE).value = (
+            Configuration.LANE_FEED_ENGINE_SEARCH_INDEX
+        )
+        self.search = DummyExternalSearchIndex()
+
+    def facets(self, **kwargs):
+        args = dict(
+            collection=Facets.COLLECTION_FULL,
+            availability=Facets.AVAILABLE_ALL,
+            order=Facets.ORDER_TITLE,
+        )
+        args.update(kwargs)
+        return Facets(self.library, **args)
+
+    def test_lane_feed_search_client(self):
+        lane = self._lane()
+        eq_(self.search, lane.lane_feed_search_client(self._db, self.search))
+
+        # By default, lane feeds come from the database.
+        self.library.setting(Library.LANE_FEED_ENGINE).value = None
+        eq_(None, lane.lane_feed_search_client(self._db, self.search))
+
+    def test_search_index_feeds_supported(self):
+        eq_(True, WorkList.search_index_feeds_supported())
+        eq_(True, Lane.search_index_feeds_supported())
+
+        # A subclass that decides which works belong in it some other
+        # way can't get its feeds from the search index, since the
+        # search index would ignore its restrictions.
+        class SeriesWorkList(WorkList):
+            def apply_filters(self, *args, **kwargs):
+                return None
+        class ContributorWorkList(WorkList):
+            def bibliographic_filter_clause(self, *args, **kwargs):
+                return None
+        eq_(False, SeriesWorkList.search_index_feeds_supported())
+        eq_(False, ContributorWorkList.search_index_feeds_supported())
+
+        # Unless it says otherwise.
+        class SearchableSeriesWorkList(SeriesWorkList):
+            supports_search_index_feeds = True
+        eq_(True, SearchableSeriesWorkList.search_index_feeds_supported())
+
+        # A subclass that doesn't change which works belong in it
+        # is fine.
+        class RenamedWorkList(WorkList):
+            pass
+        eq_(True, RenamedWorkList.search_index_feeds_supported())
+
+        # A subclass can also turn off search index feeds.
+        class DatabaseWorkList(WorkList):
+            supports_search_index_feeds = False
+        eq_(False, DatabaseWorkList.search_index_feeds_supported())
+
+        # An unsupported WorkList gets its feeds from the database
+        # even if its library gets lane feeds from the search index.
+        worklist = SeriesWorkList()
+        worklist.initialize(self.library)
+        eq_(None, worklist.lane_feed_search_client(self._db, self.search))
+        eq_(None, worklist.search_index_filters(self.search))
+
+    def test_works(self):
+        w1 = self._work(title="A", with_license_pool=True)
+        w2 = self._work(title="B", with_license_pool=True)
+        w3 = self._work(title="C", with_license_pool=True)
+        self.add_to_materialized_view([w1, w2, w3])
+        self.search.bulk_update([w1, w2, w3])
+
+        # The search index decides which works are on the page and
+        # in what order.
+        def ids_from_search_index(*args, **kwargs):
+            self.search.queries.append((args, kwargs))
+            return [w3.id, w1.id]
+        self.search.query_works_by_filter = ids_from_search_index
+
+        lane = self._lane()
+        pagination = Pagination(offset=10, size=2)
+        qu = lane.works(
+            self._db, self.facets(order=Facets.ORDER_ADDED_TO_COLLECTION,
+                                  order_ascending=False),
+            pagination, search_client=self.search
+        )
+        eq_([w3.id, w1.id], [x.works_id for x in qu])
+
+        [(args, kwargs)] = self.search.queries
+        eq_(lane.search_index_filters(self.search), args[0])
+        eq_('availability_time', kwargs['order'])
+        eq_(False, kwargs['order_ascending'])
+        eq_(2, kwargs['size'])
+        eq_(10, kwargs['offset'])
+
+        # If the search index finds nothing, the query finds nothing.
+        self.search.query_works_by_filter = lambda *args, **kwargs: []
+        eq_([], lane.works(self._db, self.facets(), pagination,
+                           search_client=self.search).all())
+
+    def test_works_falls_back_to_database(self):
+        work = self._work(with_license_pool=True)
+        self.add_to_materialized_view([work])
+        lane = self._lane()
+        pagination = Pagination(size=10)
+
+        def from_database(facets, pagination=pagination):
+            self.search.queries = []
+            qu = lane.works(self._db, facets, pagination,
+                            search_client=self.search)
+            eq_([work.id], [x.works_id for x in qu])
+            return self.search.queries
+
+        # The search index can't sort randomly.
+        eq_([], from_database(self.facets(order=Facets.ORDER_RANDOM)))
+
+        # Without pagination, the query is not for a page of a feed.
+        eq_([], from_database(self.facets(), pagination=None))
+
+        # A supported combination of facets uses the search index.
+        self.search.bulk_update([work])
+        eq_(1, len(from_database(self.facets())))
+
+    def test_work_ids_from_search_index(self):
+        lane = self._lane()
+        m = lane.work_ids_from_search_index
+
+        def kwargs(facets):
+            self.search.queries = []
+            m(self.search, facets, 10)
+            [(args, kwargs)] = self.search.queries
+            return kwargs
+
+        main = kwargs(self.facets(collection=Facets.COLLECTION_MAIN))
+        eq_(True, main['main_collection_only'])
+        eq_(Facets.AVAILABLE_ALL, main['availability'])
+
+        # The search index knows which books are available right now.
+        available_now = kwargs(self.facets(availability=Facets.AVAILABLE_NOW))
+        eq_(Facets.AVAILABLE_NOW, available_now['availability'])
+
+        featured = kwargs(self.facets(collection=Facets.COLLECTION_FEATURED))
+        eq_(self.library.minimum_featured_quality, featured['minimum_quality'])
+
+        # FeaturedFacets turn into a request for works in random
+        # order, with the best works first.
+        eq_(0.8, kwargs(FeaturedFacets(0.8))['featurable_quality'])
+
+        # But the search index doesn't know which works are featured
+        # on custom lists.
+        eq_(None, m(self.search, FeaturedFacets(0.8, uses_customlists=True), 10))
+
+    def test_search_index_filters(self):
+        parent = self._lane(fiction=True)
+        lane = self._lane(parent=parent, languages=["spa"])
+        parent_filters = parent.search_index_filters(self.search)
+        eq_(1, len(parent_filters))
+
+        # A lane that inherits its parent's restrictions has its
+        # parent's filters as well as its own.
+        filters = lane.search_index_filters(self.search)
+        eq_(2, len(filters))
+        eq_(parent_filters, filters[1:])
+
+        lane.inherit_parent_restrictions = False
+        eq_(1, len(lane.search_index_filters(self.search)))
+
+        # Children's books are filtered in ways the search index
+        # can't reproduce.
+        lane.audiences = [Classifier.AUDIENCE_CHILDREN]
+        eq_(None, lane.search_index_filters(self.search))
+
+        # So are books from a specific data source.
+        lane.audiences = [Classifier.AUDIENCE_ADULT]
+        lane.license_datasource = DataSource.lookup(
+            self._db, DataSource.GUTENBERG
+        )
+        eq_(None, lane.search_index_filters(self.search))
+
+        # If a lane's parent can't be filtered by the search index,
+        # neither can the lane.
+        lane.license_datasource = None
+        lane.inherit_parent_restrictions = True
+        parent.audiences = [Classifier.AUDIENCE_YOUNG_ADULT]
+        eq_(None, lane.search_index_filters(self.search))
+
+    def test_featured_works(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        self.add_to_materialized_view([w1, w2])
+        self.search.bulk_update([w1, w2])
+
+        lane = self._lane()
+        featured = lane.featured_works(
+            self._db, FeaturedFacets(0.5), search_client=self.search
+        )
+        eq_(set([w1.id, w2.id]), set([x.works_id for x in featured]))
+        [(args, kwargs)] = self.search.queries
+        eq_(0.5, kwargs['featurable_quality'])
+
+    def test_featured_works_with_lanes(self):
+        self.library.setting(self.library.FEATURED_LANE_SIZE).value = "2"
+        w1 = self._work(genre="Science Fiction", with_license_pool=True)
+        w2 = self._work(genre="Science Fiction", with_license_pool=True)
+        w3 = self._work(genre="Romance", with_license_pool=True)
+        self.add_to_materialized_view([w1, w2, w3])
+
+        sf_lane = self._lane(genres=["Science Fiction"])
+        romance_lane = self._lane(genres=["Romance"])
+
+        # Children's lanes can't be handled by the search index.
+        children = self._lane()
+        children.audiences = [Classifier.AUDIENCE_CHILDREN]
+
+        def ids_from_search_index(filters, **kwargs):
+            self.search.queries.append((filters, kwargs))
+            if len(self.search.queries) == 1:
+                return [w2.id, w1.id]
+            return [w3.id]
+        self.search.query_works_by_filter = ids_from_search_index
+
+        results = list(sf_lane._featured_works_with_lanes(
+            self._db, [sf_lane, children, romance_lane], FeaturedFacets(0.5),
+            search_client=self.search
+        ))
+
+        # One search request was made for each lane the search index
+        # can handle; featured_lane_size*1.3 rounds down to two works
+        # per lane.
+        eq_(2, len(self.search.queries))
+        eq_([2, 2], [kwargs['size'] for filters, kwargs in self.search.queries])
+
+        # Works from the search index come back in the order the
+        # search index gave them, ahead of the works for the
+        # children's lane, which came from the database.
+        eq_([(w2.id, sf_lane), (w1.id, sf_lane), (w3.id, romance_lane)],
+            [(mw.works_id, lane) for mw, tier, lane in results
+             if lane != children])
+        eq_([None, None, None],
+            [tier for mw, tier, lane in results if lane != children])
+
+    def test_facet_counts(self):
+        w1 = self._work(language="eng", with_license_pool=True)
+        w2 = self._work(language="spa", with_license_pool=True)
+        self.search.bulk_update([w1, w2])
+
+        lane = self._lane()
+        facets = self.facets(collection=Facets.COLLECTION_MAIN)
+        counts = lane.facet_counts(
+            self._db, facets, self.search, counts=['language']
+        )
+        eq_(2, counts['total'])
+        eq_(dict(eng=1, spa=1), counts['language'])
+        assert 'genre' not in counts
+
+        # The search index was told which facets are selected, and
+        # given the filters that define the lane.
+        [(args, kwargs)] = self.search.queries
+        eq_((lane.search_index_filters(self.search),), args)
+        eq_(Facets.AVAILABLE_ALL, kwargs['availability'])
+        eq_(Facets.COLLECTION_MAIN, kwargs['collection'])
+        eq_(self.library.minimum_featured_quality,
+            kwargs['minimum_featured_quality'])
+        eq_(['language'], kwargs['counts'])
+
+        # If the lane can't be filtered by the search index, there
+        # are no counts.
+        lane.audiences = [Classifier.AUDIENCE_CHILDREN]
+        eq_(None, lane.facet_counts(self._db, facets, self.search))
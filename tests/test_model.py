@@ -3400,6 +3400,12 @@ class TestWork(DatabaseTest):
         work.rating = 5
         work.popularity = 4
 
+        # These fields are used to build lane feeds from the search
+        # index.
+        work.last_update_time = datetime.datetime(2018, 1, 1, 12, 30)
+        pool.availability_time = datetime.datetime(2017, 1, 1)
+        pool2.availability_time = datetime.datetime(2017, 6, 1)
+
         # Make sure all of this will show up in a database query.
         self._db.flush()
 
@@ -3423,6 +3429,13 @@ class TestWork(DatabaseTest):
         eq_(work.quality, search_doc['quality'])
         eq_(work.rating, search_doc['rating'])
         eq_(work.popularity, search_doc['popularity'])
+        eq_("2018-01-01T12:30:00", search_doc['last_update_time'])
+
+        # The availability time is the most recent one for any
+        # LicensePool that makes the work available.
+        eq_("2017-06-01T00:00:00", search_doc['availability_time'])
+        eq_(True, search_doc['open_access'])
+        eq_(True, search_doc['available'])
 
         # Each collection in which the Work is found is listed in
         # the 'collections' section.
@@ -3548,12 +3561,24 @@ class TestWork(DatabaseTest):
         pool.licenses_owned = 1
         eq_(success, record.status)
 
-        # If its licenses_available changes, nothing happens
-        pool.licenses_available = 0
+        # If its licenses_available changes, but not to zero, nothing
+        # happens.
+        pool.licenses_available = 1
         eq_(success, record.status)
 
+        # If its licenses_available goes from nonzero to zero, it's
+        # no longer available now, so it needs to be reindexed.
+        pool.licenses_available = 0
+        eq_(registered, record.status)
+
+        # The same is true when licenses become available again.
+        record.status = success
+        pool.licenses_available = 1
+        eq_(registered, record.status)
+
         # If its licenses_owned goes from nonzero to zero, it needs to
         # be reindexed.
+        record.status = success
         pool.licenses_owned = 0
         eq_(registered, record.status)
 
@@ -3600,7 +3625,67 @@ class TestWork(DatabaseTest):
         # The work was not added to the search index -- that happens
         # later, when the WorkCoverageRecord is processed.
         eq_([], index.docs.values())
-      
+
+    def test_materialized_view_needs_updating(self):
+        work = self._work()
+        def records():
+            return [
+                x for x in work.coverage_records
+                if x.operation==WorkCoverageRecord.UPDATE_MATERIALIZED_VIEW_OPERATION
+            ]
+
+        # Normally the materialized view is refreshed all at once, so
+        # there's no need to keep track of which works have changed.
+        eq_(None, work.materialized_view_needs_updating())
+        eq_([], records())
+
+        # If lanes are built from a mirror of the materialized view,
+        # a WorkCoverageRecord is created to register the work that
+        # needs to be done.
+        old_value = SessionManager.uses_materialized_view_mirror
+        SessionManager.uses_materialized_view_mirror = True
+        try:
+            record = work.materialized_view_needs_updating()
+        finally:
+            SessionManager.uses_materialized_view_mirror = old_value
+        eq_([record], records())
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+
+    def test_moving_license_pool_registers_materialized_view_update(self):
+        old_work = self._work(with_license_pool=True)
+        [pool] = old_work.license_pools
+        new_work = self._work()
+
+        def registered(work):
+            return [
+                x for x in work.coverage_records
+                if x.operation==WorkCoverageRecord.UPDATE_MATERIALIZED_VIEW_OPERATION
+            ]
+
+        # Without a mirror of the materialized view, nothing is tracked.
+        pool.work = new_work
+        eq_([], registered(old_work))
+        eq_([], registered(new_work))
+
+        # With a mirror, moving the pool changes the rows of both
+        # Works, so both need to be updated.
+        old_value = SessionManager.uses_materialized_view_mirror
+        SessionManager.uses_materialized_view_mirror = True
+        try:
+            pool.work = old_work
+            eq_(1, len(registered(old_work)))
+            eq_(1, len(registered(new_work)))
+
+            # The same is true if the Work's ID is set directly.
+            for record in registered(old_work) + registered(new_work):
+                self._db.delete(record)
+            self._db.commit()
+            pool.work_id = new_work.id
+            eq_(1, len(registered(old_work)))
+            eq_(1, len(registered(new_work)))
+        finally:
+            SessionManager.uses_materialized_view_mirror = old_value
+
 
     def test_for_unchecked_subjects(self):
 
@@ -6804,6 +6889,39 @@ class TestCoverageRecord(DatabaseTest):
                                        collection=collection)
         eq_(None, result)
 
+    def test_lookup_for_identifiers(self):
+        source = DataSource.lookup(self._db, DataSource.OCLC)
+        operation = 'foo'
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+        r1 = self._coverage_record(i1, source, operation)
+        r2 = self._coverage_record(i2, source, operation)
+
+        # These records don't match.
+        self._coverage_record(i3, source, "other operation")
+        self._coverage_record(
+            i3, source, operation, collection=self._default_collection
+        )
+        other_source = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+        self._coverage_record(i1, other_source, operation)
+
+        records = CoverageRecord.lookup_for_identifiers(
+            self._db, [i1, i2, i3], source, operation
+        )
+        eq_({i1.id: r1, i2.id: r2}, records)
+
+        # The collection has to match too.
+        records = CoverageRecord.lookup_for_identifiers(
+            self._db, [i1, i2, i3], source, operation,
+            collection=self._default_collection
+        )
+        eq_([i3.id], records.keys())
+
+        eq_({}, CoverageRecord.lookup_for_identifiers(
+            self._db, [], source, operation
+        ))
+
     def test_add_for(self):
         source = DataSource.lookup(self._db, DataSource.OCLC)
         edition = self._edition()
@@ -7085,6 +7203,44 @@ class TestWorkCoverageRecord(DatabaseTest):
         eq_(WorkCoverageRecord.SUCCESS, irrelevant_record.status)
         assert irrelevant_record.timestamp < new_timestamp
 
+    def test_content_hashes(self):
+        operation = "relevant"
+        work1 = self._work()
+        work2 = self._work()
+        work3 = self._work()
+        record1, ignore = WorkCoverageRecord.add_for(work1, operation)
+        record2, ignore = WorkCoverageRecord.add_for(work2, operation)
+        other, ignore = WorkCoverageRecord.add_for(work1, "irrelevant")
+
+        WorkCoverageRecord.bulk_set_content_hash(
+            self._db, {work1.id: u"hash1", work2.id: u"hash2",
+                       work3.id: u"hash3"}, operation
+        )
+        self._db.expire_all()
+        eq_(u"hash1", record1.content_hash)
+        eq_(None, other.content_hash)
+
+        # There's no record for work3, so it has no hash.
+        eq_({work1.id: u"hash1", work2.id: u"hash2"},
+            WorkCoverageRecord.content_hashes(
+                self._db, [work1.id, work2.id, work3.id], operation
+            ))
+
+        # A hash can be cleared.
+        WorkCoverageRecord.bulk_set_content_hash(
+            self._db, {work2.id: None}, operation
+        )
+        eq_({work1.id: u"hash1"}, WorkCoverageRecord.content_hashes(
+            self._db, [work1.id, work2.id], operation
+        ))
+
+        # bulk_add clears the hash, since it can't know whether the
+        # hash is still accurate.
+        WorkCoverageRecord.bulk_add([work1], operation)
+        eq_({}, WorkCoverageRecord.content_hashes(
+            self._db, [work1.id], operation
+        ))
+
 
 class TestComplaint(DatabaseTest):
 
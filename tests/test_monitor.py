@@ -5,6 +5,7 @@ from nose.tools import (
     assert_raises_regexp,
 )
 import datetime
+import os
 
 from . import DatabaseTest
 
@@ -14,6 +15,11 @@ from testing import (
     BrokenCoverageProvider,
 )
 
+from lane import (
+    Facets,
+    Pagination,
+)
+
 from model import (
     CachedFeed,
     Collection,
@@ -22,6 +28,7 @@ from model import (
     DataSource,
     ExternalIntegration,
     Identifier,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
@@ -30,6 +37,8 @@ from model import (
 
 from monitor import (
     CachedFeedReaper,
+    CachedFeedWarmer,
+    CachedFeedWarmingJob,
     CollectionMonitor,
     CoverageProvidersFailed,
     CredentialReaper,
@@ -675,6 +684,38 @@ class TestWorkRandomnessUpdateMonitor(DatabaseTest):
         # higher that the code has broken and it's failing reliably.
         assert work.random != old_random
 
+    def test_process_batch_updates_mirror(self):
+        # Create the mirror of the lanes materialized view, and act as
+        # though lanes are being built from it.
+        base_path = os.path.split(os.path.split(__file__)[0])[0]
+        path = os.path.join(
+            base_path, "files",
+            SessionManager.MATERIALIZED_VIEW_LANES_MIRROR_FILE
+        )
+        self._db.execute(open(path).read())
+        old_uses_mirror = SessionManager.uses_materialized_view_mirror
+        SessionManager.uses_materialized_view_mirror = True
+        try:
+            work = self._work(with_license_pool=True)
+            work.presentation_ready = True
+            self._db.commit()
+            SessionManager.refresh_materialized_views(self._db)
+
+            monitor = WorkRandomnessUpdateMonitor(self._db)
+            monitor.process_batch(work.id)
+            self._db.commit()
+            self._db.refresh(work)
+
+            # The work's rows in the mirror have its new random value,
+            # without the mirror having to be rebuilt.
+            mirror_values = set(x for [x] in self._db.execute(
+                "select random from works_for_lanes where works_id=:id",
+                dict(id=work.id)
+            ))
+            eq_(set([work.random]), mirror_values)
+        finally:
+            SessionManager.uses_materialized_view_mirror = old_uses_mirror
+
 
 class TestCustomListEntryWorkUpdateMonitor(DatabaseTest):
 
@@ -752,3 +793,193 @@ class TestReaperMonitor(DatabaseTest):
         # are still in the database.
         remaining = set(self._db.query(Credential).all())
         eq_(set([active, eternal]), remaining)
+
+
+class MockPool(object):
+    """Runs jobs immediately, in the calling thread."""
+
+    def __init__(self, _db):
+        self._db = _db
+        self.jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def put(self, job):
+        self.jobs.append(job)
+        job.run(self._db)
+
+
+class MockWarmingJob(object):
+
+    def __init__(self, warmer, name):
+        self.warmer = warmer
+        self.name = name
+
+    def run(self, _db):
+        self.warmer.record_warmed(self.name, CachedFeed.PAGE_TYPE, 1.5)
+
+
+class TestCachedFeedWarmer(DatabaseTest):
+
+    def test_jobs(self):
+        parent = self._lane(u"Parent")
+        parent.priority = 0
+        other = self._lane(u"Other")
+        other.priority = 1
+        child = self._lane(u"Child", parent=parent)
+        invisible = self._lane(u"Invisible", parent=parent)
+        invisible.visible = False
+        warmer = CachedFeedWarmer(self._db, annotator_factory=None)
+
+        # Nothing has been cached, so every feed in every visible lane
+        # needs warming, starting with the library's top-level
+        # WorkList. Lanes with children need a grouped feed as well
+        # as a page feed.
+        jobs = warmer.jobs()
+        expect = [
+            (None, CachedFeed.GROUPS_TYPE),
+            (None, CachedFeed.PAGE_TYPE),
+            (parent.id, CachedFeed.GROUPS_TYPE),
+            (parent.id, CachedFeed.PAGE_TYPE),
+            (other.id, CachedFeed.PAGE_TYPE),
+            (child.id, CachedFeed.PAGE_TYPE),
+        ]
+        eq_(expect, [(job.lane_id, job.type) for job in jobs])
+
+        # Once a lane's feeds have been requested, the lane gets
+        # warmed first.
+        feed, ignore = CachedFeed.fetch(
+            self._db, child, CachedFeed.PAGE_TYPE,
+            Facets.default(self._default_library), Pagination.default(),
+            None, force_refresh=True
+        )
+        feed.recent_requests = 10
+        jobs = warmer.jobs()
+        eq_((child.id, CachedFeed.PAGE_TYPE, 10),
+            (jobs[0].lane_id, jobs[0].type, jobs[0].requests))
+
+    def test_needs_warming(self):
+        lane = self._lane()
+        warmer = CachedFeedWarmer(
+            self._db, annotator_factory=None, warming_window=60
+        )
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        args = (lane, CachedFeed.PAGE_TYPE, facets, pagination)
+
+        # There's no cached feed, so it needs warming.
+        eq_(True, warmer.needs_warming(*args, max_age=600))
+
+        feed, ignore = CachedFeed.fetch(
+            self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination,
+            None, force_refresh=True
+        )
+        feed.update(self._db, u"content")
+
+        # The feed won't expire within the warming window.
+        eq_(False, warmer.needs_warming(*args, max_age=600))
+
+        # The feed will expire within the warming window.
+        eq_(True, warmer.needs_warming(*args, max_age=30))
+
+        # A feed that's cached forever never needs warming once it
+        # exists.
+        eq_(False, warmer.needs_warming(*args, max_age="forever"))
+
+    def test_needs_warming_fallback(self):
+        # When a lane can't have a grouped feed, a page feed is cached
+        # under the groups type instead.
+        lane = self._lane()
+        warmer = CachedFeedWarmer(
+            self._db, annotator_factory=None, warming_window=60
+        )
+        featured = lane.default_featured_facets(self._db)
+        fallback = (Facets.default(self._default_library), Pagination.default())
+        args = (lane, CachedFeed.GROUPS_TYPE, featured, None)
+        eq_(True, warmer.needs_warming(*args, max_age=600, fallback=fallback))
+
+        feed, ignore = CachedFeed.fetch(
+            self._db, lane, CachedFeed.GROUPS_TYPE, fallback[0], fallback[1],
+            None, force_refresh=True
+        )
+        feed.update(self._db, u"content")
+
+        # The fallback feed is found.
+        eq_(True, warmer.needs_warming(*args, max_age=600))
+        eq_(False, warmer.needs_warming(*args, max_age=600, fallback=fallback))
+
+        # If both feeds exist, the newer one counts.
+        grouped, ignore = CachedFeed.fetch(
+            self._db, lane, CachedFeed.GROUPS_TYPE, featured, None,
+            None, force_refresh=True
+        )
+        grouped.update(self._db, u"content")
+        day = datetime.timedelta(days=1)
+        grouped.timestamp = feed.timestamp - day
+        eq_(False, warmer.needs_warming(*args, max_age=600, fallback=fallback))
+        grouped.timestamp, feed.timestamp = feed.timestamp, grouped.timestamp
+        eq_(False, warmer.needs_warming(*args, max_age=600, fallback=fallback))
+        grouped.timestamp = feed.timestamp
+        eq_(True, warmer.needs_warming(*args, max_age=600, fallback=fallback))
+
+    def test_jobs_groups_fallback(self):
+        # A lane whose grouped feed fell back to a page feed doesn't
+        # get warmed again while that feed is fresh.
+        # The parent has a sublane, so it has a grouped feed.
+        parent = self._lane(u"Parent")
+        self._lane(u"Child", parent=parent)
+        warmer = CachedFeedWarmer(self._db, annotator_factory=None)
+        feed, ignore = CachedFeed.fetch(
+            self._db, parent, CachedFeed.GROUPS_TYPE,
+            Facets.default(self._default_library), Pagination.default(),
+            None, force_refresh=True
+        )
+        feed.update(self._db, u"content")
+        jobs = [(job.lane_id, job.type) for job in warmer.jobs()]
+        assert (parent.id, CachedFeed.GROUPS_TYPE) not in jobs
+        assert (parent.id, CachedFeed.PAGE_TYPE) in jobs
+
+    def test_run_once(self):
+        pool = MockPool(self._db)
+
+        class Mock(CachedFeedWarmer):
+            def jobs(self):
+                return [MockWarmingJob(self, "lane 1"),
+                        MockWarmingJob(self, "lane 2")]
+
+        warmer = Mock(self._db, annotator_factory=None, pool=pool)
+        lane = self._lane()
+        feed, ignore = CachedFeed.fetch(
+            self._db, lane, CachedFeed.PAGE_TYPE, None, None, None,
+            force_refresh=True
+        )
+        feed.recent_requests = 10
+        warmer.run_once(None, None)
+
+        # Every job was sent to the pool, and the warmer recorded how
+        # long each one took.
+        eq_(2, len(pool.jobs))
+        eq_([("lane 1", CachedFeed.PAGE_TYPE, 1.5),
+             ("lane 2", CachedFeed.PAGE_TYPE, 1.5)], warmer.warmed)
+
+        # Request counts were decayed.
+        self._db.refresh(feed)
+        eq_(5, feed.recent_requests)
+
+    def test_job_lane(self):
+        lane = self._lane()
+        job = CachedFeedWarmingJob(
+            None, self._default_library, lane.id, CachedFeed.PAGE_TYPE
+        )
+        eq_(lane, job.lane(self._db))
+
+        # A job with no lane ID is for the library's top-level
+        # WorkList -- in this case, the library's only lane.
+        job = CachedFeedWarmingJob(
+            None, self._default_library, None, CachedFeed.PAGE_TYPE
+        )
+        eq_(lane, job.lane(self._db))
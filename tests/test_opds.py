@@ -7,6 +7,7 @@ from nose.tools import (
     eq_,
     set_trace,
     assert_raises,
+    assert_raises_regexp,
 )
 
 from . import (
@@ -14,6 +15,7 @@ from . import (
 )
 
 from psycopg2.extras import NumericRange
+from sqlalchemy import event
 from config import (
     Configuration,
     temp_config,
@@ -28,12 +30,14 @@ from facets import FacetConstants
 import model
 from model import (
     CachedFeed,
+    Collection,
     ConfigurationSetting,
     Contributor,
     DataSource,
     DeliveryMechanism,
     ExternalIntegration,
     Genre,
+    Library,
     Measurement,
     Representation,
     SessionManager,
@@ -659,6 +663,51 @@ class TestOPDS(DatabaseTest):
         assert 'opds:activefacet' not in u
         assert 'opds:activeFacet' in u
 
+    def test_facet_links_include_counts(self):
+        library = self._default_library
+        facets = Facets(
+            library, Facets.COLLECTION_FULL, Facets.AVAILABLE_ALL,
+            Facets.ORDER_TITLE
+        )
+        counts = {
+            Facets.AVAILABILITY_FACET_GROUP_NAME : {
+                Facets.AVAILABLE_ALL : 10,
+                Facets.AVAILABLE_NOW : 4,
+            },
+            Facets.COLLECTION_FACET_GROUP_NAME : {
+                Facets.COLLECTION_MAIN : 0,
+            },
+        }
+        links = AcquisitionFeed.facet_links(TestAnnotator, facets, counts)
+        count_attribute = '{%s}count' % AtomFeed.THR_NS
+        count_by_title = dict(
+            (link['title'], link.get(count_attribute)) for link in links
+        )
+
+        # Each facet link with a known count includes it, even if
+        # the count is zero.
+        eq_("10", count_by_title["All"])
+        eq_("4", count_by_title["Available now"])
+        eq_("0", count_by_title["Main Collection"])
+
+        # There are no counts for the other facets.
+        eq_(None, count_by_title["Yours to keep"])
+        eq_(None, count_by_title["Everything"])
+        eq_(None, count_by_title["Title"])
+
+        # Without counts, no facet link includes a count.
+        links = AcquisitionFeed.facet_links(TestAnnotator, facets)
+        eq_([], [x for x in links if count_attribute in x])
+
+        # The count is serialized using the Atom threading extension.
+        feed = AcquisitionFeed(self._db, "title", "http://the-url.com/", [])
+        AcquisitionFeed.add_link_to_feed(
+            feed.feed, **AcquisitionFeed.facet_link(
+                "http://facet/", "A facet", "A group", False, 7
+            )
+        )
+        assert 'thr:count="7"' in unicode(feed)
+
     def test_acquisition_feed_includes_available_and_issued_tag(self):
         today = datetime.date.today()
         today_s = today.strftime("%Y-%m-%d")
@@ -1754,6 +1803,215 @@ class TestAcquisitionFeed(DatabaseTest):
         )
         eq_(entry_string, etree.tostring(full_entry))
 
+    def test_preload(self):
+        # Building a feed takes the same small number of queries no
+        # matter how many works are in the feed.
+        def queries_to_build_feed(how_many):
+            work_ids = []
+            for i in range(how_many):
+                work = self._work(
+                    authors=[self._str, self._str], genre="Fantasy",
+                    with_open_access_download=True
+                )
+                # Make sure the entries are built from scratch.
+                work.simple_opds_entry = None
+                work_ids.append(work.id)
+            self._db.commit()
+
+            # Start out with nothing loaded but the Works themselves.
+            library_id = self._default_library.id
+            collection_id = self._default_collection.id
+            self._db.expunge_all()
+            works = self._db.query(Work).filter(Work.id.in_(work_ids)).all()
+
+            statements = []
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(self.connection, "before_cursor_execute", count)
+            try:
+                feed = AcquisitionFeed(
+                    self._db, self._str, self._url, works,
+                    annotator=Annotator
+                )
+            finally:
+                event.remove(self.connection, "before_cursor_execute", count)
+
+            # Every work got a complete entry.
+            parsed = feedparser.parse(unicode(feed))
+            eq_(how_many, len(parsed['entries']))
+            for entry in parsed['entries']:
+                eq_(2, len(entry['authors']))
+                eq_(["Fantasy"], [x['label'] for x in entry['tags']
+                                  if x['scheme'] == Subject.SIMPLIFIED_GENRE])
+
+            # The test fixtures were expunged along with everything
+            # else, so look them up again for the next round.
+            self._default__library = self._db.query(Library).get(library_id)
+            self._default__collection = self._db.query(Collection).get(
+                collection_id
+            )
+            return len(statements)
+
+        one_work = queries_to_build_feed(1)
+        many_works = queries_to_build_feed(10)
+        eq_(one_work, many_works)
+        assert many_works < 10
+
+    def test_entry_fragments(self):
+        work = self._work(with_open_access_download=True)
+        work.calculate_opds_entries(verbose=False)
+        [pool] = work.license_pools
+
+        # When a feed is built from works with cached OPDS entries,
+        # and the annotator only appends to entries, the entries are
+        # annotated without being parsed.
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [work],
+            annotator=Annotator
+        )
+        [fragment] = feed.entry_fragments
+        assert fragment.startswith(work.simple_opds_entry[:-len("</entry>")])
+        eq_(False, feed.use_entry_fragments)
+
+        # The result is the same entry we'd get by parsing the cached
+        # entry and annotating the lxml tag.
+        parsed = feedparser.parse(unicode(feed))
+        [entry] = parsed['entries']
+        expect = feed.create_entry(work)
+        assert isinstance(expect, etree._Element)
+        expect = feedparser.parse(etree.tostring(expect))
+        [expect] = expect['entries']
+        eq_(expect, entry)
+        eq_(pool.identifier.urn, entry['id'])
+
+        # An annotator that overrides annotate_work_entry() gets to
+        # see the whole entry as an lxml tag, unless it says otherwise.
+        class Mock(Annotator):
+            def annotate_work_entry(self, *args, **kwargs):
+                super(Mock, self).annotate_work_entry(*args, **kwargs)
+        eq_(False, Mock.only_appends_to_entries())
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [work], annotator=Mock()
+        )
+        eq_([], feed.entry_fragments)
+        eq_([pool.identifier.urn], [x['id'] for x in
+                                    feedparser.parse(unicode(feed))['entries']])
+
+        Mock.appends_to_entries = True
+        eq_(True, Mock.only_appends_to_entries())
+
+        # The core annotators only append to entries.
+        for annotator in (Annotator, VerboseAnnotator, TestAnnotator):
+            eq_(True, annotator.only_appends_to_entries())
+        eq_(False, TestUnfulfillableAnnotator.only_appends_to_entries())
+
+    def test_entry_fragments_keep_their_place(self):
+        works = [self._work(with_open_access_download=True)
+                 for i in range(4)]
+
+        # Two of the works don't have cached OPDS entries, so their
+        # entries will be lxml tags, mixed in with the fragments.
+        works[1].simple_opds_entry = None
+        works[2].simple_opds_entry = None
+        expect = [work.license_pools[0].identifier.urn for work in works]
+
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, works,
+            annotator=Annotator
+        )
+        eq_(2, len(feed.entry_fragments))
+        eq_(expect, [x['id'] for x in
+                     feedparser.parse(unicode(feed))['entries']])
+
+        # The same is true when the feed is streamed.
+        works[1].simple_opds_entry = None
+        works[2].simple_opds_entry = None
+        feed = AcquisitionFeed(
+            self._db, self._str, self._url, [],
+            annotator=Annotator
+        )
+        streamed = "".join(feed.stream(works))
+        eq_(expect, [x['id'] for x in
+                     feedparser.parse(streamed)['entries']])
+        eq_([], feed.entry_fragments)
+
+    def test_stream(self):
+        works = [self._work(with_open_access_download=True)
+                 for i in range(3)]
+        feed = AcquisitionFeed(
+            self._db, "A feed", self._url, [], annotator=Annotator
+        )
+        feed.STREAMING_BATCH_SIZE = 2
+
+        # Keep track of when each work is turned into an entry.
+        consumed = []
+        def work_generator():
+            for work in works:
+                consumed.append(work)
+                yield work
+
+        stream = feed.stream(work_generator())
+
+        # The first batch of entries is created before anything is
+        # sent, and the rest of the works haven't been looked at.
+        eq_(works[:2], consumed)
+        header = next(stream)
+        assert "<title>A feed</title>" in header
+        eq_(works[:2], consumed)
+
+        # Entries are created two at a time.
+        first = next(stream)
+        assert works[0].license_pools[0].identifier.urn in first
+        second = next(stream)
+        eq_(works[:2], consumed)
+        assert works[1].license_pools[0].identifier.urn in second
+        rest = list(stream)
+        eq_(works, consumed)
+        eq_('</feed>\n', rest[-1])
+
+        # The streamed entries were not left behind in the feed.
+        eq_([], feed.entry_fragments)
+        eq_(0, unicode(feed).count("<entry"))
+
+        # Put together, the pieces make the same feed as you'd get by
+        # passing the works into the constructor.
+        streamed = feedparser.parse("".join([header, first, second] + rest))
+        built = feedparser.parse(unicode(AcquisitionFeed(
+            self._db, "A feed", self._url, works, annotator=Annotator
+        )))
+        eq_([x['id'] for x in built['entries']],
+            [x['id'] for x in streamed['entries']])
+
+    def test_stream_puts_precomposed_entries_after_works(self):
+        work = self._work(with_open_access_download=True)
+        message = OPDSMessage("urn:message", 404, "Not found")
+        feed = AcquisitionFeed(
+            self._db, "A feed", self._url, [], annotator=Annotator,
+            precomposed_entries=[message]
+        )
+        streamed = "".join(feed.stream([work]))
+        assert (streamed.index(work.license_pools[0].identifier.urn)
+                < streamed.index("urn:message"))
+
+        # Nothing is left behind in the feed.
+        assert "urn:message" not in unicode(feed)
+
+    def test_stream_raises_exception_in_first_batch(self):
+        class DoomedFeed(AcquisitionFeed):
+            def add_entries(self, works):
+                if works:
+                    raise Exception("I'm doomed!")
+        feed = DoomedFeed(
+            self._db, "A feed", self._url, [], annotator=Annotator
+        )
+        work = self._work()
+
+        # The exception is raised before any part of the feed is
+        # generated.
+        assert_raises_regexp(
+            Exception, "I'm doomed!", feed.stream, [work]
+        )
+
     def test_exception_during_entry_creation_is_not_reraised(self):
         # This feed will raise an exception whenever it's asked
         # to create an entry.
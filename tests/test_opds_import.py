@@ -1,5 +1,7 @@
 import os
 import datetime
+import logging
+import time
 import urllib
 from StringIO import StringIO
 from lxml import builder
@@ -9,11 +11,13 @@ from nose.tools import (
     assert_raises,
     assert_raises_regexp
 )
+from nose.plugins.skip import SkipTest
 import feedparser
 
 from lxml import etree
 import pkgutil
 from psycopg2.extras import NumericRange
+from sqlalchemy import event
 
 from . import (
     DatabaseTest,
@@ -23,6 +27,7 @@ from config import CannotLoadConfiguration
 from opds_import import (
     AccessNotAuthenticated,
     MetadataWranglerOPDSLookup,
+    OPDSImportBatch,
     OPDSImporter,
     OPDSImportMonitor,
     OPDSXMLParser,
@@ -34,7 +39,10 @@ from util.opds_writer import (
     OPDSMessage,
 )
 from metadata_layer import (
-    LinkData
+    ContributorData,
+    IdentifierData,
+    LinkData,
+    Metadata,
 )
 from model import (
     Collection,
@@ -679,6 +687,207 @@ class TestOPDSImporter(OPDSImporterTest):
         eq_(True, failure.transient)
         assert "Utter failure!" in failure.exception
 
+    def test_extract_data_in_one_pass(self):
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        for feed in (self.content_server_mini_feed, self.content_server_feed):
+            values, xml_values, failures = OPDSImporter.extract_data_in_one_pass(
+                feed, data_source
+            )
+
+            # We got the same data we would have gotten by parsing
+            # the feed twice.
+            fp_values, fp_failures = OPDSImporter.extract_data_from_feedparser(
+                feed, data_source
+            )
+            old_xml_values, xml_failures = OPDSImporter.extract_metadata_from_elementtree(
+                feed, data_source
+            )
+            eq_(sorted(fp_values.keys()), sorted(values.keys()))
+            eq_(sorted(old_xml_values.keys()), sorted(xml_values.keys()))
+            eq_(sorted(set(fp_failures.keys() + xml_failures.keys())),
+                sorted(failures.keys()))
+
+            def summarize(data):
+                circulation = data['circulation']
+                return (
+                    data['title'], data['subtitle'], data['language'],
+                    data['publisher'], data['data_source_last_updated'],
+                    [(x.rel, x.media_type, x.content) for x in data['links']],
+                    circulation['data_source'],
+                    circulation['default_rights_uri'],
+                )
+            for id, data in values.items():
+                eq_(summarize(fp_values[id]), summarize(data))
+
+            def summarize_xml(data):
+                return (
+                    data['medium'],
+                    [x.sort_name for x in data['contributors']],
+                    [(x.type, x.identifier) for x in data['subjects']],
+                    [(x.rel, x.href) for x in data['links']],
+                )
+            for id, data in xml_values.items():
+                eq_(summarize_xml(old_xml_values[id]), summarize_xml(data))
+
+    def test_extract_data_in_one_pass_unicode(self):
+        # A feed that has already been decoded can be parsed, even if
+        # it declares an encoding other than the one lxml will see.
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        feed = self.content_server_mini_feed
+        expect, ignore, ignore = OPDSImporter.extract_data_in_one_pass(
+            feed, data_source
+        )
+        decoded = feed.decode("utf8")
+        declared = u'<?xml version="1.0" encoding="iso-8859-1"?>\n' + decoded
+        for unicode_feed in (decoded, declared):
+            values, xml_values, failures = OPDSImporter.extract_data_in_one_pass(
+                unicode_feed, data_source
+            )
+            eq_(sorted(expect.keys()), sorted(values.keys()))
+            eq_(sorted([x['title'] for x in expect.values()]),
+                sorted([x['title'] for x in values.values()]))
+
+    def test_feedparser_style_entry(self):
+        parser = OPDSXMLParser()
+        entry = etree.fromstring("""<entry xmlns="http://www.w3.org/2005/Atom" xmlns:bibframe="http://bibframe.org/vocab/" xmlns:dcterms="http://purl.org/dc/terms/">
+  <id>urn:isbn:9781234567897</id>
+  <title> A Title </title>
+  <published>2015-01-02T11:56:40-05:00</published>
+  <content type="html">&lt;p&gt;A description&lt;script&gt;alert(1)&lt;/script&gt;&lt;/p&gt;</content>
+  <dcterms:rights>http://creativecommons.org/licenses/by/4.0/</dcterms:rights>
+  <bibframe:distribution bibframe:ProviderName="Gutenberg"/>
+</entry>""")
+        data = OPDSImporter.feedparser_style_entry(parser, entry)
+        eq_("urn:isbn:9781234567897", data['id'])
+        eq_("A Title", data['title'])
+        eq_(None, data['publisher'])
+        eq_("http://creativecommons.org/licenses/by/4.0/", data['rights'])
+        eq_({'bibframe:providername': 'Gutenberg'},
+            data['bibframe_distribution'])
+
+        # With no <updated> tag, the publication date is used, and
+        # it's converted to UTC.
+        eq_(datetime.datetime(2015, 1, 2, 16, 56, 40),
+            OPDSImporter._datetime(data, 'updated_parsed'))
+
+        # HTML content is sanitized, and since there's no <summary>,
+        # it's used as the summary too.
+        [content] = data['content']
+        eq_('text/html', content['type'])
+        eq_('<p>A description</p>', content['value'])
+        eq_(content, data['summary_detail'])
+
+    def test_extract_feed_data_single_pass(self):
+        two_pass = OPDSImporter(
+            self._db, collection=None, data_source_name=DataSource.NYT,
+            single_pass=False
+        )
+        one_pass = OPDSImporter(
+            self._db, collection=None, data_source_name=DataSource.NYT
+        )
+        eq_(True, one_pass.single_pass)
+
+        old_metadata, old_failures = two_pass.extract_feed_data(
+            self.content_server_mini_feed
+        )
+        metadata, failures = one_pass.extract_feed_data(
+            self.content_server_mini_feed
+        )
+        eq_(sorted(old_metadata.keys()), sorted(metadata.keys()))
+        for urn, m in metadata.items():
+            old = old_metadata[urn]
+            eq_(old.title, m.title)
+            eq_(old.medium, m.medium)
+            eq_(len(old.links), len(m.links))
+            eq_(old.circulation is None, m.circulation is None)
+        eq_(sorted(old_failures.keys()), sorted(failures.keys()))
+        for urn, failure in failures.items():
+            eq_(old_failures[urn].exception, failure.exception)
+
+    def large_feed(self):
+        """Build a feed with a couple thousand entries."""
+        start = self.content_server_feed.index('<entry')
+        end = self.content_server_feed.rindex('</entry>') + len('</entry>')
+        entries = self.content_server_feed[start:end]
+        return (
+            self.content_server_feed[:start] + (entries * 30)
+            + self.content_server_feed[end:]
+        )
+
+    def test_single_pass_on_a_large_feed(self):
+        """Parsing a large feed once extracts the same data as parsing
+        it twice.
+        """
+        feed = self.large_feed()
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+
+        fp_values, fp_failures = OPDSImporter.extract_data_from_feedparser(
+            feed, data_source
+        )
+        xml_values, xml_failures = (
+            OPDSImporter.extract_metadata_from_elementtree(feed, data_source)
+        )
+        values, one_pass_xml_values, failures = (
+            OPDSImporter.extract_data_in_one_pass(feed, data_source)
+        )
+
+        def comparable(value):
+            # The data objects from metadata_layer don't define
+            # equality, so compare their attributes instead -- except
+            # for the times the data was extracted.
+            if isinstance(value, list):
+                return [comparable(x) for x in value]
+            if isinstance(value, dict):
+                return dict((k, comparable(v)) for k, v in value.items())
+            if type(value).__module__ == 'metadata_layer':
+                attributes = dict(vars(value))
+                for timestamp in ('taken_at', 'last_checked'):
+                    attributes.pop(timestamp, None)
+                return comparable(attributes)
+            return value
+
+        # The data extracted with lxml is exactly the same.
+        eq_(comparable(xml_values), comparable(one_pass_xml_values))
+
+        # The data extracted with feedparser has the same values, and
+        # the same number of links, subjects and so on.
+        eq_(sorted(fp_values.keys()), sorted(values.keys()))
+        for urn, detail in values.items():
+            old = fp_values[urn]
+            eq_(sorted(old.keys()), sorted(detail.keys()))
+            for key, value in detail.items():
+                if isinstance(value, list):
+                    eq_(len(old[key]), len(value))
+                elif type(value).__module__ != 'metadata_layer':
+                    eq_(old[key], value)
+
+        old_failures = dict(fp_failures)
+        old_failures.update(xml_failures)
+        eq_(sorted(old_failures.keys()), sorted(failures.keys()))
+
+    def test_single_pass_benchmark(self):
+        """Time parsing a large feed once and twice. This only runs if
+        the RUN_BENCHMARKS environment variable is set.
+        """
+        if not os.environ.get('RUN_BENCHMARKS'):
+            raise SkipTest("Set RUN_BENCHMARKS to run benchmarks.")
+        feed = self.large_feed()
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+
+        before = time.time()
+        OPDSImporter.extract_data_from_feedparser(feed, data_source)
+        OPDSImporter.extract_metadata_from_elementtree(feed, data_source)
+        two_pass = time.time() - before
+
+        before = time.time()
+        OPDSImporter.extract_data_in_one_pass(feed, data_source)
+        one_pass = time.time() - before
+
+        logging.info(
+            "Parsed a %d-byte feed in %.2f seconds (two passes) and "
+            "%.2f seconds (one pass)", len(feed), two_pass, one_pass
+        )
+
     def test_import_exception_if_unable_to_parse_feed(self):
         feed = "I am not a feed."
         importer = OPDSImporter(self._db, collection=None)
@@ -877,6 +1086,115 @@ class TestOPDSImporter(OPDSImporterTest):
         sources = [pool.data_source.name for pool in pools_g]
         eq_([DataSource.GUTENBERG, DataSource.OA_CONTENT_SERVER], sources)
         
+    def test_batch_import(self):
+        feed = self.content_server_mini_feed
+
+        # One of the books in the feed is already in the collection.
+        edition, pool = self._edition(
+            DataSource.GUTENBERG, Identifier.GUTENBERG_ID,
+            identifier_id="10441", with_license_pool=True
+        )
+
+        importer = OPDSImporter(
+            self._db, collection=self._default_collection,
+            batch_import=True
+        )
+
+        # Extracting the data from the feed looks up every
+        # Identifier mentioned in the feed at once.
+        metadata, failures = importer.extract_feed_data(feed)
+        batch = importer.batch
+        eq_(len(metadata) + len(failures), len(batch.identifiers))
+        eq_((edition.primary_identifier, False),
+            batch.identifier(edition.primary_identifier.urn))
+
+        # An Identifier can be found through any URN that refers to
+        # it, not only its own.
+        isbn = self._identifier(Identifier.ISBN, "9780674368279")
+        batch.identifiers[(isbn.type, isbn.identifier)] = isbn
+        eq_((isbn, False), batch.identifier("urn:isbn:0674368274"))
+
+        # Loading the batch finds or creates an Edition for every
+        # book, and finds the existing LicensePool.
+        batch.load(metadata.values())
+        eq_(2, len(batch.editions))
+        for m in metadata.values():
+            found, is_new = batch.edition(m)
+            eq_(False, is_new)
+            eq_(m.primary_identifier.identifier,
+                found.primary_identifier.identifier)
+        eq_(pool, batch.license_pool(edition.primary_identifier))
+
+        # Importing the feed in batch mode has the same result as
+        # importing it one entry at a time.
+        imported_editions, pools, works, failures = importer.import_from_feed(
+            feed
+        )
+        eq_(None, importer.batch)
+        eq_(1, len(failures))
+        eq_(set(["The Green Mouse", "Johnny Crow's Party"]),
+            set([x.title for x in imported_editions]))
+        eq_(2, len(pools))
+        eq_(2, len(works))
+        assert pool in pools
+
+    def test_batch_import_preloads_contributors_and_subjects(self):
+        feed = self.content_server_mini_feed
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(" ".join(statement.split()))
+
+        def lookups():
+            # The queries Contributor.lookup and Subject.lookup run
+            # for a single contributor or subject.
+            return [
+                x for x in statements
+                if "FROM contributors WHERE contributors.sort_name = " in x
+                or "FROM subjects WHERE subjects.type = " in x
+            ]
+
+        # Importing one entry at a time looks up each contributor and
+        # subject separately.
+        importer = OPDSImporter(self._db, collection=self._default_collection)
+        event.listen(self.connection, "before_cursor_execute", count)
+        try:
+            editions, pools, works, failures = importer.import_from_feed(feed)
+        finally:
+            event.remove(self.connection, "before_cursor_execute", count)
+        assert len(lookups()) > 0
+        contributors = set(
+            (e.title, c.id) for e in editions for c in e.contributors
+        )
+        classifications = set(
+            (x.identifier_id, x.subject_id)
+            for e in editions
+            for x in e.primary_identifier.classifications
+        )
+
+        # In batch mode, they're all found by the queries
+        # OPDSImportBatch.load() runs for the whole page.
+        statements[:] = []
+        importer = OPDSImporter(
+            self._db, collection=self._default_collection,
+            batch_import=True
+        )
+        event.listen(self.connection, "before_cursor_execute", count)
+        try:
+            editions, pools, works, failures = importer.import_from_feed(feed)
+        finally:
+            event.remove(self.connection, "before_cursor_execute", count)
+        eq_([], lookups())
+
+        # The same Contributors and Subjects were used.
+        eq_(contributors, set(
+            (e.title, c.id) for e in editions for c in e.contributors
+        ))
+        eq_(classifications, set(
+            (x.identifier_id, x.subject_id)
+            for e in editions
+            for x in e.primary_identifier.classifications
+        ))
+
     def test_import_with_unrecognized_distributor_creates_distributor(self):
         """We get a book from a previously unknown data source, with a license
         that comes from a second previously unknown data source. The
@@ -1199,6 +1517,54 @@ class TestOPDSImporter(OPDSImporterTest):
         eq_(lp2.work, work)
         
 
+class TestOPDSImportBatch(DatabaseTest):
+
+    def test_load_recovers_from_integrity_error(self):
+        identifier = self._identifier()
+        gutenberg = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        metadata = Metadata(
+            data_source=gutenberg,
+            primary_identifier=IdentifierData(
+                identifier.type, identifier.identifier
+            )
+        )
+        batch = OPDSImportBatch(self._db, [identifier.urn])
+
+        # Between looking for the Edition and creating it, someone
+        # else creates it.
+        real_bulk_insert = self._db.bulk_insert_mappings
+        def bulk_insert(model, mappings):
+            edition = Edition(
+                data_source=gutenberg, primary_identifier=identifier
+            )
+            self._db.add(edition)
+            self._db.flush()
+            return real_bulk_insert(model, mappings)
+        self._db.bulk_insert_mappings = bulk_insert
+        try:
+            batch.load([metadata])
+        finally:
+            del self._db.bulk_insert_mappings
+
+        # The batch uses the Edition that already existed.
+        [edition] = self._db.query(Edition).filter(
+            Edition.primary_identifier==identifier
+        ).all()
+        eq_((edition, False), batch.edition(metadata))
+
+    def test_contributor(self):
+        batch = OPDSImportBatch(self._db, [])
+        data = ContributorData(sort_name=u"Doe, Jane", lc=u"n123", viaf=u"456")
+        contributor = batch.contributor(data)
+        eq_(u"Doe, Jane", contributor.sort_name)
+        eq_(u"n123", contributor.lc)
+        eq_(u"456", contributor.viaf)
+
+        # The Contributor is remembered for later lookups.
+        eq_(contributor, batch.contributor(data))
+        eq_([contributor], batch.contributors_by_lc[u"n123"])
+
+
 class TestCombine(object):
     """Test that OPDSImporter.combine combines dictionaries in sensible
     ways.
@@ -1785,6 +2151,28 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         )
         assert "Utter failure!" in failure.exception
 
+    def test_import_one_feed_in_batch(self):
+        monitor = OPDSImportMonitor(
+            self._db, collection=self._default_collection,
+            import_class=OPDSImporter, batch_import=True
+        )
+        self._default_collection.external_account_id = "http://root-url/index.xml"
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+
+        monitor.import_one_feed(self.content_server_mini_feed)
+
+        # Both editions got a CoverageRecord.
+        editions = self._db.query(Edition).filter(
+            Edition.data_source==data_source
+        ).all()
+        eq_(2, len(editions))
+        for edition in editions:
+            record = CoverageRecord.lookup(
+                edition.primary_identifier, data_source,
+                operation=CoverageRecord.IMPORT_OPERATION
+            )
+            eq_(CoverageRecord.SUCCESS, record.status)
+
 
     def test_run_once(self):
         class MockOPDSImportMonitor(OPDSImportMonitor):
@@ -1816,6 +2204,63 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         # Feeds are imported in reverse order
         eq_(["last page", "second page", "first page"], monitor.imports)
 
+    def test_run_once_with_prefetch(self):
+        pages = {
+            "http://first/": (["http://second/"], True),
+            "http://second/": (["http://third/"], True),
+            "http://third/": (["http://fourth/"], False),
+            "http://fourth/": ([], True),
+        }
+
+        class MockImporter(OPDSImporter):
+            def extract_next_links(self, feed):
+                return pages[feed][0]
+
+        class MockOPDSImportMonitor(OPDSImportMonitor):
+            def __init__(self, *args, **kwargs):
+                super(MockOPDSImportMonitor, self).__init__(*args, **kwargs)
+                self.imports = []
+                self.broken = None
+
+            def fetch_one_link(self, url, do_get=None):
+                if url == self.broken:
+                    raise BadResponseException(url, "Broken")
+                # The 'feed' is just the URL.
+                return url
+
+            def feed_contains_new_data(self, feed):
+                return pages[feed][1]
+
+            def import_one_feed(self, feed):
+                self.imports.append(feed)
+
+        self._default_collection.external_account_id = "http://first/"
+        monitor = MockOPDSImportMonitor(
+            self._db, collection=self._default_collection,
+            import_class=MockImporter, prefetch=2
+        )
+        monitor.run_once(None, None)
+
+        # The third page had no new data, so it wasn't imported and
+        # neither was the fourth page, even if it was downloaded.
+        # Pages are imported in reverse order, as usual.
+        eq_(["http://second/", "http://first/"], monitor.imports)
+
+        # Timings were recorded for every page that was checked.
+        eq_(set(["http://first/", "http://second/", "http://third/"]),
+            set(monitor.page_timings.keys()))
+        eq_(set(['fetch', 'wait', 'check', 'import']),
+            set(monitor.page_timings["http://first/"].keys()))
+        eq_(set(['fetch', 'wait', 'check']),
+            set(monitor.page_timings["http://third/"].keys()))
+
+        # If a download fails, the error is raised in the main
+        # thread, and nothing is imported.
+        monitor.imports = []
+        monitor.broken = "http://second/"
+        assert_raises(BadResponseException, monitor.run_once, None, None)
+        eq_([], monitor.imports)
+
     def test_update_headers(self):
         """Test the _update_headers helper method."""
         monitor = OPDSImportMonitor(
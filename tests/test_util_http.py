@@ -1,7 +1,9 @@
+import os
 import requests
 import json
 from util.http import (
     HTTP, 
+    SessionPool,
     BadResponseException,
     RemoteIntegrationException,
     RequestNetworkException,
@@ -219,6 +221,109 @@ class TestHTTP(object):
         eq_(error, m(error, allowed_response_codes=["400"]))
         eq_(error, m(error, allowed_response_codes=['4xx']))
 
+
+class TestSessionPool(object):
+
+    def test_request_with_timeout_uses_session_pool(self):
+        class MockSessionPool(object):
+            def __init__(self):
+                self.requests = []
+
+            def request(self, *args, **kwargs):
+                self.requests.append((args, kwargs))
+                return MockRequestsResponse(200, content="Success!")
+
+        old_sessions = HTTP.sessions
+        HTTP.sessions = MockSessionPool()
+        try:
+            response = HTTP.get_with_timeout("http://url/", headers={})
+            [(args, kwargs)] = HTTP.sessions.requests
+        finally:
+            HTTP.sessions = old_sessions
+        eq_("Success!", response.content)
+        eq_(("GET", "http://url/"), args)
+        eq_(20, kwargs['timeout'])
+
+    def test_session_for(self):
+        pool = SessionPool(pool_size=4, max_retries=3, backoff_factor=1)
+
+        # Every request to the same host uses the same session.
+        session = pool.session_for("https://overdrive.com/a")
+        eq_(session, pool.session_for("https://OVERDRIVE.com/b?c=d"))
+
+        # Other hosts get their own sessions.
+        assert session != pool.session_for("https://axis360.com/a")
+        assert session != pool.session_for("http://overdrive.com/a")
+
+        # The session is set up to keep a pool of connections to the
+        # host, and to retry failed requests.
+        adapter = session.get_adapter("https://overdrive.com/")
+        eq_(4, adapter._pool_maxsize)
+        eq_(3, adapter.max_retries.total)
+        eq_(1, adapter.max_retries.backoff_factor)
+        eq_(SessionPool.RETRY_STATUS_CODES,
+            adapter.max_retries.status_forcelist)
+
+        # Cookies are never kept from one request to the next.
+        assert not session.cookies._policy.set_ok(object(), object())
+
+    def test_session_for_after_fork(self):
+        pool = SessionPool()
+        session = pool.session_for("http://url/")
+
+        # If the process ID changes, the sessions that were created in
+        # the parent process are thrown away.
+        pool._pid = os.getpid() + 1
+        new_session = pool.session_for("http://url/")
+        assert session != new_session
+        eq_(os.getpid(), pool._pid)
+        eq_(new_session, pool.session_for("http://url/"))
+
+    def test_concurrency_limits(self):
+        pool = SessionPool(concurrency=2, host_concurrency={"slow.com": 1})
+        pool.session_for("http://url/")
+        pool.session_for("http://slow.com/")
+        eq_(2, pool._semaphores[("http", "url")]._Semaphore__value)
+        eq_(1, pool._semaphores[("http", "slow.com")]._Semaphore__value)
+
+        # With no limit, there's no semaphore.
+        pool = SessionPool()
+        pool.session_for("http://url/")
+        eq_({}, pool._semaphores)
+
+    def test_request_and_stats(self):
+        pool = SessionPool(concurrency=1)
+        session = pool.session_for("http://url/")
+        semaphore = pool._semaphores[("http", "url")]
+
+        calls = []
+        def request(*args, **kwargs):
+            # The request is made while holding the host's semaphore.
+            calls.append((args, kwargs, semaphore._Semaphore__value))
+            return MockRequestsResponse(200, content="Success!")
+        session.request = request
+
+        response = pool.request("GET", "http://url/a", timeout=5)
+        pool.request("GET", "http://url/b")
+        eq_("Success!", response.content)
+        eq_([(("GET", "http://url/a"), dict(timeout=5), 0),
+             (("GET", "http://url/b"), {}, 0)], calls)
+        eq_(1, semaphore._Semaphore__value)
+
+        # Pretend urllib3 sent four requests, including retries, over
+        # three connections.
+        adapter = session.get_adapter("http://url/")
+        connection_pool = adapter.poolmanager.connection_from_url(
+            "http://url/"
+        )
+        connection_pool.num_requests = 4
+        connection_pool.num_connections = 3
+        eq_(
+            {"http://url": dict(requests=2, sent=4, connections=3, reused=1)},
+            pool.stats()
+        )
+
+
 class TestRemoteIntegrationException(object):
 
     def test_with_service_name(self):
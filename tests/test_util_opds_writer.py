@@ -1,3 +1,4 @@
+# encoding: utf-8
 import re
 from nose.tools import (
     eq_,
@@ -59,3 +60,86 @@ class TestAtomFeed(object):
         assert tag.startswith('<author')
         assert 'xmlns:opf="http://www.idpf.org/2007/opf"' in tag
         assert tag.endswith('opf:role="ctb"/>')
+
+    def test_add_to_entry_fragment(self):
+        fragment = unicode(etree.tostring(AtomFeed.entry(AtomFeed.title("A"))))
+        annotations = AtomFeed.entry()
+        AtomFeed.add_link_to_entry(annotations, rel="alternate", href="url")
+        annotations.append(AtomFeed.SIMPLIFIED.pwid("1"))
+
+        # The new tags are added to the end of the entry.
+        new_fragment = AtomFeed.add_to_entry_fragment(fragment, annotations)
+        entry = etree.fromstring(new_fragment)
+        eq_(['title', 'link', '{%s}pwid' % AtomFeed.SIMPLIFIED_NS],
+            [x.tag.replace('{%s}' % AtomFeed.ATOM_NS, '') for x in entry])
+        assert new_fragment.endswith(
+            '<link href="url" rel="alternate"/><simplified:pwid>1</simplified:pwid></entry>'
+        )
+
+        # An entry that doesn't declare all the namespaces we use
+        # gets the missing declarations added.
+        old_fragment = u'<entry xmlns="%s"><title>A</title></entry>' % AtomFeed.ATOM_NS
+        new_fragment = AtomFeed.add_to_entry_fragment(old_fragment, annotations)
+        entry = etree.fromstring(new_fragment)
+        eq_(AtomFeed.nsmap, entry.nsmap)
+        eq_(3, len(entry))
+
+        # Something that's not a complete <entry> tag is left alone.
+        eq_(None, AtomFeed.add_to_entry_fragment(u"<feed/>", annotations))
+
+    def test_entry_fragments(self):
+        feed = AtomFeed("A feed", "http://url/")
+        fragment = u'<entry xmlns="%s"><title>☃</title></entry>' % AtomFeed.ATOM_NS
+        feed.add_entry_fragment(fragment)
+
+        # The fragment is spliced into the serialized feed.
+        serialized = unicode(feed)
+        parsed = etree.fromstring(serialized)
+        [entry] = parsed.findall('{%s}entry' % AtomFeed.ATOM_NS)
+        eq_(u"☃", entry[0].text)
+
+    def test_entry_fragments_keep_their_place(self):
+        feed = AtomFeed("A feed", "http://url/")
+        start = len(feed.feed)
+        fragment = u'<entry xmlns="%s"><id>%%s</id></entry>' % AtomFeed.ATOM_NS
+        feed.feed.append(AtomFeed.entry(AtomFeed.id("1")))
+        feed.add_entry_fragment(fragment % "2")
+        feed.feed.append(AtomFeed.entry(AtomFeed.id("3")))
+        feed.add_entry_fragment(fragment % "4")
+
+        # Entries come out in the order they were added, whether they
+        # were lxml tags or pre-serialized.
+        entries = feed.entries_from(start)
+        eq_(fragment % "2", entries[1])
+        eq_(fragment % "4", entries[3])
+        eq_(["1", "3"], [entries[0][0].text, entries[2][0].text])
+
+        parsed = etree.fromstring(unicode(feed))
+        eq_(['1', '2', '3', '4'],
+            [x.findtext('{%s}id' % AtomFeed.ATOM_NS)
+             for x in parsed.findall('{%s}entry' % AtomFeed.ATOM_NS)])
+        assert "entry-fragment" not in unicode(feed)
+
+    def test_stream(self):
+        feed = AtomFeed("A feed", "http://url/")
+        feed.add_entry_fragment(
+            u'<entry xmlns="%s"><id>1</id></entry>' % AtomFeed.ATOM_NS
+        )
+        def entries():
+            yield AtomFeed.entry(AtomFeed.id("2"))
+            yield u'<entry xmlns="%s"><id>3</id></entry>' % AtomFeed.ATOM_NS
+
+        # The feed is serialized up to its closing tag, then each
+        # entry is serialized as it's produced, then the closing tag.
+        pieces = list(feed.stream(entries()))
+        eq_(4, len(pieces))
+        assert pieces[0].startswith('<feed')
+        assert '<id>1</id>' in pieces[0]
+        assert '<id>2</id>' in pieces[1]
+        assert '<id>3</id>' in pieces[2]
+        eq_('</feed>\n', pieces[3])
+
+        parsed = etree.fromstring("".join(pieces))
+        eq_(['1', '2', '3'],
+            [x.findtext('{%s}id' % AtomFeed.ATOM_NS)
+             for x in parsed.findall('{%s}entry' % AtomFeed.ATOM_NS)])
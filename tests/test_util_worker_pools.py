@@ -16,7 +16,9 @@ from util.worker_pools import (
     DatabaseWorker,
     Job,
     Pool,
+    ProcessPool,
     Queue,
+    RateLimiter,
     Worker,
 )
 
@@ -99,6 +101,65 @@ class TestDatabasePool(DatabaseTest):
             pool.join()
 
 
+class SquareJob(Job):
+    """A Job that can be sent to a worker process."""
+
+    def __init__(self, number):
+        self.number = number
+        self.results = []
+
+    def do_run(self):
+        return self.number * self.number
+
+    def finished_in_process(self, result):
+        self.results.append(result)
+
+
+class BrokenSquareJob(SquareJob):
+
+    def do_run(self):
+        raise RuntimeError("No squares today.")
+
+
+class TestProcessPool(object):
+
+    def test_jobs_run_in_worker_processes(self):
+        jobs = [SquareJob(i) for i in range(4)]
+        broken = BrokenSquareJob(5)
+        with ProcessPool(2) as pool:
+            for job in jobs + [broken]:
+                pool.put(job)
+
+        # Each job's result was passed back to this process.
+        eq_([[0], [1], [4], [9]], [job.results for job in jobs])
+
+        # The broken job was counted as an error.
+        eq_([], broken.results)
+        eq_(5, pool.job_total)
+        eq_(1, pool.error_count)
+
+
+class TestRateLimiter(object):
+
+    def test_wait(self):
+        now = [100.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+        limiter = RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+
+        # The first call goes right away; each one after that waits
+        # its turn.
+        for i in range(3):
+            limiter.wait()
+        eq_([0.25, 0.5], sleeps)
+
+        # Once enough time has passed, there's no need to wait.
+        now[0] = 200.0
+        limiter.wait()
+        eq_([0.25, 0.5], sleeps)
+
+
 class MockQueue(Queue):
     error_count = 0
 
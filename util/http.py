@@ -1,6 +1,14 @@
+import cookielib
 import logging
+import os
 from nose.tools import set_trace
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from threading import (
+    BoundedSemaphore,
+    RLock,
+)
 import urlparse
 from flask_babel import lazy_gettext as _
 from problem_detail import (
@@ -165,9 +173,176 @@ class RequestTimedOut(RequestNetworkException, requests.exceptions.Timeout):
     internal_message = "Timeout accessing %s: %s"
 
 
+class RejectAllCookies(cookielib.DefaultCookiePolicy):
+    """A cookie policy for pooled sessions.
+
+    Each request used to be made with a brand new session, so cookies
+    set by one response were never sent with the next request. Pooled
+    sessions keep that behavior by refusing to store any cookies.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class SessionPool(object):
+    """Keep a pooled, keep-alive `requests.Session` for each host we
+    talk to, so that repeated requests to the same distributor reuse
+    their TCP/TLS connections instead of opening new ones.
+
+    A SessionPool may be shared by any number of threads.
+    """
+
+    # The HTTP status codes that are retried, for idempotent requests.
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+    log = logging.getLogger("HTTP session pool")
+
+    def __init__(self, pool_size=10, max_retries=2, backoff_factor=0.5,
+                 concurrency=None, host_concurrency=None):
+        """Constructor.
+
+        :param pool_size: The number of connections to keep open to
+            any one host.
+        :param max_retries: The number of times to retry an idempotent
+            request that timed out, couldn't connect, or got a 5xx
+            response.
+        :param backoff_factor: Used to calculate how long to wait
+            between retries; see urllib3's Retry.
+        :param concurrency: If this is set, no more than this many
+            requests will be in progress to any one host at once.
+        :param host_concurrency: A dictionary mapping hostnames to
+            concurrency limits that override `concurrency`.
+        """
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency or {}
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self):
+        """Close every session and forget about it."""
+        with self._lock:
+            for session in getattr(self, '_sessions', {}).values():
+                session.close()
+            self._sessions = {}
+            self._semaphores = {}
+            self._request_counts = {}
+            self._pid = os.getpid()
+
+    @classmethod
+    def key(cls, url):
+        """Sessions are kept for each scheme and host."""
+        parsed = urlparse.urlparse(url)
+        return (parsed.scheme.lower(), parsed.netloc.lower())
+
+    def retry(self):
+        """Build the retry policy used by every session's adapter.
+
+        urllib3 only retries idempotent methods, so a POST that timed
+        out or got a 5xx response isn't sent again. If all retries
+        fail, the last response is returned as usual.
+        """
+        return Retry(
+            total=self.max_retries, connect=self.max_retries,
+            read=self.max_retries, status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRY_STATUS_CODES,
+            raise_on_status=False,
+        )
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size,
+            max_retries=self.retry(),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.cookies.set_policy(RejectAllCookies())
+        return session
+
+    def session_for(self, url):
+        """Find or create the session for the host of `url`."""
+        key = self.key(url)
+        with self._lock:
+            if self._pid != os.getpid():
+                # We've been forked. Connections can't be shared with
+                # the parent process, so start over.
+                self.reset()
+            session = self._sessions.get(key)
+            if session is None:
+                session = self.create_session()
+                self._sessions[key] = session
+                limit = self.host_concurrency.get(key[1], self.concurrency)
+                if limit:
+                    self._semaphores[key] = BoundedSemaphore(limit)
+                self._request_counts[key] = 0
+            return session
+
+    def request(self, http_method, url, *args, **kwargs):
+        """Make a request through the pooled session for the host of
+        `url`. This has the same signature as `requests.request`.
+        """
+        session = self.session_for(url)
+        key = self.key(url)
+        semaphore = self._semaphores.get(key)
+        with self._lock:
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+        if semaphore:
+            with semaphore:
+                return session.request(http_method, url, *args, **kwargs)
+        return session.request(http_method, url, *args, **kwargs)
+
+    def stats(self):
+        """Summarize how connections have been used for each host.
+
+        :return: A dictionary mapping hostnames to dictionaries with
+            the keys 'requests' (the number of requests made through
+            this SessionPool), 'sent' (the number of requests sent over
+            the wire, including retries), 'connections' (the number of
+            connections opened) and 'reused' (the number of requests
+            sent over a connection that was already open).
+        """
+        stats = {}
+        with self._lock:
+            for key, session in self._sessions.items():
+                sent = connections = 0
+                adapters = set(session.adapters.values())
+                for adapter in adapters:
+                    pools = adapter.poolmanager.pools
+                    for pool_key in pools.keys():
+                        pool = pools[pool_key]
+                        sent += pool.num_requests
+                        connections += pool.num_connections
+                host = "%s://%s" % key
+                stats[host] = dict(
+                    requests=self._request_counts.get(key, 0),
+                    sent=sent,
+                    connections=connections,
+                    reused=max(sent - connections, 0),
+                )
+        return stats
+
+    def log_stats(self):
+        for host, stats in sorted(self.stats().items()):
+            self.log.info(
+                "%s: %d requests, %d sent over %d connections (%d reused)",
+                host, stats['requests'], stats['sent'],
+                stats['connections'], stats['reused']
+            )
+
+
 class HTTP(object):
     """A helper for the `requests` module."""
 
+    # Requests go out through pooled keep-alive sessions. Replace this
+    # with a differently configured SessionPool to change the pool
+    # size, retry policy, or concurrency limits.
+    sessions = SessionPool()
+
     @classmethod
     def get_with_timeout(cls, url, *args, **kwargs):
         """Make a GET request with timeout handling."""
@@ -187,11 +362,11 @@ class HTTP(object):
 
     @classmethod
     def request_with_timeout(cls, http_method, url, *args, **kwargs):
-        """Call requests.request and turn a timeout into a RequestTimedOut
-        exception.
+        """Make a request through a pooled session and turn a timeout
+        into a RequestTimedOut exception.
         """
         return cls._request_with_timeout(
-            url, requests.request, http_method, url, *args, **kwargs
+            url, cls.sessions.request, http_method, url, *args, **kwargs
         )
 
     @classmethod
@@ -1,6 +1,7 @@
 
 import datetime
 import logging
+import re
 
 from lxml import builder, etree
 from nose.tools import set_trace
@@ -27,6 +28,16 @@ class AtomFeed(object):
     BIBFRAME_NS = "http://bibframe.org/vocab/"
     BIB_SCHEMA_NS = "http://bib.schema.org/"
 
+    # Marks the place of a pre-serialized entry in the lxml tree.
+    ENTRY_FRAGMENT_PLACEHOLDER = "entry-fragment:"
+    ENTRY_FRAGMENT_PLACEHOLDER_RE = re.compile(
+        "[ \t]*<!--entry-fragment:([0-9]+)-->\n?"
+    )
+
+    # OPDS uses the Atom threading extension's 'count' attribute to
+    # say how many entries are behind a facet link.
+    THR_NS = 'http://purl.org/syndication/thread/1.0'
+
     nsmap = {
         None: ATOM_NS,
         'app': APP_NS,
@@ -37,7 +48,8 @@ class AtomFeed(object):
         'schema' : SCHEMA_NS,
         'simplified' : SIMPLIFIED_NS,
         'bibframe' : BIBFRAME_NS,
-        'bib': BIB_SCHEMA_NS
+        'bib': BIB_SCHEMA_NS,
+        'thr': THR_NS,
     }
 
     default_typemap = {datetime: lambda e, v: _strftime(v)}
@@ -142,14 +154,148 @@ class AtomFeed(object):
             self.E.link(href=url, rel="self"),
         )
 
+        # Pre-serialized <entry> tags, as Unicode strings. Each one
+        # holds its place in the feed with a placeholder comment, and
+        # is spliced into the feed in place of the comment when the
+        # feed is serialized, so it never needs to be parsed.
+        self.entry_fragments = []
+
+    def add_entry_fragment(self, fragment):
+        """Add a pre-serialized <entry> to the end of the feed."""
+        placeholder = "%s%d" % (
+            self.ENTRY_FRAGMENT_PLACEHOLDER, len(self.entry_fragments)
+        )
+        self.feed.append(etree.Comment(placeholder))
+        self.entry_fragments.append(fragment)
+
+    def entries_from(self, start):
+        """Find everything added to the feed after its first `start`
+        children, in the order it was added.
+
+        :return: A list of lxml tags and/or pre-serialized entries.
+        """
+        entries = []
+        for child in self.feed[start:]:
+            prefix = self.ENTRY_FRAGMENT_PLACEHOLDER
+            if (child.tag is etree.Comment
+                and child.text.startswith(prefix)):
+                child = self.entry_fragments[int(child.text[len(prefix):])]
+            entries.append(child)
+        return entries
+
+    @classmethod
+    def entry_start_tag(cls, fragment):
+        """Find the start tag of a serialized <entry>.
+
+        :return: The index just past the end of the start tag, or None
+            if `fragment` doesn't look like a complete <entry> tag.
+        """
+        if not fragment.startswith(u"<entry") or not fragment.rstrip().endswith(u"</entry>"):
+            return None
+        return fragment.index(u">") + 1
+
+    @classmethod
+    def add_to_entry_fragment(cls, fragment, entry):
+        """Add the children of an lxml <entry> tag to the end of a
+        pre-serialized <entry>, without parsing it.
+
+        :param fragment: A serialized <entry> tag, as a Unicode string.
+        :param entry: An lxml <entry> tag created with AtomFeed.entry().
+        :return: A Unicode string, or None if `fragment` can't be
+            modified this way.
+        """
+        start = cls.entry_start_tag(fragment)
+        if start is None:
+            return None
+        start_tag = fragment[:start-1]
+
+        # An entry that was serialized a long time ago might not
+        # declare all of the namespaces used by the new tags.
+        declarations = []
+        for prefix, ns in cls.nsmap.items():
+            if prefix is None:
+                attribute = u'xmlns="'
+            else:
+                attribute = u'xmlns:%s="' % prefix
+            if attribute not in start_tag:
+                declarations.append(u' %s%s"' % (attribute, ns))
+        if declarations:
+            fragment = start_tag + u"".join(declarations) + fragment[start-1:]
+
+        if not len(entry):
+            return fragment
+
+        # Serialize `entry` and cut out everything but its children.
+        children = unicode(etree.tostring(entry))
+        children = children[children.index(u">")+1:-len(u"</entry>")]
+        end = fragment.rindex(u"</entry>")
+        return fragment[:end] + children + fragment[end:]
+
+    @classmethod
+    def serialize_entry(cls, entry):
+        """Serialize an <entry> tag for inclusion in a feed.
+
+        :param entry: An lxml tag or a pre-serialized entry.
+        :return: An ASCII string, with any other characters escaped,
+            just like the rest of a serialized feed.
+        """
+        if isinstance(entry, basestring):
+            entry = cls.remove_feed_namespace_declarations(entry)
+            return entry.encode("ascii", "xmlcharrefreplace") + "\n"
+        return etree.tostring(entry, pretty_print=True)
+
+    @classmethod
+    def remove_feed_namespace_declarations(cls, fragment):
+        """Remove namespace declarations from the start tag of a
+        serialized <entry> if the feed itself makes them, the way lxml
+        does when it serializes an entry as part of a feed.
+        """
+        start = cls.entry_start_tag(fragment)
+        if start is None:
+            return fragment
+        start_tag = fragment[:start]
+        for prefix, ns in cls.nsmap.items():
+            if prefix is None:
+                declaration = u' xmlns="%s"' % ns
+            else:
+                declaration = u' xmlns:%s="%s"' % (prefix, ns)
+            start_tag = start_tag.replace(declaration, u"", 1)
+        return start_tag + fragment[start:]
 
     def __unicode__(self):
         if self.feed is None:
             return None
 
         string_tree = etree.tostring(self.feed, pretty_print=True)
+        if self.entry_fragments:
+            def fragment(match):
+                return self.serialize_entry(
+                    self.entry_fragments[int(match.group(1))]
+                )
+            string_tree = self.ENTRY_FRAGMENT_PLACEHOLDER_RE.sub(
+                fragment, string_tree
+            )
         return string_tree.encode("utf8")
 
+    def stream(self, entries=()):
+        """Serialize this feed a piece at a time.
+
+        Everything currently in the feed is serialized first, then each
+        item in `entries` as it's produced, then the closing tag. This
+        makes it possible to start sending a large feed before all of
+        its entries have been created.
+
+        :param entries: An iterable of lxml <entry> tags and/or
+            pre-serialized entries.
+        :yield: A sequence of UTF-8 encoded strings.
+        """
+        string_tree = self.__unicode__()
+        end = string_tree.rindex("</feed>")
+        yield string_tree[:end]
+        for entry in entries:
+            yield self.serialize_entry(entry)
+        yield string_tree[end:]
+
 
 
 class OPDSFeed(AtomFeed):
@@ -1,4 +1,6 @@
 import logging
+import multiprocessing
+import time
 from contextlib import contextmanager
 from nose.tools import set_trace
 from threading import (
@@ -7,13 +9,14 @@ from threading import (
     settrace,
 )
 from Queue import Queue
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
 # Much of the work in this file is based on
 # https://github.com/shazow/workerpool, with
 # great appreciation.
 
-# TODO: Consider supporting multiprocessing as well as
-# (or instead of) multithreading.
+# ProcessPool supports multiprocessing as well as multithreading.
 
 
 class Worker(Thread):
@@ -150,6 +153,111 @@ class DatabasePool(Pool):
         return self.worker_factory(self, worker_session)
 
 
+def run_job_in_process(job, database_url=None):
+    """Run a Job in a worker process of a ProcessPool.
+
+    :param database_url: If this is provided, the job is given a
+        database session of its own, connected to this database.
+    :return: Whatever the job returns.
+    """
+    if not database_url:
+        return job.run()
+    engine = create_engine(database_url)
+    _db = sessionmaker(bind=engine)()
+    try:
+        return job.run(_db)
+    finally:
+        _db.close()
+        engine.dispose()
+
+
+class ProcessPool(object):
+    """A pool of worker processes that can be used in place of a
+    Pool or DatabasePool, for jobs that would otherwise compete for
+    the same CPU.
+
+    Jobs are pickled and sent to the worker processes, so they can't
+    hold on to database sessions, locks, or anything else that only
+    makes sense in this process. If a Job has a `finished_in_process`
+    method, it's called in this process with whatever the job
+    returned in the worker process.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, size, database_url=None):
+        self.size = size
+        self.database_url = database_url
+        self.job_total = 0
+        self.error_count = 0
+        self._pool = None
+        self._pending = []
+
+    def restart(self):
+        if not self._pool:
+            self._pool = multiprocessing.Pool(self.size)
+        return self
+
+    __enter__ = restart
+
+    def __exit__(self, type, value, traceback):
+        self.join()
+        if type:
+            self.log.error('Error with %r: %r', self, value, exc_info=traceback)
+            raise value
+        return
+
+    def put(self, job):
+        self.restart()
+        self.job_total += 1
+        result = self._pool.apply_async(
+            run_job_in_process, (job, self.database_url)
+        )
+        self._pending.append((job, result))
+
+    def join(self):
+        for job, result in self._pending:
+            try:
+                value = result.get()
+            except Exception as e:
+                self.error_count += 1
+                self.log.error("Job raised error: %r", e, exc_info=e)
+                continue
+            finished = getattr(job, 'finished_in_process', None)
+            if finished:
+                finished(value)
+        self._pending = []
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.log.info(
+            "%d/%d job errors occurred.", self.error_count, self.job_total
+        )
+
+
+class RateLimiter(object):
+    """Space out calls from any number of threads so that no more
+    than `per_second` of them start in any one second.
+    """
+
+    def __init__(self, per_second, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / per_second
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0
+        self._lock = RLock()
+
+    def wait(self):
+        """Block until it's this caller's turn to go."""
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+
 class Job(object):
     """Abstract parent class for a bit o' work that can be run in a Thread.
     For use with Worker.
@@ -169,12 +277,13 @@ class Job(object):
 
     def run(self, *args, **kwargs):
         try:
-            self.do_run(*args, **kwargs)
+            result = self.do_run(*args, **kwargs)
         except Exception as e:
             self.rollback(*args, **kwargs)
             raise e
         else:
             self.finalize(*args, **kwargs)
+            return result
 
 
 class DatabaseJob(Job):